@@ -54,6 +54,12 @@ db_info = None
 # stores ItemInfo objects so we can quickly fetch them
 item_info_cache = None
 
+# SearchIndex for all items in the database
+search_index = None
+
+# FeedCounts object that tracks item counts for feeds and folders
+feed_counts = None
+
 # command line arguments for thumbnailer (linux)
 movie_data_program_info = None
 
@@ -32,9 +32,11 @@ from miro import models
 from miro import prefs
 from miro import eventloop
 from datetime import datetime
+import heapq
+import itertools
 
 def _key_for_feed(feed):
-    """Get the key to use for feed_pending_count and
+    """Get the key to use for feed_queues and
     feed_running_count dicts.  Normally this is the feed URL, but
     the search downloads feed gets combined with the search feed
     (ss #11778)
@@ -44,15 +46,89 @@ def _key_for_feed(feed):
 
     return feed.origURL
 
+def _newest_first_key(item):
+    """Get a sort key that puts items with later release dates first.
+    """
+    date = item.get_pub_date_parsed()
+    if date is None:
+        date = datetime.min
+    delta = date - datetime.min
+    return (-(delta.days * 86400 + delta.seconds), -delta.microseconds,
+            item.id)
+
+class PendingItemQueue(object):
+    """Pending items for a single feed, newest first.
+
+    Items are kept in a heap.  Removing an item just forgets its key;
+    the stale heap entry gets thrown away when it reaches the top (or
+    when the heap gets too big).
+    """
+    def __init__(self):
+        self.heap = []
+        # maps item id -> heap key for every pending item
+        self.item_keys = {}
+
+    def __len__(self):
+        return len(self.item_keys)
+
+    def add(self, item):
+        key = _newest_first_key(item)
+        self.item_keys[item.id] = key
+        heapq.heappush(self.heap, (key, item))
+
+    def update(self, item):
+        """Re-sort item after its release date changed."""
+        if self.item_keys.get(item.id) != _newest_first_key(item):
+            self.add(item)
+
+    def remove(self, item):
+        if self.item_keys.pop(item.id, None) is None:
+            return
+        if len(self.heap) > 2 * len(self.item_keys) + 16:
+            self.heap = [entry for entry in self.heap
+                         if self.item_keys.get(entry[1].id) == entry[0]]
+            heapq.heapify(self.heap)
+
+    def next_item(self, skip_ids=()):
+        """Get the newest pending item.
+
+        Items whose id is in skip_ids are passed over.  Returns None if
+        there's no such item.
+        """
+        skipped = []
+        result = None
+        while self.heap:
+            key, item = self.heap[0]
+            if self.item_keys.get(item.id) != key:
+                heapq.heappop(self.heap)
+                continue
+            if item.id in skip_ids:
+                skipped.append(heapq.heappop(self.heap))
+                continue
+            result = item
+            break
+        for entry in skipped:
+            heapq.heappush(self.heap, entry)
+        return result
+
 class Downloader:
     def __init__(self, is_auto):
         self.dc = None
         self.paused = False
         self.running_count = 0
         self.pending_count = 0
-        self.feed_pending_count = {}
         self.feed_running_count = {}
         self.feed_time = {}
+        # maps feed keys to PendingItemQueue objects
+        self.feed_queues = {}
+        # heap of (running count, last start time, version, key) tuples.
+        # Only the entry whose version matches feed_versions[key] is
+        # current, the rest are left to be skipped over.
+        self.feed_heap = []
+        self.feed_versions = {}
+        self._version_counter = itertools.count()
+        # feeds that are at their max new limit
+        self.blocked_feeds = set()
         self.is_auto = is_auto
         if is_auto:
             pending_items = models.Item.auto_pending_view()
@@ -71,6 +147,7 @@ class Downloader:
         self.pending_items_tracker = pending_items.make_tracker()
         self.pending_items_tracker.connect('added', self.pending_on_add)
         self.pending_items_tracker.connect('removed', self.pending_on_remove)
+        self.pending_items_tracker.connect('changed', self.pending_on_change)
 
         self.running_items_tracker = running_items.make_tracker()
         self.running_items_tracker.connect('added', self.running_on_add)
@@ -95,40 +172,73 @@ class Downloader:
             self.MAX = newmax
             self.start_downloads()
 
+    def _schedule_feed(self, key):
+        """Push a fresh heap entry for a feed.
+
+        Any older entry for the feed becomes stale.  Feeds without
+        pending items and blocked feeds don't get an entry.
+        """
+        if not self.feed_queues.get(key) or key in self.blocked_feeds:
+            self.feed_versions.pop(key, None)
+            return
+        version = self._version_counter.next()
+        self.feed_versions[key] = version
+        heapq.heappush(self.feed_heap,
+                       (self.feed_running_count.get(key, 0),
+                        self.feed_time.get(key, datetime.min),
+                        version, key))
+
+    def _pop_feed(self):
+        """Pop the key of the next feed to download from.
+
+        Returns None if no feed is scheduled.
+        """
+        while self.feed_heap:
+            dummy, dummy, version, key = heapq.heappop(self.feed_heap)
+            if self.feed_versions.get(key) == version:
+                del self.feed_versions[key]
+                return key
+        return None
+
+    def _at_max_new(self, feed, key):
+        max_new = feed.get_max_new()
+        if max_new == u"unlimited":
+            return False
+        count = self.feed_running_count.get(key, 0) + feed.num_unwatched()
+        return count >= max_new
+
+    def _unblock_feed(self, key):
+        if key in self.blocked_feeds:
+            self.blocked_feeds.discard(key)
+            self._schedule_feed(key)
+
     def start_downloads_idle(self):
         if self.paused:
             return
-        last_count = 0
-        while (self.running_count < self.MAX
-               and self.pending_count > 0
-               and self.pending_count != last_count):
-            last_count = self.pending_count
-            candidate_feeds = []
-            for feed in models.Feed.make_view():
-                key = _key_for_feed(feed)
-                if self.is_auto:
-                    max_new = feed.get_max_new()
-                    if max_new != "unlimited":
-                        count = (self.feed_new_count.get(feed, 0) +
-                                self.feed_running_count.get(key, 0) +
-                                feed.num_unwatched())
-                        if count >= max_new:
-                            continue
-                if self.feed_pending_count.get(key, 0) <= 0:
-                    continue
-                candidate_feeds.append((feed,
-                                        self.feed_running_count.get(key, 0),
-                                        self.feed_time.get(feed, datetime.min)))
-            candidate_feeds.sort(key=lambda x: (x[1], x[2]))
-
-            for feed, count, dummy in candidate_feeds:
-                if self.is_auto:
-                    feed.start_auto_download()
-                else:
-                    feed.start_manual_download()
-                self.feed_time[feed] = datetime.now()
-                if self.running_count >= self.MAX:
-                    break
+        # items we've started this call.  Normally they leave the pending
+        # view as soon as they start, but if they don't we shouldn't keep
+        # picking them.
+        tried = set()
+        # feeds that only have tried items left, we re-schedule them
+        # when we're done.
+        exhausted = []
+        while self.running_count < self.MAX:
+            key = self._pop_feed()
+            if key is None:
+                break
+            item = self.feed_queues[key].next_item(tried)
+            if item is None:
+                exhausted.append(key)
+                continue
+            if self.is_auto and self._at_max_new(item.get_feed(), key):
+                self.blocked_feeds.add(key)
+                continue
+            tried.add(item.id)
+            item.download(autodl=self.is_auto)
+            self.feed_time[key] = datetime.now()
+            self._schedule_feed(key)
+        for key in exhausted:
+            self._schedule_feed(key)
         self.dc = None
 
     def start_downloads(self):
@@ -137,30 +247,57 @@ class Downloader:
         self.dc = eventloop.add_idle(self.start_downloads_idle,
                                      "Start Downloads")
 
+    def feed_limits_changed(self, feed):
+        """Call this when a feed's max new setting changes."""
+        self._unblock_feed(_key_for_feed(feed))
+        self.start_downloads()
+
     def pending_on_add(self, tracker, obj):
         feed = obj.get_feed()
         key = _key_for_feed(feed)
         self.pending_count = self.pending_count + 1
-        self.feed_pending_count[key] = self.feed_pending_count.get(key, 0) + 1
+        try:
+            queue = self.feed_queues[key]
+        except KeyError:
+            queue = self.feed_queues[key] = PendingItemQueue()
+        queue.add(obj)
+        if key not in self.feed_versions:
+            self._schedule_feed(key)
         self.start_downloads()
 
+    def pending_on_change(self, tracker, obj):
+        queue = self.feed_queues.get(_key_for_feed(obj.get_feed()))
+        if queue is not None:
+            queue.update(obj)
+
     def pending_on_remove(self, tracker, obj):
         feed = obj.get_feed()
         key = _key_for_feed(feed)
         self.pending_count = self.pending_count - 1
-        self.feed_pending_count[key] = self.feed_pending_count.get(key, 0) - 1
+        queue = self.feed_queues.get(key)
+        if queue is not None:
+            queue.remove(obj)
+            if not queue:
+                del self.feed_queues[key]
+                self.feed_versions.pop(key, None)
+                self.blocked_feeds.discard(key)
 
     def running_on_add(self, tracker, obj):
         feed = obj.get_feed()
         key = _key_for_feed(feed)
         self.running_count = self.running_count + 1
         self.feed_running_count[key] = self.feed_running_count.get(key, 0) + 1
+        if key in self.feed_versions:
+            self._schedule_feed(key)
 
     def running_on_remove(self, tracker, obj):
         feed = obj.get_feed()
         key = _key_for_feed(feed)
         self.running_count = self.running_count - 1
         self.feed_running_count[key] = self.feed_running_count.get(key, 0) - 1
+        if key in self.feed_versions:
+            self._schedule_feed(key)
+        self._unblock_feed(key)
         self.start_downloads()
 
     def new_on_add(self, tracker, obj):
@@ -174,6 +311,7 @@ class Downloader:
         key = _key_for_feed(feed)
         self.new_count = self.new_count - 1
         self.feed_new_count[key] = self.feed_new_count.get(key, 0) - 1
+        self._unblock_feed(key)
         self.start_downloads()
 
     def pause(self):
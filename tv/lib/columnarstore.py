@@ -0,0 +1,357 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.columnarstore`` -- Memory-mapped column-oriented storage.
+
+This module stores a list of dicts (normally ItemInfo state dicts) in a file
+that's laid out by column rather than by row.  Each column has a byte array
+of flags that says if the value is present, None, or missing from the dict,
+followed by the values themselves:
+
+    - ints, floats and bools are stored in fixed-width arrays
+    - unicode and byte strings are stored as (offset, length) pairs pointing
+      into a string heap for the column
+    - anything else gets pickled and stored in the heap like a string
+
+The file is opened with mmap and values are only decoded when someone asks
+for a row, so opening a file with 100k rows just means reading the header
+and the id column.
+"""
+
+import cPickle
+import itertools
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = 'MICS'
+FORMAT_VERSION = 1
+
+# column kinds
+KIND_INT = 'i'
+KIND_FLOAT = 'f'
+KIND_BOOL = 'b'
+KIND_UNICODE = 'u'
+KIND_BYTES = 'y'
+KIND_OBJECT = 'o'
+
+# flag values
+FLAG_VALUE = 0
+FLAG_NONE = 1
+FLAG_MISSING = 2
+
+_FIXED_FORMATS = {
+    KIND_INT: 'q',
+    KIND_FLOAT: 'd',
+    KIND_BOOL: 'B',
+}
+_HEAP_KINDS = (KIND_UNICODE, KIND_BYTES, KIND_OBJECT)
+_HEAP_ENTRY = struct.Struct('<II')
+_HEADER = struct.Struct('<4sHII')
+_MAX_INT = 2 ** 63 - 1
+_MIN_INT = -2 ** 63
+
+_missing = object()
+
+class ColumnarFileError(ValueError):
+    """A columnar file is truncated, corrupt or has the wrong format."""
+    pass
+
+def _column_kind(values):
+    """Pick the most compact kind that can store every value in a column."""
+    kinds = set()
+    for value in values:
+        if value is None or value is _missing:
+            continue
+        elif isinstance(value, bool):
+            kinds.add(KIND_BOOL)
+        elif isinstance(value, (int, long)):
+            if not _MIN_INT <= value <= _MAX_INT:
+                return KIND_OBJECT
+            kinds.add(KIND_INT)
+        elif isinstance(value, float):
+            kinds.add(KIND_FLOAT)
+        elif isinstance(value, unicode):
+            kinds.add(KIND_UNICODE)
+        elif type(value) is str:
+            kinds.add(KIND_BYTES)
+        else:
+            return KIND_OBJECT
+        if len(kinds) > 1:
+            return KIND_OBJECT
+    if kinds:
+        return kinds.pop()
+    # all values are None or missing.  It doesn't really matter what we use.
+    return KIND_BOOL
+
+def _pack_string(s):
+    return struct.pack('<H', len(s)) + s
+
+def _encode_heap_value(kind, value):
+    if kind == KIND_UNICODE:
+        return value.encode('utf-8')
+    elif kind == KIND_BYTES:
+        return value
+    else:
+        return cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+
+def write_file(path, rows, version, token):
+    """Write a columnar file.
+
+    :param path: path to write to.  We write to a temporary file first, then
+        rename it over path, so readers always see either the old file or
+        the complete new one.
+    :param rows: list of dicts to store.  Each dict must have an int id key.
+    :param version: version string to store in the header
+    :param token: token string to store in the header
+    """
+    row_count = len(rows)
+    column_names = set()
+    for row in rows:
+        column_names.update(row.iterkeys())
+    column_names.discard('id')
+    column_names = ['id'] + sorted(column_names)
+
+    # Build column data first, then the directory, since the directory needs
+    # to know where each column starts.
+    column_data = []
+    for name in column_names:
+        values = [row.get(name, _missing) for row in rows]
+        if name == 'id':
+            kind = KIND_INT
+        else:
+            kind = _column_kind(values)
+        flags = []
+        for value in values:
+            if value is _missing:
+                flags.append(FLAG_MISSING)
+            elif value is None:
+                flags.append(FLAG_NONE)
+            else:
+                flags.append(FLAG_VALUE)
+        flags = struct.pack('%dB' % row_count, *flags)
+        if kind in _FIXED_FORMATS:
+            default = kind == KIND_FLOAT and 0.0 or 0
+            values = [(flag == FLAG_VALUE and value or default)
+                      for flag, value in itertools.izip(
+                          bytearray(flags), values)]
+            data = struct.pack('<%d%s' % (row_count, _FIXED_FORMATS[kind]),
+                               *values)
+        else:
+            entries = []
+            heap = []
+            heap_size = 0
+            for value in values:
+                if value is None or value is _missing:
+                    entries.append(_HEAP_ENTRY.pack(0, 0))
+                    continue
+                encoded = _encode_heap_value(kind, value)
+                entries.append(_HEAP_ENTRY.pack(heap_size, len(encoded)))
+                heap.append(encoded)
+                heap_size += len(encoded)
+            data = ''.join(entries) + ''.join(heap)
+        column_data.append((name, kind, flags + data))
+
+    header = [_HEADER.pack(MAGIC, FORMAT_VERSION, row_count,
+                           len(column_names)),
+              _pack_string(version), _pack_string(token)]
+    directory_size = sum(2 + len(name.encode('utf-8')) + 1 + 8
+                         for name in column_names)
+    offset = sum(len(part) for part in header) + directory_size
+    directory = []
+    for name, kind, data in column_data:
+        directory.append(_pack_string(name.encode('utf-8')) + kind +
+                         struct.pack('<Q', offset))
+        offset += len(data)
+
+    temp_path = path + '.tmp'
+    f = open(temp_path, 'wb')
+    try:
+        f.write(''.join(header))
+        f.write(''.join(directory))
+        for name, kind, data in column_data:
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    _replace_file(temp_path, path)
+
+def _replace_file(src, dest):
+    """Rename src to dest, replacing dest in one step if it exists."""
+    if sys.platform != 'win32':
+        os.rename(src, dest)
+        return
+    # os.rename() won't replace an existing file on windows
+    import ctypes
+    MOVEFILE_REPLACE_EXISTING = 0x1
+    MOVEFILE_WRITE_THROUGH = 0x8
+    if isinstance(dest, unicode):
+        move_file = ctypes.windll.kernel32.MoveFileExW
+    else:
+        move_file = ctypes.windll.kernel32.MoveFileExA
+    if not move_file(src, dest,
+                     MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+        raise ctypes.WinError()
+
+class _Column(object):
+    def __init__(self, name, kind, offset, row_count):
+        self.name = name
+        self.kind = kind
+        self.flags_offset = offset
+        self.values_offset = offset + row_count
+        if kind in _FIXED_FORMATS:
+            self.format = '<' + _FIXED_FORMATS[kind]
+            self.width = struct.calcsize(self.format)
+            self.heap_offset = None
+            self.end = self.values_offset + self.width * row_count
+        else:
+            self.format = None
+            self.width = _HEAP_ENTRY.size
+            self.heap_offset = self.values_offset + self.width * row_count
+            self.end = self.heap_offset
+
+class ColumnarFile(object):
+    """Read-only view of a file created with write_file().
+
+    Attributes:
+        version -- version string passed to write_file()
+        token -- token string passed to write_file()
+        row_count -- number of rows stored
+        column_names -- list of column names
+    """
+
+    def __init__(self, path):
+        f = open(path, 'rb')
+        try:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError), e:
+                raise ColumnarFileError("Can't map %s: %s" % (path, e))
+        finally:
+            # the mmap keeps its own handle to the file
+            f.close()
+        try:
+            self._read_header()
+        except struct.error, e:
+            self.close()
+            raise ColumnarFileError("Error reading header: %s" % e)
+        except ColumnarFileError:
+            self.close()
+            raise
+
+    def _read_string(self, offset):
+        length = struct.unpack_from('<H', self._map, offset)[0]
+        end = offset + 2 + length
+        if end > len(self._map):
+            raise ColumnarFileError("String runs past end of file")
+        return self._map[offset+2:end], end
+
+    def _read_header(self):
+        magic, format_version, self.row_count, column_count = \
+                _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ColumnarFileError("Bad magic: %r" % magic)
+        if format_version != FORMAT_VERSION:
+            raise ColumnarFileError("Unknown format version: %s" %
+                                    format_version)
+        offset = _HEADER.size
+        self.version, offset = self._read_string(offset)
+        self.token, offset = self._read_string(offset)
+        self._columns = []
+        for i in xrange(column_count):
+            name, offset = self._read_string(offset)
+            kind = self._map[offset]
+            column_offset = struct.unpack_from('<Q', self._map,
+                                               offset + 1)[0]
+            offset += 9
+            if kind not in _FIXED_FORMATS and kind not in _HEAP_KINDS:
+                raise ColumnarFileError("Unknown column kind: %r" % kind)
+            column = _Column(name.decode('utf-8'), kind, column_offset,
+                             self.row_count)
+            if column.end > len(self._map):
+                raise ColumnarFileError("Column %s runs past end of file" %
+                                        column.name)
+            self._columns.append(column)
+        if not self._columns or self._columns[0].name != 'id':
+            raise ColumnarFileError("First column must be id")
+        self.column_names = [column.name for column in self._columns]
+
+    def ids(self):
+        """Get a list of ids for each row, in row order."""
+        id_column = self._columns[0]
+        return list(struct.unpack_from('<%dq' % self.row_count, self._map,
+                                       id_column.values_offset))
+
+    def get_row(self, row):
+        """Get the dict stored at a row index."""
+        if not 0 <= row < self.row_count:
+            raise IndexError(row)
+        try:
+            return self._get_row(row)
+        except (struct.error, cPickle.UnpicklingError, EOFError,
+                UnicodeDecodeError), e:
+            raise ColumnarFileError("Error reading row %s: %s" % (row, e))
+
+    def _get_row(self, row):
+        mapped = self._map
+        rv = {}
+        for column in self._columns:
+            flag = ord(mapped[column.flags_offset + row])
+            if flag == FLAG_MISSING:
+                continue
+            elif flag == FLAG_NONE:
+                rv[column.name] = None
+                continue
+            entry_offset = column.values_offset + column.width * row
+            if column.format is not None:
+                value = struct.unpack_from(column.format, mapped,
+                                           entry_offset)[0]
+                if column.kind == KIND_BOOL:
+                    value = bool(value)
+            else:
+                start, length = _HEAP_ENTRY.unpack_from(mapped, entry_offset)
+                start += column.heap_offset
+                data = mapped[start:start+length]
+                if len(data) != length:
+                    raise ColumnarFileError("Value runs past end of file")
+                if column.kind == KIND_UNICODE:
+                    value = data.decode('utf-8')
+                elif column.kind == KIND_BYTES:
+                    value = data
+                else:
+                    value = cPickle.loads(data)
+            rv[column.name] = value
+        return rv
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
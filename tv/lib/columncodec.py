@@ -0,0 +1,195 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.columncodec`` -- Encode container columns for the database.
+
+Columns for SchemaReprContainer and its subclasses (lists, dicts, tuples and
+the RemoteDownloader status dict) used to be stored as the python repr() of
+the value and read back with eval().  eval() is slow for big values and will
+run whatever code ends up in the column.
+
+Now we store these columns as a short header followed by JSON.  Lists,
+unicode strings, numbers, bools and None map straight to JSON, and so do
+dicts with unicode keys.  Everything else is stored as a JSON object with a
+single tag key that starts with a NUL character:
+
+    - tuples: {"\0t": [...]}.  time.struct_time values are stored as
+      tuples, which is how the repr() code restored them as well.
+    - byte strings: {"\0s": "..."}, decoded as latin-1
+    - dicts with byte string keys: {"\0S": {...}}
+    - other dicts: {"\0d": [[key, value], ...]}
+    - datetime, date, time and timedelta objects and buffers: {"\0dt": [...]},
+      {"\0date": [...]}, {"\0time": [...]}, {"\0td": [...]}, {"\0b": "..."}
+
+decode() only builds those types, and raises DecodeError for anything else,
+including the old repr() strings.  upgrade178 converted those.
+"""
+
+import datetime
+import json
+import time
+
+MAGIC = '\x00mc'
+VERSION = 2
+
+HEADER_LENGTH = len(MAGIC) + 1
+
+class DecodeError(ValueError):
+    """Raised when we can't decode a column value."""
+    pass
+
+def is_encoded(data):
+    """Check if a database value is in our format rather than a repr()
+    string.
+    """
+    return str(data[:len(MAGIC)]) == MAGIC
+
+def encode(value):
+    """Encode a value to store in the database.
+
+    :returns: byte string
+    :raises ValueError: value contains something we can't encode
+    """
+    return '%s%c%s' % (MAGIC, VERSION,
+                       json.dumps(_to_json(value), separators=(',', ':')))
+
+def decode(data):
+    """Decode a value from the database.
+
+    :param data: string or buffer returned by encode()
+    :raises DecodeError: data isn't a valid encoded value
+    """
+    if not is_encoded(data):
+        raise DecodeError("Not a columncodec value")
+    data = str(data)
+    if len(data) < HEADER_LENGTH:
+        raise DecodeError("data too short")
+    version = ord(data[len(MAGIC)])
+    if version != VERSION:
+        raise DecodeError("Unknown version: %s" % version)
+    try:
+        return json.loads(data[HEADER_LENGTH:], object_hook=_from_json_object)
+    except DecodeError:
+        raise
+    except (ValueError, TypeError, OverflowError), e:
+        raise DecodeError(str(e))
+
+def _is_tag(key):
+    return key[:1] == u'\x00'
+
+def _to_json(value):
+    if value is None or isinstance(value, (bool, int, long, float, unicode)):
+        return value
+    elif isinstance(value, str):
+        return {u'\x00s': value.decode('latin-1')}
+    elif isinstance(value, list):
+        return [_to_json(v) for v in value]
+    elif isinstance(value, (tuple, time.struct_time)):
+        return {u'\x00t': [_to_json(v) for v in value]}
+    elif isinstance(value, dict):
+        return _dict_to_json(value)
+    elif isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            raise ValueError("Can't encode datetimes with a tzinfo")
+        return {u'\x00dt': [value.year, value.month, value.day, value.hour,
+                            value.minute, value.second, value.microsecond]}
+    elif isinstance(value, datetime.date):
+        return {u'\x00date': [value.year, value.month, value.day]}
+    elif isinstance(value, datetime.time):
+        if value.tzinfo is not None:
+            raise ValueError("Can't encode times with a tzinfo")
+        return {u'\x00time': [value.hour, value.minute, value.second,
+                              value.microsecond]}
+    elif isinstance(value, datetime.timedelta):
+        return {u'\x00td': [value.days, value.seconds, value.microseconds]}
+    elif isinstance(value, buffer):
+        return {u'\x00b': str(value).decode('latin-1')}
+    else:
+        raise ValueError("Can't encode %s objects" % type(value).__name__)
+
+def _dict_to_json(value):
+    key_types = set(type(k) for k in value)
+    if not key_types or key_types == set([unicode]):
+        if not any(_is_tag(k) for k in value):
+            return dict((k, _to_json(v)) for k, v in value.iteritems())
+    elif key_types == set([str]):
+        if not any(k[:1] == '\x00' for k in value):
+            return {u'\x00S': dict((k.decode('latin-1'), _to_json(v))
+                                   for k, v in value.iteritems())}
+    return {u'\x00d': [[_to_json(k), _to_json(v)]
+                       for k, v in value.iteritems()]}
+
+def _check_type(tag, value, type_):
+    if not isinstance(value, type_):
+        raise DecodeError("Bad value for %r: %r" % (tag, value))
+
+def _check_ints(tag, values):
+    _check_type(tag, values, list)
+    for v in values:
+        if isinstance(v, bool) or not isinstance(v, (int, long)):
+            raise DecodeError("Bad value for %r: %r" % (tag, values))
+
+def _from_json_object(obj):
+    if len(obj) != 1:
+        return obj
+    tag, value = obj.items()[0]
+    if not _is_tag(tag):
+        return obj
+    if tag == u'\x00s':
+        _check_type(tag, value, unicode)
+        return value.encode('latin-1')
+    elif tag == u'\x00t':
+        _check_type(tag, value, list)
+        return tuple(value)
+    elif tag == u'\x00S':
+        _check_type(tag, value, dict)
+        return dict((k.encode('latin-1'), v) for k, v in value.iteritems())
+    elif tag == u'\x00d':
+        _check_type(tag, value, list)
+        for pair in value:
+            if not isinstance(pair, list) or len(pair) != 2:
+                raise DecodeError("Bad dict item: %r" % (pair,))
+        return dict(value)
+    elif tag == u'\x00dt':
+        _check_ints(tag, value)
+        return datetime.datetime(*value)
+    elif tag == u'\x00date':
+        _check_ints(tag, value)
+        return datetime.date(*value)
+    elif tag == u'\x00time':
+        _check_ints(tag, value)
+        return datetime.time(*value)
+    elif tag == u'\x00td':
+        _check_ints(tag, value)
+        return datetime.timedelta(*value)
+    elif tag == u'\x00b':
+        _check_type(tag, value, unicode)
+        return buffer(value.encode('latin-1'))
+    else:
+        raise DecodeError("Unknown tag: %r" % tag)
@@ -108,6 +108,7 @@ class Controller:
         logging.info("Commiting DB changes")
         app.db.finish_transaction()
         if app.item_info_cache is not None:
+            # this saves app.search_index too
             app.item_info_cache.save()
         logging.info("Closing Database...")
         if app.db is not None:
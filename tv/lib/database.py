@@ -34,6 +34,7 @@ import threading
 
 from miro import app
 from miro import signals
+from miro import util
 
 class DatabaseException(StandardError):
     """Superclass database errors."""
@@ -144,7 +145,16 @@ class DDBObjectFetcher(ViewObjectFetcher):
         self.db_info = db_info
 
     def fetch_obj(self, id_):
-        return self.db_info.db.get_obj_by_id(id_, self.klass)
+        try:
+            return self.db_info.db.get_obj_by_id(id_, self.klass)
+        except KeyError:
+            # The object was evicted after prepare_objects() restored it.
+            # Holding on to restored keeps it from being evicted again
+            # before we return it.
+            restored = self.db_info.db.ensure_objects_loaded(self.klass,
+                                                             [id_],
+                                                             self.db_info)
+            return self.db_info.db.get_obj_by_id(id_, self.klass)
 
     def fetch_obj_for_ddb_object(self, ddb_object):
         return ddb_object
@@ -153,14 +163,16 @@ class DDBObjectFetcher(ViewObjectFetcher):
         return self.db_info.db.table_name(self.klass)
 
     def prepare_objects(self, id_list):
-        if self.db_info.db.ensure_objects_loaded(self.klass, id_list,
-                                                 self.db_info):
+        restored = self.db_info.db.ensure_objects_loaded(self.klass, id_list,
+                                                         self.db_info)
+        if restored is not None:
             # sometimes objects will call remove() in setup_restored().
             # We need to filter those out.
-            new_id_list = [i for i in id_list
-                           if self.db_info.db.id_alive(i, self.klass)]
-            if len(new_id_list) < id_list:
-                id_list[:] = new_id_list # update id_list in-place
+            removed_ids = set(obj.id for obj in restored
+                              if not obj.id_exists())
+            if removed_ids:
+                # update id_list in-place
+                id_list[:] = [i for i in id_list if i not in removed_ids]
 
 class IDOnlyFetcher(ViewObjectFetcher):
     """Fetcher that just emits the IDs of objects
@@ -189,10 +201,12 @@ class View(object):
         self.db_info = db_info
 
     def _query(self):
-        id_list = self._query_ids()
-        self.fetcher.prepare_objects(id_list)
-        for id_ in id_list:
-            yield self.fetcher.fetch_obj(id_)
+        # Restore objects a chunk at a time, so that iterating through a big
+        # view doesn't need to keep all its objects in memory at once.
+        for id_chunk in util.split_values_for_sqlite(self._query_ids()):
+            self.fetcher.prepare_objects(id_chunk)
+            for id_ in id_chunk:
+                yield self.fetcher.fetch_obj(id_)
 
     def _query_ids(self):
         return list(self.db_info.db.query_ids(self.table_name, self.where,
@@ -252,13 +266,10 @@ class ViewTrackerManager(object):
         for tracker in self.trackers_for_ddb_class(obj.__class__):
             tracker.object_changed(obj, can_change_views)
 
-    def bulk_update_view_trackers(self, table_name):
-        for tracker in self.trackers_for_table(table_name):
-            tracker.check_all_objects()
-
-    def bulk_remove_from_view_trackers(self, table_name, objects):
+    def bulk_update_view_trackers(self, table_name, objects):
+        """Update view trackers based on a list of changed objects."""
         for tracker in self.trackers_for_table(table_name):
-            tracker.remove_objects(objects)
+            tracker.check_objects(objects)
 
     def remove_from_view_trackers(self, obj):
         """Update view trackers based on an object change."""
@@ -279,6 +290,10 @@ class ViewTracker(signals.SignalEmitter):
         self.joins = joins
         self.db_info = db_info
         self.bulk_mode = False
+        # predicate to check objects without SQL.  None if our WHERE clause
+        # can't be compiled.
+        self.predicate = self.db_info.db.compile_view_predicate(
+                self.table_name, where, values, joins)
         self.current_ids = self._view_object_ids()
         vt_manager = self.db_info.view_tracker_manager
         vt_manager.trackers_for_table(self.table_name).add(self)
@@ -298,6 +313,16 @@ class ViewTracker(signals.SignalEmitter):
 
     def _obj_in_view(self, obj):
         """Check if a single object is in our view."""
+        if self.predicate is not None and not obj.changed_attributes:
+            # The object hasn't changed since it was saved, so we can check
+            # it in memory rather than querying the DB.
+            if not self.db_info.db.id_alive(obj.id, obj.__class__):
+                return False
+            return self.db_info.db.obj_matches_predicate(obj, self.predicate)
+        return self._obj_in_view_sql(obj)
+
+    def _obj_in_view_sql(self, obj):
+        """Check if a single object is in our view using an SQL query."""
         where = '%s.id = ?' % (self.table_name,)
         if self.where:
             where += ' AND (%s)' % (self.where,)
@@ -306,6 +331,41 @@ class ViewTracker(signals.SignalEmitter):
         return self.db_info.db.query_count(self.table_name, where, values,
                 self.joins) > 0
 
+    def _view_object_ids_in(self, id_list):
+        """Get the ids from id_list that are in our view.
+
+        This runs one query per chunk of ids, rather than one per object.
+        """
+        rv = set()
+        for id_chunk in util.split_values_for_sqlite(id_list):
+            where = '%s.id IN (%s)' % (self.table_name,
+                    ', '.join('?' for i in xrange(len(id_chunk))))
+            if self.where:
+                where += ' AND (%s)' % (self.where,)
+            values = tuple(id_chunk) + self.values
+            rv.update(self.db_info.db.query_ids(self.table_name, where,
+                values, joins=self.joins))
+        return rv
+
+    def _objs_in_view(self, objects):
+        """Check which objects from a list are in our view.
+
+        :returns: set of ids for the objects in our view
+        """
+        rv = set()
+        to_query = []
+        for obj in objects:
+            if not self.db_info.db.id_alive(obj.id, obj.__class__):
+                continue # object was removed from the DB
+            if self.predicate is not None and not obj.changed_attributes:
+                if self.db_info.db.obj_matches_predicate(obj, self.predicate):
+                    rv.add(obj.id)
+            else:
+                to_query.append(obj.id)
+        if to_query:
+            rv.update(self._view_object_ids_in(to_query))
+        return rv
+
     def _view_object_ids(self):
         """Get all object ids in our view."""
         return set(self.db_info.db.query_ids(self.table_name,
@@ -323,11 +383,6 @@ class ViewTracker(signals.SignalEmitter):
             self.current_ids.remove(obj.id)
             self.emit('removed', self.fetcher.fetch_obj_for_ddb_object(obj))
 
-    def remove_objects(self, objects):
-        for obj in [o for o in objects if o.id in self.current_ids]:
-            self.current_ids.remove(obj.id)
-            self.emit('removed', self.fetcher.fetch_obj_for_ddb_object(obj))
-
     def check_object(self, obj):
         before = (obj.id in self.current_ids)
         now = self._obj_in_view(obj)
@@ -340,6 +395,36 @@ class ViewTracker(signals.SignalEmitter):
         elif before and now:
             self.emit('changed', self.fetcher.fetch_obj_for_ddb_object(obj))
 
+    def check_objects(self, objects):
+        """Check a list of changed objects.
+
+        This works like calling check_object() for each object, but we only
+        query the DB once for the whole list and in bulk mode we send the
+        bulk-* signals.  Objects that are neither in our view now nor were
+        before don't generate any signals.
+        """
+        in_view = self._objs_in_view(objects)
+        added = []
+        removed = []
+        changed = []
+        for obj in objects:
+            before = (obj.id in self.current_ids)
+            now = (obj.id in in_view)
+            if before and not now:
+                self.current_ids.remove(obj.id)
+                removed.append(obj)
+            elif now and not before:
+                self.current_ids.add(obj.id)
+                added.append(obj)
+            elif before and now:
+                changed.append(obj)
+        fetch = self.fetcher.fetch_obj_for_ddb_object
+        for signal, signal_objects in (('added', added),
+                ('removed', removed), ('changed', changed)):
+            if signal_objects:
+                self._emit_for_objects(signal,
+                        [fetch(obj) for obj in signal_objects])
+
     def _emit_for_objects(self, signal, objects):
         if self.bulk_mode:
             self.emit('bulk-' + signal, objects)
@@ -448,41 +533,17 @@ class BulkSQLManager(object):
                 obj.removed_from_db()
 
     def _update_view_trackers(self, to_insert, to_remove):
-        # figure out the total number of objects that have changed
-        changed_objs = set()
-        for table_name, objects in to_insert.items():
-            changed_objs.update(objects)
-        for table_name, objects in to_remove.items():
-            changed_objs.update(objects)
-        # Figure out which strategy is fastest based on the number of objects
-        # that have changed
-        if len(changed_objs) < 100:
-            self._update_view_trackers_by_object(changed_objs)
-        else:
-            self._update_view_trackers_by_table(to_insert, to_remove)
-
-    def _update_view_trackers_by_object(self, changed_objs):
-        """Update view trackers by checking each changed object.
+        """Update view trackers for the objects we inserted/removed.
 
-        This method is the fastest when there are not a lot of changed objects
+        Each tracker checks all the changed objects for a table at once,
+        which means a bulk insert costs a query or so per tracker, not per
+        tracker per object.
         """
-        for obj in changed_objs:
-            self.view_tracker_manager.update_view_trackers(obj)
-
-    def _update_view_trackers_by_table(self, to_insert, to_remove):
-        """Update view trackers by checking each table
-
-        This method is fastest when there are many changed objects
-        """
-        for table_name in to_insert:
-            self.view_tracker_manager.bulk_update_view_trackers(table_name)
-
-        for table_name, objects in to_remove.items():
-            if table_name in to_insert:
-                # already updated the view above
-                continue
-            self.view_tracker_manager.bulk_remove_from_view_trackers(
-                table_name, objects)
+        for table_name in set(to_insert.keys() + to_remove.keys()):
+            changed_objs = (to_insert.get(table_name, []) +
+                    to_remove.get(table_name, []))
+            self.view_tracker_manager.bulk_update_view_trackers(table_name,
+                    changed_objs)
 
     def add_insert(self, obj):
         table_name = self.db.table_name(obj.__class__)
@@ -538,6 +599,12 @@ class AttributeUpdateTracker(object):
 
     def __set__(self, instance, value):
         if instance.__dict__.get(self.name, "BOGUS VALUE FOO") != value:
+            if (instance.evictable and not instance.changed_attributes and
+                    not instance.in_db_init):
+                # keep the object in memory until the change is saved.
+                # (LiveStorage handles objects that are still being set up
+                # when it evicts them.)
+                instance.db_info.db.pin_object(instance)
             instance.changed_attributes.add(self.name)
         instance.__dict__[self.name] = value
 
@@ -545,6 +612,11 @@ class DDBObject(signals.SignalEmitter):
     """Dynamic Database object
     """
 
+    # Can LiveStorage drop this object from memory when it's not being used?
+    # Only set this for classes that don't keep any state outside of the
+    # database that matters, or that report it in has_memory_state().
+    evictable = False
+
     def __init__(self, *args, **kwargs):
         self.confirm_db_thread()
         self.in_db_init = True
@@ -641,6 +713,24 @@ class DDBObject(signals.SignalEmitter):
             db = db_info.db
         return db.select(cls, columns, where, values, convert=convert)
 
+    def connect(self, name, func, *extra_args):
+        if self.evictable:
+            self.db_info.db.pin_object(self)
+        return signals.SignalEmitter.connect(self, name, func, *extra_args)
+
+    def connect_weak(self, name, method, *extra_args):
+        if self.evictable:
+            self.db_info.db.pin_object(self)
+        return signals.SignalEmitter.connect_weak(self, name, method,
+                                                  *extra_args)
+
+    def has_memory_state(self):
+        """Does this object hold state that isn't saved in the database?
+
+        LiveStorage won't evict an evictable object while this returns True.
+        """
+        return False
+
     def setup_new(self):
         """Initialize a newly created object."""
         pass
@@ -51,6 +51,7 @@ from miro import schema
 from miro import util
 import types
 from miro import app
+from miro import columncodec
 from miro import dbupgradeprogress
 from miro import prefs
 
@@ -161,7 +162,7 @@ def get_object_tables(cursor):
     """
     cursor.execute("SELECT name FROM sqlite_master "
             "WHERE type='table' AND name != 'dtv_variables' AND "
-            "name NOT LIKE 'sqlite%'")
+            "name NOT LIKE 'sqlite%' AND name NOT LIKE 'item_search_%'")
     return [row[0] for row in cursor]
 
 def get_next_id(cursor):
@@ -3791,3 +3792,59 @@ def upgrade177(cursor):
     # drop the current_processor column
     cursor.execute("DROP INDEX metadata_processor")
     remove_column(cursor, 'metadata_status', ['current_processor'])
+
+def upgrade178(cursor):
+    """Convert pythonrepr columns from repr() strings to columncodec blobs."""
+    for table in get_object_tables(cursor):
+        cursor.execute("PRAGMA table_info('%s')" % table)
+        columns = [column_info[1] for column_info in cursor.fetchall()
+                   if column_info[2] == 'pythonrepr']
+        for column in columns:
+            cursor.execute("SELECT id, %s FROM %s WHERE %s IS NOT NULL" %
+                           (column, table, column))
+            updates = []
+            for id_, value in cursor.fetchall():
+                if columncodec.is_encoded(value):
+                    continue
+                try:
+                    new_value = columncodec.encode(eval_container(value))
+                except StandardError:
+                    # Leave corrupt values alone.  They will be handled by
+                    # the handle_malformed_* methods when they're restored.
+                    logging.warn("upgrade178: error converting %s.%s "
+                                 "(id: %s)", table, column, id_)
+                    continue
+                updates.append((buffer(new_value), id_))
+            cursor.executemany("UPDATE %s SET %s=? WHERE id=?" %
+                               (table, column), updates)
+
+def upgrade179(cursor):
+    """Create the tables for the search index.
+
+    SearchIndex will notice that the tables are empty and fill them in.
+    """
+    cursor.execute("CREATE TABLE item_search_ngrams(id INTEGER PRIMARY KEY, "
+                   "ngrams TEXT)")
+    cursor.execute("CREATE TABLE item_search_postings(ngram TEXT PRIMARY KEY, "
+                   "ids BLOB)")
+
+def upgrade180(cursor):
+    """Add content_fingerprint to rss_feed_impl."""
+    cursor.execute("ALTER TABLE rss_feed_impl "
+                   "ADD COLUMN content_fingerprint text")
+
+def upgrade181(cursor):
+    """Add indexes for view queries that scanned whole tables.
+
+    These were found by running IndexAdvisor on our views.
+    """
+    cursor.execute("CREATE INDEX item_feed_release_date ON item "
+                   "(feed_id, releaseDateObj)")
+    cursor.execute("CREATE INDEX item_feed_watched ON item "
+                   "(feed_id, keep, watchedTime)")
+    cursor.execute("CREATE INDEX downloader_main_item ON remote_downloader "
+                   "(main_item_id)")
+    cursor.execute("CREATE INDEX playlist_item_map_position "
+                   "ON playlist_item_map (playlist_id, position)")
+    cursor.execute("CREATE INDEX playlist_folder_item_map_position "
+                   "ON playlist_folder_item_map (playlist_id, position)")
@@ -36,6 +36,7 @@ import os
 import re
 import time
 import xml
+from hashlib import sha1
 from urlparse import urljoin
 from HTMLParser import HTMLParser, HTMLParseError
 from cStringIO import StringIO
@@ -56,6 +57,7 @@ from miro import databaselog
 from miro import dialogs
 from miro import download_utils
 from miro import eventloop
+from miro import feedcounts
 from miro import feedupdate
 from miro import flashscraper
 from miro import models
@@ -82,6 +84,13 @@ WHITESPACE_PATTERN = re.compile(r"^[ \t\r\n]*$")
 
 DEFAULT_FEED_ICON = "images/icon-podcast-small.png"
 
+# Parts of a feed body that change on every fetch without changing the
+# content.  These are removed before calculating the content fingerprint.
+LAST_BUILD_DATE_PATTERN = re.compile(r"<lastBuildDate>.*?</lastBuildDate>",
+                                     re.IGNORECASE | re.DOTALL)
+WHITESPACE_BETWEEN_TAGS_PATTERN = re.compile(r">\s+<")
+WHITESPACE_RUN_PATTERN = re.compile(r"\s+")
+
 @returns_unicode
 def default_feed_icon_url():
     return resources.url(DEFAULT_FEED_ICON)
@@ -112,6 +121,51 @@ class _RateLimiter(object):
         # get ready for the next check() call
         self.last_time = time.time()
 
+class FingerprintStats(object):
+    """Counts the work that content fingerprints let us skip.
+
+    bodies_skipped counts feed updates where the body was unchanged, so we
+    didn't update the items from it (or run feedparser at all if we already
+    had the parsed channel data).  entries_skipped counts entries that were
+    unchanged in a feed that we did parse.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.bodies_skipped = 0
+        self.entries_skipped = 0
+
+fingerprint_stats = FingerprintStats()
+
+def calc_content_fingerprint(body):
+    """Calculate a fingerprint for a feed body.
+
+    The body is normalized first: whitespace between tags is removed, other
+    runs of whitespace are collapsed and the channel's lastBuildDate is
+    dropped, since many servers regenerate it on every request.
+    """
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    body = LAST_BUILD_DATE_PATTERN.sub('', body)
+    body = WHITESPACE_BETWEEN_TAGS_PATTERN.sub('><', body)
+    body = WHITESPACE_RUN_PATTERN.sub(' ', body).strip()
+    return unicode(sha1(body).hexdigest())
+
+def _canonical_repr(value):
+    """repr() that doesn't depend on the order of dictionary keys."""
+    if hasattr(value, 'items'):
+        return '{%s}' % ', '.join('%r: %s' % (key, _canonical_repr(val))
+                                  for key, val in sorted(value.items()))
+    elif isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join(_canonical_repr(val) for val in value)
+    else:
+        return repr(value)
+
+def calc_entry_fingerprint(entry):
+    """Calculate a fingerprint for a feedparser entry."""
+    return sha1(_canonical_repr(entry)).digest()
+
 # Notes on character set encoding of feeds:
 #
 # The parsing libraries built into Python mostly use byte strings
@@ -228,18 +282,29 @@ def _on_config_change(obj, key, value):
                 pass
             feed.set_update_frequency(update_freq)
 
-def run_feedparser(html, callback, errback):
+def run_feedparser(html, callback, errback, known_ids=None,
+                   max_old_items=0):
+    """Parse a feed in the worker process.
+
+    If known_ids is given, we may stop parsing before the end of the feed.
+    See feedparserutil.parse_streaming().
+    """
     if _RUN_FEED_PARSER_INLINE:
         try:
-            rv = feedparserutil.parse(html)
+            if known_ids:
+                rv = feedparserutil.parse_streaming(html, known_ids,
+                                                    max_old_items)
+            else:
+                rv = feedparserutil.parse(html)
         except StandardError, e:
             errback(e)
         else:
             callback(rv)
     else:
-        workerprocess.send(workerprocess.FeedparserTask(html),
+        workerprocess.send(workerprocess.FeedparserTask(html, known_ids,
+                                                        max_old_items),
                            lambda msg, result: callback(result),
-                           lambda msg, error: errback(result))
+                           lambda msg, error: errback(error))
 
 # Wait X seconds before updating the feeds at startup
 INITIAL_FEED_UPDATE_DELAY = 5.0
@@ -552,6 +617,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         DDBObject.signal_change(self, needs_save=needs_save)
 
     def on_signal_change(self):
+        app.feed_counts.feed_changed(self)
         is_updating = bool(self.actualFeed.updating)
         if self.wasUpdating and not is_updating:
             self.emit('update-finished')
@@ -579,14 +645,11 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         if self.actualFeed:
             return self.actualFeed.clean_old_items()
 
-    def invalidate_counts(self):
-        for cached_count_attr in ('_num_available', '_num_unwatched',
-                '_num_downloaded', '_num_downloading'):
-            if cached_count_attr in self.__dict__:
-                del self.__dict__[cached_count_attr]
-
     def recalc_counts(self):
-        self.invalidate_counts()
+        """Send out change signals after our item counts change.
+
+        The counts themselves are kept up to date by app.feed_counts.
+        """
         self.signal_change(needs_save=False)
         if self.in_folder():
             self.get_folder().signal_change(needs_save=False)
@@ -594,39 +657,27 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
     def num_downloaded(self):
         """Returns the number of downloaded items in the feed.
         """
-        try:
-            return self._num_downloaded
-        except AttributeError:
-            self._num_downloaded = self.downloaded_items.count()
-            return self._num_downloaded
+        return app.feed_counts.get_feed_counts(self.id)[
+            feedcounts.DOWNLOADED]
 
     def num_downloading(self):
         """Returns the number of downloading items in the feed.
         """
-        try:
-            return self._num_downloading
-        except AttributeError:
-            self._num_downloading = self.downloading_items.count()
-            return self._num_downloading
+        return app.feed_counts.get_feed_counts(self.id)[
+            feedcounts.DOWNLOADING]
 
     def num_unwatched(self):
         """Returns string with number of unwatched videos in feed
         """
-        try:
-            return self._num_unwatched
-        except AttributeError:
-            self._num_unwatched = self.unwatched_items.count()
-            return self._num_unwatched
+        return app.feed_counts.get_feed_counts(self.id)[
+            feedcounts.UNWATCHED]
 
     def num_available(self):
         """Returns string with number of available videos in feed
         """
-        try:
-            return self._num_available
-        except AttributeError:
-            self._num_available = (self.available_items.count() -
-                    self.auto_pending_items.count())
-            return self._num_available
+        counts = app.feed_counts.get_feed_counts(self.id)
+        return (counts[feedcounts.AVAILABLE] -
+                counts[feedcounts.AUTO_PENDING])
 
     def get_viewed(self):
         """Returns true iff this feed has been looked at
@@ -639,38 +690,12 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         # get the list of available items before we reset the time
         available_items = list(self.available_items)
         self.last_viewed = datetime.now()
-        try:
-            del self._num_available
-        except AttributeError:
-            pass
         if self.in_folder():
             self.get_folder().signal_change()
         self.signal_change()
         for item in available_items:
             item.signal_change(needs_save=False)
 
-    def start_manual_download(self):
-        next_ = None
-        for item in self.items:
-            if item.is_pending_manual_download():
-                if next_ is None:
-                    next_ = item
-                elif item.get_pub_date_parsed() > next_.get_pub_date_parsed():
-                    next_ = item
-        if next_ is not None:
-            next_.download(autodl=False)
-
-    def start_auto_download(self):
-        next = None
-        for item in self.items:
-            if item.is_eligible_for_auto_download():
-                if next is None:
-                    next = item
-                elif item.get_pub_date_parsed() > next.get_pub_date_parsed():
-                    next = item
-        if next is not None:
-            next.download(autodl = True)
-
     def expiring_items(self):
         # items in watched folders never expire
         if self.is_watched_folder():
@@ -797,7 +822,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         self.maxNew = max_new
         self.signal_change()
         if self.maxNew >= oldMaxNew or self.maxNew < 0:
-            autodler.AUTO_DOWNLOADER.start_downloads()
+            autodler.AUTO_DOWNLOADER.feed_limits_changed(self)
 
     def set_max_old_items(self, maxOldItems):
         self.confirm_db_thread()
@@ -1173,6 +1198,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
             app.bulk_sql_manager.finish()
         self.remove_icon_cache()
         DDBObject.remove(self)
+        app.feed_counts.feed_removed(self)
         self.actualFeed.remove()
         if self.in_folder():
             self.get_folder().signal_change()
@@ -1207,11 +1233,11 @@ class ThrottledUpdateFeedImpl(FeedImpl):
         feedupdate.cancel_update(self.ufeed)
         if firstTriggerDelay >= 0:
             feedupdate.schedule_update(firstTriggerDelay, self.ufeed,
-                    self.update)
+                    self.update, self.updateFreq)
         else:
             if self.updateFreq > 0:
                 feedupdate.schedule_update(self.updateFreq, self.ufeed,
-                        self.update)
+                        self.update, self.updateFreq)
 
 class RSSFeedImplBase(ThrottledUpdateFeedImpl):
     """
@@ -1219,8 +1245,15 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
     """
     def setup_new(self, url, ufeed, title):
         FeedImpl.setup_new(self, url, ufeed, title)
+        self.entry_fingerprints = {}
         self.schedule_update_events(0)
 
+    def setup_restored(self):
+        FeedImpl.setup_restored(self)
+        # Entry fingerprints aren't saved, so the first update after startup
+        # builds FeedParserValues for every entry.
+        self.entry_fingerprints = {}
+
     def _handle_new_entry(self, entry, fp_values, channel_title):
         """Handle getting a new entry from a feed."""
         enclosure = fp_values.first_video_enclosure
@@ -1278,8 +1311,19 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
             by_url_title_key = (item.url, item.entry_title)
             if by_url_title_key != (None, None):
                 items_byURLTitle[by_url_title_key] = item
+        entry_fingerprints = {}
         for entry in parsed.entries:
             rate_limiter.check_for_sleep()
+            rss_id = entry.get('id')
+            if rss_id is not None:
+                fingerprint = calc_entry_fingerprint(entry)
+                entry_fingerprints[rss_id] = fingerprint
+                if (self.entry_fingerprints.get(rss_id) == fingerprint and
+                        rss_id in items_byid):
+                    # unchanged since the last time we saw it
+                    self.old_items.discard(items_byid[rss_id])
+                    fingerprint_stats.entries_skipped += 1
+                    continue
             entry = self.add_scraped_thumbnail(entry)
             fp_values = FeedParserValues(entry)
             new = True
@@ -1315,6 +1359,17 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
                             pass
             if new and fp_values.first_video_enclosure is not None:
                 self._handle_new_entry(entry, fp_values, channel_title)
+        if parsed.get('unparsed_entries'):
+            # parse_streaming() only stops early if the entries it didn't
+            # parse can't make us truncate anything.  Their items are still
+            # in the feed, so don't count them as old.
+            self.old_items.clear()
+        # RSSMultiFeedBase calls us once per URL, so merge the fingerprints
+        # rather than replacing them.  Drop ones for items that are gone.
+        for rss_id in self.entry_fingerprints.keys():
+            if rss_id not in items_byid:
+                del self.entry_fingerprints[rss_id]
+        self.entry_fingerprints.update(entry_fingerprints)
 
     def _allow_feed_to_override_title(self):
         """Should the RSS feed override the default title?
@@ -1351,6 +1406,15 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
             del self.old_items
         self.signal_change()
 
+    def get_max_old_items_limit(self):
+        """Get the number of old items this feed keeps, resolving the
+        "system" value from ufeed.get_max_old_items().
+        """
+        limit = self.ufeed.get_max_old_items()
+        if limit == u"system":
+            limit = app.config.get(prefs.MAX_OLD_ITEMS_DEFAULT)
+        return limit
+
     def truncate_old_items(self):
         """Truncate items so that the number of items in this feed doesn't
         exceed self.get_max_old_items()
@@ -1358,10 +1422,7 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
         Items are only truncated if they don't exist in the feed anymore, and
         if the user hasn't downloaded them.
         """
-        limit = self.ufeed.get_max_old_items()
-        if limit == u"system":
-            limit = app.config.get(prefs.MAX_OLD_ITEMS_DEFAULT)
-
+        limit = self.get_max_old_items_limit()
         item_count = self.items.count()
         if item_count > app.config.get(prefs.TRUNCATE_CHANNEL_AFTER_X_ITEMS):
             truncate = item_count - app.config.get(prefs.TRUNCATE_CHANNEL_AFTER_X_ITEMS)
@@ -1398,6 +1459,8 @@ class RSSFeedImpl(RSSFeedImplBase):
         self.etag = etag
         self.modified = modified
         self.download = None
+        self.content_fingerprint = None
+        self.pending_fingerprint = None
 
     @returns_unicode
     def get_base_href(self):
@@ -1422,6 +1485,7 @@ class RSSFeedImpl(RSSFeedImplBase):
         self.update_finished()
 
     def feedparser_errback(self, e):
+        self.pending_fingerprint = None
         if not self.ufeed.id_exists():
             return
         logging.warning("Error updating feed: %s: %s", self.url, e)
@@ -1431,6 +1495,10 @@ class RSSFeedImpl(RSSFeedImplBase):
         self.ufeed.confirm_db_thread()
         if not self.ufeed.id_exists():
             return
+        # Only remember the fingerprint once the body has been parsed, so
+        # that a failed update doesn't cause us to skip the next one.
+        self.content_fingerprint = self.pending_fingerprint
+        self.pending_fingerprint = None
         if len(parsed.entries) == len(parsed.feed) == 0:
             logging.warn("Empty feed, not updating: %s", self.url)
             self.feedparser_finished()
@@ -1452,10 +1520,42 @@ class RSSFeedImpl(RSSFeedImplBase):
             logging.timing("feed update for: %s too slow (%.3f secs)",
                            self.url, end - start)
 
+    def _restore_parsed(self, parsed):
+        self.ufeed.confirm_db_thread()
+        if not self.ufeed.id_exists():
+            return
+        self.parsed = parsed
+        self.feedparser_finished()
+
+    def _calc_streaming_args(self, html):
+        """Get the known_ids and max_old_items arguments to pass to
+        run_feedparser() for html.
+
+        For big feeds, we let the worker stop once the rest of the entries
+        can't change what truncate_old_items() does.
+        """
+        if len(html) < feedparserutil.STREAMING_PARSE_MIN_SIZE:
+            return None, 0
+        items = list(self.items)
+        if len(items) > app.config.get(prefs.TRUNCATE_CHANNEL_AFTER_X_ITEMS):
+            # truncate_old_items() needs to know about every old item
+            return None, 0
+        known_ids = set(item.rss_id for item in items
+                        if item.rss_id is not None)
+        # items without an rss_id (or with the same one as another item)
+        # might not get matched to an entry, so they count against the old
+        # items limit
+        max_old_items = (self.get_max_old_items_limit() -
+                         (len(items) - len(known_ids)))
+        if max_old_items < 0:
+            return None, 0
+        return known_ids, max_old_items
+
     def call_feedparser(self, html):
         self.ufeed.confirm_db_thread()
+        known_ids, max_old_items = self._calc_streaming_args(html)
         run_feedparser(html, self.feedparser_callback,
-                self.feedparser_errback)
+                self.feedparser_errback, known_ids, max_old_items)
 
     def update(self):
         """Updates a feed
@@ -1471,6 +1571,7 @@ class RSSFeedImpl(RSSFeedImplBase):
         if hasattr(self, 'initialHTML') and self.initialHTML is not None:
             html = self.initialHTML
             self.initialHTML = None
+            self.pending_fingerprint = calc_content_fingerprint(html)
             self.call_feedparser(html)
         else:
             try:
@@ -1491,6 +1592,7 @@ class RSSFeedImpl(RSSFeedImplBase):
             return
         logging.warn("WARNING: error in Feed.update for %s -- %s",
             self.ufeed, stringify(error))
+        feedupdate.record_error(self.ufeed)
         self.schedule_update_events(-1)
         self.updating = False
         self.ufeed.signal_change(needs_save=False)
@@ -1519,6 +1621,22 @@ class RSSFeedImpl(RSSFeedImplBase):
             self.modified = unicodify(info['last-modified'])
         else:
             self.modified = None
+        fingerprint = calc_content_fingerprint(html)
+        if fingerprint == self.content_fingerprint:
+            logging.debug("RSSFeedImpl: _update_callback: "
+                          "body unchanged (%s)", self.ufeed)
+            fingerprint_stats.bodies_skipped += 1
+            if hasattr(self, 'parsed'):
+                self.feedparser_finished()
+            else:
+                # We haven't parsed this feed since startup.  Parse it to
+                # get the channel data that get_link(), get_license(), etc.
+                # use, but don't bother updating the items.
+                known_ids, max_old_items = self._calc_streaming_args(html)
+                run_feedparser(html, self._restore_parsed,
+                        self.feedparser_errback, known_ids, max_old_items)
+            return
+        self.pending_fingerprint = fingerprint
         self.call_feedparser(html)
 
     @returns_unicode
@@ -1539,12 +1657,14 @@ class RSSFeedImpl(RSSFeedImplBase):
     def setup_restored(self):
         """Called by pickle during deserialization
         """
-        FeedImpl.setup_restored(self)
+        RSSFeedImplBase.setup_restored(self)
         self.download = None
+        self.pending_fingerprint = None
 
     def clean_old_items(self):
         self.modified = None
         self.etag = None
+        self.content_fingerprint = None
         self.update()
 
 class RSSMultiFeedBase(RSSFeedImplBase):
@@ -1639,6 +1759,7 @@ class RSSMultiFeedBase(RSSFeedImplBase):
             return
         logging.warn("WARNING: error in Feed.update for %s (%s) -- %s",
                      self.ufeed, stringify(url), stringify(error))
+        feedupdate.record_error(self.ufeed)
         self.schedule_update_events(-1)
         self.updating -= 1
         self.check_update_finished()
@@ -1773,6 +1894,7 @@ class ScraperFeedImpl(ThrottledUpdateFeedImpl):
             self.downloads.discard(download)
             logging.warning("unhandled error for ScraperFeedImpl.get_html: %s",
                             error)
+            feedupdate.record_error(self.ufeed)
             self.check_done()
         download = grab_url(url, callback, errback, etag=etag,
                 modified=modified, default_mime_type='text/html')
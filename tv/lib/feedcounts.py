@@ -0,0 +1,315 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.feedcounts`` -- Keep track of the item counts for feeds and
+folders.
+
+The sidebar shows the number of downloaded, downloading, unwatched and
+available items for every feed and folder.  Running COUNT(*) queries for
+each of those every time an item changed got expensive with lots of
+feeds, so FeedCounts loads all the counts with one query at startup, then
+keeps them up to date as items change.
+
+We don't try to calculate whether an item should be counted in python,
+since it's easy to get the NULL handling slightly different from the SQL
+views.  Instead, changed items are remembered and when someone asks for a
+count we run one query for all of them, using the same expressions as the
+views in Item.
+"""
+
+import logging
+
+from miro import app
+from miro import eventloop
+from miro import models
+from miro import util
+
+# Expressions that calculate if an item should be counted.  These match
+# the WHERE clauses for Item.feed_downloaded_view(),
+# Item.feed_downloading_view(), etc.
+_DOWNLOADED_SQL = ("(item.is_file_item OR rd.state in ('finished', "
+                   "'uploading', 'uploading-paused'))")
+_COUNT_COLUMNS = [
+    # downloaded
+    _DOWNLOADED_SQL,
+    # downloading
+    "(rd.state in ('downloading', 'uploading') AND rd.main_item_id=item.id)",
+    # unwatched
+    "(NOT item.seen AND item.file_type in ('audio', 'video') AND %s)" %
+    _DOWNLOADED_SQL,
+    # available
+    "(NOT item.autoDownloaded AND item.downloadedTime IS NULL AND "
+    "NOT item.is_file_item AND feed.last_viewed <= item.creationTime)",
+    # auto pending
+    "(feed.autoDownloadable AND NOT item.was_downloaded AND "
+    "(item.eligibleForAutoDownload OR feed.getEverything))",
+]
+_JOINS = ("LEFT JOIN remote_downloader AS rd ON item.downloader_id=rd.id "
+          "LEFT JOIN feed ON item.feed_id=feed.id ")
+
+DOWNLOADED, DOWNLOADING, UNWATCHED, AVAILABLE, AUTO_PENDING = range(5)
+_NO_COUNTS = (0,) * len(_COUNT_COLUMNS)
+
+class FeedCounts(object):
+    """Tracks item counts for each feed and folder.
+
+    Items call item_changed() and item_removed() and feeds call
+    feed_changed() and feed_removed().  Those calls are cheap, the work
+    happens in flush(), which is called before we return any counts.
+
+    When app.debugmode is set, we periodically check our counts against
+    the database and log a warning if they are different.
+
+    Attributes:
+    - item_counts -- maps item ids to (feed_id, counts) tuples for each
+      item that's counted for at least 1 thing
+    - feed_counts -- maps feed ids to lists of counts
+    - folder_counts -- maps folder ids to lists of counts
+    """
+
+    CHECK_INTERVAL = 60
+
+    def __init__(self):
+        self.loaded = False
+        self.item_counts = {}
+        self.feed_counts = {}
+        self.folder_counts = {}
+        # maps feed ids to their folder id
+        self.feed_folders = {}
+        # maps feed ids to the feed attributes that our counts depend on
+        self.feed_states = {}
+        self.changed_items = set()
+        self.changed_feeds = set()
+        self._check_dc = None
+
+    def load(self):
+        """Load the counts for all feeds."""
+        self.item_counts = {}
+        self.feed_counts = {}
+        self.folder_counts = {}
+        self.feed_folders = {}
+        self.feed_states = {}
+        # The query below gets everything that's in the database.  Only
+        # items waiting for a bulk insert still need to be handled later.
+        self.changed_items = set(item_id for item_id in self.changed_items
+                if app.bulk_sql_manager.will_insert(item_id))
+        self.changed_feeds = set()
+        for (feed_id, folder_id, last_viewed, auto_downloadable,
+                get_everything) in models.Feed.select(['id', 'folder_id',
+                    'last_viewed', 'autoDownloadable', 'getEverything']):
+            self.feed_folders[feed_id] = folder_id
+            self.feed_states[feed_id] = (last_viewed, auto_downloadable,
+                                         get_everything)
+        self._fetch_counts('item.feed_id IS NOT NULL', ())
+        self.loaded = True
+        if app.debugmode:
+            self._schedule_check()
+
+    def unload(self):
+        if self._check_dc is not None:
+            self._check_dc.cancel()
+            self._check_dc = None
+        self.loaded = False
+
+    def _fetch_counts(self, where, values):
+        sql = ("SELECT item.id, item.feed_id, %s FROM item %s WHERE %s" %
+               (', '.join(_COUNT_COLUMNS), _JOINS, where))
+        app.db.cursor.execute(sql, values)
+        seen = set()
+        for row in app.db.cursor.fetchall():
+            item_id, feed_id = row[0], row[1]
+            seen.add(item_id)
+            if app.bulk_sql_manager.will_remove(item_id):
+                # item_removed() already took care of this one
+                continue
+            counts = tuple(value and 1 or 0 for value in row[2:])
+            self._set_item_counts(item_id, feed_id, counts)
+        return seen
+
+    def _set_item_counts(self, item_id, feed_id, counts):
+        old_feed_id, old_counts = self.item_counts.get(item_id,
+                                                       (None, _NO_COUNTS))
+        if feed_id is None:
+            counts = _NO_COUNTS
+        if (feed_id, counts) == (old_feed_id, old_counts):
+            return
+        if old_feed_id is not None:
+            self._add_counts(old_feed_id, old_counts, -1)
+        if counts != _NO_COUNTS:
+            self._add_counts(feed_id, counts, 1)
+            self.item_counts[item_id] = (feed_id, counts)
+        else:
+            self.item_counts.pop(item_id, None)
+
+    def _add_counts(self, feed_id, counts, sign):
+        total = self.feed_counts.setdefault(feed_id, [0] * len(counts))
+        for i, value in enumerate(counts):
+            total[i] += sign * value
+        self._add_folder_counts(self.feed_folders.get(feed_id), counts, sign)
+
+    def _add_folder_counts(self, folder_id, counts, sign):
+        if folder_id is None:
+            return
+        total = self.folder_counts.setdefault(folder_id, [0] * len(counts))
+        for i, value in enumerate(counts):
+            total[i] += sign * value
+
+    def item_changed(self, item):
+        self.changed_items.add(item.id)
+
+    def item_removed(self, item):
+        if not self.loaded:
+            return
+        self.changed_items.discard(item.id)
+        self._set_item_counts(item.id, None, _NO_COUNTS)
+
+    def feed_changed(self, feed):
+        """Call this when a feed changes.
+
+        If the feed's folder changed, we move its counts to the new folder.
+        If the attributes that the available counts depend on changed, we
+        recalculate the counts for all of its items.
+        """
+        if not self.loaded:
+            return
+        folder_id = feed.folder_id
+        old_folder_id = self.feed_folders.get(feed.id)
+        if folder_id != old_folder_id:
+            counts = self.feed_counts.get(feed.id, _NO_COUNTS)
+            self._add_folder_counts(old_folder_id, counts, -1)
+            self._add_folder_counts(folder_id, counts, 1)
+            self.feed_folders[feed.id] = folder_id
+        state = (feed.last_viewed, feed.autoDownloadable, feed.getEverything)
+        if state != self.feed_states.get(feed.id):
+            self.feed_states[feed.id] = state
+            self.changed_feeds.add(feed.id)
+
+    def feed_removed(self, feed):
+        if not self.loaded:
+            return
+        # Make sure counts for items moved out of the feed go to their new
+        # feed.
+        self.flush()
+        counts = self.feed_counts.pop(feed.id, _NO_COUNTS)
+        self._add_folder_counts(self.feed_folders.pop(feed.id, None), counts,
+                                -1)
+        self.feed_states.pop(feed.id, None)
+        self.changed_feeds.discard(feed.id)
+
+    def flush(self):
+        """Update our counts for the items and feeds that have changed."""
+        if not self.loaded:
+            self.load()
+            return
+        if self.changed_feeds:
+            changed_feeds = list(self.changed_feeds)
+            self.changed_feeds = set()
+            for chunk in util.split_values_for_sqlite(changed_feeds):
+                self._fetch_counts('item.feed_id IN (%s)' %
+                                   ', '.join('?' * len(chunk)), chunk)
+        if self.changed_items:
+            # Items waiting for a bulk insert aren't in the database yet.
+            # Leave them for the next flush.
+            bulk_sql_manager = app.bulk_sql_manager
+            changed_items = []
+            pending_items = set()
+            for item_id in self.changed_items:
+                if bulk_sql_manager.will_insert(item_id):
+                    pending_items.add(item_id)
+                else:
+                    changed_items.append(item_id)
+            self.changed_items = pending_items
+            for chunk in util.split_values_for_sqlite(changed_items):
+                seen = self._fetch_counts('item.id IN (%s)' %
+                                          ', '.join('?' * len(chunk)), chunk)
+                for item_id in chunk:
+                    if item_id not in seen:
+                        # removed while we weren't looking
+                        self._set_item_counts(item_id, None, _NO_COUNTS)
+
+    def get_feed_counts(self, feed_id):
+        """Get the counts for a feed.
+
+        :returns: list of counts, indexed by DOWNLOADED, DOWNLOADING, etc.
+        """
+        self.flush()
+        return self.feed_counts.get(feed_id, _NO_COUNTS)
+
+    def get_folder_counts(self, folder_id):
+        """Get the counts for a folder.
+
+        :returns: list of counts, indexed by DOWNLOADED, DOWNLOADING, etc.
+        """
+        self.flush()
+        return self.folder_counts.get(folder_id, _NO_COUNTS)
+
+    def _schedule_check(self):
+        self._check_dc = eventloop.add_timeout(self.CHECK_INTERVAL,
+                                               self._periodic_check,
+                                               "check feed counts")
+
+    def _periodic_check(self):
+        self._check_dc = None
+        if not self.loaded:
+            return
+        self.check_consistency()
+        self._schedule_check()
+
+    def calc_feed_counts_from_db(self):
+        """Calculate the counts for every feed with a grouped SQL query.
+
+        :returns: dict mapping feed ids to lists of counts
+        """
+        sql = ("SELECT item.feed_id, %s FROM item %s "
+               "WHERE item.feed_id IS NOT NULL GROUP BY item.feed_id" %
+               (', '.join('SUM(CASE WHEN %s THEN 1 ELSE 0 END)' % column
+                          for column in _COUNT_COLUMNS), _JOINS))
+        app.db.cursor.execute(sql)
+        return dict((row[0], list(row[1:]))
+                    for row in app.db.cursor.fetchall())
+
+    def check_consistency(self):
+        """Check our counts against the database.
+
+        If they are different, log a warning and reload them.
+
+        :returns: True if the counts were correct
+        """
+        self.flush()
+        db_counts = self.calc_feed_counts_from_db()
+        for feed_id in set(db_counts.keys() + self.feed_counts.keys()):
+            our_counts = list(self.feed_counts.get(feed_id, _NO_COUNTS))
+            correct_counts = db_counts.get(feed_id, list(_NO_COUNTS))
+            if our_counts != correct_counts:
+                logging.warn("FeedCounts: counts for feed %s are wrong "
+                             "(%s != %s).  Reloading", feed_id, our_counts,
+                             correct_counts)
+                self.load()
+                return False
+        return True
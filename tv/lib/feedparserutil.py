@@ -33,6 +33,8 @@
 from datetime import datetime
 from time import struct_time
 from types import NoneType
+import itertools
+import re
 import threading
 
 from miro.clock import clock
@@ -90,6 +92,129 @@ def parse(url_file_stream_or_string):
     _yahoo_hack(parsed['entries'])
     return parsed
 
+# Feeds smaller than this are always parsed in one go.  Only big feeds are
+# worth splitting up.
+STREAMING_PARSE_MIN_SIZE = 256 * 1024
+# Number of entries that parse_streaming() sends through feedparser at once
+STREAMING_BATCH_SIZE = 100
+
+_ENTRY_TAG_RE = re.compile(r'<(item|entry)[\s>]')
+_ENTRY_RES = {
+    'item': re.compile(r'<item[\s>].*?</item\s*>', re.DOTALL),
+    'entry': re.compile(r'<entry[\s>].*?</entry\s*>', re.DOTALL),
+}
+_ENTRY_END_RES = {
+    'item': re.compile(r'</item\s*>'),
+    'entry': re.compile(r'</entry\s*>'),
+}
+_BETWEEN_ENTRIES_RE = re.compile(r'^(\s|<!--.*?-->)*$', re.DOTALL)
+
+def split_entries(html):
+    """Split the XML for a RSS/Atom feed into its entries.
+
+    The entries are split up lazily, so callers that stop early don't pay
+    for scanning the rest of the feed.
+
+    :returns: (header, entry_chunks, footer, entry_count) tuple, where
+        entry_chunks is an iterator and header + ''.join(entry_chunks) +
+        footer == html.  entry_count is a quick count of the entry end tags.
+        Returns None if we can't find the entries.  If it turns out that
+        we can't split the feed up safely, iterating over entry_chunks
+        raises a ValueError.
+    """
+    match = _ENTRY_TAG_RE.search(html)
+    if match is None:
+        return None
+    tag = match.group(1)
+    end_match = _ENTRY_END_RES[tag].match(html, html.rfind('</' + tag))
+    if end_match is None or end_match.start() < match.start():
+        return None
+    entry_count = html.count('</' + tag, match.start())
+    return (html[:match.start()],
+            _iter_entry_chunks(html, tag, match.start(), end_match.end()),
+            html[end_match.end():], entry_count)
+
+def _iter_entry_chunks(html, tag, start, end):
+    """Yield the entries in html[start:end] for split_entries()."""
+    last_end = None
+    chunk = None
+    for match in _ENTRY_RES[tag].finditer(html, start, end):
+        if last_end is not None:
+            between = html[last_end:match.start()]
+            if not _BETWEEN_ENTRIES_RE.match(between):
+                # Something other than whitespace between entries.  Maybe a
+                # CDATA section with an end tag in it.  Don't try to be
+                # clever.
+                raise ValueError("Can't split entries at %d" % last_end)
+            # keep the whitespace between entries with the entry before it
+            yield chunk + between
+        chunk = match.group(0)
+        last_end = match.end()
+    if last_end != end:
+        raise ValueError("Can't split entries at %s" % last_end)
+    yield chunk
+
+def iter_parsed_batches(header, chunks, footer,
+                        batch_size=STREAMING_BATCH_SIZE):
+    """Parse entry chunks from split_entries() in batches.
+
+    Each batch is wrapped with header and footer, so that it's a complete
+    feed for feedparser.  Yields (parsed, chunk_count) tuples, where parsed
+    is the result of parse() for the batch.
+    """
+    chunks = iter(chunks)
+    while True:
+        batch = list(itertools.islice(chunks, batch_size))
+        if not batch:
+            return
+        yield parse(header + ''.join(batch) + footer), len(batch)
+
+def parse_streaming(html, known_ids, max_old_items,
+                    batch_size=STREAMING_BATCH_SIZE):
+    """Parse a feed, stopping once the rest of it doesn't matter.
+
+    Entries are parsed in batches, in document order.  After a batch where
+    all the entries have ids in known_ids, we assume the rest of the
+    entries are known too.  We stop if that leaves at most max_old_items of
+    known_ids that aren't in the feed anymore, since then the unparsed
+    entries can't change which old items the feed keeps.  When we stop
+    early, the "unparsed_entries" key is set to the number of entries we
+    skipped.
+
+    If the feed can't be split up, this is the same as parse().
+    """
+    parts = split_entries(html)
+    if parts is None or not known_ids:
+        return parse(html)
+    header, chunks, footer, entry_count = parts
+    known_ids = set(known_ids)
+    parsed = None
+    parsed_count = 0
+    new_count = 0
+    try:
+        for batch_parsed, chunk_count in iter_parsed_batches(
+                header, chunks, footer, batch_size):
+            if len(batch_parsed['entries']) != chunk_count:
+                # our splitting didn't match what feedparser thinks the
+                # entries are.  Fall back to parsing the whole thing.
+                return parse(html)
+            if parsed is None:
+                parsed = batch_parsed
+            else:
+                parsed['entries'].extend(batch_parsed['entries'])
+            parsed_count += chunk_count
+            batch_new_count = len([entry for entry in batch_parsed['entries']
+                                   if entry.get('id') not in known_ids])
+            new_count += batch_new_count
+            gone_count = len(known_ids) - (entry_count - new_count)
+            if (batch_new_count == 0 and parsed_count < entry_count and
+                    gone_count <= max_old_items):
+                parsed['unparsed_entries'] = entry_count - parsed_count
+                break
+    except ValueError:
+        return parse(html)
+    return parsed
+
 def _yahoo_hack(feedparser_entries):
     """Hack yahoo search to provide enclosures"""
     for entry in feedparser_entries:
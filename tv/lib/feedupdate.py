@@ -30,27 +30,130 @@
 """feedupdate.py -- Handles updating feeds.
 
 Our basic strategy is to limit the number of feeds that are
-simultaniously updating at any given time.  Right now the limit is set
-to 3.
+simultaniously updating at any given time.  There's a global limit
+(prefs.MAX_FEED_UPDATES) and a limit for each host.  Hosts take turns
+starting updates, so that a host with lots of feeds or a slow host doesn't
+hold up the others.
+
+The limit for each host adapts to how the host is doing.  It grows by 1
+each time an update finishes quickly without an error, up to
+prefs.MAX_FEED_UPDATES_PER_HOST, and is cut in half when an update is slow
+or fails.
+
+For each host, we update the feeds that are the most overdue first.
 """
 
 import collections
+import heapq
+import itertools
+import urlparse
 
+from miro import app
 from miro import eventloop
+from miro import prefs
+from miro import signals
+from miro.clock import clock
+
+# updates that take longer than this many seconds count as slow
+SLOW_UPDATE_TIME = 20.0
+# how much weight new samples get for HostUpdateStats.avg_latency and
+# HostUpdateStats.error_rate
+STATS_SMOOTHING = 0.3
+
+def _feed_host(feed):
+    url = feed.get_url()
+    host = urlparse.urlparse(url)[1].lower()
+    if not host:
+        # feeds with special URLs (dtv:..., etc) get grouped by their scheme
+        host = url.split(':', 1)[0]
+    return host
+
+class HostUpdateStats(object):
+    """Tracks the update queue for a single host.
 
-MAX_UPDATES = 3
+    Attributes:
+        host -- hostname
+        queue -- heap of (priority, sequence, feed, update_callback) tuples
+        updating -- feeds currently updating
+        limit -- how many feeds we allow to update at once
+        avg_latency -- smoothed average time of an update in seconds
+        error_rate -- smoothed fraction of updates that failed
+        update_count -- total updates finished
+        error_count -- total updates that failed
+    """
+    def __init__(self, host):
+        self.host = host
+        self.queue = []
+        self.updating = set()
+        self.limit = 1
+        self.avg_latency = None
+        self.error_rate = 0.0
+        self.update_count = 0
+        self.error_count = 0
+
+    def can_start_update(self):
+        return len(self.queue) > 0 and len(self.updating) < self.limit
+
+    def record_update(self, latency, failed, max_limit):
+        self.update_count += 1
+        if failed:
+            self.error_count += 1
+        if self.avg_latency is None:
+            self.avg_latency = latency
+        else:
+            self.avg_latency += STATS_SMOOTHING * (latency -
+                    self.avg_latency)
+        self.error_rate += STATS_SMOOTHING * (float(failed) -
+                self.error_rate)
+        if failed or latency > SLOW_UPDATE_TIME:
+            self.limit = self.limit // 2
+        else:
+            self.limit += 1
+        # the max limit could have changed since we last checked
+        self.limit = max(1, min(max_limit, self.limit))
 
-class FeedUpdateQueue(object):
+    def stats_dict(self):
+        return {
+            'host': self.host,
+            'queued': len(self.queue),
+            'updating': len(self.updating),
+            'limit': self.limit,
+            'avg_latency': self.avg_latency,
+            'error_rate': self.error_rate,
+            'update_count': self.update_count,
+            'error_count': self.error_count,
+        }
+
+class FeedUpdateQueue(signals.SignalEmitter):
+    """Schedules feed updates.
+
+    Signals:
+        changed -- the queue or the stats for a host changed
+    """
     def __init__(self):
-        self.update_queue = collections.deque()
+        signals.SignalEmitter.__init__(self, 'changed')
         self.timeouts = {}
         self.callback_handles = {}
-        self.currently_updating = set()
+        # maps feed -> (HostUpdateStats, start time, failed) for updating
+        # feeds
+        self.currently_updating = {}
+        # maps feed id -> time that we last finished updating the feed
+        self.last_update = {}
+        # maps feed id -> update frequency in seconds
+        self.update_freqs = {}
+        self.hosts = {}
+        # hosts with queued updates, in the order they get to start them
+        self.host_rotation = collections.deque()
+        self.queued_ids = set()
+        self.sequence = itertools.count()
 
-    def schedule_update(self, delay, feed, update_callback):
+    def schedule_update(self, delay, feed, update_callback, update_freq=None):
         name = "Feed update (%s)" % feed.get_title()
-        self.timeouts[feed.id] = eventloop.add_timeout(delay, self.do_update, 
-                name, args=(feed, update_callback))
+        if update_freq is not None:
+            self.update_freqs[feed.id] = update_freq
+        due = clock() + delay
+        self.timeouts[feed.id] = eventloop.add_timeout(delay, self.do_update,
+                name, args=(feed, update_callback, due))
 
     def cancel_update(self, feed):
         try:
@@ -60,31 +163,112 @@ class FeedUpdateQueue(object):
         else:
             timeout.cancel()
 
-    def do_update(self, feed, update_callback):
-        del self.timeouts[feed.id]
-        self.update_queue.append((feed, update_callback))
+    def _calc_priority(self, feed, due):
+        """Calculate when a feed should have been updated.
+
+        Lower values are more overdue and get updated first.
+        """
+        try:
+            update_freq = self.update_freqs[feed.id]
+            last_update = self.last_update[feed.id]
+        except KeyError:
+            return due
+        if update_freq > 0:
+            return min(due, last_update + update_freq)
+        return due
+
+    def _get_host_stats(self, host):
+        try:
+            return self.hosts[host]
+        except KeyError:
+            stats = self.hosts[host] = HostUpdateStats(host)
+            return stats
+
+    def do_update(self, feed, update_callback, due=None):
+        self.timeouts.pop(feed.id, None)
+        if feed.id in self.queued_ids:
+            # already waiting to update
+            return
+        if due is None:
+            due = clock()
+        host_stats = self._get_host_stats(_feed_host(feed))
+        if not host_stats.queue:
+            self.host_rotation.append(host_stats)
+        heapq.heappush(host_stats.queue, (self._calc_priority(feed, due),
+            self.sequence.next(), feed, update_callback))
+        self.queued_ids.add(feed.id)
         self.run_update_queue()
+        self.emit('changed')
+
+    def record_error(self, feed):
+        """Record that the current update for a feed failed."""
+        try:
+            host_stats, start, failed = self.currently_updating[feed]
+        except KeyError:
+            return
+        self.currently_updating[feed] = (host_stats, start, True)
 
     def update_finished(self, feed):
         for callback_handle in self.callback_handles.pop(feed.id):
             feed.disconnect(callback_handle)
-        self.currently_updating.remove(feed)
+        host_stats, start, failed = self.currently_updating.pop(feed)
+        host_stats.updating.discard(feed)
+        now = clock()
+        self.last_update[feed.id] = now
+        host_stats.record_update(now - start, failed,
+                app.config.get(prefs.MAX_FEED_UPDATES_PER_HOST))
         # call run_update_queue in an idle to avoid re-updating the feed that
         # just finished.  That could cause weird effects since we are in the
         # update-finished callback right now.  See #16277
         eventloop.add_idle(self.run_update_queue, 'run feed update queue')
+        self.emit('changed')
+
+    def feed_removed(self, feed):
+        self.update_finished(feed)
+        self.last_update.pop(feed.id, None)
+        self.update_freqs.pop(feed.id, None)
 
     def run_update_queue(self):
-        while (len(self.update_queue) > 0 and 
-               len(self.currently_updating) < MAX_UPDATES):
-            feed, update_callback = self.update_queue.popleft()
+        max_updates = app.config.get(prefs.MAX_FEED_UPDATES)
+        # number of hosts in a row that couldn't start an update.  Once we
+        # go through every host without starting one, we're done.
+        skipped = 0
+        while (len(self.host_rotation) > skipped and
+               len(self.currently_updating) < max_updates):
+            host_stats = self.host_rotation[0]
+            self.host_rotation.rotate(-1)
+            if not host_stats.can_start_update():
+                skipped += 1
+                continue
+            skipped = 0
+            priority, seq, feed, update_callback = heapq.heappop(
+                    host_stats.queue)
+            self.queued_ids.discard(feed.id)
+            if not host_stats.queue:
+                # host_stats was rotated to the end
+                self.host_rotation.pop()
             if feed in self.currently_updating:
                 continue
-            handle = feed.connect('update-finished', self.update_finished)
-            handle2 = feed.connect('removed', self.update_finished)
-            self.callback_handles[feed.id] = (handle, handle2)
-            self.currently_updating.add(feed)
-            update_callback()
+            self._start_update(host_stats, feed, update_callback)
+
+    def _start_update(self, host_stats, feed, update_callback):
+        handle = feed.connect('update-finished', self.update_finished)
+        handle2 = feed.connect('removed', self.feed_removed)
+        self.callback_handles[feed.id] = (handle, handle2)
+        self.currently_updating[feed] = (host_stats, clock(), False)
+        host_stats.updating.add(feed)
+        update_callback()
+
+    def queue_depth(self):
+        """Get the number of feeds waiting to update."""
+        return len(self.queued_ids)
+
+    def host_stats(self):
+        """Get stats for each host we've updated feeds for.
+
+        :returns: list of dicts, see HostUpdateStats.stats_dict()
+        """
+        return [stats.stats_dict() for stats in self.hosts.values()]
 
 global_update_queue = FeedUpdateQueue()
 
@@ -92,8 +276,42 @@ def cancel_update(feed):
     """Cancel any pending updates for feed."""
     global_update_queue.cancel_update(feed)
 
-def schedule_update(delay, feed, update_callback):
+def schedule_update(delay, feed, update_callback, update_freq=None):
     """Schedules a feed to be updated sometime around delay seconds in
     the future.
+
+    :param update_freq: how often the feed should be updated, in seconds.
+        Used to figure out which feeds are the most overdue.
+    """
+    global_update_queue.schedule_update(delay, feed, update_callback,
+            update_freq)
+
+def record_error(feed):
+    """Record that the current update for feed failed.
+
+    This makes the update queue lower the number of simultaneous updates for
+    the feed's host.
     """
-    global_update_queue.schedule_update(delay, feed, update_callback)
+    global_update_queue.record_error(feed)
+
+def format_stats(queue_depth, updating_count, host_stats, bodies_skipped=0,
+                 entries_skipped=0):
+    """Format the stats from a FeedUpdateStatsChanged message for logging.
+
+    :returns: string with summary lines, then one line for each host
+    """
+    lines = ['Feed updates: %d queued, %d updating' % (queue_depth,
+                                                       updating_count),
+             'Unchanged content skipped: %d feed bodies, %d entries' % (
+                 bodies_skipped, entries_skipped)]
+    for stats in sorted(host_stats, key=lambda stats: stats['host']):
+        if stats['avg_latency'] is None:
+            latency = 'n/a'
+        else:
+            latency = '%.2fs' % stats['avg_latency']
+        lines.append('    %s: %d queued, %d updating, limit %d, '
+                     'latency %s, %d/%d failed (error rate %.2f)' % (
+                         stats['host'], stats['queued'], stats['updating'],
+                         stats['limit'], latency, stats['error_count'],
+                         stats['update_count'], stats['error_rate']))
+    return '\n'.join(lines)
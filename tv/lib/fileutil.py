@@ -243,8 +243,8 @@ def delete(path, retry_after=10, retry_for=60, firsttime=True):
             if firsttime:
                 logging.debug('restarting subprocess_manager to hopefully '
                               'free file references')
-                from miro.workerprocess import _subprocess_manager
-                _subprocess_manager.restart(clean=True)
+                from miro.workerprocess import _worker_pool
+                _worker_pool.restart(clean=True)
 
     else:
         deletes_in_progress.discard(path)
@@ -32,7 +32,9 @@
 
 import logging
 
+from miro import app
 from miro import feed
+from miro import feedcounts
 from miro import playlist
 from miro.database import DDBObject, ObjectNotFoundError
 from miro.databasehelper import make_simple_get_set
@@ -133,34 +135,27 @@ class ChannelFolder(FolderBase):
     def has_downloaded_items(self):
         """True if this folder has feeds with downloaded items.
         """
-        for mem in self.get_children_view():
-            if mem.has_downloaded_items():
-                return True
-        return False
+        return app.feed_counts.get_folder_counts(self.id)[
+            feedcounts.DOWNLOADED] > 0
 
     def has_downloading_items(self):
         """True if this folder has feeds with downloading items.
         """
-        for mem in self.get_children_view():
-            if mem.has_downloading_items():
-                return True
-        return False
+        return app.feed_counts.get_folder_counts(self.id)[
+            feedcounts.DOWNLOADING] > 0
 
     def num_unwatched(self):
         """Returns number of unwatched items in feed.
         """
-        unwatched = 0
-        for child in self.get_children_view():
-            unwatched += child.num_unwatched()
-        return unwatched
+        return app.feed_counts.get_folder_counts(self.id)[
+            feedcounts.UNWATCHED]
 
     def num_available(self):
         """Returns number of available items in feed
         """
-        available = 0
-        for child in self.get_children_view():
-            available += child.num_available()
-        return available
+        counts = app.feed_counts.get_folder_counts(self.id)
+        return (counts[feedcounts.AVAILABLE] -
+                counts[feedcounts.AUTO_PENDING])
 
     def mark_as_viewed(self):
         """Marks all children as viewed.
@@ -415,6 +415,26 @@ class MiroInterpreter(cmd.Cmd):
         return self.handle_item_complete(text, self._get_item_view(),
                 lambda i: i.is_downloaded())
 
+    @run_in_event_loop
+    def do_dbprofile(self, line):
+        """dbprofile start|stop|reset|report -- Profiles database queries."""
+        profiler = app.db.profiler
+        if line == 'start':
+            profiler.start()
+        elif line == 'stop':
+            profiler.stop()
+        elif line == 'reset':
+            profiler.reset()
+        elif line in ('', 'report'):
+            print profiler.format_report()
+        else:
+            print "Usage: dbprofile start|stop|reset|report"
+            return
+        if profiler.enabled:
+            print "Query profiler is running"
+        else:
+            print "Query profiler is stopped"
+
     @run_in_event_loop
     def do_testdialog(self, line):
         """testdialog -- Tests the cli dialog system."""
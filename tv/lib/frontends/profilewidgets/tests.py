@@ -249,7 +249,8 @@ class ProfileItemView(ProfiledCode):
         retval = []
         for x in xrange(count):
             item_info = messages.ItemInfo.__new__(messages.ItemInfo)
-            item_info.__dict__ = item_info_template.copy()
+            for name, value in item_info_template.iteritems():
+                setattr(item_info, name, value)
             self.mutate_item(item_info)
             item_info.id = self.id_counter.next()
             retval.append(item_info)
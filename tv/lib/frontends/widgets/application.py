@@ -49,6 +49,7 @@ from miro import config
 from miro import crashreport
 from miro import prefs
 from miro import feed
+from miro import feedupdate
 from miro.infoupdater import InfoUpdater
 from miro import startup
 from miro import signals
@@ -109,6 +110,8 @@ class Application:
         self.download_count = 0
         self.paused_count = 0
         self.unwatched_count = 0
+        # are we logging FeedUpdateStatsChanged messages? (see the Dev menu)
+        self.tracking_feed_update_stats = False
         app.frontend_config_watcher = config.ConfigWatcher(call_on_ui_thread)
         self.crash_reports_to_handle = []
         app.widget_state = WidgetStateStore()
@@ -1129,6 +1132,14 @@ class Application:
     def force_feedparser_processing(self):
         messages.ForceFeedparserProcessing().send_to_backend()
 
+    def toggle_feed_update_stats(self):
+        """Dev method: start/stop logging the feed update queue stats."""
+        if self.tracking_feed_update_stats:
+            messages.StopTrackingFeedUpdateStats().send_to_backend()
+        else:
+            messages.TrackFeedUpdateStats().send_to_backend()
+        self.tracking_feed_update_stats = not self.tracking_feed_update_stats
+
     def _printout_memory_stats(self, title):
         # base_classes is a list of base classes that we care about.  If you
         # want to check memory usage for a different class, add it to the
@@ -1583,6 +1594,9 @@ class WidgetsMessageHandler(messages.MessageHandler):
     def handle_items_changed(self, message):
         app.info_updater.handle_items_changed(message)
 
+    def handle_item_search_results(self, message):
+        app.info_updater.handle_item_search_results(message)
+
     def handle_download_count_changed(self, message):
         app.widgetapp.download_count = message.count
         library_tab_list = app.tabs['library']
@@ -1608,6 +1622,14 @@ class WidgetsMessageHandler(messages.MessageHandler):
         app.widgetapp.unwatched_count = message.count
         app.widgetapp.handle_unwatched_count_changed()
 
+    def handle_feed_update_stats_changed(self, message):
+        if not app.widgetapp.tracking_feed_update_stats:
+            # sent before the backend got StopTrackingFeedUpdateStats
+            return
+        logging.info(feedupdate.format_stats(message.queue_depth,
+                message.updating_count, message.host_stats,
+                message.bodies_skipped, message.entries_skipped))
+
     def handle_conversions_count_changed(self, message):
         library_tab_list = app.tabs['library']
         library_tab_list.update_converting_count(message.running_count,
@@ -115,7 +115,7 @@ class ItemListTracker(signals.SignalEmitter):
         self.item_list = itemlist.ItemList()
         self.id = id_
         self.is_tracking = False
-        self.search_filter = SearchFilter()
+        self.search_filter = SearchFilter(self._send_search_message)
         self.saw_initial_list = False
 
     def connect(self, name, func, *extra_args):
@@ -148,6 +148,8 @@ class ItemListTracker(signals.SignalEmitter):
                 self.on_item_list)
         app.info_updater.item_changed_callbacks.add(self.type, self.id,
                 self.on_items_changed)
+        app.info_updater.item_search_callbacks.add(self.type, self.id,
+                self.on_item_search_results)
         self.is_tracking = True
 
     def _send_track_items_message(self):
@@ -163,8 +165,13 @@ class ItemListTracker(signals.SignalEmitter):
                 self.on_item_list)
         app.info_updater.item_changed_callbacks.remove(self.type, self.id,
                 self.on_items_changed)
+        app.info_updater.item_search_callbacks.remove(self.type, self.id,
+                self.on_item_search_results)
         self.is_tracking = False
 
+    def _send_search_message(self, query):
+        messages.SearchItems(self.type, self.id, query).send_to_backend()
+
     def on_item_list(self, message):
         self.add_initial_items(message.items)
 
@@ -201,6 +208,18 @@ class ItemListTracker(signals.SignalEmitter):
 
     def set_search(self, query):
         added, removed = self.search_filter.set_search(query)
+        self._update_search_matches(added, removed)
+
+    def on_item_search_results(self, message):
+        if message.ranked:
+            # only the top matches, we need all of them to filter our list
+            return
+        results = self.search_filter.handle_search_results(message.query,
+                message.ids)
+        if results is not None:
+            self._update_search_matches(*results)
+
+    def _update_search_matches(self, added, removed):
         self.emit("items-will-change", added, [], removed)
         self.item_list.add_items(added)
         self.item_list.remove_items(removed)
@@ -247,11 +266,27 @@ class ManualItemListTracker(ItemListTracker):
 
 class SearchFilter(object):
     """SearchFilter filter out non-matching items from item lists
+
+    Lists of items from the database are searched using the backend's search
+    index.  We call send_search() with the query, which should send a
+    SearchItems message.  Until handle_search_results() gets the results, the
+    database items that matched before keep matching.  Single items that get
+    added or changed are checked with search.item_matches().
+
+    We only index other items (from devices, shares, etc) ourselves.
     """
-    def __init__(self):
+    def __init__(self, send_search=None):
+        """Create a SearchFilter
+
+        :param send_search: function to send a search query to the backend.
+            If None, we index all items ourselves.
+        """
         self.searcher = search.ItemSearcher()
+        self.send_search = send_search
         self.query = ''
         self.all_items = {} # maps id to item info
+        self.indexed_ids = set() # ids for items the backend searches
+        self.index_matches = set() # ids in indexed_ids that match query
         self.matching_ids = set()
         self._pending_changes = collections.deque()
         self._index_pass_scheduled = False
@@ -273,8 +308,9 @@ class SearchFilter(object):
             self._schedule_indexing()
             return items
         self._ensure_index_ready()
-        self._add_items(items)
-        self.matching_ids = self.searcher.search(self.query)
+        self._add_items(items, check_index_matches=False)
+        self._send_search()
+        self.matching_ids = self._search(self.query)
         return [i for i in items if i.id in self.matching_ids]
 
     def filter_changes(self, added, changed, removed):
@@ -298,7 +334,7 @@ class SearchFilter(object):
         self._update_items(changed)
         self._remove_ids(removed)
 
-        matches = self.searcher.search(self.query)
+        matches = self._search(self.query)
         old_matches = self.matching_ids
 
         added_filtered = [i for i in added if i.id in matches]
@@ -324,21 +360,72 @@ class SearchFilter(object):
         """
         self._ensure_index_ready()
         self.query = query
-        matches = self.searcher.search(self.query)
+        if query:
+            # keep the current matches until we get the search results
+            self.index_matches.intersection_update(self.matching_ids)
+            self._send_search()
+        else:
+            self.index_matches = set(self.indexed_ids)
+        return self._update_matches()
+
+    def handle_search_results(self, query, ids):
+        """Handle the results of a search that we sent to the backend.
+
+        :param query: search query that the results are for
+        :param ids: ids of the database items that match query
+
+        :returns: (added, removed) based on the results, or None if they are
+            for an old search
+        """
+        if query != self.query or not query:
+            return None
+        self.index_matches = self.indexed_ids.intersection(ids)
+        return self._update_matches()
+
+    def _update_matches(self):
+        matches = self._search(self.query)
         added = matches - self.matching_ids
         removed = self.matching_ids - matches
         self.matching_ids = matches
         added_infos = [self.all_items[id_] for id_ in added]
         return added_infos, removed
 
-    def _add_items(self, items):
+    def _search(self, query):
+        matches = self.searcher.search(query)
+        matches.update(self.index_matches)
+        return matches
+
+    def _send_search(self):
+        if self.query and self.indexed_ids:
+            self.send_search(self.query)
+
+    def _uses_search_index(self, item):
+        return (self.send_search is not None and
+                item.source_type == 'database')
+
+    def _check_index_match(self, item):
+        if not self.query or search.item_matches(item, self.query):
+            self.index_matches.add(item.id)
+        else:
+            self.index_matches.discard(item.id)
+
+    def _add_items(self, items, check_index_matches=True):
         for item in items:
             self.all_items[item.id] = item
-            self.searcher.add_item(item)
+            if self._uses_search_index(item):
+                self.indexed_ids.add(item.id)
+                if check_index_matches:
+                    self._check_index_match(item)
+            else:
+                self.searcher.add_item(item)
 
     def _update_items(self, items):
         for item in items:
             self.all_items[item.id] = item
+            if self._uses_search_index(item):
+                self.indexed_ids.add(item.id)
+                self._check_index_match(item)
+                continue
             try:
                 self.searcher.update_item(item)
             except KeyError:
@@ -353,6 +440,10 @@ class SearchFilter(object):
     def _remove_ids(self, id_list):
         for id_ in id_list:
             del self.all_items[id_]
+            if id_ in self.indexed_ids:
+                self.indexed_ids.remove(id_)
+                self.index_matches.discard(id_)
+                continue
             try:
                 self.searcher.remove_item(id_)
             except KeyError:
@@ -369,7 +460,7 @@ class SearchFilter(object):
                 self._add_items(added)
                 self._update_items(changed)
                 self._remove_ids(removed)
-            self.matching_ids = self.searcher.search(self.query)
+            self.matching_ids = self._search(self.query)
 
     def _schedule_indexing(self):
         if not self._index_pass_scheduled:
@@ -388,4 +479,4 @@ class SearchFilter(object):
         if len(self._pending_changes) > 0:
             self._schedule_indexing()
         else:
-            self.matching_ids = self.searcher.search(self.query)
+            self.matching_ids = self._search(self.query)
@@ -277,6 +277,10 @@ def get_app_menu():
                 MenuItem(_("Force Feedparser Processing"),
                     "ForceFeedparserProcessing"),
                 MenuItem(_("Clog Backend"), "ClogBackend"),
+                MenuItem(_("Toggle Query Profiler"), "ToggleQueryProfiler"),
+                MenuItem(_("Dump Query Profile"), "DumpQueryProfile"),
+                MenuItem(_("Toggle Feed Update Stats"),
+                         "ToggleFeedUpdateStats"),
                 MenuItem(_("Run Echoprint"), "RunEchoprint"),
                 MenuItem(_("Run ENMFP"), "RunENMFP"),
                 MenuItem(_("Force Main DB Save Error"),
@@ -592,6 +596,18 @@ def on_force_feedparser_processing():
 def on_clog_backend():
     app.widgetapp.clog_backend()
 
+@action_handler("ToggleQueryProfiler")
+def on_toggle_query_profiler():
+    messages.ToggleQueryProfiler().send_to_backend()
+
+@action_handler("DumpQueryProfile")
+def on_dump_query_profile():
+    messages.DumpQueryProfile().send_to_backend()
+
+@action_handler("ToggleFeedUpdateStats")
+def on_toggle_feed_update_stats():
+    app.widgetapp.toggle_feed_update_stats()
+
 @action_handler("RunEchoprint")
 def on_run_echoprint():
     print 'Running echoprint'
@@ -35,6 +35,7 @@ The main ways this module used is grab_url() and grab_headers().  grab_url
 fetches a HTTP or HTTPS url, while grab_headers only fetches the headers.
 """
 
+import collections
 import logging
 import os
 import stat
@@ -67,6 +68,12 @@ except:
 
 REDIRECTION_LIMIT = 10
 MAX_AUTH_ATTEMPTS = 5
+# How many unused libcurl handles CurlHandlePool keeps around
+MAX_IDLE_HANDLES_PER_HOST = 4
+MAX_IDLE_HANDLES = 32
+# Data that handles from CurlHandlePool share with each other
+SHARED_CURL_DATA = ('LOCK_DATA_DNS', 'LOCK_DATA_SSL_SESSION',
+        'LOCK_DATA_COOKIE')
 
 _logged_noproxy_error = False
 
@@ -237,22 +244,29 @@ class TransferOptions(object):
             self.invalid_url = True
             return
 
-    def build_handle(self, out_headers):
+    def build_handle(self, out_headers, handle_pool=None):
         """Build a libCURL handle.  This should only be called inside the
         LibCURLManager thread.
+
+        :param out_headers: dict of headers to send
+        :param handle_pool: CurlHandlePool to get the handle from.  If None,
+            we create a new handle.
         """
         if self.etag is not None:
             out_headers['etag'] = self.etag
         if self.modified is not None:
             out_headers['If-Modified-Since'] = self.modified
 
-        handle = self._init_handle()
+        handle = self._init_handle(handle_pool)
         self._setup_post(handle, out_headers)
         self._setup_headers(handle, out_headers)
         return handle
 
-    def _init_handle(self):
-        handle = pycurl.Curl()
+    def _init_handle(self, handle_pool):
+        if handle_pool is not None:
+            handle = handle_pool.get_handle(self.scheme, self.host)
+        else:
+            handle = pycurl.Curl()
         handle.setopt(pycurl.USERAGENT, user_agent())
         handle.setopt(pycurl.FOLLOWLOCATION, 1)
         handle.setopt(pycurl.MAXREDIRS, REDIRECTION_LIMIT)
@@ -451,11 +465,11 @@ class CurlTransfer(object):
                 self.proxy_auth = auth
             self._send_new_request()
 
-    def build_handle(self):
+    def build_handle(self, handle_pool=None):
         """Build a libCURL handle.  This should only be called inside the
         LibCURLManager thread.
         """
-        self.handle = self.options.build_handle(self.out_headers)
+        self.handle = self.options.build_handle(self.out_headers, handle_pool)
         # don't authenticate SSL certificates see #15180
         self.handle.setopt(pycurl.SSL_VERIFYPEER, 0)
 
@@ -849,6 +863,113 @@ class TransferStats(object):
         self.initial_size = 0
         self.status_code = None
 
+def _make_curl_share():
+    """Create a CurlShare object for CurlHandlePool.
+
+    :returns: CurlShare object, or None if pycurl doesn't support them
+    """
+    try:
+        share = pycurl.CurlShare()
+    except AttributeError:
+        logging.warn("pycurl.CurlShare doesn't exist")
+        return None
+    for name in SHARED_CURL_DATA:
+        lock_data = getattr(pycurl, name, None)
+        if lock_data is None:
+            continue
+        try:
+            share.setopt(pycurl.SH_SHARE, lock_data)
+        except pycurl.error, e:
+            logging.warn("Can't share %s between libcurl handles: %s",
+                    name, e)
+    return share
+
+class CurlHandlePool(object):
+    """Reuses libcurl handles between transfers.
+
+    Creating a new handle for each transfer means that libcurl throws away
+    its SSL session cache and has to do a full TLS handshake for every
+    request.  Instead, we keep finished handles around, grouped by the
+    scheme/host they were used for, and hand them out again when another
+    transfer for that host starts.
+
+    All handles are also attached to a CurlShare object, so that DNS
+    lookups, SSL sessions and cookies are shared between them.  Combined
+    with the connection cache in the multi handle, this lets keep-alive
+    connections get reused across transfers.
+
+    This class should only be used inside the LibCURLManager thread.
+    """
+    def __init__(self, max_idle_per_host=MAX_IDLE_HANDLES_PER_HOST,
+            max_idle=MAX_IDLE_HANDLES):
+        self.max_idle_per_host = max_idle_per_host
+        self.max_idle = max_idle
+        self.share = _make_curl_share()
+        # maps (scheme, host) -> list of idle handles.  The least recently
+        # used hosts come first.
+        self.idle_handles = collections.OrderedDict()
+        self.idle_count = 0
+        self.created_count = 0
+        self.reused_count = 0
+
+    def get_handle(self, scheme, host):
+        """Get a handle to use for a transfer.
+
+        The handle will have all of its options reset, except for the share
+        object.
+        """
+        key = (scheme, host)
+        try:
+            handles = self.idle_handles[key]
+        except KeyError:
+            handle = pycurl.Curl()
+            self.created_count += 1
+        else:
+            handle = handles.pop()
+            if not handles:
+                del self.idle_handles[key]
+            self.idle_count -= 1
+            handle.reset()
+            self.reused_count += 1
+        if self.share is not None:
+            handle.setopt(pycurl.SHARE, self.share)
+        return handle
+
+    def release_handle(self, scheme, host, handle):
+        """Give back a handle from get_handle() once its transfer is done.
+
+        The handle must not be part of a CurlMulti object anymore.
+        """
+        key = (scheme, host)
+        handles = self.idle_handles.pop(key, [])
+        if len(handles) >= self.max_idle_per_host:
+            handle.close()
+        else:
+            handles.append(handle)
+            self.idle_count += 1
+        if handles:
+            # re-insert the list to mark the host as most recently used
+            self.idle_handles[key] = handles
+        while self.idle_count > self.max_idle:
+            self._close_least_recent_host()
+
+    def _close_least_recent_host(self):
+        key, handles = self.idle_handles.popitem(last=False)
+        for handle in handles:
+            handle.close()
+        self.idle_count -= len(handles)
+
+    def close(self):
+        """Close all idle handles and the share object."""
+        for handles in self.idle_handles.values():
+            for handle in handles:
+                handle.close()
+        self.idle_handles.clear()
+        self.idle_count = 0
+        if self.share is not None:
+            self.share.close()
+            self.share = None
+
 class LibCURLManager(eventloop.SimpleEventLoop):
     """Manage a set of CurlTransfers.
 
@@ -857,11 +978,13 @@ class LibCURLManager(eventloop.SimpleEventLoop):
       - Runs a thread for pycurl to use
       - Manages the libcurl multi object
       - Handles adding/removing CurlTransfers objects
+      - Reuses libcurl handles with a CurlHandlePool
     """
 
     def __init__(self):
         eventloop.SimpleEventLoop.__init__(self)
         self.multi = pycurl.CurlMulti()
+        self.handle_pool = CurlHandlePool()
         self.transfer_map = {}
         self.transfers_to_add = Queue.Queue()
         self.transfers_to_remove = Queue.Queue()
@@ -883,6 +1006,7 @@ class LibCURLManager(eventloop.SimpleEventLoop):
         for transfer in self.transfer_map.values():
             self.multi.remove_handle(transfer.handle)
             transfer.handle.close()
+        self.handle_pool.close()
         self.multi.close()
 
     def add_transfer(self, transfer):
@@ -932,7 +1056,7 @@ class LibCURLManager(eventloop.SimpleEventLoop):
             except Queue.Empty:
                 break
             try:
-                transfer.build_handle()
+                transfer.build_handle(self.handle_pool)
             except NetworkError, e:
                 transfer.call_errback(e)
                 continue
@@ -945,22 +1069,32 @@ class LibCURLManager(eventloop.SimpleEventLoop):
             except Queue.Empty:
                 break
             transfer.on_cancel(remove_file)
-            try:
-                del self.transfer_map[transfer.handle]
-            except KeyError:
+            # If the transfer already finished, its handle may have been
+            # given to another transfer, so check that it's still ours.
+            if self.transfer_map.get(transfer.handle) is not transfer:
                 continue
+            del self.transfer_map[transfer.handle]
             self.multi.remove_handle(transfer.handle)
+            self.release_handle(transfer, transfer.handle)
 
     def check_finished(self):
         queued, finished, errors = self.multi.info_read()
         for handle in finished:
             try:
-                self.pop_transfer(handle).on_finished()
+                transfer = self.pop_transfer(handle)
+                try:
+                    transfer.on_finished()
+                finally:
+                    self.release_handle(transfer, handle)
             except StandardError:
                 logging.stacktrace("Error calling on_finished()")
         for handle, code, message in errors:
             try:
-                self.pop_transfer(handle).on_error(code, handle)
+                transfer = self.pop_transfer(handle)
+                try:
+                    transfer.on_error(code, handle)
+                finally:
+                    self.release_handle(transfer, handle)
             except StandardError:
                 logging.stacktrace("Error calling on_error()")
 
@@ -969,6 +1103,10 @@ class LibCURLManager(eventloop.SimpleEventLoop):
         self.multi.remove_handle(handle)
         return transfer
 
+    def release_handle(self, transfer, handle):
+        self.handle_pool.release_handle(transfer.options.scheme,
+                transfer.options.host, handle)
+
 class HTTPClient(object):
     """HTTP client for a grab_url call.
 
@@ -0,0 +1,411 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.indexadvisor`` -- Find view queries that scan whole tables.
+
+IndexAdvisor runs EXPLAIN QUERY PLAN for the queries that a view and its
+ViewTracker send to SQLite and looks for tables that get scanned.  For each
+scan, it looks at the view's WHERE clause and joins and proposes a
+composite index that SQLite could use instead.
+
+The WHERE clause analysis is simple: only the top-level terms joined by AND
+are considered.  Equality tests (``=``, ``IN``, ``IS NULL``) on a column go
+first in the proposed index, followed by at most one range test (``<``,
+``>``, ``IS NOT NULL``).  Terms with OR, NOT or bare boolean columns can't
+use an index and are ignored.  For joined tables, the column used in the
+join is treated as an equality test.
+
+Proposals are just that.  If an index is worth having, it should be added
+to the schema and created in a databaseupgrade step.
+"""
+
+import inspect
+import re
+
+_conjunct_split_re = re.compile(r"'(?:[^']|'')*'|\(|\)|\bAND\b",
+        re.IGNORECASE)
+_column = r'(?:(?P<qualifier>\w+)\.)?(?P<column>\w+)'
+_value = r"(?:\?|'(?:[^']|'')*'|-?\d+(?:\.\d+)?)"
+_equality_res = [re.compile(r'^%s\s*(?:==|=)\s*%s$' % (_column, _value)),
+        re.compile(r'^%s\s+IS\s+NULL$' % _column, re.IGNORECASE),
+        re.compile(r'^%s\s+IN\s*\((?!\s*SELECT\b)[^()]*\)$' % _column,
+            re.IGNORECASE),
+]
+_range_res = [re.compile(r'^%s\s*(?:<|<=|>|>=)\s*%s$' % (_column, _value)),
+        re.compile(r'^%s\s+IS\s+NOT\s+NULL$' % _column, re.IGNORECASE),
+]
+_join_table_re = re.compile(
+        r'^(?P<table>\w+)(?:\s+(?:AS\s+)?(?P<alias>\w+))?$', re.IGNORECASE)
+_join_on_re = re.compile(r'^(?:(\w+)\.)?(\w+)\s*==?\s*(?:(\w+)\.)?(\w+)$')
+_scan_re = re.compile(r'^SCAN (?:TABLE )?(?P<name>\w+)'
+        r'(?: AS (?P<alias>\w+))?', re.IGNORECASE)
+_search_re = re.compile(r'^SEARCH (?:TABLE )?(?P<name>\w+)'
+        r'(?: AS (?P<alias>\w+))? USING (?:COVERING )?INDEX \w+ '
+        r'\((?P<terms>.*)\)', re.IGNORECASE)
+_loop_re = re.compile(r'^(?:SCAN|SEARCH) ', re.IGNORECASE)
+_order_by_re = re.compile(r'^%s(?:\s+(?:ASC|DESC))?$' % _column,
+        re.IGNORECASE)
+_temp_b_tree_re = re.compile(r'^USE TEMP B-TREE FOR (?:RIGHT PART OF )?'
+        r'ORDER BY', re.IGNORECASE)
+
+def split_conjuncts(where):
+    """Split a WHERE clause into its top-level terms joined by AND.
+
+    Outer parentheses around each term are stripped.
+    """
+    terms = []
+    depth = start = 0
+    for m in _conjunct_split_re.finditer(where):
+        token = m.group(0)
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+        elif token.upper() == 'AND' and depth == 0:
+            terms.append(where[start:m.start()])
+            start = m.end()
+    terms.append(where[start:])
+    return [_strip_parens(term.strip()) for term in terms if term.strip()]
+
+def _strip_parens(term):
+    while term.startswith('(') and term.endswith(')'):
+        depth = 0
+        for i, c in enumerate(term):
+            if c == '(':
+                depth += 1
+            elif c == ')':
+                depth -= 1
+                if depth == 0 and i < len(term) - 1:
+                    # the first paren closes before the end of the term
+                    return term
+        term = term[1:-1].strip()
+    return term
+
+class ViewQuery(object):
+    """A query that a view or its tracker runs.
+
+    Attributes match the arguments to LiveStorage.query_ids(), plus
+    description, which says where the query came from.
+    """
+    def __init__(self, description, table_name, where, values=None,
+            order_by=None, joins=None, limit=None):
+        self.description = description
+        self.table_name = table_name
+        self.where = where
+        self.values = values
+        self.order_by = order_by
+        self.joins = joins
+        self.limit = limit
+
+def find_views(klass, argument_values):
+    """Find the views that a DDBObject class defines.
+
+    Views are the classmethods whose names end in ``_view``.
+
+    :param argument_values: dict mapping the argument names that the view
+        methods take to a list of values to call them with
+    :returns: list of (description, View) tuples
+    """
+    views = []
+    for name in dir(klass):
+        if not name.endswith('_view') or name == 'make_view':
+            continue
+        method = getattr(klass, name)
+        if not inspect.ismethod(method) or method.im_self is not klass:
+            continue # not a classmethod
+        arg_names = inspect.getargspec(method.im_func)[0][1:]
+        arg_lists = [[]]
+        for arg_name in arg_names:
+            arg_lists = [args + [value] for args in arg_lists
+                    for value in argument_values[arg_name]]
+        for args in arg_lists:
+            description = '%s.%s(%s)' % (klass.__name__, name,
+                    ', '.join(repr(arg) for arg in args))
+            views.append((description, method(*args)))
+    return views
+
+def view_queries(description, view):
+    """Get the queries that a view and its ViewTracker run.
+
+    This is the view's own query, plus the queries ViewTracker uses to check
+    if one or several objects are in the view when it can't compile the WHERE
+    clause to python.
+    """
+    queries = [ViewQuery(description, view.table_name, view.where,
+        view.values, view.order_by, view.joins, view.limit)]
+    for check, id_test, id_values in (('single', '%s.id = ?', (0,)),
+            ('batch', '%s.id IN (?, ?)', (0, 0))):
+        where = id_test % view.table_name
+        if view.where:
+            where += ' AND (%s)' % view.where
+        values = id_values + tuple(view.values or ())
+        queries.append(ViewQuery('%s tracker %s check' % (description, check),
+            view.table_name, where, values, joins=view.joins))
+    return queries
+
+class QueryAdvice(object):
+    """The results of checking a ViewQuery.
+
+    Attributes:
+
+    - query -- ViewQuery we checked
+    - plan -- EXPLAIN QUERY PLAN detail lines
+    - scans -- list of table names that the plan scans
+    - proposals -- list of (table_name, columns) indexes that we think would
+      help
+    - notes -- list of strings explaining scans that we couldn't propose an
+      index for
+    """
+    def __init__(self, query, plan):
+        self.query = query
+        self.plan = plan
+        self.scans = []
+        self.proposals = []
+        self.notes = []
+
+class _TableTerms(object):
+    """Terms from a query that an index on one table could use."""
+    def __init__(self, table):
+        self.table = table
+        self.join_columns = []
+        self.equality_columns = []
+        self.range_columns = []
+        self.order_column = None
+
+    def index_columns(self, outer, sorts):
+        """Get the columns for an index that would help a query.
+
+        :param outer: is this table the outer loop of the query?  If not,
+            the join columns can be used to look up rows.
+        :param sorts: does the query sort its results with a temp b-tree?
+            If so, the ORDER BY column of the outer table can be added.
+        """
+        columns = []
+        if not outer:
+            columns.extend(self.join_columns)
+        for column in self.equality_columns:
+            if column not in columns:
+                columns.append(column)
+        if self.range_columns:
+            columns.append(self.range_columns[0])
+        elif outer and sorts and self.order_column is not None:
+            columns.append(self.order_column)
+        return tuple(columns)
+
+class IndexAdvisor(object):
+    """Check view queries for full table scans and propose indexes.
+
+    Attributes:
+
+    - advice -- list of QueryAdvice for each query we checked
+    """
+    def __init__(self, storage, object_schemas):
+        """Create an IndexAdvisor.
+
+        :param storage: LiveStorage to run EXPLAIN QUERY PLAN with
+        :param object_schemas: list of ObjectSchemas in the database
+        """
+        self.storage = storage
+        self.columns = {}
+        self.indexes = {}
+        for schema in object_schemas:
+            self.columns[schema.table_name] = set(f[0] for f in schema.fields)
+            self.indexes[schema.table_name] = list(schema.indexes)
+        self.advice = []
+
+    def check_views(self, klass, argument_values):
+        """Check all the views that a class defines.
+
+        See find_views() for argument_values.
+        """
+        for description, view in find_views(klass, argument_values):
+            for query in view_queries(description, view):
+                self.check_query(query)
+
+    def check_query(self, query):
+        """Check a ViewQuery and add a QueryAdvice for it to self.advice."""
+        plan = self.storage.explain_query_ids(query.table_name, query.where,
+                query.values, query.order_by, query.joins, query.limit)
+        advice = QueryAdvice(query, plan)
+        tables = {query.table_name: _TableTerms(query.table_name)}
+        for join_table, join_on in (query.joins or {}).items():
+            self._add_join(join_table, join_on, tables)
+        if query.where:
+            for term in split_conjuncts(query.where):
+                self._add_where_term(term, query.table_name, tables)
+        if query.order_by:
+            self._add_order_by(query.order_by, query.table_name, tables)
+        sorts = [line for line in plan if _temp_b_tree_re.match(line)]
+        outer = True
+        for line in plan:
+            if not _loop_re.match(line):
+                continue
+            m = _scan_re.match(line) or _search_re.match(line)
+            if m is None:
+                # primary key lookup
+                outer = False
+                continue
+            name = m.group('alias') or m.group('name')
+            terms = tables.get(name)
+            if terms is None:
+                # table from a subquery
+                terms = _TableTerms(name)
+            if m.re is _scan_re:
+                self._advise_scan(advice, terms, outer, sorts)
+            elif name == query.table_name:
+                used_count = len(re.split(r'\bAND\b', m.group('terms')))
+                self._advise_search(advice, terms, outer, sorts,
+                        used_count)
+            outer = False
+        self.advice.append(advice)
+        return advice
+
+    def _add_join(self, join_table, join_on, tables):
+        m = _join_table_re.match(join_table.strip())
+        if m is None:
+            return
+        terms = _TableTerms(m.group('table'))
+        alias = m.group('alias') or terms.table
+        tables[alias] = terms
+        m = _join_on_re.match(join_on.strip())
+        if m is None:
+            return
+        for qualifier, column in ((m.group(1), m.group(2)),
+                (m.group(3), m.group(4))):
+            if qualifier == alias and column != 'id':
+                terms.join_columns.append(column)
+
+    def _find_table_terms(self, qualifier, column, main_table, tables):
+        if qualifier is not None:
+            return tables.get(qualifier)
+        # unqualified columns belong to the main table if it has them,
+        # otherwise to the joined table that does
+        if column in self.columns.get(main_table, ()):
+            return tables[main_table]
+        for terms in tables.values():
+            if column in self.columns.get(terms.table, ()):
+                return terms
+        return None
+
+    def _add_where_term(self, term, main_table, tables):
+        for regexes, is_range in ((_equality_res, False), (_range_res, True)):
+            for regex in regexes:
+                m = regex.match(term)
+                if m is None:
+                    continue
+                column = m.group('column')
+                terms = self._find_table_terms(m.group('qualifier'), column,
+                        main_table, tables)
+                if terms is None:
+                    return
+                if is_range:
+                    columns = terms.range_columns
+                else:
+                    columns = terms.equality_columns
+                if column not in columns:
+                    columns.append(column)
+                return
+
+    def _add_order_by(self, order_by, main_table, tables):
+        m = _order_by_re.match(order_by.strip())
+        if m is None:
+            return
+        terms = self._find_table_terms(m.group('qualifier'),
+                m.group('column'), main_table, tables)
+        if terms is not None:
+            terms.order_column = m.group('column')
+
+    def _existing_index(self, table, columns):
+        """Find an index that starts with columns."""
+        for name, index_columns in self.indexes.get(table, ()):
+            if tuple(index_columns[:len(columns)]) == columns:
+                return name
+        return None
+
+    def _advise_scan(self, advice, terms, outer, sorts):
+        advice.scans.append(terms.table)
+        columns = terms.index_columns(outer, sorts)
+        if not columns:
+            advice.notes.append("%s: no indexable terms" % terms.table)
+            return
+        existing = self._existing_index(terms.table, columns)
+        if existing is not None:
+            advice.notes.append("%s: SQLite chose not to use %s" %
+                    (terms.table, existing))
+            return
+        advice.proposals.append((terms.table, columns))
+
+    def _advise_search(self, advice, terms, outer, sorts, used_count):
+        columns = terms.index_columns(outer, sorts)
+        if (len(columns) > used_count and
+                self._existing_index(terms.table, columns) is None):
+            advice.proposals.append((terms.table, columns))
+
+    def proposed_indexes(self):
+        """Get the indexes that we propose.
+
+        :returns: dict mapping (table_name, columns) to the list of
+            descriptions of queries that would use it
+        """
+        proposed = {}
+        for advice in self.advice:
+            for proposal in advice.proposals:
+                proposed.setdefault(proposal, []).append(
+                        advice.query.description)
+        # an index also serves queries that would use a prefix of it
+        for table, columns in proposed.keys():
+            for i in xrange(1, len(columns)):
+                prefix = (table, columns[:i])
+                if prefix in proposed:
+                    proposed[table, columns].extend(proposed.pop(prefix))
+        return proposed
+
+    def format_report(self):
+        """Get a text report of the scans and proposed indexes."""
+        lines = ["Checked %d queries, %d do full table scans" % (
+            len(self.advice), len([a for a in self.advice if a.scans]))]
+        for advice in self.advice:
+            if not advice.scans and not advice.proposals:
+                continue
+            lines.append('')
+            lines.append(advice.query.description)
+            for line in advice.plan:
+                lines.append("    %s" % line)
+            for note in advice.notes:
+                lines.append("    note: %s" % note)
+        proposed = self.proposed_indexes()
+        if proposed:
+            lines.append('')
+            lines.append("Proposed indexes:")
+            for (table, columns), descriptions in sorted(proposed.items()):
+                lines.append("  %s (%s) -- used by %d queries" % (table,
+                    ', '.join(columns), len(descriptions)))
+                for description in sorted(set(descriptions)):
+                    lines.append("      %s" % description)
+        return '\n'.join(lines)
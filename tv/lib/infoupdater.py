@@ -84,9 +84,9 @@ class InfoUpdaterCallbackList(object):
 class InfoUpdater(signals.SignalEmitter):
     """Track channel/item updates from the backend.
 
-    To track item updates, use the item_list_callbacks and
-    item_changed_callbacks attributes, both are instances of
-    InfoUpdaterCallbackList.  To track tab updates, connect to one of the
+    To track item updates, use the item_list_callbacks,
+    item_changed_callbacks and item_search_callbacks attributes, all are
+    instances of InfoUpdaterCallbackList.  To track tab updates, connect to one of the
     signals below.
 
     Signals:
@@ -110,6 +110,7 @@ class InfoUpdater(signals.SignalEmitter):
 
         self.item_list_callbacks = InfoUpdaterCallbackList()
         self.item_changed_callbacks = InfoUpdaterCallbackList()
+        self.item_search_callbacks = InfoUpdaterCallbackList()
 
     def handle_items_changed(self, message):
         callback_list = self.item_changed_callbacks
@@ -121,6 +122,11 @@ class InfoUpdater(signals.SignalEmitter):
         for callback in callback_list.get(message.type, message.id):
             callback(message)
 
+    def handle_item_search_results(self, message):
+        callback_list = self.item_search_callbacks
+        for callback in callback_list.get(message.type, message.id):
+            callback(message)
+
     def handle_tabs_changed(self, message):
         if message.type == 'feed':
             signal_start = 'feeds'
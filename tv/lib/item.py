@@ -410,6 +410,10 @@ class Item(DDBObject, iconcache.IconCacheOwnerMixin):
 
     ICON_CACHE_VITAL = False
 
+    # items can be dropped from memory and restored later, unless they have
+    # one of the flags from setup_common() set (see has_memory_state())
+    evictable = True
+
     # tweaked by the unittests to make things easier
     _allow_nonexistent_paths = False
 
@@ -455,6 +459,9 @@ class Item(DDBObject, iconcache.IconCacheOwnerMixin):
         self.creationTime = datetime.now()
         self._look_for_downloader()
         self.setup_common()
+        # restored items are already counted, since the counts come from the
+        # database
+        Item._path_count_tracker.add_item(self)
         self.split_item()
 
     def setup_restored(self):
@@ -472,13 +479,22 @@ class Item(DDBObject, iconcache.IconCacheOwnerMixin):
         self.expiring = None
         self.showMoreInfo = False
         self.playing = False
-        Item._path_count_tracker.add_item(self)
+
+    def has_memory_state(self):
+        # setup_common() resets these when an item is restored.  expiring is
+        # only a cache, so it's fine to lose it.
+        if self.in_db_init:
+            return False
+        return (self.playing or self.showMoreInfo or self.selected or
+                self.active)
 
     def after_setup_new(self):
         app.item_info_cache.item_created(self)
+        app.feed_counts.item_changed(self)
 
     def signal_change(self, needs_save=True, can_change_views=True):
         app.item_info_cache.item_changed(self)
+        app.feed_counts.item_changed(self)
         DDBObject.signal_change(self, needs_save, can_change_views)
 
     @classmethod
@@ -2015,6 +2031,7 @@ class Item(DDBObject, iconcache.IconCacheOwnerMixin):
         # need to call this after DDBObject.remove(), so that the item info is
         # there for ItemInfoFetcher to see.
         app.item_info_cache.item_removed(self)
+        app.feed_counts.item_removed(self)
 
     def setup_links(self):
         self.split_item()
@@ -2345,7 +2362,8 @@ class DeletedFileChecker(object):
     This class ensures that we only schedule one idle callback at a time.
     """
     def __init__(self):
-        # track items that we should call check_deleted for
+        # track ids of items that we should call check_deleted for.  We use
+        # ids so that items can be evicted from memory while they wait.
         self.items_to_check = set()
         # track if we have run_checks() scheduled as an idle callback
         self.check_scheduled = False
@@ -2353,7 +2371,7 @@ class DeletedFileChecker(object):
         self.started = False
 
     def schedule_check(self, item):
-        self.items_to_check.add(item)
+        self.items_to_check.add(item.id)
         self._ensure_run_checks_scheduled()
 
     def start_checks(self):
@@ -2390,9 +2408,14 @@ class DeletedFileChecker(object):
 
         app.bulk_sql_manager.start()
         try:
-            for item in items_this_pass:
-                if item.id_exists():
-                    item.check_deleted()
+            for id_ in items_this_pass:
+                try:
+                    item = app.db.get_obj_by_id(id_, Item)
+                except KeyError:
+                    # The item was removed, or evicted from memory.  In the
+                    # second case, we'll check it when it's restored.
+                    continue
+                item.check_deleted()
         finally:
             app.bulk_sql_manager.finish()
             if self.items_to_check:
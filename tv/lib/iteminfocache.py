@@ -46,17 +46,26 @@ The general strategy is to just dumbly pickle the data and if we notice any
 errors, or if the DB version changes, throw away the cache and rebuild.  We
 use a lot of direct SQL queries in this code, borrowing app.db's cursor.  This
 is slightly naughty, but results in fast peformance.
+
+There is also ColumnarItemInfoCache, which stores the ItemInfo data in a
+memory-mapped file (see columnarstore) and only builds ItemInfo objects when
+they are asked for.  This makes startup faster and uses less memory for large
+libraries.  The ITEM_INFO_CACHE_BACKEND pref selects which one we use.
 """
 
 import cPickle
 import itertools
 import logging
+import os
 
 from miro import app
+from miro import columnarstore
 from miro import dbupgradeprogress
 from miro import eventloop
 from miro import itemsource
+from miro import messages
 from miro import models
+from miro import prefs
 from miro import schema
 from miro import signals
 
@@ -73,21 +82,27 @@ class ItemInfoCache(signals.SignalEmitter):
 
     Signals:
         added (obj, item_info) -- an item info object was created
-        changed (obj, item_info) -- an item info object was updated
+        changed (obj, item_info, old_item_info) -- an item info object was
+                                                   updated
         removed (obj, item_info) -- an item info object was removed
     """
 
     # how often should we save cache data to the DB? (in seconds)
     SAVE_INTERVAL = 30
     VERSION_KEY = 'item_info_cache_db_version'
+    SAVE_TOKEN_KEY = 'item_info_cache_save_token'
 
     def __init__(self):
         signals.SignalEmitter.__init__(self)
         self.create_signal('added')
         self.create_signal('changed')
         self.create_signal('removed')
+        self.create_signal('saved')
         self.id_to_info = None
+        # token from our last save, see save()
+        self.save_token = None
         self.loaded = False
+        self.did_failsafe_load = False
 
     def load(self):
         # call _reset_changes() first.  This way if we throw an exception
@@ -105,6 +120,11 @@ class ItemInfoCache(signals.SignalEmitter):
             app.db.cursor.execute("DELETE FROM item_info_cache")
             did_failsafe_load = True
         app.db.set_variable(self.VERSION_KEY, self.version())
+        try:
+            self.save_token = app.db.get_variable(self.SAVE_TOKEN_KEY)
+        except KeyError:
+            self.save_token = None
+        self.did_failsafe_load = did_failsafe_load
         self._save_dc = None
         if did_failsafe_load:
             # Need to save the cache data we just created
@@ -119,18 +139,6 @@ class ItemInfoCache(signals.SignalEmitter):
     def _info_to_blob(self, info):
         return buffer(cPickle.dumps(info))
 
-    def _blob_to_info(self, blob):
-        info = cPickle.loads(str(blob))
-        # Download stats are no longer valid, reset them
-        info.leechers = None
-        info.seeders = None
-        info.up_rate = None
-        info.down_rate = None
-        if info.download_info is not None:
-            info.download_info.rate = 0
-            info.download_info.eta = 0
-        return info
-
     def _quick_load(self):
         """Load ItemInfos using the item_info_cache table
 
@@ -141,7 +149,7 @@ class ItemInfoCache(signals.SignalEmitter):
             quick_load_values = {}
             app.db.cursor.execute("SELECT id, pickle FROM item_info_cache")
             for row in app.db.cursor:
-                quick_load_values[row[0]] = self._blob_to_info(row[1])
+                quick_load_values[row[0]] = blob_to_info(row[1])
             # double check that we have the right number of rows
             if len(quick_load_values) == self._db_item_count():
                 self.id_to_info = quick_load_values
@@ -176,6 +184,25 @@ class ItemInfoCache(signals.SignalEmitter):
         self._infos_deleted = set()
 
     def save(self):
+        """Save our changes to the DB.
+
+        Each save stores a new token, which we pass to the saved signal.
+        Objects that save data built from our ItemInfos (like SearchIndex)
+        should save it along with the token from the signal.  If it doesn't
+        match save_token when they load, their data is out of sync with ours.
+        """
+        self._save_dc = None
+        # Unset the old token before saving.  If we crash before setting the
+        # new one, the saved data won't match anyone's token.
+        app.db.unset_variable(self.SAVE_TOKEN_KEY)
+        self.save_token = None
+        self._save_changes()
+        token = os.urandom(8).encode('hex')
+        app.db.set_variable(self.SAVE_TOKEN_KEY, token)
+        self.save_token = token
+        self.emit('saved', token)
+
+    def _save_changes(self):
         app.db.cursor.execute("BEGIN TRANSACTION")
         try:
             self._run_inserts()
@@ -254,6 +281,7 @@ class ItemInfoCache(signals.SignalEmitter):
         if item.id not in self.id_to_info:
             # signal_change() called inside setup_new(), just ignor it
             return
+        old_info = self.id_to_info[item.id]
         info = itemsource.DatabaseItemSource._item_info_for(item)
         self.id_to_info[item.id] = info
         if item.id in self._infos_added:
@@ -262,7 +290,7 @@ class ItemInfoCache(signals.SignalEmitter):
         else:
             self._infos_changed[item.id] = info
         self.schedule_save_to_db()
-        self.emit("changed", info)
+        self.emit("changed", info, old_info)
 
     def item_removed(self, item):
         if not self.loaded:
@@ -291,6 +319,311 @@ class ItemInfoCache(signals.SignalEmitter):
         self.schedule_save_to_db()
         self.emit("removed", info)
 
+class _LazyInfoMap(object):
+    """dict-like object that maps ids to ItemInfos stored in a ColumnarFile.
+
+    ItemInfo objects are only created the first time they are accessed.
+    After that, they (and any ItemInfos set by the ItemInfoCache) are stored
+    in a regular dict.
+    """
+    def __init__(self, columnar_file, info_from_state, infos=None):
+        if infos is None:
+            infos = {}
+        self._info_from_state = info_from_state
+        self._infos = infos
+        self.set_file(columnar_file)
+
+    def set_file(self, columnar_file):
+        """Switch to a new file.
+
+        All ItemInfos that haven't been created yet must be in the new file.
+        """
+        self.columnar_file = columnar_file
+        self._rows = {}
+        for row, id_ in enumerate(columnar_file.ids()):
+            if id_ not in self._infos:
+                self._rows[id_] = row
+
+    def close_file(self):
+        self.columnar_file.close()
+
+    def reopen_file(self, columnar_file):
+        """Switch back to the file we closed with close_file()."""
+        self.columnar_file = columnar_file
+
+    def __getitem__(self, id_):
+        try:
+            return self._infos[id_]
+        except KeyError:
+            row = self._rows.pop(id_)
+        state = self.columnar_file.get_row(row)
+        info = self._info_from_state(state)
+        self._infos[id_] = info
+        return info
+
+    def __setitem__(self, id_, info):
+        self._rows.pop(id_, None)
+        self._infos[id_] = info
+
+    def __delitem__(self, id_):
+        if id_ in self._infos:
+            del self._infos[id_]
+        else:
+            del self._rows[id_]
+
+    def __contains__(self, id_):
+        return id_ in self._infos or id_ in self._rows
+
+    def __len__(self):
+        return len(self._infos) + len(self._rows)
+
+    def __iter__(self):
+        return itertools.chain(self._infos.keys(), self._rows.keys())
+
+    def pop(self, id_):
+        info = self[id_]
+        del self._infos[id_]
+        return info
+
+    def values(self):
+        return [self[id_] for id_ in self]
+
+    def copy(self):
+        return dict((id_, self[id_]) for id_ in self)
+
+    def iterstates(self):
+        """Iterate through the pickle state of each ItemInfo.
+
+        Rows that we haven't created ItemInfos for are read straight from the
+        file.
+        """
+        for info in self._infos.itervalues():
+            yield info.__getstate__()
+        for row in self._rows.itervalues():
+            yield self.columnar_file.get_row(row)
+
+class ColumnarItemInfoCache(ItemInfoCache):
+    """ItemInfoCache that stores its data in a columnar file.
+
+    The file is written with columnarstore.write_file() and memory-mapped
+    when we load.  Changes since the file was written are saved to the
+    item_info_cache table, the same way ItemInfoCache saves them, with a NULL
+    pickle for removed items.  Once there are enough of them, we write a new
+    file with everything in it and empty the table.
+
+    Each new file gets a random token, which we also store in the database.
+    If the token in the file doesn't match the database we throw away the
+    file, since it's from a different database or we crashed before we could
+    store the token.
+    """
+
+    FILENAME = 'item_info_cache.dat'
+    TOKEN_KEY = 'item_info_cache_file_token'
+    # Write a new file once the table holds changes for more than this
+    # fraction of the items (or REWRITE_MIN_CHANGES, whichever is bigger).
+    REWRITE_FRACTION = 0.2
+    REWRITE_MIN_CHANGES = 1000
+
+    def __init__(self, path=None):
+        ItemInfoCache.__init__(self)
+        if path is None:
+            path = os.path.join(app.config.get(prefs.SUPPORT_DIRECTORY),
+                                self.FILENAME)
+        self.path = path
+        # ids that have a row in the item_info_cache table
+        self._changed_ids = set()
+        self._needs_rewrite = False
+
+    def _quick_load(self):
+        """Load ItemInfos using our columnar file.
+
+        This only reads the file header, the ids and the changes saved since
+        the file was written.  ItemInfo objects are created as needed.
+        """
+        saved_db_version = app.db.get_variable(self.VERSION_KEY)
+        if saved_db_version != self.version() or not os.path.exists(self.path):
+            return
+        token = app.db.get_variable(self.TOKEN_KEY)
+        columnar_file = columnarstore.ColumnarFile(self.path)
+        try:
+            if (columnar_file.version == self.version() and
+                    columnar_file.token == token):
+                id_to_info = _LazyInfoMap(columnar_file, self._state_to_info)
+                changed_ids = self._load_changes(id_to_info)
+                if len(id_to_info) == self._db_item_count():
+                    self.id_to_info = id_to_info
+                    self._changed_ids = changed_ids
+                    return
+        except:
+            columnar_file.close()
+            raise
+        columnar_file.close()
+
+    def _load_changes(self, id_to_info):
+        changed_ids = set()
+        app.db.cursor.execute("SELECT id, pickle FROM item_info_cache")
+        for id_, blob in app.db.cursor.fetchall():
+            changed_ids.add(id_)
+            if blob is not None:
+                id_to_info[id_] = blob_to_info(blob)
+            elif id_ in id_to_info:
+                del id_to_info[id_]
+        return changed_ids
+
+    def _state_to_info(self, state):
+        info = messages.ItemInfo.__new__(messages.ItemInfo)
+        info.__setstate__(state)
+        _reset_download_stats(info)
+        return info
+
+    def _rebuild_unread_infos(self, error):
+        """Handle a ColumnarFileError from reading our file.
+
+        We keep the ItemInfos we already have, build the rest from the Item
+        objects like _failsafe_load() does, and write a new file on the next
+        save.
+        """
+        logging.warn("Error reading item info cache file: %s", error)
+        id_to_info = self.id_to_info
+        infos = id_to_info._infos
+        for item in models.Item.make_view():
+            if item.id not in infos:
+                infos[item.id] = itemsource.DatabaseItemSource._item_info_for(
+                    item)
+        id_to_info.close_file()
+        self.id_to_info = infos
+        self._needs_rewrite = True
+        self.schedule_save_to_db()
+
+    def get_info(self, id_):
+        try:
+            return ItemInfoCache.get_info(self, id_)
+        except columnarstore.ColumnarFileError, e:
+            self._rebuild_unread_infos(e)
+            return ItemInfoCache.get_info(self, id_)
+
+    def all_infos(self):
+        try:
+            return ItemInfoCache.all_infos(self)
+        except columnarstore.ColumnarFileError, e:
+            self._rebuild_unread_infos(e)
+            return ItemInfoCache.all_infos(self)
+
+    def item_changed(self, item):
+        try:
+            ItemInfoCache.item_changed(self, item)
+        except columnarstore.ColumnarFileError, e:
+            self._rebuild_unread_infos(e)
+            ItemInfoCache.item_changed(self, item)
+
+    def item_removed(self, item):
+        try:
+            ItemInfoCache.item_removed(self, item)
+        except columnarstore.ColumnarFileError, e:
+            self._rebuild_unread_infos(e)
+            ItemInfoCache.item_removed(self, item)
+
+    def _save_changes(self):
+        if not (self._infos_added or self._infos_changed or
+                self._infos_deleted or self._needs_rewrite):
+            return
+        changed_ids = self._changed_ids.union(self._infos_added,
+                                              self._infos_changed,
+                                              self._infos_deleted)
+        rewrite_limit = max(self.REWRITE_MIN_CHANGES,
+                            len(self.id_to_info) * self.REWRITE_FRACTION)
+        if (self._needs_rewrite or
+                not isinstance(self.id_to_info, _LazyInfoMap) or
+                len(changed_ids) > rewrite_limit):
+            self._write_file()
+        else:
+            ItemInfoCache._save_changes(self)
+            self._changed_ids = changed_ids
+
+    def _run_inserts(self):
+        # The table only holds changes since the file was written, so items
+        # may or may not have rows already
+        sql = "REPLACE INTO item_info_cache (id, pickle) VALUES (?, ?)"
+        values = [(id, self._info_to_blob(info)) for (id, info) in
+                  itertools.chain(self._infos_added.iteritems(),
+                                  self._infos_changed.iteritems())]
+        if values:
+            app.db.cursor.executemany(sql, values)
+
+    def _run_updates(self):
+        # _run_inserts() handles these too
+        pass
+
+    def _run_deletes(self):
+        if not self._infos_deleted:
+            return
+        sql = "REPLACE INTO item_info_cache (id, pickle) VALUES (?, NULL)"
+        app.db.cursor.executemany(sql, ((id_,) for id_ in
+                                        self._infos_deleted))
+
+    def _write_file(self):
+        """Write every ItemInfo to a new file and clear the saved changes."""
+        lazy_map = None
+        if isinstance(self.id_to_info, _LazyInfoMap):
+            try:
+                rows = list(self.id_to_info.iterstates())
+            except columnarstore.ColumnarFileError, e:
+                self._rebuild_unread_infos(e)
+            else:
+                lazy_map = self.id_to_info
+                infos = lazy_map._infos
+        if lazy_map is None:
+            infos = self.id_to_info
+            rows = [info.__getstate__() for info in infos.itervalues()]
+        token = os.urandom(8).encode('hex')
+        if lazy_map is not None:
+            # Windows can't replace a file that's mapped
+            lazy_map.close_file()
+        try:
+            columnarstore.write_file(self.path, rows, self.version(), token)
+        except:
+            if lazy_map is not None:
+                lazy_map.reopen_file(columnarstore.ColumnarFile(self.path))
+            raise
+        # Clear the changes before storing the token.  If we crash in
+        # between, the token won't match and we do a failsafe load rather
+        # than apply old changes to the new file.
+        app.db.cursor.execute("DELETE FROM item_info_cache")
+        app.db.set_variable(self.TOKEN_KEY, token)
+        self.id_to_info = _LazyInfoMap(columnarstore.ColumnarFile(self.path),
+                                       self._state_to_info, infos)
+        self._changed_ids = set()
+        self._needs_rewrite = False
+        self._reset_changes()
+
+def blob_to_info(blob):
+    """Convert a pickle from the item_info_cache table to an ItemInfo.
+
+    This doesn't touch app.db, so it's safe to call from other threads.
+    """
+    info = cPickle.loads(str(blob))
+    _reset_download_stats(info)
+    return info
+
+def _reset_download_stats(info):
+    # Download stats are no longer valid, reset them
+    info.leechers = None
+    info.seeders = None
+    info.up_rate = None
+    info.down_rate = None
+    if info.download_info is not None:
+        info.download_info.rate = 0
+        info.download_info.eta = 0
+
+def create_item_info_cache():
+    """Create an ItemInfoCache using the backend from our prefs."""
+    backend = app.config.get(prefs.ITEM_INFO_CACHE_BACKEND)
+    if backend == u'columnar':
+        return ColumnarItemInfoCache()
+    elif backend != u'sqlite':
+        logging.warn("Unknown item info cache backend: %r", backend)
+    return ItemInfoCache()
+
 def create_sql():
     """Get the SQL needed to create the tables we need for the ItemInfo cache
     """
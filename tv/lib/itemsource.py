@@ -557,7 +557,7 @@ class SharingItemHandler(ItemHandler):
         if info.is_playing != is_playing:
             # modifying the ItemInfo in-place messes up the Tracker's
             # object-changed logic, so make a copy
-            info = messages.ItemInfo(info.id, **info.__dict__)
+            info = messages.ItemInfo(info.id, **info.get_attributes())
             info.is_playing = is_playing
             info.item_source.emit("changed", info)
 
@@ -775,7 +775,7 @@ class DeviceItemHandler(ItemHandler):
             # object-changed logic, so make a copy
             info_cache = app.device_manager.info_cache[info.device.mount]
             info = info_cache[info.id] = messages.ItemInfo(
-                info.id, **info.__dict__)
+                info.id, **info.get_attributes())
             database = info.device.database
             info.is_playing = is_playing
             database[info.file_type][info.id][u'is_playing'] = is_playing
@@ -29,12 +29,15 @@
 # libdaap.py
 # Server/Client implementation of DAAP
 
+import collections
 import errno
 import os
 import sys
 import itertools
+import select
 import socket
 import random
+import time
 import traceback
 # XXX merged into urllib.urlparse in Python 3
 import urlparse
@@ -44,6 +47,7 @@ import SocketServer
 import threading
 import httplib
 import gzip
+import Queue
 try:
     from cStringIO import StringIO
 except ImportError:
@@ -64,6 +68,8 @@ DEFAULT_PORT = 3689
 DAAP_TIMEOUT = 1800    # timeout (in seconds)
 
 DAAP_MAXCONN = 10      # Number of maximum connections we want to allow.
+DAAP_RESPONSE_CACHE_SIZE = 64    # Encoded item listings kept per revision.
+DAAP_WORKER_THREADS = 4    # Request handler threads for DaapEventServer.
 
 # !!! No user servicable parts below. !!!
 
@@ -106,6 +112,35 @@ class SessionObject(object):
     # on the requests which come in.
     pass
 
+class ResponseCache(object):
+    # Encoded replies, keyed by a tuple whose first element is the backend
+    # revision the reply was built at.  The backend calls invalidate() with
+    # the new revision every time its contents change; replies built
+    # against an older revision are never stored, so a listing computed
+    # while the revision was being bumped cannot outlive the bump.
+    def __init__(self, max_size=DAAP_RESPONSE_CACHE_SIZE):
+        self.lock = threading.Lock()
+        self.max_size = max_size
+        self.revision = 0
+        self.entries = dict()
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def put(self, key, blob):
+        with self.lock:
+            if key[0] != self.revision:
+                return
+            if len(self.entries) >= self.max_size:
+                self.entries.clear()
+            self.entries[key] = blob
+
+    def invalidate(self, revision):
+        with self.lock:
+            self.revision = revision
+            self.entries.clear()
+
 class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     # GRRR!  Stupid Windows!  When bind() is called twice on a socket
     # it should return EADDRINUSE on the second one - Windows doesn't!
@@ -123,11 +158,16 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
         self.session_lock = threading.Lock()
         self.debug = False
         self.log_message_callback = None
+        self.response_cache = None
 
     # New functions in subclass.  Note: we can separate some of these out
     # into separate libraries but not now.
     def set_backend(self, backend):
         self.backend = backend
+        # Backends that can tell us when their contents change may hand
+        # us a ResponseCache so item listings are only encoded once per
+        # revision.
+        self.response_cache = getattr(backend, 'response_cache', None)
 
     def set_finished_callback(self, callback):
         self.finished_callback = callback
@@ -162,31 +202,38 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
                     break
             session_obj = SessionObject()
             self.activeconn[s] = session_obj
-            session_obj.timer = threading.Timer(DAAP_TIMEOUT,
-                                                self.daap_timeout_callback,
-                                                [s])
             session_obj.counter = itertools.count()
             current_thread = threading.current_thread()
             current_thread.generation = session_obj.counter.next()
-            self.activeconn[s].timer.start()
+            self.start_timeout(s)
         return s
 
     def renew_session(self, s):
         with self.session_lock:
             try:
-                self.activeconn[s].timer.cancel()
+                self.cancel_timeout(s)
             except KeyError:
                 return False
-            # Pants...  we need to create a new timer object.
-            self.activeconn[s].timer = threading.Timer(DAAP_TIMEOUT,
-                                                   self.daap_timeout_callback,
-                                                   [s])
             current_thread = threading.current_thread()
             current_thread.generation = self.activeconn[s].counter.next()
-            self.activeconn[s].timer.start()
+            self.start_timeout(s)
             # OK, thank the caller for telling us the guy's alive
             return True
 
+    # At this point: session_lock acquired
+    def start_timeout(self, s):
+        # Pants...  we need to create a new timer object every time.
+        session_obj = self.activeconn[s]
+        session_obj.timer = threading.Timer(DAAP_TIMEOUT,
+                                            self.daap_timeout_callback,
+                                            [s])
+        session_obj.timer.start()
+
+    # At this point: session_lock acquired.  Raises KeyError for unknown
+    # sessions.
+    def cancel_timeout(self, s):
+        self.activeconn[s].timer.cancel()
+
     def handle_error(self, request, client_address):
         pass
 
@@ -195,7 +242,7 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
         # conn.
         with self.session_lock:
             try:
-                self.activeconn[s].timer.cancel()
+                self.cancel_timeout(s)
                 # XXX can't just delete? - need to keep a reference count 
                 # for the connection, we can have data/control connection?
                 del self.activeconn[s]
@@ -234,7 +281,11 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     def do_send_reply(self, rcode, reply, content_type=DEFAULT_CONTENT_TYPE,
                       content_encoding=None, extra_headers=[]):
-        blob = encode_response(reply, content_encoding=content_encoding)
+        if isinstance(reply, StreamObj):
+            # Already encoded, e.g. served from the response cache.
+            blob = reply
+        else:
+            blob = encode_response(reply, content_encoding=content_encoding)
         try:
             self.send_response(rcode)
             self.send_header('Content-type', content_type)
@@ -247,8 +298,7 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             for k, v in blob.get_headers():
                 self.send_header(k, v)
             self.end_headers()
-            for chunk in blob:
-                self.wfile.write(chunk)
+            self.send_body(blob)
         # Remote guy could be mean and cut us off.  If so, silence the broken
         # pipe error, and continue on our merry way
         except IOError:
@@ -257,6 +307,15 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 self.server.del_session(session)
             raise    # Give upper layer a chance to deal
 
+    def send_body(self, blob):
+        if isinstance(blob, ChunkedStreamObj):
+            # Files go straight from the file to the socket.
+            self.wfile.flush()
+            blob.sendall(self.request)
+        else:
+            for chunk in blob:
+                self.wfile.write(chunk)
+
     # Convenience function: convenient that session-id must be non-zero so
     # you can use it for True/False testing too.
     def get_session(self):
@@ -357,11 +416,19 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             return (DAAP_BADREQUEST, [], [])
         if not session:
             return (DAAP_FORBIDDEN, [], [])
-        revision = self.server.backend.get_revision(session, old_revision,
-                                                    self.request)
-        reply = []
-        reply.append(('mupd', [('mstt', DAAP_OK), ('musr', revision)]))
-        return (DAAP_OK, reply, [])
+        revision = self.wait_revision(session, old_revision)
+        if revision is None:
+            # Parked until the revision changes, see DaapEventServer.
+            return (None, [], [])
+        return (DAAP_OK, self.update_reply(revision), [])
+
+    # Block until the backend moves on from old_revision.
+    def wait_revision(self, session, old_revision):
+        return self.server.backend.get_revision(session, old_revision,
+                                                self.request)
+
+    def update_reply(self, revision):
+        return [('mupd', [('mstt', DAAP_OK), ('musr', revision)])]
 
     def do_stream_file(self, db_id, item_id, ext, chunk):
         rc = DAAP_OK
@@ -393,9 +460,9 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     def get_request_path(self, itemid, enclosure):
         # XXX
-        # This API is bad because we can't get the address we used to connect
-        # with the client unless we poke into semi-private data.  Ugh.
-        address, addrlength = self.rfile._sock.getsockname()
+        # This API is bad because we have to ask the socket which address
+        # the client connected to.  Ugh.
+        address, addrlength = self.request.getsockname()
         listen_address, port = self.server.server_address
         return ('daap://%s:%d/databases/1/items/%d.%s?session-id=%d' % 
                 (address, port, itemid, enclosure, self.get_session()))
@@ -545,14 +612,26 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         backend_id = playlist_id
         if backend_id == 2:
             backend_id = None
-        items = self.server.backend.get_items(playlist_id=backend_id)
-        itemlist = []
-        deleted = []
         try:
             meta = query['meta']
         except KeyError:
             meta = DEFAULT_DAAP_META
         revision, delta = self.get_revision(query) 
+        # The listing only depends on the backend contents and on what was
+        # asked for, so encode it once per revision and share it between
+        # clients.  Read the cache revision before fetching the items: if
+        # the backend moves on in between, the reply is simply not stored.
+        cache = self.server.response_cache
+        if cache:
+            content_encoding = self.reply_encoding()
+            key = (cache.revision, delta, playlist_id, meta, content_encoding)
+            blob = cache.get(key)
+            if blob is not None:
+                return (DAAP_OK, blob, [])
+        items = self.server.backend.get_items(playlist_id=backend_id,
+                                              delta=delta)
+        itemlist = []
+        deleted = []
         meta_list = [m.strip() for m in meta.split(',')]
         # NB: mikd must be the first guy in the listing.
         # GRR stupid Rhythmbox!  The meta reply must appear in order otherwise
@@ -595,6 +674,9 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             content.append(('mudl', deleted))    # Itemlist deleted
 
         reply = [(tag, content)]
+        if cache:
+            reply = encode_response(reply, content_encoding=content_encoding)
+            cache.put(key, reply)
         return (DAAP_OK, reply, [])
 
     def do_database_items(self, path, query):
@@ -734,6 +816,387 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         # prohibited list.
         return None
 
+###############################################################################
+
+# DaapEventServer: event driven server.
+#
+# DaapTCPServer runs a thread per connection, and every /update long-poll
+# blocks one of them in backend.get_revision().  DaapEventServer does all of
+# the socket I/O on a single thread instead: connections are multiplexed
+# with select(), complete requests are run by a small pool of worker
+# threads (handlers may block, e.g. waiting for a transcoded chunk), and
+# /update long-polls are parked with backend.add_revision_waiter() until
+# the backend calls us back with a new revision.  Session timeouts are
+# deadlines checked by the I/O thread rather than a timer thread each.
+#
+# Accepting connections still goes through handle_request() or
+# serve_forever(), so a DaapEventServer can be driven like a DaapTCPServer.
+# Call server_close() to stop the I/O and worker threads.
+
+DAAP_MAX_REQUEST_SIZE = 64 * 1024    # Bytes of request headers we accept.
+
+def make_wakeup_pair():
+    # A pair of connected sockets, to wake up select() from other threads.
+    # Windows can only select() on sockets, so we don't use a pipe.
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        first = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        first.connect(listener.getsockname())
+        second, address = listener.accept()
+    finally:
+        listener.close()
+    return first, second
+
+class ReplyBuffer(object):
+    # Stands in for a request handler's wfile: the reply is collected here
+    # and written out by the I/O thread once the socket is writable.
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def getvalue(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+class DaapConnection(object):
+    # State of a client connection to a DaapEventServer.  Only the I/O
+    # thread touches this, apart from the worker running a request while
+    # busy is set.
+    def __init__(self, sock, client_address):
+        self.sock = sock
+        self.client_address = client_address
+        self.inbuf = ''
+        self.outbuf = collections.deque()
+        self.body = None              # ChunkedStreamObj being sent.
+        self.busy = False             # A worker is running a request.
+        self.parked = None            # Handler of a parked /update.
+        self.session = 0              # Set on the control connection.
+        self.close_when_done = False
+        self.closed = False
+
+    def idle(self):
+        return (not self.busy and self.parked is None and
+                not self.outbuf and self.body is None)
+
+class DaapEventRequestHandler(DaapHttpRequestHandler):
+    # Runs a single request, already read in by the I/O thread, on a
+    # worker thread.  The reply is left in wfile (and body, for files) for
+    # the I/O thread to send.
+    def __init__(self, data, connection, server):
+        self.request = connection.sock
+        self.client_address = connection.client_address
+        self.server = server
+        self.daap_connection = connection
+        self.rfile = StringIO(data)
+        self.wfile = ReplyBuffer()
+        self.close_connection = 1    # Until parse_request() says otherwise
+        self.body = None
+        self.parked_session = 0
+        self.old_revision = 0
+        self.woken_revision = None
+
+    def do_send_reply(self, rcode, reply, content_type=DEFAULT_CONTENT_TYPE,
+                      content_encoding=None, extra_headers=[]):
+        # A parked /update has no reply until it is woken up.
+        if rcode is None:
+            return
+        DaapHttpRequestHandler.do_send_reply(self, rcode, reply,
+                                             content_type=content_type,
+                                             content_encoding=content_encoding,
+                                             extra_headers=extra_headers)
+
+    def send_body(self, blob):
+        if isinstance(blob, ChunkedStreamObj):
+            # Files are sent by the I/O thread as the socket drains.
+            self.body = blob
+        else:
+            DaapHttpRequestHandler.send_body(self, blob)
+
+    def wait_revision(self, session, old_revision):
+        server = self.server
+        callback = lambda revision: server.revision_changed(self, revision)
+        revision = server.backend.add_revision_waiter(session, old_revision,
+                                                      callback)
+        if revision is None:
+            self.parked_session = session
+            self.old_revision = old_revision
+        return revision
+
+    # Called by the I/O thread to finish a parked /update.
+    def send_update_reply(self, revision):
+        self.parked_session = 0
+        self.do_send_reply(DAAP_OK, self.update_reply(revision),
+                           content_encoding=self.reply_encoding())
+        return self.wfile.getvalue()
+
+class DaapEventServer(DaapTCPServer):
+    def __init__(self, server_address, RequestHandlerClass,
+                 bind_and_activate=True,
+                 worker_threads=DAAP_WORKER_THREADS):
+        DaapTCPServer.__init__(self, server_address, RequestHandlerClass,
+                               bind_and_activate)
+        self.activeconn = dict()
+        self.connections = dict()    # socket -> DaapConnection
+        # Hand-offs to the I/O thread, protected by event_lock.
+        self.event_lock = threading.Lock()
+        self.new_connections = []
+        self.finished_requests = []
+        self.woken_requests = []
+        self.quit = False
+        self.wakeup_r, self.wakeup_w = make_wakeup_pair()
+        self.jobs = Queue.Queue()
+        self.io_thread = threading.Thread(target=self.io_loop,
+                                          name='DAAP I/O Thread')
+        self.io_thread.daemon = True
+        self.io_thread.start()
+        self.workers = []
+        for i in xrange(worker_threads):
+            t = threading.Thread(target=self.worker,
+                                 name='DAAP Worker Thread')
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    # Session timeouts are deadlines, see expire_sessions().
+    def start_timeout(self, s):
+        self.activeconn[s].deadline = time.time() + DAAP_TIMEOUT
+
+    def cancel_timeout(self, s):
+        self.activeconn[s].deadline = None
+
+    def next_timeout(self):
+        with self.session_lock:
+            deadlines = [session_obj.deadline for session_obj in
+                         self.activeconn.itervalues() if
+                         session_obj.deadline is not None]
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.time())
+
+    def expire_sessions(self):
+        now = time.time()
+        with self.session_lock:
+            expired = [s for s, session_obj in self.activeconn.iteritems() if
+                       session_obj.deadline is not None and
+                       session_obj.deadline <= now]
+        for s in expired:
+            self.daap_timeout_callback(s)
+
+    # Called from the accepting thread instead of spawning a handler thread.
+    def process_request(self, request, client_address):
+        request.setblocking(0)
+        with self.event_lock:
+            self.new_connections.append(DaapConnection(request,
+                                                       client_address))
+        self.wakeup()
+
+    # Called by the backend, with its lock held, when the revision of a
+    # parked /update changes.
+    def revision_changed(self, handler, revision):
+        handler.woken_revision = revision
+        with self.event_lock:
+            self.woken_requests.append(handler)
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self.wakeup_w.send('x')
+        except socket.error:
+            # Closed during shutdown.
+            pass
+
+    def server_close(self):
+        with self.event_lock:
+            self.quit = True
+        self.wakeup()
+        self.io_thread.join()
+        for t in self.workers:
+            self.jobs.put(None)
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+        DaapTCPServer.server_close(self)
+
+    def worker(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            connection, data = job
+            handler = self.RequestHandlerClass(data, connection, self)
+            try:
+                handler.handle_one_request()
+            except Exception, e:
+                (typ, value, tb) = sys.exc_info()
+                parts = 'Error: Exception handling request: %s\nTraceback:\n'
+                parts += ''.join(traceback.format_list(
+                                 traceback.extract_tb(tb)))
+                handler.log_message(parts, e)
+                handler.close_connection = 1
+            with self.event_lock:
+                self.finished_requests.append(handler)
+            self.wakeup()
+
+    def io_loop(self):
+        while True:
+            rset = [self.wakeup_r] + self.connections.keys()
+            wset = [c.sock for c in self.connections.itervalues() if
+                    c.outbuf or c.body is not None]
+            try:
+                r, w, x = select.select(rset, wset, [], self.next_timeout())
+            except select.error, (err, errstring):
+                if err == errno.EINTR:
+                    continue
+                raise
+            if self.wakeup_r in r:
+                self.wakeup_r.recv(4096)
+            with self.event_lock:
+                quit = self.quit
+                new_connections = self.new_connections
+                finished_requests = self.finished_requests
+                woken_requests = self.woken_requests
+                self.new_connections = []
+                self.finished_requests = []
+                self.woken_requests = []
+            if quit:
+                break
+            for connection in new_connections:
+                self.connections[connection.sock] = connection
+            for handler in finished_requests:
+                self.request_finished(handler)
+            for handler in woken_requests:
+                connection = handler.daap_connection
+                if connection.parked is handler:
+                    self.unpark(connection, handler.woken_revision)
+            for sock in r:
+                connection = self.connections.get(sock)
+                if connection:
+                    self.read(connection)
+            for sock in w:
+                connection = self.connections.get(sock)
+                if connection:
+                    self.write(connection)
+            self.expire_sessions()
+        for connection in self.connections.values():
+            self.close_connection(connection)
+
+    def read(self, connection):
+        try:
+            data = connection.sock.recv(65536)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            self.close_connection(connection)
+            return
+        connection.inbuf += data
+        # The client has moved on without waiting for the update, just
+        # tell it nothing has changed.
+        if connection.parked is not None:
+            self.unpark(connection, connection.parked.old_revision)
+        self.next_request(connection)
+
+    def write(self, connection):
+        try:
+            if connection.outbuf:
+                data = connection.outbuf[0]
+                sent = connection.sock.send(data)
+                if sent < len(data):
+                    connection.outbuf[0] = data[sent:]
+                else:
+                    connection.outbuf.popleft()
+            elif connection.body is not None:
+                if not connection.body.send(connection.sock):
+                    connection.body = None
+        except (socket.error, IOError), e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self.close_connection(connection)
+            return
+        self.next_request(connection)
+
+    def next_request(self, connection):
+        if not connection.idle():
+            return
+        if connection.close_when_done:
+            self.close_connection(connection)
+            return
+        end = connection.inbuf.find('\r\n\r\n')
+        if end < 0:
+            if len(connection.inbuf) > DAAP_MAX_REQUEST_SIZE:
+                self.close_connection(connection)
+            return
+        data = connection.inbuf[:end + 4]
+        connection.inbuf = connection.inbuf[end + 4:]
+        connection.busy = True
+        self.jobs.put((connection, data))
+
+    def request_finished(self, handler):
+        connection = handler.daap_connection
+        connection.busy = False
+        if connection.closed:
+            if handler.parked_session:
+                self.backend.remove_revision_waiter(handler.parked_session)
+            return
+        # /login makes this the control connection of the session.
+        session = getattr(handler, 'session', 0)
+        if session:
+            connection.session = session
+        data = handler.wfile.getvalue()
+        if data:
+            connection.outbuf.append(data)
+        connection.body = handler.body
+        if handler.close_connection or handler.wfile.closed:
+            connection.close_when_done = True
+        if handler.parked_session:
+            connection.parked = handler
+            # Woken up before we got here?
+            if handler.woken_revision is not None:
+                self.unpark(connection, handler.woken_revision)
+        self.next_request(connection)
+
+    def unpark(self, connection, revision):
+        handler = connection.parked
+        connection.parked = None
+        self.backend.remove_revision_waiter(handler.parked_session)
+        connection.outbuf.append(handler.send_update_reply(revision))
+
+    def close_connection(self, connection):
+        del self.connections[connection.sock]
+        connection.closed = True
+        if connection.body is not None:
+            connection.body.close()
+            connection.body = None
+        try:
+            connection.sock.close()
+        except socket.error:
+            pass
+        if connection.parked is not None:
+            handler = connection.parked
+            connection.parked = None
+            self.backend.remove_revision_waiter(handler.parked_session)
+        # Same as DaapHttpRequestHandler.finish() for the control connection
+        if connection.session:
+            self.del_session(connection.session)
+            if self.finished_callback:
+                self.finished_callback(connection.session)
+            if self.log_message_callback:
+                self.log_message_callback(
+                    'finish called on session %d.  Bye ...',
+                    connection.session)
+
 def mdns_init():
     return mdns.mdns_init()
 
@@ -795,12 +1258,19 @@ def runloop(daapserver):
     daapserver.serve_forever()
 
 def make_daap_server(backend, debug=False, name='pydaap', port=DEFAULT_PORT,
-                     max_conn=DAAP_MAXCONN, robust=True):
-    handler = DaapHttpRequestHandler
+                     max_conn=DAAP_MAXCONN, robust=True, event_driven=False):
+    # event_driven: use a DaapEventServer.  The backend must then support
+    # add_revision_waiter() and remove_revision_waiter().
+    if event_driven:
+        server_class = DaapEventServer
+        handler = DaapEventRequestHandler
+    else:
+        server_class = DaapTCPServer
+        handler = DaapHttpRequestHandler
     failed = False
     while True:
         try:
-            httpd = DaapTCPServer(('', port), handler)
+            httpd = server_class(('', port), handler)
             break
         except socket.error, e:
             if robust and not port == 0:
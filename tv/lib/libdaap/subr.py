@@ -28,9 +28,13 @@
 
 # subr.py
 
+import errno
+import mmap
 import os
+import socket
 import stat
 import struct
+import sys
 import urllib
 import gzip
 
@@ -40,6 +44,35 @@ except ImportError:
     from StringIO import StringIO
 from const import *
 
+def _load_sendfile():
+    # Python 2 has no os.sendfile(), so on Linux call the libc one through
+    # ctypes.  Same signature: sendfile(out_fd, in_fd, offset, count).
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc_sendfile = libc.sendfile64
+    except (ImportError, OSError, AttributeError):
+        return None
+    libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                              ctypes.POINTER(ctypes.c_int64),
+                              ctypes.c_size_t]
+    libc_sendfile.restype = ctypes.c_ssize_t
+    def sendfile(out_fd, in_fd, offset, count):
+        offset = ctypes.c_int64(offset)
+        sent = libc_sendfile(out_fd, in_fd, ctypes.byref(offset), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    return sendfile
+
+# None if the platform doesn't have one.
+sendfile = getattr(os, 'sendfile', None) or _load_sendfile()
+
 # XXX calcsize()?  We need to do some overriding however.
 fmts = {
     DMAP_TYPE_LIST: ('0s', 0),
@@ -100,11 +133,14 @@ class ChunkedStreamObj(object):
 
        for chunk in streamobj:
            write(chunk)
+
+       Or, to send it to a socket without copying the data through Python
+       strings, call send(sock) until it returns 0, or sendall(sock).
     """
     DEFAULT_CHUNK_SIZE = 128 * 1024
 
     def __init__(self, file_obj, hint, start=0, end=0,
-                 chunksize=DEFAULT_CHUNK_SIZE):
+                 chunksize=DEFAULT_CHUNK_SIZE, use_sendfile=True):
         hint = os.path.basename(hint) if hint else ''
         self.file_hint = hint
         self.chunksize = chunksize
@@ -125,6 +161,12 @@ class ChunkedStreamObj(object):
         # On error, I think we need to reposition the stream back to the start?
         self.unread = self.streamsize
         self.rangetext = rangetext
+        # Where send() continues from: the caller has already seeked to the
+        # start of the range.
+        self.offset = file_obj.tell()
+        self.sendfile = sendfile if use_sendfile else None
+        self.map = None
+        self.can_map = True
 
     # Be careful: debug only: if you call this your object is consumed and 
     # you will need to create new one.
@@ -153,6 +195,63 @@ class ChunkedStreamObj(object):
     def __len__(self):
         return self.streamsize
 
+    def send(self, sock):
+        """
+           send(sock) -> int
+
+           Send the next part of the stream to sock straight from the file,
+           using sendfile() if the platform has it and an mmap() of the file
+           otherwise.  Returns the number of bytes sent, or 0 once the stream
+           is done (or the file turns out to be shorter than expected).
+           Errors, including EAGAIN on non-blocking sockets, are raised as
+           socket.error.
+        """
+        if self.unread <= 0:
+            return 0
+        if self.sendfile:
+            try:
+                sent = self.sendfile(sock.fileno(), self.file_obj.fileno(),
+                                     self.offset, self.unread)
+            except OSError, e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise socket.error(e.errno, e.strerror)
+                # Not supported for this file or socket.
+                self.sendfile = None
+                return self.send(sock)
+        else:
+            sent = sock.send(self._get_buffer())
+        if not sent:
+            self.unread = 0
+        self.offset += sent
+        self.unread -= sent
+        if self.unread <= 0:
+            self.close()
+        return sent
+
+    def sendall(self, sock):
+        while self.send(sock):
+            pass
+
+    def close(self):
+        if self.map:
+            self.map.close()
+            self.map = None
+
+    def _get_buffer(self):
+        readsize = min(self.unread, self.chunksize)
+        if self.map is None and self.can_map:
+            try:
+                self.map = mmap.mmap(self.file_obj.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError, OverflowError):
+                # Empty files can't be mapped, nor can files too big for
+                # the address space.
+                self.can_map = False
+        if self.map is not None:
+            return buffer(self.map, self.offset, readsize)
+        self.file_obj.seek(self.offset, os.SEEK_SET)
+        return self.file_obj.read(readsize)
+
     def get_headers(self):
         headers = []
         if self.rangetext:
@@ -232,6 +331,17 @@ def find_daap_tag(searchtag, data):
     except (RuntimeError, ValueError):
         return None
 
+# header for each tag: code (4 bytes), length (4 bytes), network byte order
+_header_struct = struct.Struct('!4sI')
+# header and value for fixed size types, used to encode
+_value_structs = dict((typ, struct.Struct('!4sI' + fmt))
+                      for typ, (fmt, size) in fmts.items()
+                      if typ not in (DMAP_TYPE_LIST, DMAP_TYPE_STRING))
+# just the value for fixed size types, used to decode
+_decode_structs = dict((typ, struct.Struct('!' + fmt))
+                       for typ, (fmt, size) in fmts.items()
+                       if typ not in (DMAP_TYPE_LIST, DMAP_TYPE_STRING))
+
 def decode_response(reply):
     """
        decode_response(reply) -> reply
@@ -242,36 +352,42 @@ def decode_response(reply):
        Things in a DMAP_TYPE_LIST container will contain a list with other
        response codes.
     """
+    return _decode(reply, 0, len(reply))
+
+def _decode(reply, start, end):
+    # Decode reply[start:end].  We work with offsets rather than slicing
+    # off each tag as we go, so the only copies we make are string values.
+    #
     # This must be wrapped around a try ... except block in case the other
     # end lies to us about the size of the individual items.
     decoded = []
+    pos = start
     try:
-        while reply:
-            headerfmt = '!4sI'
-            headersize = struct.calcsize(headerfmt)
-            code, size = struct.unpack(headerfmt, reply[:headersize])
-            reply = reply[headersize:]
+        while pos < end:
+            if pos + _header_struct.size > end:
+                raise ValueError
+            code, size = _header_struct.unpack_from(reply, pos)
+            pos += _header_struct.size
             realname, realtype = dmap_consts[code]
             realfmt, realsize = fmts[realtype]
             # XXX check size == realsize
             if realtype == DMAP_TYPE_LIST:
                 decoded.append((code,
-                                decode_response(reply[:size])))
+                                _decode(reply, pos, min(pos + size, end))))
                 # next guy
-                reply = reply[size:]
+                pos += size
                 continue
             if realtype == DMAP_TYPE_STRING:
-                # overwrite the size for string with the size specified
-                # by the server.
-                realfmt = str(size) + realfmt 
+                # use the size for string specified by the server.
+                if pos + size > end:
+                    raise ValueError
+                value = reply[pos:pos + size]
             else:
-                if realsize != size:
+                if realsize != size or pos + size > end:
                     raise ValueError
-                realfmt = '!' + realfmt
-            realfmtsize = struct.calcsize(realfmt)
-            (value, ) = struct.unpack(realfmt, reply[:realfmtsize])
+                (value, ) = _decode_structs[realtype].unpack_from(reply, pos)
             decoded.append((code, value))
-            reply = reply[realfmtsize:]
+            pos += size
         return decoded
     except (struct.error, KeyError, ValueError), e:
         return [(-1, [])]
@@ -290,36 +406,10 @@ def encode_response(reply, content_encoding=None):
        content_encoding: specify content encoding.  Right now we only support
        gzip.
     """
-    blob = ''
-    subblob = ''
     try:
-        for code, value in reply:
-            nam, typ = dmap_consts[code]
-            fmt, size = fmts[typ]
-            if typ == DMAP_TYPE_LIST:
-                # list container - override the value and the size.  Set
-                # value to '' to append nothingness but tack on the subblob at 
-                # the end. 
-                subblob = str(encode_response(value))
-                size = len(subblob)
-                value = ''
-            if typ == DMAP_TYPE_STRING:
-                fmt = str(len(value)) + fmt
-                size = len(value)
-                # This ensures we always get a string type even if we are lame
-                # and passed a unicode in.
-                value = str(buffer(value))
-            # code (4 bytes), length (4 bytes), data (variable), network byte
-            # order
-            fmt = '!4sI' + fmt
-            # XXX slow - should bunch up
-            try:
-                blob += struct.pack(fmt, code, size, value)
-            except struct.error:
-                # This pack did not work.  Let's ignore it
-                pass
-            blob += subblob
-        blob = StreamObj(blob, content_encoding=content_encoding)
+        chunks = []
+        _encode(reply, chunks)
+        blob = StreamObj(''.join(chunks), content_encoding=content_encoding)
     except ValueError:
         # This is probably a file.  Just pass up to the
         # caller and let the caller deal with it.
@@ -327,6 +417,42 @@ def encode_response(reply, content_encoding=None):
         blob = ChunkedStreamObj(file_obj, hint, start, end)
     return blob
 
+def _encode(reply, chunks):
+    # Append the encoded reply to chunks and return its length.  A list
+    # container's header needs the size of its contents, so we leave a slot
+    # for it and fill it in after encoding the contents.
+    total = 0
+    for code, value in reply:
+        nam, typ = dmap_consts[code]
+        if typ == DMAP_TYPE_LIST:
+            index = len(chunks)
+            chunks.append(None)
+            size = _encode(value, chunks)
+            chunks[index] = _header_struct.pack(code, size)
+            total += _header_struct.size + size
+        elif typ == DMAP_TYPE_STRING:
+            size = len(value)
+            # This ensures we always get a string type even if we are lame
+            # and passed a unicode in.
+            if not isinstance(value, str):
+                value = str(buffer(value))[:size]
+            try:
+                chunks.append(_header_struct.pack(code, size))
+            except struct.error:
+                # This pack did not work.  Let's ignore it
+                continue
+            chunks.append(value)
+            total += _header_struct.size + size
+        else:
+            value_struct = _value_structs[typ]
+            try:
+                chunks.append(value_struct.pack(code, fmts[typ][1], value))
+            except struct.error:
+                # This pack did not work.  Let's ignore it
+                continue
+            total += value_struct.size
+    return total
+
 def split_url_path(urlpath):
     """
        split_url_path(urlpath) -> path, dict
@@ -43,6 +43,7 @@ from miro import conversions
 from miro import downloader
 from miro import eventloop
 from miro import feed
+from miro import feedupdate
 from miro import guide
 from miro import fileutil
 from miro import commandline
@@ -65,6 +66,13 @@ from miro.plat.utils import make_url_safe, filename_to_unicode
 
 import shutil
 
+def _info_attributes(info):
+    # ItemInfo keeps its attributes in __slots__, so it doesn't have a
+    # __dict__
+    if isinstance(info, messages.ItemInfo):
+        return info.get_attributes()
+    return info.__dict__
+
 class ViewTracker(object):
     """Handles tracking views for TrackGuides, TrackChannels, TrackPlaylist and
     TrackItems.
@@ -120,7 +128,8 @@ class ViewTracker(object):
         for obj in changed:
             info = self.info_factory(obj)
             if (obj.id not in self._last_sent_info or
-                info.__dict__ != self._last_sent_info[obj.id].__dict__):
+                (_info_attributes(info) !=
+                 _info_attributes(self._last_sent_info[obj.id]))):
                 retval.append(info)
                 self._last_sent_info[obj.id] = info
         return retval
@@ -738,6 +747,38 @@ class UnwatchedCountTracker(CountTracker):
     def make_message(self, count):
         return messages.UnwatchedCountChanged(count)
 
+class FeedUpdateStatsTracker(object):
+    """Sends FeedUpdateStatsChanged messages when the feed update queue
+    changes.
+    """
+    def __init__(self):
+        self.update_queue = feedupdate.global_update_queue
+        self.signal_handle = self.update_queue.connect('changed',
+                self.on_queue_changed)
+        self.message_scheduled = False
+
+    def on_queue_changed(self, update_queue):
+        # the queue can change many times in a row when lots of feeds update
+        # at once.  Only send one message for all of those changes.
+        if not self.message_scheduled:
+            eventloop.add_idle(self.send_message,
+                    'send FeedUpdateStatsChanged')
+            self.message_scheduled = True
+
+    def send_message(self):
+        self.message_scheduled = False
+        if self.signal_handle is None:
+            return
+        messages.FeedUpdateStatsChanged(self.update_queue.queue_depth(),
+                len(self.update_queue.currently_updating),
+                self.update_queue.host_stats(),
+                feed.fingerprint_stats.bodies_skipped,
+                feed.fingerprint_stats.entries_skipped).send_to_frontend()
+
+    def stop_tracking(self):
+        self.update_queue.disconnect(self.signal_handle)
+        self.signal_handle = None
+
 class BackendMessageHandler(messages.MessageHandler):
     def __init__(self, frontend_startup_callback):
         messages.MessageHandler.__init__(self)
@@ -753,6 +794,7 @@ class BackendMessageHandler(messages.MessageHandler):
         self.new_video_count_tracker = None
         self.new_audio_count_tracker = None
         self.unwatched_count_tracker = None
+        self.feed_update_stats_tracker = None
         self.item_trackers = {}
         search_feed = Feed.get_search_feed()
         search_feed.connect('update-finished', self._search_update_finished)
@@ -1360,6 +1402,14 @@ New ids: %s""", playlist_item_ids, message.item_ids)
         else:
             item_tracker.unlink()
 
+    def handle_search_items(self, message):
+        if message.ranked:
+            ids = app.search_index.search_ranked(message.query)
+        else:
+            ids = app.search_index.search(message.query)
+        messages.ItemSearchResults(message.type, message.id, message.query,
+                ids, message.ranked).send_to_frontend()
+
     def handle_cancel_auto_download(self, message):
         try:
             item_ = item.Item.get_by_id(message.id)
@@ -1625,6 +1675,16 @@ New ids: %s""", playlist_item_ids, message.item_ids)
             self.unwatched_count_tracker.stop_tracking()
             self.unwatched_count_tracker = None
 
+    def handle_track_feed_update_stats(self, message):
+        if self.feed_update_stats_tracker is None:
+            self.feed_update_stats_tracker = FeedUpdateStatsTracker()
+        self.feed_update_stats_tracker.send_message()
+
+    def handle_stop_tracking_feed_update_stats(self, message):
+        if self.feed_update_stats_tracker:
+            self.feed_update_stats_tracker.stop_tracking()
+            self.feed_update_stats_tracker = None
+
     def handle_subscription_link_clicked(self, message):
         url = message.url
         subscriptions = subscription.find_subscribe_links(url)
@@ -1960,6 +2020,19 @@ New ids: %s""", playlist_item_ids, message.item_ids)
         time.sleep(message.n)
         logging.debug('handle_clog_backend: Backend out of snooze.  Yawn!')
 
+    def handle_toggle_query_profiler(self, message):
+        if app.db.profiler.enabled:
+            app.db.profiler.stop()
+            logging.info("query profiler stopped")
+        else:
+            app.db.profiler.start()
+            logging.info("query profiler started")
+
+    def handle_dump_query_profile(self, message):
+        logging.info(app.db.profiler.format_report())
+        if message.reset:
+            app.db.profiler.reset()
+
     def handle_force_feedparser_processing(self, message):
         # For all our RSS feeds, force an update
         for f in feed.Feed.make_view():
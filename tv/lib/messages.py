@@ -175,6 +175,23 @@ class StopTrackingItems(BackendMessage):
         self.type = typ
         self.id = id_
 
+class SearchItems(BackendMessage):
+    """Search the database items with the backend's search index.
+
+    The backend will send back an ItemSearchResults message.
+
+    :param type: type of object being tracked (same as in TrackItems)
+    :param id: id of the object being tracked (same as in TrackItems)
+    :param query: search query
+    :param ranked: if True, only send back the best matches for the query
+        (see search.ItemSearcher.search_ranked())
+    """
+    def __init__(self, typ, id_, query, ranked=False):
+        self.type = typ
+        self.id = id_
+        self.query = query
+        self.ranked = ranked
+
 class TrackDownloadCount(BackendMessage):
     """Start tracking the number of downloading items.  After this message is
     received the backend will send a corresponding DownloadCountChanged
@@ -252,6 +269,19 @@ class StopTrackingUnwatchedCount(BackendMessage):
     """
     pass
 
+class TrackFeedUpdateStats(BackendMessage):
+    """Start tracking the feed update queue.  When this message is
+    received the backend will send a corresponding FeedUpdateStatsChanged
+    message.  It will also send FeedUpdateStatsChanged whenever the queue
+    changes.
+    """
+    pass
+
+class StopTrackingFeedUpdateStats(BackendMessage):
+    """Stop tracking the feed update queue.
+    """
+    pass
+
 class TrackWatchedFolders(BackendMessage):
     """Begin tracking watched folders
 
@@ -923,6 +953,17 @@ class ForceDBSaveError(BackendMessage):
     """Simulate an error running an INSERT/UPDATE statement on the main DB.
     """
 
+class ToggleQueryProfiler(BackendMessage):
+    """Dev message: start or stop collecting database query statistics.
+    """
+    pass
+
+class DumpQueryProfile(BackendMessage):
+    """Dev message: log the database query statistics collected so far.
+    """
+    def __init__(self, reset=False):
+        self.reset = reset
+
 class ForceDeviceDBSaveError(BackendMessage):
     """Simulate an error running an INSERT/UPDATE statement on a device DB.
     """
@@ -1203,20 +1244,73 @@ class ItemInfo(object):
     :param has_drm: True/False if known; None if unknown (usually means no)
     """
 
+    # Attributes that most ItemInfos have.  We store these in slots rather
+    # than a per-instance dict, which saves a lot of memory when we have lots
+    # of ItemInfos around.
+    __slots__ = (
+        'id', 'name', 'feed_id', 'feed_name', 'parent_sort_key', 'feed_url',
+        'state', 'description', 'release_date', 'size', 'duration',
+        'resume_time', 'permalink', 'commentslink', 'payment_link',
+        'has_shareable_url', 'can_be_saved', 'pending_manual_dl',
+        'pending_auto_dl', 'item_viewed', 'downloaded', 'is_external',
+        'video_watched', 'video_path', 'thumbnail', 'thumbnail_url',
+        'file_format', 'license', 'file_url', 'is_container_item',
+        'is_file_item', 'is_playable', 'file_type', 'subtitle_encoding',
+        'seeding_status', 'mime_type', 'date_added', 'last_played',
+        'last_watched', 'downloaded_time', 'children', 'expiration_date',
+        'download_info', 'leechers', 'seeders', 'connections', 'up_rate',
+        'down_rate', 'up_total', 'down_total', 'up_down_ratio', 'remote',
+        'device', 'source_type', 'play_count', 'skip_count', 'auto_rating',
+        'is_playing', 'host', 'port', 'item_source',
+        # metadata attributes (see metadata.attribute_names)
+        'album', 'album_artist', 'album_tracks', 'artist', 'cover_art',
+        'screenshot', 'has_drm', 'genre', 'track', 'year', 'rating', 'show',
+        'episode_id', 'episode_number', 'season_number', 'kind',
+        'net_lookup_enabled',
+        # calculated attributes
+        'description_stripped', 'search_terms', 'name_sort_key',
+        'album_sort_key', 'artist_sort_key', 'album_artist_sort_key',
+        'description_oneline',
+    )
+
+    # String attributes that usually have the same value for many items.
+    # We intern these so that all the ItemInfos share one copy.
+    interned_attributes = frozenset([
+        'feed_name', 'feed_url', 'state', 'file_format', 'license',
+        'file_type', 'mime_type', 'source_type', 'album', 'album_artist',
+        'artist', 'genre', 'kind', 'show', 'seeding_status',
+    ])
+
     html_stripper = util.HTMLStripper()
 
     def __repr__(self):
         return "<ItemInfo %r>" % self.id
 
+    def get_attributes(self):
+        """Get a dict that contains all of our attributes."""
+        rv = {}
+        for name in self.__slots__:
+            try:
+                rv[name] = getattr(self, name)
+            except AttributeError:
+                pass
+        return rv
+
+    def _set_attributes(self, attributes):
+        for name, value in attributes.iteritems():
+            if name in self.interned_attributes:
+                value = _intern_string(value)
+            setattr(self, name, value)
+
     def __getstate__(self):
-        d = self.__dict__.copy()
+        d = self.get_attributes()
         d['device'] = None
         del d['description_stripped']
         del d['search_terms']
         return d
 
     def __setstate__(self, d):
-        self.__dict__.update(d)
+        self._set_attributes(d)
         self.description_stripped = ItemInfo.html_stripper.strip(
                 self.description)
         self.search_terms = search.calc_search_terms(self)
@@ -1224,7 +1318,7 @@ class ItemInfo(object):
     def __init__(self, id_, **kwargs):
         self.id = id_
 
-        self.__dict__.update(kwargs) # we're just a thin wrapper around some
+        self._set_attributes(kwargs) # we're just a thin wrapper around some
                                      # data
 
         # stuff we can calculate from other attributes
@@ -1244,6 +1338,19 @@ class ItemInfo(object):
         self.description_oneline = (
                 self.description_stripped[0].replace('\n', '$'))
 
+_interned_strings = {}
+def _intern_string(value):
+    """Get a shared copy of a string attribute for ItemInfo.
+
+    The builtin intern() only handles byte strings, so we use our own table.
+    The table is never cleared, so this should only be used for attributes
+    that have a limited number of distinct values.
+    """
+    if isinstance(value, basestring):
+        # key on the type too, since 'foo' == u'foo'
+        return _interned_strings.setdefault((type(value), value), value)
+    return value
+
 class DownloadInfo(object):
     """Tracks the download state of an item.
 
@@ -1443,6 +1550,27 @@ class ItemsChanged(FrontendMessage):
     '(%d added, %d changed, %d removed)>') % (self.type, self.id,
     len(self.added), len(self.changed), len(self.removed))
 
+class ItemSearchResults(FrontendMessage):
+    """Sends the frontend the results of a SearchItems message.
+
+    :param type: type of object being tracked (same as in SearchItems)
+    :param id: id of the object being tracked (same as in SearchItems)
+    :param query: search query (same as in SearchItems)
+    :param ids: set of ids for the database items that match query.  For
+        ranked searches, a list of the ids for the best matches, best first.
+    :param ranked: same as in SearchItems
+    """
+    def __init__(self, typ, id_, query, ids, ranked=False):
+        self.type = typ
+        self.id = id_
+        self.query = query
+        self.ids = ids
+        self.ranked = ranked
+
+    def __str__(self):
+        return ('<miro.messages.ItemSearchResults %s:%s %r '
+    '(%d matches)>') % (self.type, self.id, self.query, len(self.ids))
+
 class WatchedFolderList(FrontendMessage):
     """Sends the frontend the initial list of watched folders.
 
@@ -1511,6 +1639,25 @@ class UnwatchedCountChanged(FrontendMessage):
     def __init__(self, count):
         self.count = count
 
+class FeedUpdateStatsChanged(FrontendMessage):
+    """Informs the frontend that the feed update queue has changed.
+
+    :param queue_depth: number of feeds waiting to update
+    :param updating_count: number of feeds currently updating
+    :param host_stats: list of dicts with stats for each host.  See
+        feedupdate.HostUpdateStats.stats_dict() for the keys.
+    :param bodies_skipped: number of updates where the feed body was
+        unchanged (see feed.FingerprintStats)
+    :param entries_skipped: number of unchanged entries that we skipped
+    """
+    def __init__(self, queue_depth, updating_count, host_stats,
+                 bodies_skipped, entries_skipped):
+        self.queue_depth = queue_depth
+        self.updating_count = updating_count
+        self.host_stats = host_stats
+        self.bodies_skipped = bodies_skipped
+        self.entries_skipped = entries_skipped
+
 class ConversionTaskInfo(object):
     """Tracks the state of an conversion task.
 
@@ -140,6 +140,28 @@ LAST_SEARCH_ENGINE = \
 # comma-separated list of search engine names; see searchengines.py for more information
 SEARCH_ORDERING = \
     Pref(key='SearchOrdering', default=None, platformSpecific=False)
+# how to store the ItemInfo cache between runs: "sqlite" stores pickles in the
+# item_info_cache table, "columnar" uses a memory-mapped file in the support
+# directory (see iteminfocache.ColumnarItemInfoCache)
+ITEM_INFO_CACHE_BACKEND = \
+    Pref(key='ItemInfoCacheBackend', default=u"sqlite", platformSpecific=False)
+# number of worker processes to run tasks like feedparser and mutagen in.  0
+# means use one for each CPU (see workerprocess.py)
+WORKER_PROCESS_COUNT = \
+    Pref(key='WorkerProcessCount', default=0, platformSpecific=False)
+# max number of feeds that can update at once (see feedupdate.py)
+MAX_FEED_UPDATES = \
+    Pref(key='MaxFeedUpdates', default=8, platformSpecific=False)
+# max number of feeds from a single host that can update at once
+MAX_FEED_UPDATES_PER_HOST = \
+    Pref(key='MaxFeedUpdatesPerHost', default=2, platformSpecific=False)
+# how many unused items to keep in memory before letting them be garbage
+# collected.  -1 means keep everything (see storedatabase.LiveStorage)
+DB_OBJECT_CACHE_SIZE = \
+    Pref(key='DBObjectCacheSize', default=5000, platformSpecific=False)
+# use write-ahead logging for the database, which lets us run read-only
+# queries in other threads (see storedatabase.LiveStorage)
+DB_WAL_MODE = Pref(key='DBWALMode', default=False, platformSpecific=False)
 
 
 # These have a hardcoded default which can be overridden by setting an
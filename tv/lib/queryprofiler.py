@@ -0,0 +1,223 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.queryprofiler`` -- Collect statistics about database queries.
+
+LiveStorage passes every statement that goes through LiveStorage._execute()
+to its QueryProfiler.  When the profiler is enabled, it keeps track of the
+number of calls, time spent and rows returned for each statement and for
+each python call site.  Statements are normalized first, so that a view
+called with different values or with a different number of ids counts as
+one statement.
+
+The call site is the first stack frame outside of the database code.  If
+the query was run to check a ViewTracker, the call site is marked as such,
+since the code that changed the object isn't really responsible for the
+query.
+
+The first time we see a SELECT, we also run EXPLAIN QUERY PLAN on it and
+remember statements that do a full scan of one of the tables in
+QueryProfiler.scan_check_tables.
+
+Statements that are run directly on app.db.cursor aren't profiled.
+"""
+
+import collections
+import os
+import re
+import sys
+
+# how many query times to keep per statement to calculate percentiles
+SAMPLE_SIZE = 1000
+
+# modules that make up the database layer.  We skip frames from these
+# when looking for a call site.
+_DB_LAYER_MODULES = frozenset([
+    'miro.database', 'miro.storedatabase', 'miro.queryprofiler',
+    'miro.viewpredicate',
+])
+
+_whitespace_re = re.compile(r'\s+')
+_string_literal_re = re.compile(r"'(?:[^']|'')*'")
+_number_re = re.compile(r'\b\d+(?:\.\d+)?\b')
+_in_list_re = re.compile(r'IN \(\?(?:, ?\?)*\)', re.IGNORECASE)
+
+def normalize_sql(sql):
+    """Normalize a SQL statement for grouping.
+
+    Literal values get replaced with "?" and IN lists are collapsed to
+    "IN (...)", since views often build those from lists of ids.
+    """
+    sql = _whitespace_re.sub(' ', sql).strip()
+    sql = _string_literal_re.sub('?', sql)
+    sql = _number_re.sub('?', sql)
+    return _in_list_re.sub('IN (...)', sql)
+
+class QueryStats(object):
+    """Statistics for one statement or call site."""
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.rows = 0
+        self.samples = collections.deque(maxlen=SAMPLE_SIZE)
+
+    def add(self, query_time, row_count):
+        self.count += 1
+        self.total_time += query_time
+        self.rows += row_count
+        self.samples.append(query_time)
+
+    def mean_time(self):
+        if self.count == 0:
+            return 0.0
+        return self.total_time / self.count
+
+    def percentile_time(self, percent):
+        """Get the query time at a percentile of our recent samples."""
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        index = int(round(percent / 100.0 * (len(samples) - 1)))
+        return samples[index]
+
+class QueryProfiler(object):
+    """Tracks statistics for database queries.
+
+    Attributes:
+
+    - enabled -- are we currently collecting statistics?
+    - by_statement -- maps normalized SQL to QueryStats
+    - by_call_site -- maps call site descriptions to QueryStats
+    - full_scans -- maps normalized SQL to the query plan lines that scan a
+      table in scan_check_tables
+    """
+
+    scan_check_tables = ('item',)
+
+    def __init__(self, explain=None):
+        """Create a QueryProfiler.
+
+        :param explain: function that takes (sql, values) and returns the
+            detail lines from EXPLAIN QUERY PLAN for a statement.  If None,
+            we don't check query plans.
+        """
+        self.explain = explain
+        self.enabled = False
+        self._scan_re = re.compile(r'\bSCAN (?:TABLE )?(?:%s)\b' %
+                '|'.join(self.scan_check_tables))
+        self.reset()
+
+    def reset(self):
+        self.by_statement = {}
+        self.by_call_site = {}
+        self.full_scans = {}
+        self._explained = set()
+
+    def start(self):
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+    def record(self, sql, values, query_time, row_count):
+        """Record a query that we ran."""
+        statement = normalize_sql(sql)
+        self._get_stats(self.by_statement, statement).add(query_time,
+                row_count)
+        self._get_stats(self.by_call_site, _find_call_site()).add(
+                query_time, row_count)
+        if statement not in self._explained:
+            self._explained.add(statement)
+            self._check_plan(statement, sql, values)
+
+    def _get_stats(self, stats_map, key):
+        try:
+            return stats_map[key]
+        except KeyError:
+            stats = stats_map[key] = QueryStats()
+            return stats
+
+    def _check_plan(self, statement, sql, values):
+        if (self.explain is None or
+                not sql.lstrip().upper().startswith('SELECT')):
+            return
+        scans = [line for line in self.explain(sql, values)
+                 if self._scan_re.search(line)]
+        if scans:
+            self.full_scans[statement] = scans
+
+    def format_report(self, limit=20):
+        """Get a text report of the statistics we've collected.
+
+        :param limit: max number of statements and call sites to list
+        """
+        total_count = sum(s.count for s in self.by_statement.itervalues())
+        total_time = sum(s.total_time for s in self.by_statement.itervalues())
+        lines = ["Query profile: %d queries, %0.3f seconds" %
+                 (total_count, total_time)]
+        for title, stats_map in (("statement", self.by_statement),
+                                 ("call site", self.by_call_site)):
+            lines.append('')
+            lines.append("By %s:" % title)
+            lines.append("%7s %9s %9s %9s %9s  %s" % ('count', 'total(s)',
+                'mean(ms)', 'p95(ms)', 'rows', title))
+            items = sorted(stats_map.items(),
+                    key=lambda item: item[1].total_time, reverse=True)
+            for key, stats in items[:limit]:
+                lines.append("%7d %9.3f %9.2f %9.2f %9d  %s" % (stats.count,
+                    stats.total_time, stats.mean_time() * 1000,
+                    stats.percentile_time(95) * 1000, stats.rows, key))
+        if self.full_scans:
+            lines.append('')
+            lines.append("Full table scans on %s:" %
+                    ', '.join(self.scan_check_tables))
+            for statement, scans in sorted(self.full_scans.items()):
+                lines.append("  %s" % statement)
+                for scan in scans:
+                    lines.append("      %s" % scan)
+        return '\n'.join(lines)
+
+def _find_call_site():
+    from miro import database
+    frame = sys._getframe(1)
+    tracker = False
+    while frame is not None:
+        if frame.f_globals.get('__name__') not in _DB_LAYER_MODULES:
+            break
+        if isinstance(frame.f_locals.get('self'), database.ViewTracker):
+            tracker = True
+        frame = frame.f_back
+    if frame is None:
+        return '<unknown>'
+    code = frame.f_code
+    site = "%s:%d (%s)" % (os.path.basename(code.co_filename),
+            frame.f_lineno, code.co_name)
+    if tracker:
+        site = "ViewTracker check from %s" % site
+    return site
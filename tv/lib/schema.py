@@ -503,6 +503,8 @@ class ItemSchema(MultiClassObjectSchema):
             ('item_feed_downloader', ('feed_id', 'downloader_id',)),
             ('item_file_type', ('file_type',)),
             ('item_filename', ('filename',)),
+            ('item_feed_release_date', ('feed_id', 'releaseDateObj')),
+            ('item_feed_watched', ('feed_id', 'keep', 'watchedTime')),
     )
 
 class FeedSchema(DDBObjectSchema):
@@ -554,6 +556,7 @@ class RSSFeedImplSchema(FeedImplSchema):
         ('initialHTML', SchemaBinary(noneOk=True)),
         ('etag', SchemaString(noneOk=True)),
         ('modified', SchemaString(noneOk=True)),
+        ('content_fingerprint', SchemaString(noneOk=True)),
     ]
 
 class SavedSearchFeedImplSchema(FeedImplSchema):
@@ -636,6 +639,7 @@ class RemoteDownloaderSchema(DDBObjectSchema):
 
     indexes = (
         ('downloader_state', ('state',)),
+        ('downloader_main_item', ('main_item_id',)),
     )
 
     @staticmethod
@@ -690,6 +694,7 @@ class PlaylistItemMapSchema(DDBObjectSchema):
 
     indexes = (
         ('playlist_item_map_item_id', ('item_id',)),
+        ('playlist_item_map_position', ('playlist_id', 'position')),
     )
 
 class PlaylistFolderItemMapSchema(DDBObjectSchema):
@@ -704,6 +709,7 @@ class PlaylistFolderItemMapSchema(DDBObjectSchema):
 
     indexes = (
         ('playlist_folder_item_map_item_id', ('item_id',)),
+        ('playlist_folder_item_map_position', ('playlist_id', 'position')),
     )
 
 class TabOrderSchema(DDBObjectSchema):
@@ -879,7 +885,7 @@ class MetadataEntrySchema(DDBObjectSchema):
         ('metadata_entry_status_and_source', ('status_id', 'source')),
     )
 
-VERSION = 177
+VERSION = 181
 
 object_schemas = [
     IconCacheSchema, ItemSchema, FeedSchema,
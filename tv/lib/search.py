@@ -30,8 +30,15 @@
 """search.py -- Indexed searching of items.
 
 To make incremental search fast, we index the N-grams for each item.
+
+rank_matches() can be used to sort search results by relevance.
 """
+import array
+import bisect
 import collections
+from datetime import datetime
+import heapq
+import math
 import os
 import re
 
@@ -46,6 +53,18 @@ WORDMATCHER = re.compile("\w+", re.UNICODE)
 NGRAM_MIN = 3
 NGRAM_MAX = 5
 SEARCHOBJECTS = {}
+# how many results to return from ranked searches by default
+RANKED_LIMIT = 200
+# how much a match in each field counts for ranked searches
+TITLE_WEIGHT = 8.0
+ARTIST_WEIGHT = 4.0
+FEED_WEIGHT = 2.0
+DESCRIPTION_WEIGHT = 1.5
+FILENAME_WEIGHT = 1.0
+# new items get their score multiplied by up to (1 + RECENCY_WEIGHT).  The
+# boost is halved every RECENCY_HALF_LIFE days.
+RECENCY_WEIGHT = 0.5
+RECENCY_HALF_LIFE = 30.0
 
 def _get_boolean_search(search_string):
     if not SEARCHOBJECTS.has_key(search_string):
@@ -113,6 +132,75 @@ def _calc_search_text(item_info):
         match_against.append(filename_to_unicode(filename))
     return (' '.join(match_against)).lower()
 
+def _calc_weighted_fields(item_info):
+    """Get the fields that _calc_search_text() uses, along with how much a
+    match in each one is worth.
+
+    :returns: list of (weight, lowercased text) tuples
+    """
+    fields = [(TITLE_WEIGHT, item_info.name),
+              (DESCRIPTION_WEIGHT, item_info.description)]
+    for text in (item_info.artist, item_info.album, item_info.genre):
+        if text is not None:
+            fields.append((ARTIST_WEIGHT, text))
+    if item_info.feed_name is not None:
+        fields.append((FEED_WEIGHT, item_info.feed_name))
+    if item_info.download_info and item_info.download_info.torrent:
+        fields.append((FILENAME_WEIGHT, u'torrent'))
+    if item_info.video_path:
+        filename = os.path.basename(item_info.video_path)
+        fields.append((FILENAME_WEIGHT, filename_to_unicode(filename)))
+    return [(weight, text.lower()) for weight, text in fields if text]
+
+def _recency_boost(item_info, now):
+    date = item_info.release_date
+    if not isinstance(date, datetime) or date == datetime.min:
+        date = item_info.date_added
+    if not isinstance(date, datetime):
+        return 1.0
+    age = now - date
+    age_days = max(age.days + age.seconds / 86400.0, 0)
+    return 1.0 + RECENCY_WEIGHT * (0.5 ** (age_days / RECENCY_HALF_LIFE))
+
+def score_item(item_info, search_text, now=None):
+    """Calculate how well an item matches a search.
+
+    Each positive term in the search scores points for every field it's
+    found in, based on the field's weight and how many times it occurs.  The
+    total gets a boost for recently released items.
+
+    This doesn't check if the item actually matches the search, use
+    item_matches() or ItemSearcher.search() for that.
+    """
+    if now is None:
+        now = datetime.now()
+    parsed_search = _get_boolean_search(search_text)
+    score = 0.0
+    fields = _calc_weighted_fields(item_info)
+    for term in parsed_search.positive_terms:
+        if len(term) < NGRAM_MIN:
+            continue
+        for weight, text in fields:
+            count = text.count(term)
+            if count:
+                score += weight * (1.0 + math.log(count))
+    return score * _recency_boost(item_info, now)
+
+def rank_matches(id_list, get_info, search_text, limit=RANKED_LIMIT):
+    """Pick the best matches for a search.
+
+    :param id_list: ids of the items that match search_text
+    :param get_info: function that returns the ItemInfo for an id
+    :param search_text: search_text that was used to find the items
+    :param limit: max number of ids to return
+
+    :returns: list of the top ids, best match first
+    """
+    now = datetime.now()
+    scored = ((score_item(get_info(id_), search_text, now), id_)
+              for id_ in id_list)
+    return [id_ for (score, id_) in heapq.nlargest(limit, scored)]
+
 def calc_search_terms(item_info):
     """Return a list of terms that we want to index for an ItemInfo. """
     return WORDMATCHER.findall(_calc_search_text(item_info))
@@ -189,7 +277,13 @@ def list_matches(item_infos, search_text):
 class ItemSearcher(object):
     """Index Item objects so that they can be searched quickly """
 
-    def __init__(self):
+    def __init__(self, get_info=None):
+        """Create an ItemSearcher
+
+        :param get_info: function that returns the ItemInfo for an id.  Only
+            needed for search_ranked().
+        """
+        self.get_info = get_info
         # map N-grams -> set of item ids
         self._ngram_map = collections.defaultdict(set)
         # map item id -> list of N-grams
@@ -228,11 +322,14 @@ class ItemSearcher(object):
         grams = _ngrams_for_term(term)
         # note that we need to copy the value from _ngram_map.  We don't want
         # our calls to intersection_update to change it.
-        rv = set(self._ngram_map[grams[0]])
+        rv = set(self._ngram_map.get(grams[0], ()))
         for gram in grams[1:]:
-            rv.intersection_update(self._ngram_map[gram])
+            rv.intersection_update(self._ngram_map.get(gram, ()))
         return rv
 
+    def _all_ids(self):
+        return set(self._item_ngrams.keys())
+
     def search(self, search_text):
         """Search through the index items.
 
@@ -253,8 +350,208 @@ class ItemSearcher(object):
             for term in positive_terms[1:]:
                 matching_ids.intersection_update(self._term_search(term))
         else:
-            matching_ids = set(self._item_ngrams.keys())
+            matching_ids = self._all_ids()
 
         for term in negative_terms:
             matching_ids.difference_update(self._term_search(term))
         return matching_ids
+
+    def search_ranked(self, search_text, k=RANKED_LIMIT):
+        """Search through the index items and rank the results.
+
+        :param search_text: search_text to search with
+        :param k: max number of ids to return
+
+        :returns: list of the ids that best match the search, best first
+        """
+        return rank_matches(self.search(search_text), self.get_info,
+                            search_text, k)
+
+def _intersect_sorted(first, second):
+    """Intersect 2 sorted arrays of ids.
+
+    :returns: sorted array of ids in both arrays
+    """
+    if len(first) > len(second):
+        first, second = second, first
+    if len(first) * 8 >= len(second):
+        # The arrays are about the same size.  Merging them in python is
+        # slower than letting a set do the work.
+        return array.array('i', sorted(set(first).intersection(second)))
+    # first is much smaller, find each of its ids in second using a binary
+    # search, starting from where the last one was found.
+    rv = array.array('i')
+    lo = 0
+    len_second = len(second)
+    for id_ in first:
+        lo = bisect.bisect_left(second, id_, lo)
+        if lo == len_second:
+            break
+        if second[lo] == id_:
+            rv.append(id_)
+    return rv
+
+class CompactItemSearcher(ItemSearcher):
+    """ItemSearcher that uses less memory for large indexes.
+
+    Instead of a set of ids for each N-gram, we give each N-gram an integer
+    key and store a sorted array of ids for each key.  Searches intersect the
+    arrays by merging them.
+
+    Changing a sorted array is expensive, so we don't do it right away.
+    Added ids get stored in a pending set for the key and removed ids get
+    stored as tombstones.  When we search for a key with pending changes, or
+    when the total number of pending changes reaches COMPACT_THRESHOLD (or
+    the number of items, if that's larger), we merge the changes into the
+    arrays.
+    """
+
+    COMPACT_THRESHOLD = 50000
+
+    def __init__(self, get_info=None):
+        self.get_info = get_info
+        # map N-grams -> integer keys
+        self._ngram_keys = {}
+        # list of sorted id arrays, indexed by key
+        self._postings = []
+        # map key -> set of ids added/removed since the last compaction
+        self._added = {}
+        self._tombstones = {}
+        self._pending_count = 0
+        # map item id -> array of keys for the item's N-grams
+        self._item_keys = {}
+
+    def _key_for_ngram(self, ngram):
+        try:
+            return self._ngram_keys[ngram]
+        except KeyError:
+            key = self._ngram_keys[ngram] = len(self._postings)
+            self._postings.append(array.array('i'))
+            return key
+
+    def _add_item(self, item_info):
+        # This gets called a lot when building the index, so it's written to
+        # avoid attribute lookups in the loops.
+        item_id = item_info.id
+        ngram_keys = self._ngram_keys
+        keys = set()
+        for ngram in _ngrams_for_item(item_info):
+            key = ngram_keys.get(ngram)
+            if key is None:
+                key = self._key_for_ngram(ngram)
+            keys.add(key)
+        added = self._added
+        tombstones = self._tombstones
+        for key in keys:
+            if tombstones and item_id in tombstones.get(key, ()):
+                # the id is still in the array, so just drop the tombstone
+                tombstones[key].discard(item_id)
+            elif key in added:
+                added[key].add(item_id)
+            else:
+                added[key] = set([item_id])
+        self._pending_count += len(keys)
+        self._item_keys[item_id] = array.array('i', keys)
+        self._check_compact()
+
+    def _remove_item(self, item_id):
+        for key in self._item_keys.pop(item_id):
+            added = self._added.get(key)
+            if added is not None and item_id in added:
+                # the id never made it into the array
+                added.discard(item_id)
+            else:
+                self._tombstones.setdefault(key, set()).add(item_id)
+            self._pending_count += 1
+        self._check_compact()
+
+    def _check_compact(self):
+        if self._pending_count >= max(self.COMPACT_THRESHOLD,
+                                      len(self._item_keys)):
+            self.compact()
+
+    def compact(self):
+        """Merge all pending changes into the posting arrays."""
+        for key in set(self._added) | set(self._tombstones):
+            self._compact_key(key)
+        self._pending_count = 0
+
+    def _compact_key(self, key):
+        added = self._added.pop(key, None)
+        tombstones = self._tombstones.pop(key, None)
+        if not added and not tombstones:
+            return
+        postings = self._postings[key]
+        if not tombstones:
+            added = sorted(added)
+            if not postings or added[0] > postings[-1]:
+                # common case: new items have higher ids than the old ones,
+                # so we can just append them.
+                postings.extend(added)
+                return
+        ids = set(postings)
+        if tombstones:
+            ids.difference_update(tombstones)
+        if added:
+            ids.update(added)
+        self._postings[key] = array.array('i', sorted(ids))
+
+    def _postings_for_ngram(self, ngram):
+        key = self._ngram_keys.get(ngram)
+        if key is None:
+            return array.array('i')
+        if key in self._added or key in self._tombstones:
+            self._compact_key(key)
+        return self._postings[key]
+
+    def _term_postings(self, term):
+        """Get a sorted array of ids that match a term."""
+        grams = _ngrams_for_term(term)
+        # start with the shortest posting list, so that the intersections are
+        # as fast as possible
+        posting_lists = sorted((self._postings_for_ngram(gram)
+                                for gram in grams), key=len)
+        rv = posting_lists[0]
+        for postings in posting_lists[1:]:
+            if not rv:
+                break
+            rv = _intersect_sorted(rv, postings)
+        return rv
+
+    def _term_search(self, term):
+        return set(self._term_postings(term))
+
+    def _all_ids(self):
+        return set(self._item_keys.keys())
+
+    def search(self, search_text):
+        """Search through the index items.
+
+        :param search_text: search_text to search with
+
+        :returns: set of ids that match the search
+        """
+        parsed_search = _get_boolean_search(search_text)
+        positive_terms = [t for t in parsed_search.positive_terms
+                if len(t) >= NGRAM_MIN]
+        negative_terms = [t for t in parsed_search.negative_terms
+                if len(t) >= NGRAM_MIN]
+
+        if positive_terms:
+            posting_lists = sorted((self._term_postings(term)
+                                    for term in positive_terms), key=len)
+            matching = posting_lists[0]
+            for postings in posting_lists[1:]:
+                if not matching:
+                    break
+                matching = _intersect_sorted(matching, postings)
+            matching_ids = set(matching)
+        else:
+            matching_ids = self._all_ids()
+
+        for term in negative_terms:
+            if not matching_ids:
+                break
+            matching_ids.difference_update(self._term_postings(term))
+        return matching_ids
+
@@ -0,0 +1,314 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.searchindex`` -- Persistent N-gram index for item searches.
+
+SearchIndex is a search.ItemSearcher for all items in the database.  It's
+owned by the backend and kept up to date using the added/changed/removed
+signals from ItemInfoCache.  The frontend sends a SearchItems message to
+filter item lists, so they don't need to build their own index.
+
+The index is stored in 2 tables:
+
+    - item_search_postings maps each N-gram to the ids of the items that
+      contain it, stored as a packed array of ints.  We load this at startup
+      to build the in-memory index.
+    - item_search_ngrams stores the N-grams for each item.  We normally get
+      the old N-grams for changed/removed items from the ItemInfos that
+      ItemInfoCache passes us, so this is only read as a fallback.
+
+We save our changes whenever ItemInfoCache saves, along with the token from
+its saved signal.  If the token doesn't match when we load, the two got out
+of sync (for example we crashed in between the saves), so we throw away the
+tables and rebuild the index from the ItemInfos.  We also do that if
+anything else looks wrong.
+"""
+
+import array
+import collections
+import logging
+import threading
+
+from miro import app
+from miro import search
+
+class SearchIndex(search.ItemSearcher):
+    """Index all items in the database for searching.
+
+    search() can be called from any thread.  The other methods should only
+    be called from the backend thread.
+    """
+
+    VERSION_KEY = 'item_search_index_version'
+    # ItemInfoCache save token that our saved data goes with
+    TOKEN_KEY = 'item_search_index_token'
+    # bump this if we change the table format
+    VERSION = 1
+
+    def __init__(self, item_info_cache):
+        search.ItemSearcher.__init__(self, item_info_cache.get_info)
+        self.item_info_cache = item_info_cache
+        # we don't store N-grams for each item in memory, they're in the
+        # item_search_ngrams table.  _ids stores the ids we've indexed.
+        self._item_ngrams = None
+        self._ids = set()
+        self._lock = threading.Lock()
+        self._reset_changes()
+        self._callback_handles = [
+            item_info_cache.connect('added', self._on_info_added),
+            item_info_cache.connect('changed', self._on_info_changed),
+            item_info_cache.connect('removed', self._on_info_removed),
+            item_info_cache.connect('saved', self._on_info_cache_saved),
+        ]
+
+    def version(self):
+        return "%s-%s-%s-%s" % (self.VERSION, search.NGRAM_MIN,
+                                search.NGRAM_MAX,
+                                self.item_info_cache.version())
+
+    def _reset_changes(self):
+        # maps item ids -> N-gram list, or None if the item was removed
+        self._changed_items = {}
+        self._changed_ngrams = set()
+
+    def load(self):
+        try:
+            loaded = self._quick_load()
+        except StandardError, e:
+            logging.warn("Error loading search index: %s", e)
+            loaded = False
+        if not loaded:
+            self._rebuild()
+        app.db.set_variable(self.VERSION_KEY, self.version())
+
+    def _quick_load(self):
+        """Load the index from the DB.
+
+        :returns: True if the load was successful
+        """
+        if self.item_info_cache.did_failsafe_load:
+            return False
+        if app.db.get_variable(self.VERSION_KEY) != self.version():
+            return False
+        if (app.db.get_variable(self.TOKEN_KEY) !=
+                self.item_info_cache.save_token):
+            return False
+        app.db.cursor.execute("SELECT id FROM item_search_ngrams")
+        ids = set(row[0] for row in app.db.cursor)
+        if ids != set(self.item_info_cache.id_to_info):
+            return False
+        ngram_map = collections.defaultdict(set)
+        app.db.cursor.execute("SELECT ngram, ids FROM item_search_postings")
+        for ngram, id_blob in app.db.cursor:
+            id_array = array.array('i')
+            id_array.fromstring(str(id_blob))
+            ngram_map[ngram] = set(id_array)
+        self._ngram_map = ngram_map
+        self._ids = ids
+        return True
+
+    def _rebuild(self):
+        """Rebuild the index from ItemInfoCache."""
+        logging.info("Rebuilding search index")
+        app.db.unset_variable(self.TOKEN_KEY)
+        app.db.cursor.execute("DELETE FROM item_search_ngrams")
+        app.db.cursor.execute("DELETE FROM item_search_postings")
+        with self._lock:
+            self._ngram_map = collections.defaultdict(set)
+            self._ids = set()
+            self._reset_changes()
+            for info in self.item_info_cache.all_infos():
+                self._add_item(info)
+        self.schedule_save_to_db()
+
+    def unlink(self):
+        for handle in self._callback_handles:
+            self.item_info_cache.disconnect(handle)
+        self._callback_handles = []
+
+    def _on_info_added(self, item_info_cache, info):
+        if info.id in self._ids:
+            self.update_item(info)
+        else:
+            self.add_item(info)
+
+    def _on_info_changed(self, item_info_cache, info, old_info):
+        if info.id not in self._ids:
+            self.add_item(info)
+            return
+        new_ngrams = set(search._ngrams_for_item(info))
+        old_ngrams = set(search._ngrams_for_item(old_info))
+        if new_ngrams != old_ngrams:
+            with self._lock:
+                self._change_item(info.id, old_ngrams, new_ngrams)
+            self.schedule_save_to_db()
+
+    def _on_info_removed(self, item_info_cache, info):
+        if info.id in self._ids:
+            self.remove_item(info.id, search._ngrams_for_item(info))
+
+    def add_item(self, item_info):
+        with self._lock:
+            search.ItemSearcher.add_item(self, item_info)
+        self.schedule_save_to_db()
+
+    def update_item(self, item_info):
+        with self._lock:
+            search.ItemSearcher.update_item(self, item_info)
+        self.schedule_save_to_db()
+
+    def remove_item(self, item_id, item_ngrams=None):
+        """Remove an item from the index.
+
+        :param item_id: id of the item to remove
+        :param item_ngrams: N-grams we indexed for the item.  If not given,
+                            we read them from the item_search_ngrams table.
+        """
+        with self._lock:
+            self._remove_item(item_id, item_ngrams)
+        self.schedule_save_to_db()
+
+    def _add_item(self, item_info):
+        item_ngrams = set(search._ngrams_for_item(item_info))
+        for ngram in item_ngrams:
+            self._ngram_map[ngram].add(item_info.id)
+        self._ids.add(item_info.id)
+        self._changed_items[item_info.id] = item_ngrams
+        self._changed_ngrams.update(item_ngrams)
+
+    def _change_item(self, item_id, old_ngrams, new_ngrams):
+        """Update the index for the N-grams that changed for an item."""
+        for ngram in old_ngrams - new_ngrams:
+            id_set = self._ngram_map.get(ngram)
+            if id_set is not None:
+                id_set.discard(item_id)
+                if not id_set:
+                    del self._ngram_map[ngram]
+        for ngram in new_ngrams - old_ngrams:
+            self._ngram_map[ngram].add(item_id)
+        self._changed_items[item_id] = new_ngrams
+        self._changed_ngrams.update(old_ngrams.symmetric_difference(
+            new_ngrams))
+
+    def _remove_item(self, item_id, item_ngrams=None):
+        if item_ngrams is None:
+            item_ngrams = self._get_item_ngrams(item_id)
+        for ngram in item_ngrams:
+            id_set = self._ngram_map.get(ngram)
+            if id_set is not None:
+                id_set.discard(item_id)
+                if not id_set:
+                    del self._ngram_map[ngram]
+        self._ids.remove(item_id)
+        self._changed_items[item_id] = None
+        self._changed_ngrams.update(item_ngrams)
+
+    def _get_item_ngrams(self, item_id):
+        """Get the N-grams that we indexed for an item.
+
+        Raises a KeyError if the item is not in the index.
+        """
+        if item_id in self._changed_items:
+            item_ngrams = self._changed_items[item_id]
+            if item_ngrams is None:
+                raise KeyError(item_id)
+            return item_ngrams
+        app.db.cursor.execute("SELECT ngrams FROM item_search_ngrams "
+                              "WHERE id=?", (item_id,))
+        row = app.db.cursor.fetchone()
+        if row is None:
+            raise KeyError(item_id)
+        return row[0].split()
+
+    def _all_ids(self):
+        return set(self._ids)
+
+    def search(self, search_text):
+        """Search through all items in the database.
+
+        :param search_text: search_text to search with
+
+        :returns: set of ids that match the search
+        """
+        with self._lock:
+            return search.ItemSearcher.search(self, search_text)
+
+    def schedule_save_to_db(self):
+        # we save when ItemInfoCache does, so that our data matches its data
+        self.item_info_cache.schedule_save_to_db()
+
+    def _on_info_cache_saved(self, item_info_cache, token):
+        app.db.cursor.execute("BEGIN TRANSACTION")
+        try:
+            self._save_item_ngrams()
+            self._save_postings()
+        except StandardError:
+            app.db.cursor.execute("ROLLBACK TRANSACTION")
+            raise
+        else:
+            app.db.cursor.execute("COMMIT TRANSACTION")
+        self._reset_changes()
+        app.db.set_variable(self.TOKEN_KEY, token)
+
+    def _save_item_ngrams(self):
+        deleted = []
+        replaced = []
+        for item_id, item_ngrams in self._changed_items.iteritems():
+            if item_ngrams is None:
+                deleted.append((item_id,))
+            else:
+                replaced.append((item_id, u' '.join(item_ngrams)))
+        app.db.cursor.executemany("DELETE FROM item_search_ngrams "
+                                  "WHERE id=?", deleted)
+        app.db.cursor.executemany("REPLACE INTO item_search_ngrams "
+                                  "(id, ngrams) VALUES (?, ?)", replaced)
+
+    def _save_postings(self):
+        deleted = []
+        replaced = []
+        for ngram in self._changed_ngrams:
+            id_set = self._ngram_map.get(ngram)
+            if id_set:
+                id_array = array.array('i', sorted(id_set))
+                replaced.append((ngram, buffer(id_array.tostring())))
+            else:
+                deleted.append((ngram,))
+        app.db.cursor.executemany("DELETE FROM item_search_postings "
+                                  "WHERE ngram=?", deleted)
+        app.db.cursor.executemany("REPLACE INTO item_search_postings "
+                                  "(ngram, ids) VALUES (?, ?)", replaced)
+
+def create_sql():
+    """Get the SQL needed to create the tables for the search index."""
+    return [
+        "CREATE TABLE item_search_ngrams(id INTEGER PRIMARY KEY, "
+        "ngrams TEXT)",
+        "CREATE TABLE item_search_postings(ngram TEXT PRIMARY KEY, "
+        "ids BLOB)",
+    ]
@@ -26,6 +26,8 @@
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
 
+import bisect
+import collections
 import errno
 import logging
 import os
@@ -81,6 +83,13 @@ supported_filetypes = filetypes.VIDEO_EXTENSIONS + filetypes.AUDIO_EXTENSIONS
 # vs daap which is millisecond.
 DURATION_SCALE = 1000
 
+# Number of item changes SharingManagerBackend remembers for answering
+# delta requests.  Clients further behind than that get a full listing.
+CHANGE_LOG_SIZE = 10000
+
+ITEM_CHANGED = 'changed'
+ITEM_DELETED = 'deleted'
+
 MIRO_ITEMKIND_MOVIE = (1 << 0)
 MIRO_ITEMKIND_PODCAST = (1 << 1)
 MIRO_ITEMKIND_SHOW = (1 << 2)
@@ -1151,9 +1160,25 @@ class SharingManagerBackend(object):
         # XXX daapplaylist should be hidden from view. 
         self.daapitems = dict()         # DAAP format XXX - index via the items
         self.daap_playlists = dict()    # Playlist, in daap format
-        self.playlist_item_map = dict() # Playlist -> item mapping
-        self.deleted_item_map = dict()  # Playlist -> deleted item mapping
+        self.playlist_item_map = dict() # Playlist -> set of item ids
+        self.deleted_item_map = dict()  # Playlist -> removed item -> revision
         self.in_shutdown = False
+        # Encoded item listings served by the DAAP server, dropped
+        # whenever the revision changes.
+        self.response_cache = libdaap.ResponseCache()
+        self.response_cache.invalidate(self.revision)
+        # (revision, item id, ITEM_CHANGED/ITEM_DELETED), oldest first.
+        # Changes at or before change_log_horizon may have been dropped.
+        self.change_log = []
+        self.change_log_horizon = self.revision
+        # (revision, item id) of deleted_item() entries, oldest first, and
+        # the last revision each session told us it has seen.  Deleted
+        # entries are dropped once every session is past them.
+        self.tombstones = collections.deque()
+        self.client_revisions = dict()
+        # Session -> callback for /update requests parked by an event
+        # driven DAAP server, see add_revision_waiter().
+        self.revision_waiters = dict()
         self.config_handle = app.backend_config_watcher.connect('changed',
                              self.on_config_changed)
 
@@ -1170,16 +1195,16 @@ class SharingManagerBackend(object):
     def handle_item_list(self, message):
         with self.item_lock:
             self.update_revision()
-            item_ids = [item.id for item in message.items]
+            item_ids = set(item.id for item in message.items)
             if message.id is not None:
                 self.daap_playlists[message.id]['revision'] = self.revision
                 self.playlist_item_map[message.id] = item_ids
-                self.deleted_item_map[message.id] = []
+                self.deleted_item_map[message.id] = dict()
                 # Update the revision of these items, so they will match
                 # when the playlist items are fetched.
                 for item_id in item_ids:
                     try:
-                        self.daapitems[item_id]['revision'] = self.revision
+                        self.touch_item(item_id)
                     except KeyError:
                         # This non-downloaded podcast item?  I think what
                         # we want to do here is set it as a podcast item
@@ -1189,11 +1214,13 @@ class SharingManagerBackend(object):
                         # stuff from the individual feeds.
                         pass
             else:
-                deleted = [item_id for item_id in self.daapitems if
-                           item_id not in item_ids]
+                # Items already deleted don't need to be deleted again.
+                deleted = [item_id for item_id, item in
+                           self.daapitems.iteritems() if
+                           item['valid'] and item_id not in item_ids]
                 self.make_item_dict(message.items)
                 for d in deleted:
-                    self.daapitems[d] = self.deleted_item()
+                    self.delete_item(d)
 
     def handle_items_changed(self, message):
         # If items are changed, overwrite with a recreated entry.  This
@@ -1208,24 +1235,18 @@ class SharingManagerBackend(object):
                         revision = self.revision
                         self.daap_playlists[message.id]['revision'] = revision
                         self.playlist_item_map[message.id].remove(itemid)
-                        self.deleted_item_map[message.id].append(itemid)
-                except KeyError:
-                    pass
-                try:
-                    if message.id is None:
-                        self.daapitems[itemid] = self.deleted_item()
+                        self.deleted_item_map[message.id][itemid] = revision
                 except KeyError:
                     pass
+                if message.id is None:
+                    self.delete_item(itemid)
             if message.id is not None:
                 item_ids = [item.id for item in message.added]
                 self.daap_playlists[message.id]['revision'] = self.revision
                 # If they have been previously removed, unmark deleted.
                 for i in item_ids:
-                    try:
-                        self.deleted_item_map[message.id].remove(i)
-                    except ValueError:
-                        pass
-                self.playlist_item_map[message.id] += item_ids
+                    self.deleted_item_map[message.id].pop(i, None)
+                self.playlist_item_map[message.id].update(item_ids)
 
             # Only make or modify an item if it is for main library.
             # Otherwise, we just re-create an item when all that's changed
@@ -1242,23 +1263,84 @@ class SharingManagerBackend(object):
                 # available podcasts come into view.
                 for x in message.added:
                     try:
-                        self.daapitems[x.id]['revision'] = self.revision
+                        self.touch_item(x.id)
                     except KeyError:
                         pass
                 for x in message.changed:
                     try:
-                        self.daapitems[x.id]['revision'] = self.revision
+                        self.touch_item(x.id)
                     except KeyError: 
                         pass
 
     def deleted_item(self):
         return dict(revision=self.revision, valid=False)
 
+    # At this point: item_lock acquired
+    def log_change(self, item_id, op):
+        self.change_log.append((self.revision, item_id, op))
+        if len(self.change_log) > 2 * CHANGE_LOG_SIZE:
+            # Trim in bulk so that logging a change stays cheap.
+            cut = len(self.change_log) - CHANGE_LOG_SIZE
+            self.change_log_horizon = self.change_log[cut - 1][0]
+            del self.change_log[:cut]
+
+    # At this point: item_lock acquired
+    def reset_change_log(self):
+        self.change_log = []
+        self.change_log_horizon = self.revision
+
+    # At this point: item_lock acquired.  Raises KeyError for unknown items.
+    def touch_item(self, item_id):
+        self.daapitems[item_id]['revision'] = self.revision
+        self.log_change(item_id, ITEM_CHANGED)
+
+    # At this point: item_lock acquired
+    def delete_item(self, item_id):
+        self.daapitems[item_id] = self.deleted_item()
+        self.tombstones.append((self.revision, item_id))
+        self.log_change(item_id, ITEM_DELETED)
+
+    # At this point: item_lock acquired
+    def changes_since(self, delta):
+        """Get a dict mapping the ids of items changed after revision delta
+        to their last change, or None if the change log doesn't go back that
+        far.
+        """
+        if delta < self.change_log_horizon:
+            return None
+        start = bisect.bisect_left(self.change_log, (delta + 1,))
+        changes = dict()
+        for revision, item_id, op in self.change_log[start:]:
+            changes[item_id] = op
+        return changes
+
+    # At this point: item_lock acquired
+    def compact_tombstones(self):
+        # Sessions that have seen a revision have also seen every deletion
+        # up to it.  New sessions start with a full listing, so they don't
+        # need the old deletions either.
+        if self.client_revisions:
+            horizon = min(self.client_revisions.itervalues())
+        else:
+            horizon = self.revision
+        while self.tombstones and self.tombstones[0][0] <= horizon:
+            revision, item_id = self.tombstones.popleft()
+            item = self.daapitems.get(item_id)
+            # The item may have come back since.
+            if (item is not None and not item['valid'] and
+              item['revision'] <= horizon):
+                del self.daapitems[item_id]
+
     # At this point: item_lock acquired
     def update_revision(self, directed=None):
         self.revision += 1
         self.directed = directed
+        self.response_cache.invalidate(self.revision)
         self.revision_cv.notify_all()
+        waiters = self.revision_waiters
+        self.revision_waiters = dict()
+        for callback in waiters.itervalues():
+            callback(self.revision)
 
     def make_daap_playlists(self, items, typ):
         for item in items:
@@ -1343,8 +1425,8 @@ class SharingManagerBackend(object):
                 for p in playlists:
                     # no need to update the revision here: already done in
                     # make_daap_playlists.
-                    self.playlist_item_map[p.id] = []
-                    self.deleted_item_map[p.id] = []
+                    self.playlist_item_map[p.id] = set()
+                    self.deleted_item_map[p.id] = dict()
                     app.info_updater.item_list_callbacks.add(self.type,
                                                      p.id,
                                                      self.handle_item_list)
@@ -1429,16 +1511,16 @@ class SharingManagerBackend(object):
             for playlist_id in self.daap_playlists.keys():
                 # revision for playlist already created in make_daap_playlist
                 if playlist_id in playlist_ids:
-                    self.playlist_item_map[playlist_id] = [x.item_id
+                    self.playlist_item_map[playlist_id] = set(x.item_id
                       for x in playlist.PlaylistItemMap.playlist_view(
-                      playlist_id)]
+                      playlist_id))
                 elif playlist_id in feed_ids:
-                    self.playlist_item_map[playlist_id] = [x.id
-                      for x in Item.feed_view(playlist_id)]
+                    self.playlist_item_map[playlist_id] = set(x.id
+                      for x in Item.feed_view(playlist_id))
                 else:
                     logging.error('playlist id %s not valid', playlist_id)
                     continue
-                self.deleted_item_map[playlist_id] = []
+                self.deleted_item_map[playlist_id] = dict()
 
     def start_tracking(self):
         self.populate_playlists()
@@ -1513,10 +1595,15 @@ class SharingManagerBackend(object):
 
     def get_revision(self, session, old_revision, request):
         self.revision_cv.acquire()
-        while self.revision == old_revision:
+        self.client_revisions[session] = old_revision
+        self.compact_tombstones()
+        # One watcher is enough: it keeps watching the socket while we wait
+        # again after wakeups meant for other sessions.
+        if self.revision == old_revision:
             t = threading.Thread(target=self.watcher, args=(session, request))
             t.daemon = True
             t.start()
+        while self.revision == old_revision:
             self.revision_cv.wait()
             # If we really did a update or if the wakeup was directed at us
             # (because we are quitting or something) then release the lock
@@ -1528,6 +1615,28 @@ class SharingManagerBackend(object):
         self.revision_cv.release()
         return self.revision
 
+    def add_revision_waiter(self, session, old_revision, callback):
+        """Non-blocking get_revision() for event driven DAAP servers.
+
+        Returns the current revision if it differs from old_revision.
+        Otherwise returns None, and callback is called with the new
+        revision, with item_lock held, the next time it changes.
+        """
+        with self.item_lock:
+            self.client_revisions[session] = old_revision
+            self.compact_tombstones()
+            if self.revision != old_revision:
+                return self.revision
+            self.revision_waiters[session] = callback
+            return None
+
+    def remove_revision_waiter(self, session):
+        with self.item_lock:
+            try:
+                del self.revision_waiters[session]
+            except KeyError:
+                pass
+
     def get_file(self, itemid, generation, ext, session, request_path_func,
                  offset=0, chunk=None):
         file_obj = None
@@ -1600,9 +1709,10 @@ class SharingManagerBackend(object):
                 if cover_art:
                     file_obj = open(cover_art, 'rb')
                     file_obj.seek(offset, os.SEEK_SET)
-            except OSError:
+            except EnvironmentError:
                 if file_obj:
                     file_obj.close()
+                file_obj = None
         else:
             # If there is an outstanding job delete it first.
             try:
@@ -1612,9 +1722,10 @@ class SharingManagerBackend(object):
             try:
                 file_obj = open(path, 'rb')
                 file_obj.seek(offset, os.SEEK_SET)
-            except OSError:
+            except EnvironmentError:
                 if file_obj:
                     file_obj.close()
+                file_obj = None
         return file_obj, os.path.basename(path)
 
     def get_playlists(self):
@@ -1650,10 +1761,17 @@ class SharingManagerBackend(object):
                 # working out what needs to be updated.
                 if share_types_orig != self.share_types:
                     self.update_revision()
+                else:
+                    # Item revisions are reset below, which changes what
+                    # a delta listing contains.
+                    self.response_cache.invalidate(self.revision)
                 for p in self.daap_playlists:
                     self.daap_playlists[p]['revision'] = self.revision
                 for i in self.daapitems:
                     self.daapitems[i]['revision'] = self.revision
+                # Everything changed at once: don't log every item, just
+                # send a full listing to anyone behind this revision.
+                self.reset_change_log()
 
     # XXX TEMPORARY: should this item be podcast?  We won't need this when
     # the item type's metadata is completely accurate and won't lie to us.
@@ -1663,47 +1781,68 @@ class SharingManagerBackend(object):
         is_feed = not any([feed_url.startswith(x) for x in ersatz_feeds])
         return item.feed_id and is_feed and not item.is_file_item
 
-    def get_items(self, playlist_id=None):
-        # Easy: just return
+    def is_shared(self, item):
+        # At this point: item_lock acquired.  Invalid (deleted) items are
+        # always passed through so the client learns about the deletion.
+        if not item['valid']:
+            return True
+        mk = item['com.apple.itunes.mediakind']
+        ik = item['org.participatoryculture.miro.itemkind']
+        podcast = ik and (ik & MIRO_ITEMKIND_PODCAST)
+        include_if_podcast = (podcast and
+                              SharingManagerBackend.SHARE_FEED in
+                              self.share_types)
+        return (mk in self.share_types and
+                (not podcast or include_if_podcast))
+
+    def get_items(self, playlist_id=None, delta=0):
+        # If the client already has revision delta, only the items changed
+        # since then are returned, using the change log when it reaches
+        # back far enough.
         with self.item_lock:
+            members = None
+            if playlist_id:
+                members = self.playlist_item_map.get(playlist_id, set())
+            changes = None
+            if delta:
+                changes = self.changes_since(delta)
+            if changes is not None:
+                if members is None:
+                    item_ids = changes.keys()
+                else:
+                    item_ids = [x for x in changes if x in members]
+            elif members is not None:
+                # Only look at the playlist's own members rather than
+                # scanning the whole library for them.
+                item_ids = members
+            else:
+                item_ids = self.daapitems.keys()
             items = dict()
-            if not playlist_id:
-                for k in self.daapitems.keys():
-                    item = self.daapitems[k]
-                    valid = item['valid']
-                    if valid:
-                        mk = item['com.apple.itunes.mediakind']
-                        ik = item['org.participatoryculture.miro.itemkind']
-                        podcast = ik and (ik & MIRO_ITEMKIND_PODCAST)
-                        include_if_podcast = (podcast and
-                          SharingManagerBackend.SHARE_FEED in self.share_types)
-                    if (not valid or
-                      mk in self.share_types and 
-                      (not podcast or include_if_podcast)):
-                        items[k] = item
-                    else:
-                        items[k] = self.deleted_item()
-                return items
-            # XXX Somehow cache this?
-            playlist = dict()
-            if self.playlist_item_map.has_key(playlist_id):
-                for x in self.daapitems.keys():
+            if members is not None:
+                # Items taken out of the playlist are sent as deleted, so
+                # that the client drops them from it.  The change log only
+                # covers the library, so check when they were taken out.
+                removed = self.deleted_item_map.get(playlist_id, {})
+                for x, revision in removed.iteritems():
+                    if changes is None or revision > delta:
+                        items[x] = self.deleted_item()
+            for x in item_ids:
+                if changes is not None and changes[x] == ITEM_DELETED:
+                    items[x] = self.deleted_item()
+                    continue
+                try:
                     item = self.daapitems[x]
-                    valid = item['valid']
-                    if valid:
-                        mk = item['com.apple.itunes.mediakind']
-                        ik = item['org.participatoryculture.miro.itemkind']
-                        podcast = ik and (ik & MIRO_ITEMKIND_PODCAST)
-                        include_if_podcast = (podcast and
-                          SharingManagerBackend.SHARE_FEED in self.share_types)
-                    if (x in self.playlist_item_map[playlist_id] and
-                      (not valid or
-                       mk in self.share_types and
-                       (not podcast or include_if_podcast))):
-                        playlist[x] = item
-                    else:
-                        playlist[x] = self.deleted_item()
-            return playlist
+                except KeyError:
+                    # Only changed items can have been compacted away
+                    # since they were logged.
+                    if changes is not None:
+                        items[x] = self.deleted_item()
+                    continue
+                if self.is_shared(item):
+                    items[x] = item
+                else:
+                    items[x] = self.deleted_item()
+            return items
 
     def make_item_dict(self, items):
         # See the daap_rmapping/daap_mapping for a list of mappings that
@@ -1793,12 +1932,19 @@ class SharingManagerBackend(object):
             itemprop['valid'] = True
 
             self.daapitems[item.id] = itemprop
+            self.log_change(item.id, ITEM_CHANGED)
 
     def finished_callback(self, session):
         # Like shutdown but only shuts down one of the sessions.  No need to
         # set shutdown.   XXX - could race - if we terminate control connection
         # and and reach here, before a transcode job arrives.  Then the
         # transcode job gets created anyway.
+        with self.item_lock:
+            try:
+                del self.client_revisions[session]
+            except KeyError:
+                pass
+            self.compact_tombstones()
         with self.transcode_lock:
             try:
                 self.transcode[session].shutdown()
@@ -2034,6 +2180,7 @@ class SharingManager(object):
                         cmd = self.r.recv(4)
                         logging.debug('sharing: CMD %s' % cmd)
                         if cmd == SharingManager.CMD_QUIT:
+                            self.server.server_close()
                             del self.thread
                             del self.server
                             self.reload_done_event.set()
@@ -2080,7 +2227,7 @@ class SharingManager(object):
 
         name = app.config.get(prefs.SHARE_NAME).encode('utf-8')
         self.server = libdaap.make_daap_server(self.backend, debug=True,
-                                               name=name)
+                                               name=name, event_driven=True)
         if not self.server:
             self.sharing = False
             return
@@ -69,6 +69,7 @@ from miro import item
 from miro import itemsource
 from miro import iteminfocache
 from miro import feed
+from miro import feedcounts
 from miro import folder
 from miro import messages
 from miro import messagehandler
@@ -81,6 +82,7 @@ from miro import tabs
 from miro import theme
 from miro import util
 from miro import searchengines
+from miro import searchindex
 from miro import storedatabase
 from miro import conversions
 from miro import devices
@@ -277,7 +279,12 @@ def finish_startup(obj, thread):
     item.setup_deleted_checker()
     logging.info("Restoring database...")
     start = time.time()
-    app.db = storedatabase.LiveStorage()
+    app.db = storedatabase.LiveStorage(
+            object_cache_size=app.config.get(prefs.DB_OBJECT_CACHE_SIZE),
+            wal_mode=app.config.get(prefs.DB_WAL_MODE))
+    # items can change during the upgrade, so this needs to exist now.  It
+    # doesn't do anything until load() is called.
+    app.feed_counts = feedcounts.FeedCounts()
     try:
         app.db.upgrade_database()
     except databaseupgrade.DatabaseTooNewError:
@@ -307,8 +314,11 @@ def finish_startup(obj, thread):
         mem_usage_test_event.set()
 
     item.setup_metadata_manager()
-    app.item_info_cache = iteminfocache.ItemInfoCache()
+    app.item_info_cache = iteminfocache.create_item_info_cache()
     app.item_info_cache.load()
+    app.search_index = searchindex.SearchIndex(app.item_info_cache)
+    app.search_index.load()
+    app.feed_counts.load()
     dbupgradeprogress.upgrade_end()
 
     logging.info("Loading video converters...")
@@ -569,34 +579,72 @@ def clear_icon_cache_orphans():
 
     # delete files in the icon cache directory that don't belong to IconCache
     # objects.
-
     cachedir = fileutil.expand_filename(app.config.get(
         prefs.ICON_CACHE_DIRECTORY))
     if not os.path.isdir(cachedir):
         return
 
-    existingFiles = [os.path.normcase(os.path.join(cachedir, f))
-            for f in os.listdir(cachedir)]
-    yield None
+    if app.db.read_pool is not None:
+        # In WAL mode, scan the directory outside the backend thread
+        app.db.call_in_read_thread(_on_icon_files_cleared,
+                _on_clear_icon_files_error, _clear_orphan_icon_files,
+                "clear orphaned icon files", cachedir)
+        return
 
-    knownIcons = iconcache.IconCache.all_filenames()
+    existing_files = _list_icon_files(cachedir)
     yield None
 
-    knownIcons = [ os.path.normcase(fileutil.expand_filename(path)) for path in
-            knownIcons]
+    known_icons = set(os.path.normcase(fileutil.expand_filename(path))
+            for path in iconcache.IconCache.all_filenames())
     yield None
 
-    for filename in existingFiles:
-        if (os.path.exists(filename)
-                and os.path.basename(filename)[0] != '.'
-                and os.path.basename(filename) != 'extracted'
-                and not filename in knownIcons):
+    for filename in existing_files:
+        if _is_orphan_icon_file(filename, known_icons):
             try:
                 os.remove(filename)
             except OSError:
                 pass
         yield None
 
+def _list_icon_files(cachedir):
+    return [os.path.normcase(os.path.join(cachedir, f))
+            for f in os.listdir(cachedir)]
+
+def _is_orphan_icon_file(filename, known_icons):
+    basename = os.path.basename(filename)
+    return (basename[0] != '.' and basename != 'extracted' and
+            filename not in known_icons and os.path.exists(filename))
+
+# In WAL mode, files newer than this might belong to IconCache objects that
+# were changed after we read the database
+ICON_FILE_GRACE_PERIOD = 3600
+
+def _clear_orphan_icon_files(reader, cachedir):
+    existing_files = _list_icon_files(cachedir)
+    known_icons = set(os.path.normcase(fileutil.expand_filename(row[0]))
+            for row in reader.select(iconcache.IconCache, ['filename'],
+                                     'filename IS NOT NULL'))
+    cutoff = time.time() - ICON_FILE_GRACE_PERIOD
+    removed_count = 0
+    for filename in existing_files:
+        if not _is_orphan_icon_file(filename, known_icons):
+            continue
+        try:
+            if os.path.getmtime(filename) > cutoff:
+                continue
+            os.remove(filename)
+        except OSError:
+            continue
+        removed_count += 1
+    return removed_count
+
+def _on_icon_files_cleared(removed_count):
+    if removed_count:
+        logging.info("Removed %d orphaned icon files", removed_count)
+
+def _on_clear_icon_files_error(error):
+    logging.warn("Error clearing orphaned icon files: %s", error)
+
 def send_startup_crash_report(report):
     logging.info("Startup failed, waiting to send crash report")
     title = _("Submitting Crash Report")
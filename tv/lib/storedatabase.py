@@ -40,10 +40,9 @@ separate column.
 Most columns are stored using SQLite datatypes (``INTEGER``, ``REAL``,
 ``TEXT``, ``DATETIME``, etc.).  However some of our python values,
 don't have an equivalent (lists, dicts and timedelta objects).  For
-those, we store the python representation of the object.  This makes
-the column look similar to a JSON value, although not quite the same.
-The hope is that it will be human readable.  We use the type
-``pythonrepr`` to label these columns.
+those, we store a tagged JSON encoding of the object (see the
+columncodec module).  We use the type ``pythonrepr`` to label these columns, since
+older databases stored the python representation of the object there.
 """
 
 import collections
@@ -52,8 +51,9 @@ import shutil
 import cPickle
 import itertools
 import logging
-import datetime
+import threading
 import traceback
+import weakref
 import time
 import os
 import sys
@@ -65,6 +65,7 @@ except ImportError:
     from pysqlite2 import dbapi2 as sqlite3
 
 from miro import app
+from miro import columncodec
 from miro import crashreport
 from miro import convert20database
 from miro import databaseupgrade
@@ -75,8 +76,11 @@ from miro import fileutil
 from miro import iteminfocache
 from miro import messages
 from miro import schema
+from miro import searchindex
 from miro import prefs
+from miro import queryprofiler
 from miro import util
+from miro import viewpredicate
 from miro.gtcache import gettext as _
 from miro.plat.utils import PlatformFilenameType, filename_to_unicode
 
@@ -110,6 +114,11 @@ _sqlite_type_map = {
 
 VERSION_KEY = "Democracy Version"
 
+# How many SQL statements to memoize.  sqlite3 keeps a cache of compiled
+# statements for each connection, which we make the same size, so the
+# statements we build the text for stay compiled as well.
+STATEMENT_CACHE_SIZE = 500
+
 class DatabaseObjectCache(object):
     """Handles caching objects for a database.
 
@@ -170,6 +179,190 @@ class DatabaseObjectCache(object):
             if key[0] == category:
                 del self._objects[key]
 
+class ReadOnlyConnectionPool(object):
+    """Pool of read-only connections to a database in WAL mode.
+
+    With write-ahead logging, readers don't block the writer and the writer
+    doesn't block readers, so these connections can be used from threads
+    other than the backend thread.  See LiveStorage.call_in_read_thread().
+    """
+    def __init__(self, path, max_idle=4):
+        self.path = path
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _open(self):
+        connection = sqlite3.connect(self.path,
+                isolation_level=None,
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                check_same_thread=False,
+                cached_statements=STATEMENT_CACHE_SIZE)
+        connection.execute("PRAGMA query_only=1")
+        return connection
+
+    def get(self):
+        """Get a connection.  Pass it to put() when you're done."""
+        with self._lock:
+            if self._closed:
+                raise ValueError("ReadOnlyConnectionPool is closed")
+            if self._idle:
+                return self._idle.pop()
+        return self._open()
+
+    def put(self, connection):
+        with self._lock:
+            if not self._closed and len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """Close the idle connections.
+
+        Connections that are in use get closed when they are passed to put().
+        """
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+class DatabaseReader(object):
+    """Read-only access to the database for LiveStorage.call_in_read_thread().
+
+    DatabaseReader only hands out plain data: rows from query() and
+    ItemInfos from item_infos().  DDBObjects can only be used in the backend
+    thread.
+    """
+    def __init__(self, storage, cursor):
+        self.storage = storage
+        self.cursor = cursor
+
+    def query(self, sql, values=()):
+        """Run a SELECT statement and return the rows as tuples."""
+        self.cursor.execute(sql, values)
+        return self.cursor.fetchall()
+
+    def select(self, klass, columns, where=None, values=None):
+        """Select columns for a DDBObject class, like DDBObject.select().
+
+        Values get converted from SQL the same way as for DDBObjects.
+        """
+        if values is None:
+            values = ()
+        rows = self.query(self.storage._get_select_sql(klass, columns, where),
+                values)
+        return self.storage._convert_rows(klass, columns, rows)
+
+    def item_infos(self, ids=None):
+        """Get ItemInfos from the item_info_cache table.
+
+        ItemInfoCache only saves that table every SAVE_INTERVAL seconds, so
+        the infos may be a little out of date.  The columnar backend doesn't
+        use the table at all.
+
+        :param ids: ids of the items to get, or None to get all items
+        """
+        if isinstance(app.item_info_cache,
+                iteminfocache.ColumnarItemInfoCache):
+            raise ValueError("item_info_cache table not in use")
+        sql = "SELECT pickle FROM item_info_cache"
+        if ids is None:
+            rows = self.query(sql)
+        else:
+            rows = []
+            for id_chunk in util.split_values_for_sqlite(list(ids)):
+                rows.extend(self.query("%s WHERE id IN (%s)" %
+                    (sql, ', '.join('?' for i in xrange(len(id_chunk)))),
+                    id_chunk))
+        return [iteminfocache.blob_to_info(row[0]) for row in rows]
+
+# Functions to build SQL text.  LiveStorage memoizes their results in a
+# SQLCache.  All arguments need to be hashable, so joins get passed as
+# a tuple of (table, on_clause) pairs -- see _joins_key().  Values,
+# including ids, always get passed as bound parameters, so that the text
+# only depends on the shape of the query.
+
+def _joins_key(joins):
+    if joins is None:
+        return None
+    return tuple(joins.items())
+
+def _query_bottom_sql(table_name, where, joins, order_by, limit):
+    sql = StringIO()
+    sql.write("FROM %s\n" % table_name)
+    if joins is not None:
+        for join_table, join_where in joins:
+            sql.write('LEFT JOIN %s ON %s\n' % (join_table, join_where))
+    if where is not None:
+        sql.write("WHERE %s" % where)
+    if order_by is not None:
+        sql.write(" ORDER BY %s" % order_by)
+    if limit is not None:
+        sql.write(" LIMIT %s" % limit)
+    return sql.getvalue()
+
+def _query_ids_sql(table_name, where, joins, order_by, limit):
+    return "SELECT %s.id %s" % (table_name, _query_bottom_sql(table_name,
+        where, joins, order_by, limit))
+
+def _query_count_sql(table_name, where, joins, limit):
+    return "SELECT COUNT(*) %s" % _query_bottom_sql(table_name, where,
+            joins, None, limit)
+
+def _select_sql(table_name, columns, where, joins, limit):
+    return "SELECT %s %s" % (', '.join(columns), _query_bottom_sql(
+        table_name, where, joins, None, limit))
+
+def _insert_sql(obj_schema):
+    return "INSERT INTO %s (%s) VALUES(%s)" % (obj_schema.table_name,
+            ', '.join(name for name, schema_item in obj_schema.fields),
+            ', '.join('?' for i in xrange(len(obj_schema.fields))))
+
+def _update_sql(table_name, columns):
+    return "UPDATE %s SET %s WHERE id=?" % (table_name,
+            ', '.join('%s=?' % name for name in columns))
+
+def _restore_sql(obj_schema, id_count):
+    column_names = ['%s.%s' % (obj_schema.table_name, f[0])
+            for f in obj_schema.fields]
+    return "SELECT %s FROM %s WHERE id IN (%s)" % (', '.join(column_names),
+            obj_schema.table_name, ', '.join('?' for i in xrange(id_count)))
+
+def _delete_sql(table_name, where):
+    sql = 'DELETE FROM %s' % table_name
+    if where is not None:
+        sql += '\nWHERE %s' % where
+    return sql
+
+class SQLCache(util.Cache):
+    """Memoizes SQL text.
+
+    Keys are tuples of a function from above and its arguments.
+
+    This isn't thread-safe, so code that runs outside the backend thread
+    (DatabaseReader) builds its SQL without it.
+    """
+    def create_new_value(self, key):
+        return key[0](*key[1:])
+
+def _call_with_pool_connection(storage, pool, function, args, kwargs):
+    connection = pool.get()
+    try:
+        cursor = connection.cursor()
+        # use a single read transaction, so that all queries see the same
+        # snapshot of the database
+        cursor.execute("BEGIN")
+        try:
+            return function(DatabaseReader(storage, cursor), *args, **kwargs)
+        finally:
+            cursor.execute("COMMIT")
+            cursor.close()
+    finally:
+        pool.put(connection)
+
 class LiveStorageErrorHandler(object):
     """Handle database errors for LiveStorage.
     """
@@ -349,9 +542,14 @@ class LiveStorage:
     Attributes:
 
     - cache -- DatabaseObjectCache object
+    - read_pool -- ReadOnlyConnectionPool if we're in WAL mode, otherwise
+      None.  Use call_in_read_thread() rather than using it directly.
+    - profiler -- QueryProfiler for our queries.  It's disabled until
+      someone calls profiler.start().
     """
     def __init__(self, path=None, error_handler=None, preallocate=None,
-                 object_schemas=None, schema_version=None):
+                 object_schemas=None, schema_version=None,
+                 object_cache_size=None, wal_mode=False):
         """Create a LiveStorage for a database
 
         :param path: path to the database (or ":memory:")
@@ -362,6 +560,11 @@ class LiveStorage:
            schema.object_schemas
         :param schema_version: current version of the schema for upgrading
            purposes.  Defaults to schema.VERSION.
+        :param object_cache_size: how many clean, evictable DDBObjects to
+           keep in memory after they are no longer used.  None or a negative
+           value means never evict them.
+        :param wal_mode: use write-ahead logging and make read-only
+           connections available through call_in_read_thread()
         """
         if path is None:
             path = app.config.get(prefs.SQLITE_PATHNAME)
@@ -390,17 +593,32 @@ class LiveStorage:
         self.cache = DatabaseObjectCache()
         self.raise_load_errors = False # only gets set in unittests
         self._dc = None
-        self._query_times = {}
+        self.profiler = queryprofiler.QueryProfiler(self._explain_query_plan)
         self.path = path
         self._quitting_from_operational_error = False
         self._object_schemas = object_schemas
         self._schema_version = schema_version
         self._schema_map = {}
         self._schema_column_map = {}
+        self._table_column_types = {}
         self._all_schemas = []
-        self._object_map = {} # maps object id -> DDBObjects in memory
-        self._ids_loaded = set()
+        # maps (id, table name) -> DDBObjects in memory.  This only holds
+        # weak references, _pinned_objects and _recent_objects keep the
+        # objects alive.
+        self._object_map = weakref.WeakValueDictionary()
+        # objects that we can't evict: non-evictable classes, objects with
+        # unsaved changes and objects with signal callbacks
+        self._pinned_objects = {}
+        # recently used evictable objects, least recent first
+        self._recent_objects = collections.OrderedDict()
+        if object_cache_size is not None and object_cache_size < 0:
+            object_cache_size = None
+        self.object_cache_size = object_cache_size
+        self.wal_mode = wal_mode
+        # ReadOnlyConnectionPool, only set if we're actually in WAL mode
+        self.read_pool = None
         self._statements_in_transaction = []
+        self._sql_cache = SQLCache(STATEMENT_CACHE_SIZE)
         eventloop.connect("event-finished", self.on_event_finished)
         for oschema in object_schemas:
             self._all_schemas.append(oschema)
@@ -410,6 +628,9 @@ class LiveStorage:
                     klass.track_attribute_changes(field_name)
             for name, schema_item in oschema.fields:
                 self._schema_column_map[oschema, name] = schema_item
+            self._table_column_types[oschema.table_name] = dict(
+                    (name, _sqlite_type_map[schema_item.__class__])
+                    for name, schema_item in oschema.fields)
         self._converter = SQLiteConverter()
 
         self.open_connection()
@@ -427,7 +648,8 @@ class LiveStorage:
         try:
             self.connection = sqlite3.connect(path,
                     isolation_level=None,
-                    detect_types=sqlite3.PARSE_DECLTYPES)
+                    detect_types=sqlite3.PARSE_DECLTYPES,
+                    cached_statements=STATEMENT_CACHE_SIZE)
         except sqlite3.Error, e:
             logging.warn("Error opening sqlite database: %s", e)
             action = self.error_handler.handle_open_error()
@@ -445,14 +667,83 @@ class LiveStorage:
 
         self.cursor = self.connection.cursor()
         try:
-            self.cursor.execute("PRAGMA journal_mode=PERSIST");
+            self._set_journal_mode(path)
         except sqlite3.DatabaseError:
-            msg = "Error running 'PRAGMA journal_mode=PERSIST'"
+            msg = "Error setting the journal mode"
             self.error_handler.handle_load_error()
             self._handle_load_error(msg, init_schema=False)
             self.created_new = True
             # rerun the command with our fresh database
-            self.cursor.execute("PRAGMA journal_mode=PERSIST");
+            self._set_journal_mode(path)
+
+    def _set_journal_mode(self, path):
+        """Set the journal mode for a newly opened connection.
+
+        If wal_mode is set, we try to use write-ahead logging and create
+        read_pool.  Otherwise, or if that fails, we use a persistent rollback
+        journal.  Note that a database in WAL mode stays that way until we
+        change the journal mode again, even for other processes.
+        """
+        self._close_read_pool()
+        if self.wal_mode and path != ':memory:':
+            self.cursor.execute("PRAGMA journal_mode=WAL")
+            if self.cursor.fetchone()[0].lower() == 'wal':
+                self.read_pool = ReadOnlyConnectionPool(path)
+                return
+            logging.warn("Couldn't turn on WAL mode for %s", path)
+        self.cursor.execute("PRAGMA journal_mode=PERSIST")
+
+    def _close_read_pool(self):
+        if self.read_pool is not None:
+            self.read_pool.close()
+            self.read_pool = None
+
+    def call_in_read_thread(self, callback, errback, function, name,
+                            *args, **kwargs):
+        """Run read-only database code without blocking the backend.
+
+        function gets called as function(reader, *args, **kwargs), where
+        reader is a DatabaseReader.  In WAL mode, it runs in the eventloop
+        thread pool with a connection from read_pool.  Otherwise it runs in
+        an idle callback using our connection, which is no faster but lets
+        callers use the same code either way.  Afterwards callback(result) or
+        errback(exception) gets called in the backend thread.
+
+        The rules for function are:
+
+        - It sees the database as of when it started, including all changes
+          made before call_in_read_thread() was called.  Changes made after
+          that may or may not be visible, but all queries that it runs see
+          the same snapshot.
+        - It can't write to the database.  Writes on a read-only connection
+          raise sqlite3.OperationalError.
+        - It can't use DDBObjects, views, or anything else that touches
+          app.db.  Instead it should return plain data (ids, rows, ItemInfos)
+          and let callback look up objects.  Those objects may have changed
+          or been removed in the meantime.
+        """
+        # Changes from the current event don't get committed until it
+        # finishes (see on_event_finished()), so start the call from an idle
+        # callback.
+        eventloop.add_idle(self._start_read_call, name,
+                args=(callback, errback, function, name, args, kwargs))
+
+    def _start_read_call(self, callback, errback, function, name, args,
+                         kwargs):
+        if self.read_pool is not None:
+            eventloop.call_in_thread(callback, errback,
+                    _call_with_pool_connection, name, self, self.read_pool,
+                    function, args, kwargs)
+            return
+        cursor = self.connection.cursor()
+        try:
+            result = function(DatabaseReader(self, cursor), *args, **kwargs)
+        except StandardError, e:
+            errback(e)
+        else:
+            callback(result)
+        finally:
+            cursor.close()
 
     def _ensure_database_directory_exists(self, path):
         if path != ':memory:' and not os.path.exists(os.path.dirname(path)):
@@ -466,8 +757,9 @@ class LiveStorage:
         trying to open a database file.
         """
         self.connection = sqlite3.connect(':memory:',
-                                          isolation_level=None,
-                                          detect_types=sqlite3.PARSE_DECLTYPES)
+                isolation_level=None,
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                cached_statements=STATEMENT_CACHE_SIZE)
         self.created_new = True
         eventloop.add_timeout(300,
                               self._try_save_temp_to_disk,
@@ -553,6 +845,9 @@ class LiveStorage:
             self._dc.cancel()
             self._dc = None
         self.finish_transaction()
+        # close the read-only connections first, so that we're the last
+        # connection and sqlite checkpoints and removes the WAL file
+        self._close_read_pool()
 
         # the unittests run in memory and vacuum causes a segfault if
         # the db is in memory.
@@ -766,13 +1061,62 @@ class LiveStorage:
                       "(name, serialized_value) VALUES (?,?)",
                       ('simulate_db_save_error', 1), is_update=True)
 
+    def _object_key(self, obj):
+        return (obj.id, app.db.table_name(obj.__class__))
+
+    def _can_evict(self, obj):
+        if (not obj.evictable or obj.changed_attributes or
+                obj.has_memory_state()):
+            return False
+        for callbacks in obj.signal_callbacks.itervalues():
+            if callbacks:
+                return False
+        return True
+
+    def _add_recent_object(self, key, obj):
+        recent = self._recent_objects
+        if key in recent:
+            del recent[key]
+        recent[key] = obj
+        if self.object_cache_size is None:
+            return
+        while len(recent) > self.object_cache_size:
+            old_key, old_obj = recent.popitem(last=False)
+            if not self._can_evict(old_obj):
+                # connected to a signal since we last checked
+                self._pinned_objects[old_key] = old_obj
+
     def remember_object(self, obj):
-        key = (obj.id, app.db.table_name(obj.__class__))
+        key = self._object_key(obj)
         self._object_map[key] = obj
-        self._ids_loaded.add(key)
+        if self._can_evict(obj):
+            self._pinned_objects.pop(key, None)
+            self._add_recent_object(key, obj)
+        else:
+            self._recent_objects.pop(key, None)
+            self._pinned_objects[key] = obj
+
+    def pin_object(self, obj):
+        """Keep an evictable object in memory.
+
+        DDBObject calls this when an object gets unsaved changes or signal
+        callbacks.  The object stays pinned until it's saved without any
+        callbacks connected.
+        """
+        key = self._object_key(obj)
+        if self._object_map.get(key) is not obj:
+            return # removed object
+        self._recent_objects.pop(key, None)
+        self._pinned_objects[key] = obj
+
+    def _object_saved(self, obj):
+        key = self._object_key(obj)
+        if key in self._pinned_objects and self._can_evict(obj):
+            del self._pinned_objects[key]
+            self._add_recent_object(key, obj)
 
     def forget_object(self, obj):
-        key = (obj.id, app.db.table_name(obj.__class__))
+        key = self._object_key(obj)
         try:
             del self._object_map[key]
         except KeyError:
@@ -780,12 +1124,18 @@ class LiveStorage:
                        'key error in forget_object: %s (obj: %s)' %
                        (obj.id, obj))
             logging.error(details)
-        self._ids_loaded.discard(key)
+        self._pinned_objects.pop(key, None)
+        self._recent_objects.pop(key, None)
+
+    def forget_all_objects(self):
+        """Drop all objects from memory.
 
-    def _insert_sql_for_schema(self, obj_schema):
-        return "INSERT INTO %s (%s) VALUES(%s)" % (obj_schema.table_name,
-                ', '.join(name for name, schema_item in obj_schema.fields),
-                ', '.join('?' for i in xrange(len(obj_schema.fields))))
+        Objects will be restored from disk again the next time they are
+        needed.
+        """
+        self._object_map = weakref.WeakValueDictionary()
+        self._pinned_objects = {}
+        self._recent_objects = collections.OrderedDict()
 
     def _values_for_obj(self, obj_schema, obj):
         values = []
@@ -806,9 +1156,10 @@ class LiveStorage:
 
         obj_schema = self._schema_map[obj.__class__]
         values = self._values_for_obj(obj_schema, obj)
-        sql = self._insert_sql_for_schema(obj_schema)
+        sql = self._sql_cache.get((_insert_sql, obj_schema))
         self._execute(sql, values, is_update=True)
         obj.reset_changed_attributes()
+        self._object_saved(obj)
 
     def bulk_insert(self, objects):
         """Insert a list of objects in one go.
@@ -824,22 +1175,23 @@ class LiveStorage:
             if obj_schema != self._schema_map[obj.__class__]:
                 raise ValueError("Incompatible types for bulk insert")
             value_list.append(self._values_for_obj(obj_schema, obj))
-        sql = self._insert_sql_for_schema(obj_schema)
+        sql = self._sql_cache.get((_insert_sql, obj_schema))
         self._execute(sql, value_list, is_update=True, many=True)
         for obj in objects:
             obj.reset_changed_attributes()
+            self._object_saved(obj)
 
     def update_obj(self, obj):
         """Update a DDBObject on disk."""
 
         obj_schema = self._schema_map[obj.__class__]
-        setters = []
+        columns = []
         values = []
         for name, schema_item in obj_schema.fields:
             if (isinstance(schema_item, schema.SchemaSimpleItem) and
                     name not in obj.changed_attributes):
                 continue
-            setters.append('%s=?' % name)
+            columns.append(name)
             value = getattr(obj, name)
             try:
                 schema_item.validate(value)
@@ -850,9 +1202,11 @@ class LiveStorage:
             values.append(self._converter.to_sql(obj_schema, name,
                 schema_item, value))
         obj.reset_changed_attributes()
+        self._object_saved(obj)
         if values:
-            sql = "UPDATE %s SET %s WHERE id=%s" % (obj_schema.table_name,
-                    ', '.join(setters), obj.id)
+            sql = self._sql_cache.get((_update_sql, obj_schema.table_name,
+                tuple(columns)))
+            values.append(obj.id)
             self._execute(sql, values, is_update=True)
             if (self.cursor.rowcount != 1 and not
                     self._quitting_from_operational_error):
@@ -868,7 +1222,7 @@ class LiveStorage:
         """Remove a DDBObject from disk."""
 
         schema = self._schema_map[obj.__class__]
-        sql = "DELETE FROM %s WHERE id=?" % (schema.table_name)
+        sql = self._sql_cache.get((_delete_sql, schema.table_name, 'id=?'))
         self._execute(sql, (obj.id,), is_update=True)
         self.forget_object(obj)
 
@@ -914,9 +1268,14 @@ class LiveStorage:
         """Get a particular DDBObject.
 
         This will throw a KeyError if id is not in the database, or if the
-        object for id has not been loaded yet.
+        object for id has not been loaded yet (or has been evicted).
         """
-        return self._object_map[(id_, app.db.table_name(klass))]
+        key = (id_, app.db.table_name(klass))
+        obj = self._object_map[key]
+        if (self.object_cache_size is not None and
+                key not in self._pinned_objects):
+            self._add_recent_object(key, obj)
+        return obj
 
     def id_alive(self, id_, klass):
         """Check if an id exists and is loaded in the database."""
@@ -931,62 +1290,80 @@ class LiveStorage:
     def object_from_class_table(self, obj, klass):
         return self._schema_map[klass] is self._schema_map[obj.__class__]
 
-    def _get_query_bottom(self, table_name, where, joins, order_by, limit):
-        sql = StringIO()
-        sql.write("FROM %s\n" % table_name)
-        if joins is not None:
-            for join_table, join_where in joins.items():
-                sql.write('LEFT JOIN %s ON %s\n' % (join_table, join_where))
-        if where is not None:
-            sql.write("WHERE %s" % where)
-        if order_by is not None:
-            sql.write(" ORDER BY %s" % order_by)
-        if limit is not None:
-            sql.write(" LIMIT %s" % limit)
-        return sql.getvalue()
+    def compile_view_predicate(self, table_name, where, values, joins=None):
+        """Compile the WHERE clause for a view into a python predicate.
+
+        :returns: ViewPredicate or None if the view uses SQL that can't be
+            checked in python (joins, subqueries, ...)
+        """
+        if joins:
+            return None
+        try:
+            return viewpredicate.compile_where(where, values, table_name,
+                    self._table_column_types[table_name])
+        except viewpredicate.CantCompile:
+            return None
+
+    def obj_matches_predicate(self, obj, predicate):
+        """Check a DDBObject against a predicate from
+        compile_view_predicate().
+
+        The check uses the in-memory values of obj, so it only matches what
+        SQL would return if obj has been saved since it was last changed.
+        """
+        obj_schema = self._schema_map[obj.__class__]
+        def get_column(name):
+            schema_item = self._schema_column_map[obj_schema, name]
+            value = self._converter.to_sql(obj_schema, name, schema_item,
+                    getattr(obj, name))
+            return viewpredicate.sql_value(value)
+        return predicate.matches(get_column)
 
     def ensure_objects_loaded(self, klass, id_list, db_info):
         """Ensure that a list of ids are loaded into memory.
 
-        :returns: True iff we needed to load objects
+        :returns: list of the objects we restored, or None if they were all
+            in memory already
         """
         table_name = app.db.table_name(klass)
         unrestored_ids = []
         for id_ in id_list:
-            if (id_, table_name) not in self._ids_loaded:
+            if (id_, table_name) not in self._object_map:
                 unrestored_ids.append(id_)
         if unrestored_ids:
             # restore any objects that we don't already have in memory.
             schema = self._schema_map[klass]
-            self._restore_objects(schema, unrestored_ids, db_info)
-            return True
-        return False
+            return self._restore_objects(schema, unrestored_ids, db_info)
+        return None
 
     def query_ids(self, table_name, where, values=None, order_by=None,
             joins=None, limit=None):
-        sql = StringIO()
-        sql.write("SELECT %s.id " % table_name)
-        sql.write(self._get_query_bottom(table_name, where, joins,
-            order_by, limit))
-        self.cursor.execute(sql.getvalue(), values)
-        return (row[0] for row in self.cursor.fetchall())
+        sql = self._sql_cache.get((_query_ids_sql, table_name, where,
+            _joins_key(joins), order_by, limit))
+        return (row[0] for row in self._select_rows(sql, values))
 
-    def _restore_objects(self, schema, id_set, db_info):
-        column_names = ['%s.%s' % (schema.table_name, f[0])
-                for f in schema.fields]
+    def explain_query_ids(self, table_name, where, values=None,
+            order_by=None, joins=None, limit=None):
+        """Get the EXPLAIN QUERY PLAN detail lines for a query_ids() call.
+        """
+        if values is None:
+            values = ()
+        sql = _query_ids_sql(table_name, where, _joins_key(joins), order_by,
+                limit)
+        return self._explain_query_plan(sql, values)
 
+    def _restore_objects(self, schema, id_set, db_info):
         # we can only feed sqlite so many variables at once, send it chunks of
         # 900 ids at once
         id_list = tuple(id_set)
+        restored = []
         for id_list_chunk in util.split_values_for_sqlite(id_list):
-            sql = StringIO()
-            sql.write("SELECT %s " % (', '.join(column_names),))
-            sql.write("FROM %s WHERE id IN (%s)" % (schema.table_name, 
-                ', '.join('?' for i in xrange(len(id_list_chunk)))))
-
-            self.cursor.execute(sql.getvalue(), id_list_chunk)
-            for row in self.cursor.fetchall():
-                self._restore_object_from_row(schema, row, db_info)
+            sql = self._sql_cache.get((_restore_sql, schema,
+                len(id_list_chunk)))
+            for row in self._select_rows(sql, id_list_chunk):
+                restored.append(self._restore_object_from_row(schema, row,
+                                                              db_info))
+        return restored
 
     def _restore_object_from_row(self, schema, db_row, db_info):
         restored_data = {}
@@ -1018,9 +1395,9 @@ class LiveStorage:
         if columns_to_update:
             # We are using some values that are different than what's stored
             # in disk.  Update the database to make things match.
-            setters = ['%s=?' % c for c in columns_to_update]
-            sql = "UPDATE %s SET %s WHERE id=%s" % (schema.table_name,
-                    ', '.join(setters), restored_data['id'])
+            sql = self._sql_cache.get((_update_sql, schema.table_name,
+                tuple(columns_to_update)))
+            values_to_update.append(restored_data['id'])
             self._execute(sql, values_to_update)
         klass = schema.get_ddb_class(restored_data)
         return klass(restored_data=restored_data, db_info=db_info)
@@ -1030,30 +1407,33 @@ class LiveStorage:
 
     def query_count(self, table_name, where, values=None, joins=None,
             limit=None):
-        sql = StringIO()
-        sql.write('SELECT COUNT(*) ')
-        sql.write(self._get_query_bottom(table_name, where, joins,
-            None, limit))
-        return self._execute(sql.getvalue(), values)[0][0]
+        sql = self._sql_cache.get((_query_count_sql, table_name, where,
+            _joins_key(joins), limit))
+        return self._execute(sql, values)[0][0]
 
     def delete(self, klass, where, values):
         schema = self._schema_map[klass]
-        sql = StringIO()
-        sql.write('DELETE FROM %s' % schema.table_name)
-        if where is not None:
-            sql.write('\nWHERE %s' % where)
-        self._execute(sql.getvalue(), values, is_update=True)
+        sql = self._sql_cache.get((_delete_sql, schema.table_name, where))
+        self._execute(sql, values, is_update=True)
 
     def select(self, klass, columns, where, values, joins=None, limit=None,
             convert=True):
         schema = self._schema_map[klass]
-        sql = StringIO()
-        sql.write('SELECT %s ' % ', '.join(columns))
-        sql.write(self._get_query_bottom(schema.table_name, where, joins, None,
-            limit))
-        results = self._execute(sql.getvalue(), values)
+        sql = self._sql_cache.get((_select_sql, schema.table_name,
+            tuple(columns), where, _joins_key(joins), limit))
+        results = self._execute(sql, values)
         if not convert:
             return results
+        return self._convert_rows(klass, columns, results)
+
+    def _get_select_sql(self, klass, columns, where, joins=None, limit=None):
+        """Build the SQL for select() without using the SQL cache."""
+        schema = self._schema_map[klass]
+        return _select_sql(schema.table_name, columns, where,
+                _joins_key(joins), limit)
+
+    def _convert_rows(self, klass, columns, results):
+        schema = self._schema_map[klass]
         schema_items = [self._schema_column_map[schema, c] for c in columns]
         rows = []
         for row in results:
@@ -1092,6 +1472,9 @@ class LiveStorage:
         failed = False
         if is_update:
             self._statements_in_transaction.append((sql, values, many))
+        profile = self.profiler.enabled
+        if profile:
+            start = time.time()
         try:
             self._time_execute(sql, values, many)
         except sqlite3.OperationalError, e:
@@ -1106,9 +1489,44 @@ class LiveStorage:
             self._handle_operational_error(e, is_update)
 
         if is_update:
-            return None
+            results = None
+            row_count = self.cursor.rowcount
         else:
-            return self.cursor.fetchall()
+            results = self.cursor.fetchall()
+            row_count = len(results)
+        if profile and not failed:
+            self.profiler.record(sql, values, time.time() - start, row_count)
+        return results
+
+    def _select_rows(self, sql, values):
+        """Run a SELECT statement and return all the rows.
+
+        Unlike _execute(), this doesn't try to handle OperationalErrors.
+        """
+        if values is None:
+            values = ()
+        profile = self.profiler.enabled
+        if profile:
+            start = time.time()
+        self.cursor.execute(sql, values)
+        rows = self.cursor.fetchall()
+        if profile:
+            self.profiler.record(sql, values, time.time() - start, len(rows))
+        return rows
+
+    def _explain_query_plan(self, sql, values):
+        """Get the detail lines of EXPLAIN QUERY PLAN for a statement."""
+        # use a separate cursor so that we don't clobber the results of the
+        # query we're profiling
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, values)
+            return [row[-1] for row in cursor]
+        except sqlite3.Error, e:
+            logging.warn("EXPLAIN QUERY PLAN failed for %s: %s", sql, e)
+            return []
+        finally:
+            cursor.close()
 
     def _time_execute(self, sql, values, many):
         start = time.time()
@@ -1202,29 +1620,11 @@ class LiveStorage:
             raise
 
     def _check_time(self, sql, query_time):
+        # self.profiler tracks cumulative query times
         SINGLE_QUERY_LIMIT = 0.5
-        CUMULATIVE_LIMIT = 1.0
         if query_time > SINGLE_QUERY_LIMIT:
             logging.timing("query slow (%0.3f seconds): %s", query_time, sql)
 
-        return # comment out to test cumulative query times
-
-        # more than half a second in the last
-        old_times = self._query_times.setdefault(sql, [])
-        now = time.time()
-        dropoff_time = now - 5
-        cumulative = query_time
-        for i in reversed(xrange(len(old_times))):
-            old_time, old_query_time = old_times[i]
-            if old_time < dropoff_time:
-                old_times = old_times[i+1:]
-                break
-            cumulative += old_query_time
-        old_times.append((now, query_time))
-        if cumulative > CUMULATIVE_LIMIT:
-            logging.timing('query cumulatively slow: %0.2f '
-                    '(%0.03f): %s', cumulative, query_time, sql)
-
     def _init_database(self):
         """Create a new empty database."""
 
@@ -1239,6 +1639,8 @@ class LiveStorage:
                         (name, schema.table_name, ', '.join(columns)))
         self._create_variables_table()
         self.cursor.execute(iteminfocache.create_sql())
+        for sql in searchindex.create_sql():
+            self.cursor.execute(sql)
         self.set_version()
 
     def _get_size_info(self):
@@ -1314,6 +1716,7 @@ class LiveStorage:
 
         :param init_schema: should we create tables for our schema?
         """
+        self._close_read_pool()
         self.connection.close()
         self.save_invalid_db()
         self.open_connection()
@@ -1337,6 +1740,12 @@ class LiveStorage:
         save_name = self._find_unused_db_name(
             target_path, "corrupt_database")
         os.rename(self.path, os.path.join(target_path, save_name))
+        # move any WAL files too, sqlite would apply them to our new
+        # database otherwise
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.rename(self.path + suffix,
+                          os.path.join(target_path, save_name + suffix))
 
     def _find_unused_db_name(self, target_path, save_name):
         org_save_name = save_name
@@ -1428,10 +1837,11 @@ class SQLiteConverter(object):
         return filename_to_unicode(value)
 
     def _repr_to_sql(self, value, schema_item):
-        return repr(value)
+        return buffer(columncodec.encode(value))
 
     def _repr_from_sql(self, value, schema_item):
-        return eval(value, __builtins__, {'datetime': datetime, 'time': _TIME_MODULE_SHADOW})
+        # old-style repr() strings were converted by upgrade178
+        return columncodec.decode(value)
 
     def _status_from_sql(self, repr_value, schema_item):
         status_dict = self._repr_from_sql(repr_value, schema_item)
@@ -1449,20 +1859,10 @@ class SQLiteConverter(object):
             value = to_save.get(key)
             if value is not None:
                 to_save[key] = filename_to_unicode(value)
-        return repr(to_save)
+        return buffer(columncodec.encode(to_save))
 
     def _string_set_to_sql(self, value, schema_item):
         return schema_item.delimiter.join(value)
 
     def _string_set_from_sql(self, value, schema_item):
         return set(value.split(schema_item.delimiter))
-
-class TimeModuleShadow:
-    """In Python 2.6, time.struct_time is a named tuple and evals poorly,
-    so we have struct_time_shadow which takes the arguments that struct_time
-    should have and returns a 9-tuple
-    """
-    def struct_time(self, tm_year=0, tm_mon=0, tm_mday=0, tm_hour=0, tm_min=0, tm_sec=0, tm_wday=0, tm_yday=0, tm_isdst=0):
-        return (tm_year, tm_mon, tm_mday, tm_hour, tm_min, tm_sec, tm_wday, tm_yday, tm_isdst)
-
-_TIME_MODULE_SHADOW = TimeModuleShadow()
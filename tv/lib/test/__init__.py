@@ -59,17 +59,26 @@ from miro.test.networktest import *
 from miro.test.httpclienttest import *
 from miro.test.httpdownloadertest import *
 from miro.test.httpauthtoolstest import *
+from miro.test.libdaaptest import *
+from miro.test.sharingtest import *
 from miro.test.feedtest import *
+from miro.test.feedupdatetest import *
+from miro.test.feedcountstest import *
+from miro.test.autodlertest import *
 from miro.test.feedparsertest import *
 from miro.test.parseurltest import *
 from miro.test.utiltest import *
 from miro.test.playlisttest import *
 from miro.test.signalstest import *
 from miro.test.messagetest import *
+from miro.test.columnarstoretest import *
 from miro.test.strippertest import *
 from miro.test.xhtmltest import *
 from miro.test.iconcachetest import *
 from miro.test.databasetest import *
+from miro.test.queryprofilertest import *
+from miro.test.indexadvisortest import *
+from miro.test.viewpredicatetest import *
 from miro.test.itemtest import *
 from miro.test.filetypestest import *
 from miro.test.cellpacktest import *
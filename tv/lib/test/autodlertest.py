@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta
+
+from miro.test.framework import MiroTestCase
+from miro import autodler
+from miro import feed
+from miro import item
+
+class AutoDownloaderTestBase(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.started = []
+        self.base_date = datetime(2010, 1, 1)
+
+    def make_item(self, feed_, i, days):
+        fp_values = item.FeedParserValues({'title': u'item%d' % i,
+            'enclosures': [{'url': u'http://example.com/%d.mpeg' % i}]})
+        new_item = item.Item(fp_values, feed_id=feed_.id)
+        new_item.releaseDateObj = self.base_date + timedelta(days=days)
+        new_item.signal_change()
+        new_item.download = self.make_download_recorder(new_item)
+        return new_item
+
+    def make_download_recorder(self, item_):
+        def download(autodl=False):
+            self.started.append((item_, autodl))
+        return download
+
+class PendingItemQueueTest(AutoDownloaderTestBase):
+    def setUp(self):
+        AutoDownloaderTestBase.setUp(self)
+        self.feed = feed.Feed(u'http://example.com/feed')
+        self.queue = autodler.PendingItemQueue()
+        self.items = [self.make_item(self.feed, i, days)
+                      for i, days in enumerate((3, 1, 7, 5))]
+        for item_ in self.items:
+            self.queue.add(item_)
+
+    def test_newest_first(self):
+        self.assertEquals(self.queue.next_item(), self.items[2])
+        self.queue.remove(self.items[2])
+        self.assertEquals(self.queue.next_item(), self.items[3])
+        self.assertEquals(len(self.queue), 3)
+
+    def test_skip_ids(self):
+        skip = set([self.items[2].id, self.items[3].id])
+        self.assertEquals(self.queue.next_item(skip), self.items[0])
+        # skipped items stay in the queue
+        self.assertEquals(self.queue.next_item(), self.items[2])
+
+    def test_release_date_changed(self):
+        self.items[1].releaseDateObj = self.base_date + timedelta(days=10)
+        self.queue.update(self.items[1])
+        self.assertEquals(self.queue.next_item(), self.items[1])
+        self.assertEquals(len(self.queue), 4)
+        self.items[1].releaseDateObj = self.base_date
+        self.queue.update(self.items[1])
+        self.assertEquals(self.queue.next_item(), self.items[2])
+
+    def test_remove_all(self):
+        for item_ in self.items:
+            self.queue.remove(item_)
+        self.assertEquals(self.queue.next_item(), None)
+        self.assertEquals(len(self.queue), 0)
+
+class DownloaderTest(AutoDownloaderTestBase):
+    def setUp(self):
+        AutoDownloaderTestBase.setUp(self)
+        self.feed = feed.Feed(u'http://example.com/feed')
+        self.feed.set_auto_download_mode(u'all')
+        self.feed2 = feed.Feed(u'http://example.com/feed2')
+        self.feed2.set_auto_download_mode(u'all')
+        self.items = [self.make_item(self.feed, i, i) for i in xrange(3)]
+        self.items2 = [self.make_item(self.feed2, i + 3, i)
+                       for i in xrange(3)]
+        self.downloader = autodler.Downloader(True)
+
+    def started_items(self):
+        return [item_ for item_, autodl in self.started]
+
+    def test_round_robin(self):
+        self.downloader.start_downloads_idle()
+        started = self.started_items()
+        # we never start more than the max downloads.  Since the items
+        # never actually start running, the downloader keeps going until
+        # it's tried everything
+        self.assertEquals(len(started), 6)
+        self.assertEquals(set(started), set(self.items + self.items2))
+        # feeds should take turns, each starting with their newest item
+        first_feeds = set(started[i].feed_id for i in (0, 1))
+        self.assertEquals(first_feeds, set([self.feed.id, self.feed2.id]))
+        self.assert_(started[0] in (self.items[2], self.items2[2]))
+        self.assert_(started[1] in (self.items[2], self.items2[2]))
+        for item_, autodl in self.started:
+            self.assert_(autodl)
+
+    def test_max_new(self):
+        self.feed.maxNew = 0
+        self.feed.signal_change()
+        self.downloader.start_downloads_idle()
+        self.assertEquals(set(self.started_items()), set(self.items2))
+        # raising the limit should unblock the feed
+        self.feed.maxNew = 5
+        self.downloader.feed_limits_changed(self.feed)
+        self.started = []
+        self.downloader.start_downloads_idle()
+        self.assertEquals(set(self.started_items()),
+                          set(self.items + self.items2))
+
+    def test_pending_removed(self):
+        self.feed.set_auto_download_mode(u'off')
+        self.downloader.start_downloads_idle()
+        self.assertEquals(set(self.started_items()), set(self.items2))
+
+    def test_pending_changed(self):
+        self.items[0].releaseDateObj = self.base_date + timedelta(days=10)
+        self.items[0].signal_change()
+        self.downloader.start_downloads_idle()
+        started = self.started_items()
+        self.assert_(started[0] is self.items[0] or
+                     started[1] is self.items[0])
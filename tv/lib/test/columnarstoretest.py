@@ -0,0 +1,190 @@
+import os
+from datetime import datetime
+
+from miro import app
+from miro import columnarstore
+from miro import iteminfocache
+from miro import itemsource
+from miro.feed import Feed
+from miro.item import Item, FeedParserValues
+from miro.singleclick import _build_entry
+from miro.test.framework import MiroTestCase
+
+class ColumnarStoreTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.path = os.path.join(self.tempdir, 'test.dat')
+
+    def write_and_read(self, rows):
+        columnarstore.write_file(self.path, rows, '1-2', 'abc')
+        columnar_file = columnarstore.ColumnarFile(self.path)
+        self.assertEquals(columnar_file.version, '1-2')
+        self.assertEquals(columnar_file.token, 'abc')
+        self.assertEquals(columnar_file.row_count, len(rows))
+        self.assertEquals(columnar_file.ids(), [row['id'] for row in rows])
+        read_rows = [columnar_file.get_row(i) for i in xrange(len(rows))]
+        columnar_file.close()
+        return read_rows
+
+    def test_round_trip(self):
+        rows = [
+            {'id': 1, 'name': u'f\xfco', 'size': 2 ** 40, 'rate': 1.5,
+             'seen': True, 'path': '/tmp/foo', 'date': datetime(2011, 1, 1),
+             'children': [], 'huge': 2 ** 70},
+            {'id': 5, 'name': None, 'size': 0, 'rate': None,
+             'seen': False, 'path': None, 'date': None,
+             'children': [1, 2], 'huge': 0},
+            # missing keys should stay missing
+            {'id': 3, 'name': u''},
+        ]
+        self.assertEquals(self.write_and_read(rows), rows)
+
+    def test_mixed_types(self):
+        rows = [{'id': 1, 'value': u'text'}, {'id': 2, 'value': 'bytes'},
+                {'id': 3, 'value': 4}, {'id': 4, 'value': True}]
+        read_rows = self.write_and_read(rows)
+        self.assertEquals(read_rows, rows)
+        self.assertEquals(type(read_rows[1]['value']), str)
+        self.assertEquals(type(read_rows[3]['value']), bool)
+
+    def test_empty(self):
+        self.assertEquals(self.write_and_read([]), [])
+
+    def test_corrupt_file(self):
+        columnarstore.write_file(self.path, [{'id': 1, 'name': u'foo'}],
+                                 '1', 'abc')
+        data = open(self.path, 'rb').read()
+        for bad_data in ('XXXX' + data[4:], data[:20]):
+            f = open(self.path, 'wb')
+            f.write(bad_data)
+            f.close()
+            self.assertRaises(columnarstore.ColumnarFileError,
+                              columnarstore.ColumnarFile, self.path)
+
+class ColumnarItemInfoCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.path = os.path.join(self.tempdir, 'item_info_cache.dat')
+        self.feed = Feed(u'dtv:manualFeed')
+        self.items = []
+        for i in xrange(5):
+            entry = _build_entry(u'http://example.com/%d' % i,
+                                 'video/x-unknown')
+            self.items.append(Item(FeedParserValues(entry),
+                                   feed_id=self.feed.id))
+        self.load_new_cache()
+        app.db.finish_transaction()
+        # this saves the search index too, otherwise loading the next cache
+        # would rebuild the index, which loads every info
+        app.item_info_cache.save()
+
+    def load_new_cache(self):
+        app.item_info_cache = iteminfocache.ColumnarItemInfoCache(self.path)
+        app.item_info_cache.load()
+        self.setup_new_search_index()
+
+    def check_infos(self):
+        for item in self.items:
+            cache_info = app.item_info_cache.get_info(item.id)
+            real_info = itemsource.DatabaseItemSource._item_info_for(item)
+            self.assertEquals(cache_info.get_attributes(),
+                              real_info.get_attributes())
+
+    def test_lazy_load(self):
+        self.load_new_cache()
+        id_to_info = app.item_info_cache.id_to_info
+        self.assert_(isinstance(id_to_info, iteminfocache._LazyInfoMap))
+        self.assertEquals(len(id_to_info._infos), 0)
+        self.check_infos()
+        self.assertEquals(len(id_to_info._infos), len(self.items))
+
+    def test_changes_saved(self):
+        self.load_new_cache()
+        self.items[0].title = u'new title'
+        self.items[0].signal_change()
+        self.items[1].remove()
+        del self.items[1]
+        app.db.finish_transaction()
+        app.item_info_cache.save()
+        self.load_new_cache()
+        self.assert_(isinstance(app.item_info_cache.id_to_info,
+                                iteminfocache._LazyInfoMap))
+        self.assertEquals(len(app.item_info_cache.id_to_info),
+                          len(self.items))
+        self.check_infos()
+
+    def test_token_mismatch(self):
+        app.db.set_variable(app.item_info_cache.TOKEN_KEY, 'bogus')
+        self.load_new_cache()
+        # we should have done a failsafe load
+        self.assert_(isinstance(app.item_info_cache.id_to_info, dict))
+        self.check_infos()
+
+    def test_corrupt_file(self):
+        f = open(self.path, 'wb')
+        f.write('BOGUS')
+        f.close()
+        self.load_new_cache()
+        self.assert_(isinstance(app.item_info_cache.id_to_info, dict))
+        self.check_infos()
+        # next save should fix the file
+        app.item_info_cache.save()
+        self.load_new_cache()
+        self.assert_(isinstance(app.item_info_cache.id_to_info,
+                                iteminfocache._LazyInfoMap))
+        self.check_infos()
+
+    def saved_change_count(self):
+        app.db.cursor.execute("SELECT COUNT(*) FROM item_info_cache")
+        return app.db.cursor.fetchone()[0]
+
+    def test_changes_saved_incrementally(self):
+        self.load_new_cache()
+        token = app.db.get_variable(app.item_info_cache.TOKEN_KEY)
+        self.items[0].title = u'new title'
+        self.items[0].signal_change()
+        self.items[1].remove()
+        del self.items[1]
+        app.db.finish_transaction()
+        app.item_info_cache.save()
+        # the file is left alone, the changes go in the table
+        self.assertEquals(app.db.get_variable(app.item_info_cache.TOKEN_KEY),
+                          token)
+        self.assertEquals(self.saved_change_count(), 2)
+        self.load_new_cache()
+        self.assertEquals(len(app.item_info_cache.id_to_info),
+                          len(self.items))
+        self.check_infos()
+
+    def test_rewrite_after_many_changes(self):
+        self.load_new_cache()
+        app.item_info_cache.REWRITE_MIN_CHANGES = 1
+        token = app.db.get_variable(app.item_info_cache.TOKEN_KEY)
+        self.items[0].title = u'new title'
+        self.items[0].signal_change()
+        app.db.finish_transaction()
+        app.item_info_cache.save()
+        self.assertEquals(self.saved_change_count(), 1)
+        self.items[2].title = u'other title'
+        self.items[2].signal_change()
+        app.db.finish_transaction()
+        app.item_info_cache.save()
+        self.assertNotEquals(
+            app.db.get_variable(app.item_info_cache.TOKEN_KEY), token)
+        self.assertEquals(self.saved_change_count(), 0)
+        self.load_new_cache()
+        self.check_infos()
+
+    def test_corrupt_row(self):
+        self.load_new_cache()
+        def get_row(row):
+            raise columnarstore.ColumnarFileError("bad row")
+        app.item_info_cache.id_to_info.columnar_file.get_row = get_row
+        self.check_infos()
+        self.assert_(isinstance(app.item_info_cache.id_to_info, dict))
+        # next save should write a new file
+        app.item_info_cache.save()
+        self.load_new_cache()
+        self.assert_(isinstance(app.item_info_cache.id_to_info,
+                                iteminfocache._LazyInfoMap))
+        self.check_infos()
@@ -146,6 +146,33 @@ class ViewTrackerTest(DatabaseTestCase):
         self.assertEquals(self.remove_callbacks, [self.i2])
         self.assertEquals(self.change_callbacks, [self.i1])
 
+    def test_bulk_only_signals_changed_objects(self):
+        self.setup_view(item.Item.make_view("feed.userTitle='booya'",
+                joins={'feed': 'feed.id=item.feed_id'}))
+        query_ids = app.db.query_ids
+        query_calls = []
+        def counting_query_ids(table_name, where, *args, **kwargs):
+            if where and "feed.userTitle='booya'" in where:
+                query_calls.append(where)
+            return query_ids(table_name, where, *args, **kwargs)
+        app.db.query_ids = counting_query_ids
+        app.bulk_sql_manager.start()
+        new_items = []
+        for i in xrange(150):
+            new_items.append(item.Item(
+                item.FeedParserValues({'title': u'new%d' % i}),
+                feed_id=self.feed.id))
+            item.Item(item.FeedParserValues({'title': u'other%d' % i}),
+                feed_id=self.feed2.id)
+        self.i2.remove()
+        app.bulk_sql_manager.finish()
+        self.assertSameSet(self.add_callbacks, new_items)
+        self.assertEquals(self.remove_callbacks, [self.i2])
+        # i1 was in the view the whole time, but didn't change
+        self.assertEquals(self.change_callbacks, [])
+        # all the changed objects should be checked with a single query
+        self.assertEquals(len(query_calls), 1)
+
     def test_unlink(self):
         self.tracker.unlink()
         self.feed2.set_title(u"booya")
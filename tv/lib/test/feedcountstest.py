@@ -0,0 +1,134 @@
+from datetime import datetime
+
+from miro.test.framework import MiroTestCase
+from miro import app
+from miro import downloader
+from miro import feed
+from miro import feedcounts
+from miro import folder
+from miro import item
+from miro.fileobject import FilenameType
+
+class FeedCountsTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.folder = folder.ChannelFolder(u'folder')
+        self.feed = feed.Feed(u'file:///feeds/feed.rss')
+        self.feed.set_folder(self.folder)
+        self.feed2 = feed.Feed(u'file:///feeds/feed2.rss')
+        self.manual_feed = feed.Feed(u'dtv:manualFeed',
+                initiallyAutoDownloadable=False)
+        self.items = [self.make_item(self.feed, i) for i in xrange(4)]
+        self.items.append(self.make_item(self.feed2, 4))
+        self.downloaders = []
+        for i, state in enumerate((u'finished', u'downloading', u'paused')):
+            dl = downloader.RemoteDownloader(
+                    u'http://example.com/feed/movie%d.mpeg' % i,
+                    self.items[i])
+            self.items[i].set_downloader(dl)
+            # on_signal_change() recalculates state from status
+            dl.status['state'] = state
+            dl.signal_change(needs_signal_item=False)
+            self.downloaders.append(dl)
+        self.file_item = item.FileItem(FilenameType('/videos/file.avi'),
+                                       feed_id=self.manual_feed.id)
+        self.file_item.file_type = u'video'
+        self.file_item.signal_change()
+        self.feeds = [self.feed, self.feed2, self.manual_feed]
+
+    def make_item(self, feed_, i):
+        fp_values = item.FeedParserValues({'title': u'item%d' % i,
+            'enclosures': [{'url': u'http://example.com/feed/%d.mpeg' % i}]})
+        new_item = item.Item(fp_values, feed_id=feed_.id)
+        new_item.file_type = u'video'
+        new_item.signal_change()
+        return new_item
+
+    def check_counts(self):
+        for feed_ in self.feeds:
+            self.assertEquals(feed_.num_downloaded(),
+                              feed_.downloaded_items.count())
+            self.assertEquals(feed_.num_downloading(),
+                              feed_.downloading_items.count())
+            self.assertEquals(feed_.num_unwatched(),
+                              feed_.unwatched_items.count())
+            self.assertEquals(feed_.num_available(),
+                              feed_.available_items.count() -
+                              feed_.auto_pending_items.count())
+        children = list(self.folder.get_children_view())
+        self.assertEquals(self.folder.num_unwatched(),
+                          sum(child.num_unwatched() for child in children))
+        self.assertEquals(self.folder.num_available(),
+                          sum(child.num_available() for child in children))
+        self.assert_(app.feed_counts.check_consistency())
+
+    def test_initial_counts(self):
+        self.check_counts()
+        self.assertEquals(self.feed.num_downloaded(), 1)
+        self.assertEquals(self.feed.num_downloading(), 1)
+        self.assertEquals(self.manual_feed.num_downloaded(), 1)
+        self.assertEquals(self.folder.num_unwatched(), 1)
+
+    def test_load(self):
+        # a fresh FeedCounts should load the same counts with 1 query
+        counts = dict((feed_.id, list(app.feed_counts.get_feed_counts(
+            feed_.id))) for feed_ in self.feeds)
+        app.feed_counts = feedcounts.FeedCounts()
+        app.feed_counts.load()
+        for feed_ in self.feeds:
+            self.assertEquals(list(app.feed_counts.get_feed_counts(feed_.id)),
+                              counts[feed_.id])
+
+    def test_item_changes(self):
+        self.check_counts()
+        self.items[0].mark_item_seen()
+        self.check_counts()
+        self.assertEquals(self.feed.num_unwatched(), 0)
+        self.downloaders[1].status['state'] = u'finished'
+        self.downloaders[1].signal_change()
+        self.check_counts()
+        self.assertEquals(self.feed.num_downloaded(), 2)
+        self.assertEquals(self.feed.num_downloading(), 0)
+        self.items[3].remove()
+        self.file_item.remove()
+        self.check_counts()
+
+    def test_item_moved(self):
+        self.check_counts()
+        self.items[0].set_feed(self.feed2.id)
+        self.check_counts()
+        self.assertEquals(self.feed.num_downloaded(), 0)
+        self.assertEquals(self.feed2.num_downloaded(), 1)
+
+    def test_feed_changes(self):
+        self.check_counts()
+        self.feed.mark_as_viewed()
+        self.check_counts()
+        self.feed2.set_folder(self.folder)
+        self.check_counts()
+        self.feed.set_folder(None)
+        self.check_counts()
+        self.feed2.remove()
+        self.feeds.remove(self.feed2)
+        self.check_counts()
+        self.assertEquals(self.folder.num_available(), 0)
+
+    def test_new_items(self):
+        self.check_counts()
+        app.bulk_sql_manager.start()
+        try:
+            for i in xrange(10, 15):
+                self.make_item(self.feed, i)
+            # counts should still be right while the inserts are pending
+            self.assertEquals(self.feed.num_downloaded(), 1)
+        finally:
+            app.bulk_sql_manager.finish()
+        self.check_counts()
+
+    def test_inconsistency_fixed(self):
+        self.check_counts()
+        # change the DB behind FeedCounts' back
+        app.db.cursor.execute("UPDATE item SET seen=1")
+        self.assert_(not app.feed_counts.check_consistency())
+        self.assert_(app.feed_counts.check_consistency())
+        self.assertEquals(self.feed.num_unwatched(), 0)
@@ -126,6 +126,91 @@ class FeedParserTest(MiroTestCase):
             d = d['bozo_exception']
         self.eq_output(pprint.pformat(d), output)
 
+def _make_big_feed(entry_count, first=0):
+    """Make a RSS feed with entries first to entry_count - 1, newest
+    first.
+    """
+    parts = ["""<?xml version="1.0"?>
+<rss version="2.0">
+  <channel>
+    <title>Big Feed</title>
+    <link>http://example.com/</link>
+"""]
+    for i in reversed(xrange(first, entry_count)):
+        parts.append("""    <item>
+      <title>Entry %(i)d</title>
+      <guid isPermaLink="false">guid-%(i)d&amp;x</guid>
+      <enclosure url="http://example.com/%(i)d.mpg" type="video/mpeg" />
+    </item>
+""" % {'i': i})
+    parts.append("""  </channel>
+</rss>
+""")
+    return ''.join(parts)
+
+def _entry_ids(entries):
+    return [entry['id'] for entry in entries]
+
+def _guids(*range_args):
+    return [u'guid-%d&x' % i for i in xrange(*range_args)]
+
+class StreamingParseTest(MiroTestCase):
+    def test_split_entries(self):
+        html = _make_big_feed(3)
+        header, chunks, footer, count = feedparserutil.split_entries(html)
+        chunks = list(chunks)
+        self.assertEquals(header + ''.join(chunks) + footer, html)
+        self.assertEquals(len(chunks), 3)
+        self.assertEquals(count, 3)
+        self.assert_(chunks[0].lstrip().startswith('<item>'))
+        self.assert_('<title>Big Feed</title>' in header)
+
+    def test_cant_split(self):
+        self.assertEquals(feedparserutil.split_entries(
+            '<rss><channel><title>Empty</title></channel></rss>'), None)
+        html = _make_big_feed(3).replace('<title>Entry 1</title>',
+                '<title><![CDATA[Entry </item> 1]]></title>')
+        header, chunks, footer, count = feedparserutil.split_entries(html)
+        self.assertRaises(ValueError, list, chunks)
+        # we should fall back to parsing the whole thing
+        parsed = feedparserutil.parse_streaming(html, [u'guid-0&x'], 0,
+                                                batch_size=1)
+        self.assertEquals(len(parsed.entries), 3)
+
+    def test_no_known_entries(self):
+        html = _make_big_feed(250)
+        parsed = feedparserutil.parse_streaming(html, [u'unknown'], 20)
+        self.assertEquals(_entry_ids(parsed.entries),
+                          _entry_ids(feedparserutil.parse(html).entries))
+        self.assert_('unparsed_entries' not in parsed)
+        self.assertEquals(parsed.feed.title, u'Big Feed')
+
+    def test_stops_early(self):
+        html = _make_big_feed(1000)
+        parsed = feedparserutil.parse_streaming(html, _guids(990), 20,
+                                                batch_size=100)
+        # we should parse the first batch, which has the 10 new entries,
+        # then the next one, which is all known entries, then stop.
+        self.assertEquals(_entry_ids(parsed.entries), _guids(999, 799, -1))
+        self.assertEquals(_entry_ids(parsed.entries),
+                _entry_ids(feedparserutil.parse(html).entries[:200]))
+        self.assertEquals(parsed['unparsed_entries'], 800)
+        self.assertEquals(parsed.entries[0].title, u'Entry 999')
+
+    def test_old_items_limit(self):
+        # 30 of our items aren't in the feed.  If we only keep 20 old items,
+        # we need to see all the entries to know which ones to truncate.
+        html = _make_big_feed(1000, first=30)
+        parsed = feedparserutil.parse_streaming(html, _guids(990), 20,
+                                                batch_size=100)
+        self.assertEquals(_entry_ids(parsed.entries), _guids(999, 29, -1))
+        self.assert_('unparsed_entries' not in parsed)
+        # if we keep 30, nothing gets truncated, so we can stop early.
+        parsed = feedparserutil.parse_streaming(html, _guids(990), 30,
+                                                batch_size=100)
+        self.assertEquals(_entry_ids(parsed.entries), _guids(999, 799, -1))
+        self.assertEquals(parsed['unparsed_entries'], 770)
+
 class FeedParserValuesTest(unittest.TestCase):
     def test_empty(self):
         fpv = FeedParserValues({})
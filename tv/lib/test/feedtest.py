@@ -5,11 +5,13 @@ from time import sleep
 from miro import app
 from miro import prefs
 from miro import dialogs
+from miro import feed
 from miro import feedparserutil
 from miro.item import Item
 from miro.feed import validate_feed_url, normalize_feed_url, Feed
 
 from miro.test.framework import MiroTestCase, EventLoopTest
+from miro.test.feedparsertest import _make_big_feed
 
 class FakeDownloader(object):
     def __init__(self):
@@ -523,5 +525,122 @@ by-nd/1.0</creativeCommons:license>
         self.save_then_restore_db()
         self.assertEquals(self.item.get_rss_id(), None)
 
+class FeedFingerprintTest(FeedTestCase):
+    def setUp(self):
+        FeedTestCase.setUp(self)
+        feed.fingerprint_stats.reset()
+        self.write_feed([u'Bumper Sticker', u'Poster'])
+        self.feed = self.make_feed()
+
+    def write_feed(self, titles, build_date='Wed, 16 Mar 2005 12:03:42 EST',
+                   indent='  '):
+        parts = ["""<?xml version="1.0"?>
+<rss version="2.0">
+%(indent)s<channel>
+%(indent)s<title>Downhill Battle Pics</title>
+%(indent)s<link>http://downhillbattle.org/</link>
+%(indent)s<lastBuildDate>%(build_date)s</lastBuildDate>
+""" % {'indent': indent, 'build_date': build_date}]
+        for i, title in enumerate(titles):
+            parts.append("""\
+%(indent)s<item>
+%(indent)s<title>%(title)s</title>
+%(indent)s<guid>guid-%(i)d</guid>
+%(indent)s<enclosure url="http://downhillbattle.org/key/gallery/%(i)d.mpg" />
+%(indent)s</item>
+""" % {'indent': indent, 'title': title, 'i': i})
+        parts.append("""%s</channel>
+</rss>""" % indent)
+        self.write_file(''.join(parts))
+
+    def item_titles(self):
+        return sorted(i.get_title() for i in Item.make_view())
+
+    def test_fingerprint_saved(self):
+        self.assertNotEquals(self.feed.actualFeed.content_fingerprint, None)
+        self.assertEquals(feed.fingerprint_stats.bodies_skipped, 0)
+        self.assertEquals(feed.fingerprint_stats.entries_skipped, 0)
+
+    def test_unchanged_body(self):
+        # whitespace and lastBuildDate changes shouldn't count
+        self.write_feed([u'Bumper Sticker', u'Poster'],
+                        build_date='Thu, 17 Mar 2005 12:03:42 EST',
+                        indent='    ')
+        self.update_feed(self.feed)
+        self.assertEquals(feed.fingerprint_stats.bodies_skipped, 1)
+        self.assertEquals(feed.fingerprint_stats.entries_skipped, 0)
+        self.assertEquals(self.item_titles(), [u'Bumper Sticker', u'Poster'])
+        self.assert_(not self.feed.actualFeed.updating)
+
+    def test_unchanged_entries(self):
+        self.write_feed([u'Bumper Sticker', u'Big Poster'])
+        self.update_feed(self.feed)
+        self.assertEquals(feed.fingerprint_stats.bodies_skipped, 0)
+        self.assertEquals(feed.fingerprint_stats.entries_skipped, 1)
+        self.assertEquals(self.item_titles(),
+                          [u'Big Poster', u'Bumper Sticker'])
+
+    def test_unchanged_body_after_restart(self):
+        # without the parsed channel data, we should still run feedparser,
+        # but not update the items.
+        del self.feed.actualFeed.parsed
+        self.update_feed(self.feed)
+        self.assertEquals(feed.fingerprint_stats.bodies_skipped, 1)
+        self.assertEquals(self.feed.actualFeed.parsed['feed']['link'],
+                          u'http://downhillbattle.org/')
+
+    def test_clean_old_items_reparses(self):
+        self.feed.actualFeed.clean_old_items()
+        self.assertEquals(self.feed.actualFeed.content_fingerprint, None)
+
+class StreamingFeedParseTest(FeedTestCase):
+    def setUp(self):
+        FeedTestCase.setUp(self)
+        self.old_min_size = feedparserutil.STREAMING_PARSE_MIN_SIZE
+        feedparserutil.STREAMING_PARSE_MIN_SIZE = 0
+        self.old_parse_streaming = feedparserutil.parse_streaming
+        feedparserutil.parse_streaming = self.parse_streaming
+        self.streaming_results = []
+        app.config.set(prefs.MAX_OLD_ITEMS_DEFAULT, 20)
+        self.write_file(_make_big_feed(250))
+        self.feed = self.make_feed()
+
+    def tearDown(self):
+        feedparserutil.STREAMING_PARSE_MIN_SIZE = self.old_min_size
+        feedparserutil.parse_streaming = self.old_parse_streaming
+        FeedTestCase.tearDown(self)
+
+    def parse_streaming(self, html, known_ids, max_old_items):
+        parsed = self.old_parse_streaming(html, known_ids, max_old_items)
+        self.streaming_results.append(parsed)
+        return parsed
+
+    def test_unparsed_entries_kept(self):
+        self.assertEquals(Item.make_view().count(), 250)
+        # Add a new entry.  Most of the old entries won't get parsed, but
+        # they're still in the feed, so their items shouldn't be truncated.
+        self.write_file(_make_big_feed(251))
+        self.update_feed(self.feed)
+        self.assertEquals(len(self.streaming_results), 1)
+        self.assert_(self.streaming_results[0].get('unparsed_entries'))
+        self.assertEquals(Item.make_view().count(), 251)
+
+    def test_old_items_truncated(self):
+        # Add 31 new entries and drop 30 old ones.  We only keep 20 old
+        # items, so we need to parse the whole feed to truncate the others.
+        self.write_file(_make_big_feed(281, first=30))
+        self.update_feed(self.feed)
+        self.assertEquals(len(self.streaming_results), 1)
+        self.assert_('unparsed_entries' not in self.streaming_results[0])
+        self.assertEquals(Item.make_view().count(), 251 + 20)
+
+    def test_too_many_items(self):
+        # Once we're over TRUNCATE_CHANNEL_AFTER_X_ITEMS, we always parse the
+        # whole feed
+        app.config.set(prefs.TRUNCATE_CHANNEL_AFTER_X_ITEMS, 200)
+        self.write_file(_make_big_feed(251))
+        self.update_feed(self.feed)
+        self.assertEquals(self.streaming_results, [])
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,153 @@
+import itertools
+
+from miro import app
+from miro import feedupdate
+from miro import prefs
+from miro import signals
+from miro.test.framework import EventLoopTest
+
+class FakeFeed(signals.SignalEmitter):
+    id_counter = itertools.count(1)
+
+    def __init__(self, url, update_list):
+        signals.SignalEmitter.__init__(self, 'update-finished', 'removed')
+        self.id = self.id_counter.next()
+        self.url = url
+        self.update_list = update_list
+
+    def get_title(self):
+        return self.url
+
+    def get_url(self):
+        return self.url
+
+    def update(self):
+        self.update_list.append(self)
+
+    def finish_update(self):
+        self.emit('update-finished')
+
+class FeedUpdateQueueTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        app.config.set(prefs.MAX_FEED_UPDATES, 3)
+        app.config.set(prefs.MAX_FEED_UPDATES_PER_HOST, 2)
+        self.queue = feedupdate.FeedUpdateQueue()
+        self.updated = []
+
+    def make_feed(self, host, path='feed'):
+        return FakeFeed(u'http://%s/%s' % (host, path), self.updated)
+
+    def queue_update(self, feed, due=0):
+        self.queue.do_update(feed, feed.update, due)
+
+    def finish_update(self, feed, error=False):
+        if error:
+            self.queue.record_error(feed)
+        feed.finish_update()
+        self.runPendingIdles()
+
+    def test_global_limit(self):
+        feeds = [self.make_feed('host%d.com' % i) for i in xrange(5)]
+        for feed in feeds:
+            self.queue_update(feed)
+        self.assertEquals(self.updated, feeds[:3])
+        self.assertEquals(self.queue.queue_depth(), 2)
+        self.finish_update(feeds[0])
+        self.assertEquals(self.updated, feeds[:4])
+
+    def test_round_robin(self):
+        # host a has lots of feeds, but host b and c shouldn't have to wait
+        # for them all.
+        a_feeds = [self.make_feed('a.com', i) for i in xrange(4)]
+        b_feed = self.make_feed('b.com')
+        c_feed = self.make_feed('c.com')
+        for feed in a_feeds + [b_feed, c_feed]:
+            self.queue_update(feed)
+        self.assertEquals(self.updated, [a_feeds[0], b_feed, c_feed])
+
+    def test_host_limit_adapts(self):
+        feeds = [self.make_feed('a.com', i) for i in xrange(5)]
+        for feed in feeds:
+            self.queue_update(feed)
+        host_stats = self.queue.hosts['a.com']
+        # we start with 1 update per host, and go up after each success
+        self.assertEquals(self.updated, feeds[:1])
+        self.finish_update(feeds[0])
+        self.assertEquals(host_stats.limit, 2)
+        self.assertEquals(self.updated, feeds[:3])
+        # we shouldn't go over MAX_FEED_UPDATES_PER_HOST
+        self.finish_update(feeds[1])
+        self.assertEquals(host_stats.limit, 2)
+        self.assertEquals(self.updated, feeds[:4])
+        # errors cut the limit
+        self.finish_update(feeds[2], error=True)
+        self.assertEquals(host_stats.limit, 1)
+        self.assertEquals(host_stats.error_count, 1)
+        self.assertEquals(self.updated, feeds[:4])
+        self.finish_update(feeds[3])
+        self.assertEquals(self.updated, feeds)
+
+    def test_slow_updates(self):
+        host_stats = self.queue._get_host_stats('a.com')
+        host_stats.limit = 2
+        host_stats.record_update(feedupdate.SLOW_UPDATE_TIME + 1, False, 2)
+        self.assertEquals(host_stats.limit, 1)
+
+    def test_overdue_first(self):
+        feeds = [self.make_feed('a.com', i) for i in xrange(3)]
+        self.queue_update(feeds[0])
+        # feeds[1] is less overdue than feeds[2], so feeds[2] should go
+        # first.
+        self.queue_update(feeds[1], due=100)
+        self.queue_update(feeds[2], due=50)
+        self.finish_update(feeds[0])
+        self.assertEquals(self.updated, [feeds[0], feeds[2], feeds[1]])
+
+    def test_duplicate_updates(self):
+        feeds = [self.make_feed('a.com', i) for i in xrange(2)]
+        self.queue_update(feeds[0])
+        self.queue_update(feeds[1])
+        self.queue_update(feeds[1])
+        self.assertEquals(self.queue.queue_depth(), 1)
+
+    def test_removed(self):
+        feeds = [self.make_feed('a.com', i) for i in xrange(2)]
+        for feed in feeds:
+            self.queue_update(feed)
+        feeds[0].emit('removed')
+        self.runPendingIdles()
+        self.assertEquals(self.updated, feeds)
+
+    def test_stats(self):
+        changes = []
+        self.queue.connect('changed', lambda queue: changes.append(True))
+        feed = self.make_feed('a.com')
+        self.queue_update(feed)
+        self.finish_update(feed)
+        self.assertEquals(len(changes), 2)
+        stats = self.queue.host_stats()
+        self.assertEquals(len(stats), 1)
+        self.assertEquals(stats[0]['host'], 'a.com')
+        self.assertEquals(stats[0]['update_count'], 1)
+        self.assertEquals(stats[0]['queued'], 0)
+        self.assertEquals(stats[0]['updating'], 0)
+
+    def test_format_stats(self):
+        feeds = [self.make_feed('b.com'), self.make_feed('a.com')]
+        for feed in feeds:
+            self.queue_update(feed)
+        self.runPendingIdles()
+        self.finish_update(feeds[0], error=True)
+        text = feedupdate.format_stats(self.queue.queue_depth(),
+                len(self.queue.currently_updating), self.queue.host_stats(),
+                2, 10)
+        lines = text.split('\n')
+        self.assertEquals(lines[0], 'Feed updates: 0 queued, 1 updating')
+        self.assertEquals(lines[1],
+                'Unchanged content skipped: 2 feed bodies, 10 entries')
+        self.assert_(lines[2].startswith('    a.com: 0 queued, 1 updating, '
+                                         'limit 1, latency n/a, 0/0 failed'))
+        self.assert_(lines[3].startswith('    b.com: 0 queued, 0 updating, '
+                                         'limit 1, latency '))
+        self.assert_('1/1 failed' in lines[3])
@@ -13,11 +13,13 @@ from miro import database
 from miro import eventloop
 from miro import extensionmanager
 from miro import feed
+from miro import feedcounts
 from miro import downloader
 from miro import httpauth
 from miro import httpclient
 from miro import item
 from miro import iteminfocache
+from miro import searchindex
 from miro import itemsource
 from miro import util
 from miro import prefs
@@ -329,8 +331,7 @@ class MiroTestCase(unittest.TestCase):
             patcher.stop()
         # shutdown workerprocess if we started it for some reason.
         workerprocess.shutdown()
-        workerprocess._subprocess_manager = \
-                workerprocess.WorkerSubprocessManager()
+        workerprocess._worker_pool = workerprocess.WorkerProcessPool()
         workerprocess._miro_task_queue.reset()
         self.reset_log_filter()
         signals.system.disconnect_all()
@@ -456,6 +457,13 @@ class MiroTestCase(unittest.TestCase):
     def setup_new_item_info_cache(self):
         app.item_info_cache = iteminfocache.ItemInfoCache()
         app.item_info_cache.load()
+        self.setup_new_search_index()
+
+    def setup_new_search_index(self):
+        if app.search_index is not None:
+            app.search_index.unlink()
+        app.search_index = searchindex.SearchIndex(app.item_info_cache)
+        app.search_index.load()
 
     def reset_failed_soft_count(self):
         app.controller.failed_soft_count = 0
@@ -479,13 +487,16 @@ class MiroTestCase(unittest.TestCase):
         database.initialize()
 
     def clear_ddb_object_cache(self):
-        app.db._ids_loaded = set()
-        app.db._object_map = {}
+        app.db.forget_all_objects()
         app.db.cache = storedatabase.DatabaseObjectCache()
 
     def setup_new_database(self, path, **kwargs):
         app.db = storedatabase.LiveStorage(path, **kwargs)
         app.db.raise_load_errors = self.raise_db_load_errors
+        if app.feed_counts is not None:
+            app.feed_counts.unload()
+        # FeedCounts loads itself the first time counts are asked for
+        app.feed_counts = feedcounts.FeedCounts()
 
     def allow_db_load_errors(self, allow):
         app.db.raise_load_errors = self.raise_db_load_errors = not allow
@@ -499,9 +510,7 @@ class MiroTestCase(unittest.TestCase):
 
     def reload_object(self, obj):
         # force an object to be reloaded from the databas.
-        key = (obj.id, app.db.table_name(obj.__class__))
-        del app.db._object_map[key]
-        app.db._ids_loaded.remove(key)
+        app.db.forget_object(obj)
         return obj.__class__.get_by_id(obj.id)
 
     def handle_error(self, obj, report):
@@ -14,7 +14,8 @@ from miro import httpclient
 from miro import signals
 from miro.plat import resources
 from miro.test import mock
-from miro.test.framework import EventLoopTest, uses_httpclient
+from miro.test import testhttpserver
+from miro.test.framework import EventLoopTest, MiroTestCase, uses_httpclient
 
 from miro.gtcache import gettext as _
 
@@ -166,6 +167,19 @@ class HTTPClientTest(HTTPClientTestBase):
         self.assertEquals(post_data.getvalue('file1'), 'contents#1')
         self.assertEquals(post_data.getvalue('file2'), 'abc\0\0def')
 
+    @uses_httpclient
+    def test_connection_reuse(self):
+        # sequential requests to the same host should use a single keep-alive
+        # connection
+        handler_class = testhttpserver.MiroHTTPRequestHandler
+        connections_before = handler_class.handlers_created
+        for i in xrange(3):
+            self.grab_url(self.httpserver.build_url('test.txt'))
+            self.assertEquals(self.grab_url_info['body'],
+                    self.test_response_data)
+        self.assertEquals(handler_class.handlers_created - connections_before,
+                1)
+
     def _test_head_common(self):
         url = self.httpserver.build_url('test.txt')
         self.grab_url(url)
@@ -973,6 +987,52 @@ class BadURLTest(HTTPClientTestBase):
         self.check_errback_called()
         self.assert_(isinstance(self.grab_url_error, httpclient.MalformedURL))
 
+class CurlHandlePoolTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.pool = httpclient.CurlHandlePool(max_idle_per_host=2,
+                max_idle=3)
+
+    def tearDown(self):
+        self.pool.close()
+        MiroTestCase.tearDown(self)
+
+    def test_reuse(self):
+        handle = self.pool.get_handle('http', 'example.com')
+        self.pool.release_handle('http', 'example.com', handle)
+        self.assert_(self.pool.get_handle('http', 'example.com') is handle)
+        self.assertEquals(self.pool.created_count, 1)
+        self.assertEquals(self.pool.reused_count, 1)
+
+    def test_hosts_separate(self):
+        handle = self.pool.get_handle('http', 'example.com')
+        self.pool.release_handle('http', 'example.com', handle)
+        self.assert_(self.pool.get_handle('https', 'example.com')
+                is not handle)
+        self.assert_(self.pool.get_handle('http', 'example.org')
+                is not handle)
+        self.assertEquals(self.pool.created_count, 3)
+
+    def test_max_idle_per_host(self):
+        handles = [self.pool.get_handle('http', 'example.com')
+                for i in xrange(3)]
+        for handle in handles:
+            self.pool.release_handle('http', 'example.com', handle)
+        self.assertEquals(self.pool.idle_count, 2)
+        self.assertEquals(len(self.pool.idle_handles[
+            ('http', 'example.com')]), 2)
+
+    def test_max_idle(self):
+        hosts = ['a.example.com', 'b.example.com', 'c.example.com',
+                'd.example.com']
+        handles = [self.pool.get_handle('http', host) for host in hosts]
+        for host, handle in zip(hosts, handles):
+            self.pool.release_handle('http', host, handle)
+        # the least recently used host should have been dropped
+        self.assertEquals(self.pool.idle_count, 3)
+        self.assertSameSet(self.pool.idle_handles.keys(),
+                [('http', host) for host in hosts[1:]])
+
 class NetworkErrorTest(HTTPClientTestBase):
     def setUp(self):
         HTTPClientTestBase.setUp(self)
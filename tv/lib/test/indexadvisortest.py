@@ -0,0 +1,202 @@
+from datetime import datetime, timedelta
+
+from miro.test.framework import MiroTestCase
+from miro import app
+from miro import downloader
+from miro import feed
+from miro import folder
+from miro import guide
+from miro import iconcache
+from miro import indexadvisor
+from miro import item
+from miro import metadata
+from miro import playlist
+from miro import schema
+from miro.fileobject import FilenameType
+
+def _insert_rows(table_name, rows):
+    columns = rows[0].keys()
+    app.db.cursor.executemany("INSERT INTO %s (%s) VALUES (%s)" %
+            (table_name, ', '.join(columns), ', '.join('?' for c in columns)),
+            [[row[c] for c in columns] for row in rows])
+
+def _copy_rows(schema_class, template_id, ids, update_row):
+    columns = [f[0] for f in schema_class.fields]
+    template_row = app.db.cursor.execute("SELECT %s FROM %s WHERE id=?" %
+            (', '.join(columns), schema_class.table_name),
+            (template_id,)).fetchone()
+    rows = []
+    for i, id_ in enumerate(ids):
+        row = dict(zip(columns, template_row))
+        row['id'] = id_
+        update_row(i, row)
+        rows.append(row)
+    _insert_rows(schema_class.table_name, rows)
+
+class SyntheticDatabase(object):
+    """Fill the database with lots of items, downloaders and playlists.
+
+    The rows are inserted as copies of a template row, which is a lot
+    faster than creating DDBObjects.  Half of the items go in the first
+    feed, so that we have one big feed, and the rest are spread over the
+    others.  ANALYZE is run at the end, so that SQLite plans queries the
+    way it would for a big database.
+
+    Attributes:
+
+    - feeds -- list of Feeds we created
+    - item_ids -- list of item ids we created
+    """
+    def __init__(self, feed_count, items_per_feed, downloader_count,
+            playlist_count, items_per_playlist):
+        self.feeds = [feed.Feed(u'http://example.com/feed%d' % i)
+                for i in xrange(feed_count)]
+        template = item.Item(item.FeedParserValues({
+            'title': u'item',
+            'enclosures': [{'url': u'http://example.com/feed/item.mp3'}],
+        }), feed_id=self.feeds[0].id)
+        dl = downloader.RemoteDownloader(
+                u'http://example.com/feed/item.mp3', template)
+        next_id = dl.id + 1
+        self.item_ids = range(next_id, next_id + feed_count * items_per_feed)
+        next_id += len(self.item_ids)
+        now = datetime.now()
+        def update_item(i, row):
+            row['feed_id'] = self.feeds[i % 2 and i % feed_count].id
+            row['file_type'] = (u'video', u'audio', u'other')[i % 3]
+            row['releaseDateObj'] = now - timedelta(minutes=i)
+            if i % 2:
+                row['watchedTime'] = now - timedelta(minutes=i)
+            row['keep'] = bool(i % 5)
+        _copy_rows(schema.ItemSchema, template.id, self.item_ids,
+                update_item)
+        downloader_ids = range(next_id, next_id + downloader_count)
+        next_id += downloader_count
+        def update_downloader(i, row):
+            row['main_item_id'] = self.item_ids[i * 3 + 2]
+            row['state'] = u'finished'
+        _copy_rows(schema.RemoteDownloaderSchema, dl.id, downloader_ids,
+                update_downloader)
+        for schema_class in (schema.PlaylistItemMapSchema,
+                schema.PlaylistFolderItemMapSchema):
+            rows = []
+            for i in xrange(playlist_count * items_per_playlist):
+                row = {'id': next_id, 'playlist_id': i % playlist_count,
+                        'item_id': self.item_ids[i],
+                        'position': i // playlist_count}
+                if schema_class is schema.PlaylistFolderItemMapSchema:
+                    row['count'] = 1
+                rows.append(row)
+                next_id += 1
+            _insert_rows(schema_class.table_name, rows)
+        app.db.cursor.execute("ANALYZE")
+
+class SplitConjunctsTest(MiroTestCase):
+    def test_split(self):
+        self.assertEquals(indexadvisor.split_conjuncts(
+            "feed_id=? AND (deleted IS NULL or not deleted)"),
+            ['feed_id=?', 'deleted IS NULL or not deleted'])
+        self.assertEquals(indexadvisor.split_conjuncts(
+            "((a AND b) OR c) and d IN (1, 2)"),
+            ['(a AND b) OR c', 'd IN (1, 2)'])
+
+    def test_string_literals(self):
+        self.assertEquals(indexadvisor.split_conjuncts(
+            "title='A AND (B' AND seen"), ["title='A AND (B'", 'seen'])
+
+class IndexAdvisorTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.advisor = indexadvisor.IndexAdvisor(app.db,
+                schema.object_schemas)
+
+    def check(self, where, values=(), order_by=None, joins=None):
+        query = indexadvisor.ViewQuery('test', 'item', where, values,
+                order_by, joins)
+        return self.advisor.check_query(query)
+
+    def test_scan(self):
+        advice = self.check('keep=? AND lastWatched > ? AND NOT seen',
+                (True, datetime.now()))
+        self.assertEquals(advice.scans, ['item'])
+        self.assertEquals(advice.proposals,
+                [('item', ('keep', 'lastWatched'))])
+
+    def test_no_indexable_terms(self):
+        advice = self.check('NOT seen OR keep')
+        self.assertEquals(advice.scans, ['item'])
+        self.assertEquals(advice.proposals, [])
+        self.assertEquals(advice.notes, ['item: no indexable terms'])
+
+    def test_composite_index(self):
+        # item_parent only covers one of the terms
+        advice = self.check("parent_id=? AND file_type IN ('video', 'audio')",
+                (1,))
+        self.assertEquals(advice.scans, [])
+        self.assertEquals(advice.proposals,
+                [('item', ('parent_id', 'file_type'))])
+
+    def test_existing_index(self):
+        advice = self.check('feed_id=? AND releaseDateObj > ?',
+                (1, datetime.now()))
+        self.assertEquals(advice.scans, [])
+        self.assertEquals(advice.proposals, [])
+
+    def test_order_by(self):
+        advice = self.check('file_type=?', (u'video',),
+                order_by='lastWatched DESC')
+        self.assertEquals(advice.proposals,
+                [('item', ('file_type', 'lastWatched'))])
+
+    def test_join(self):
+        advice = self.check('item.id=? AND icon.filename IS NOT NULL', (1,),
+                joins={'icon_cache AS icon': 'icon.url=item.thumbnail_url'})
+        self.assertEquals(advice.scans, ['icon_cache'])
+        self.assertEquals(advice.proposals,
+                [('icon_cache', ('url', 'filename'))])
+
+    def test_proposed_indexes(self):
+        self.check('keep IS NULL')
+        self.check('keep IS NULL AND lastWatched > ?', (datetime.now(),))
+        self.assertEquals(self.advisor.proposed_indexes(), {
+            ('item', ('keep', 'lastWatched')): ['test', 'test'],
+        })
+
+class ViewIndexTest(MiroTestCase):
+    """Run IndexAdvisor on all our views against a big database."""
+
+    # views that we've added indexes for
+    INDEXED_VIEWS = ('Item.latest_in_feed_view', 'Item.feed_expiring_view',
+            'Item.watchable_other_view', 'Item.playlist_view',
+            'Item.playlist_folder_view', 'PlaylistItemMap.playlist_view')
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.database = SyntheticDatabase(20, 50, 200, 5, 50)
+
+    def view_arguments(self):
+        feed_id = self.database.feeds[0].id
+        return {
+            'feed_id': [feed_id],
+            'parent_id': [self.database.item_ids[0]],
+            'folder_id': [0], 'id_': [0],
+            'dler_id': [0],
+            'path': [FilenameType('/videos/file.avi')],
+            'watched_before': [datetime.now()],
+            'include_podcasts': [False, True],
+            'playlist_id': [1], 'playlist_folder_id': [1],
+        }
+
+    def test_views(self):
+        advisor = indexadvisor.IndexAdvisor(app.db, schema.object_schemas)
+        for klass in (item.Item, feed.Feed, feed.FeedImpl,
+                downloader.RemoteDownloader, playlist.SavedPlaylist,
+                playlist.PlaylistItemMap, folder.PlaylistFolderItemMap,
+                guide.ChannelGuide, iconcache.IconCache,
+                metadata.MetadataStatus):
+            advisor.check_views(klass, self.view_arguments())
+        self.assert_(len(advisor.advice) > 100)
+        for advice in advisor.advice:
+            if advice.query.description.startswith(self.INDEXED_VIEWS):
+                self.assertEquals(advice.proposals, [],
+                        advisor.format_report())
@@ -202,6 +202,41 @@ class ItemRemoveTest(MiroTestCase):
         item.remove()
         self.assert_(not downloader.id_exists())
 
+class ItemEvictionTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        feed = Feed(u'http://example.com/1')
+        self.ids = [Item(fp_values_for_url(u'http://example.com/1/item%d' % i),
+                         feed_id=feed.id).id for i in xrange(10)]
+        # new items are referenced by their icon caches, start over with
+        # restored ones
+        self.clear_ddb_object_cache()
+        app.db.object_cache_size = 2
+
+    def load_all(self):
+        return [i.id for i in Item.make_view()]
+
+    def test_evict(self):
+        self.load_all()
+        self.assert_(not app.db.id_alive(self.ids[0], Item))
+
+    def pinned(self, id_):
+        return (id_, app.db.table_name(Item)) in app.db._pinned_objects
+
+    def test_playing_item_pinned(self):
+        item = Item.get_by_id(self.ids[0])
+        item.set_is_playing(True)
+        del item
+        self.load_all()
+        # playing isn't saved, so evicting the item would lose it
+        self.assert_(self.pinned(self.ids[0]))
+        item = Item.get_by_id(self.ids[0])
+        self.assert_(item.is_playing())
+        # once it stops playing, we can evict it again
+        item.set_is_playing(False)
+        self.load_all()
+        self.assert_(not self.pinned(self.ids[0]))
+
 class SubtitleEncodingTest(MiroTestCase):
     def setUp(self):
         MiroTestCase.setUp(self)
@@ -0,0 +1,635 @@
+import errno
+import httplib
+import os
+import random
+import select
+import socket
+import struct
+import threading
+import time
+
+from miro.test.framework import MiroTestCase
+from miro.libdaap import libdaap
+from miro.libdaap import subr
+from miro.libdaap.const import *
+
+# The DMAP codec before it was rewritten to work with offsets.  We check
+# that the new one produces exactly the same results.
+
+def reference_decode_response(reply):
+    decoded = []
+    try:
+        while reply:
+            headerfmt = '!4sI'
+            headersize = struct.calcsize(headerfmt)
+            code, size = struct.unpack(headerfmt, reply[:headersize])
+            reply = reply[headersize:]
+            realname, realtype = dmap_consts[code]
+            realfmt, realsize = subr.fmts[realtype]
+            if realtype == DMAP_TYPE_LIST:
+                decoded.append((code,
+                                reference_decode_response(reply[:size])))
+                reply = reply[size:]
+                continue
+            if realtype == DMAP_TYPE_STRING:
+                realfmt = str(size) + realfmt 
+            else:
+                if realsize != size:
+                    raise ValueError
+                realfmt = '!' + realfmt
+            realfmtsize = struct.calcsize(realfmt)
+            (value, ) = struct.unpack(realfmt, reply[:realfmtsize])
+            decoded.append((code, value))
+            reply = reply[realfmtsize:]
+        return decoded
+    except (struct.error, KeyError, ValueError), e:
+        return [(-1, [])]
+
+def reference_encode_response(reply):
+    blob = ''
+    subblob = ''
+    for code, value in reply:
+        nam, typ = dmap_consts[code]
+        fmt, size = subr.fmts[typ]
+        if typ == DMAP_TYPE_LIST:
+            subblob = reference_encode_response(value)
+            size = len(subblob)
+            value = ''
+        if typ == DMAP_TYPE_STRING:
+            fmt = str(len(value)) + fmt
+            size = len(value)
+            value = str(buffer(value))
+        fmt = '!4sI' + fmt
+        try:
+            blob += struct.pack(fmt, code, size, value)
+        except struct.error:
+            pass
+        blob += subblob
+    return blob
+
+_codes_by_type = {}
+for _code, (_name, _type) in dmap_consts.items():
+    _codes_by_type.setdefault(_type, []).append(_code)
+for _codes in _codes_by_type.values():
+    _codes.sort()
+
+_value_ranges = {
+    DMAP_TYPE_BYTE: (-0x80, 0x7f),
+    DMAP_TYPE_UBYTE: (0, 0xff),
+    DMAP_TYPE_SHORT: (-0x8000, 0x7fff),
+    DMAP_TYPE_USHORT: (0, 0xffff),
+    DMAP_TYPE_INT: (-0x80000000, 0x7fffffff),
+    DMAP_TYPE_UINT: (0, 0xffffffff),
+    DMAP_TYPE_LONG: (-0x8000000000000000, 0x7fffffffffffffff),
+    DMAP_TYPE_ULONG: (0, 0xffffffffffffffff),
+    DMAP_TYPE_DATE: (0, 0xffffffff),
+    DMAP_TYPE_VERSION: (0, 0xffffffff),
+}
+
+def make_listing(rand, depth=0, lists_last=False):
+    """Make a random DMAP listing.
+
+    :param lists_last: only put lists at the end of each level.  The old
+        encoder added the previous list's contents again after any tags that
+        followed it, so it only got those listings right.
+    """
+    listing = []
+    for i in xrange(rand.randint(0, 6)):
+        typ = rand.choice(_codes_by_type.keys())
+        if typ == DMAP_TYPE_LIST and (depth > 3 or lists_last):
+            continue
+        code = rand.choice(_codes_by_type[typ])
+        if typ == DMAP_TYPE_LIST:
+            value = make_listing(rand, depth + 1, lists_last)
+        elif typ == DMAP_TYPE_STRING:
+            value = ''.join(chr(rand.randint(0, 255))
+                    for j in xrange(rand.randint(0, 20)))
+        else:
+            value = rand.randint(*_value_ranges[typ])
+        listing.append((code, value))
+    if lists_last:
+        for i in xrange(rand.randint(0, 2) if depth <= 3 else 0):
+            listing.append((rand.choice(_codes_by_type[DMAP_TYPE_LIST]),
+                make_listing(rand, depth + 1, lists_last)))
+    return listing
+
+def make_item_listing(count):
+    """Make a listing like DaapHttpRequestHandler.do_itemlist() sends."""
+    items = []
+    for i in xrange(count):
+        items.append(('mlit', [
+            ('mikd', DAAP_ITEMKIND_AUDIO),
+            ('miid', i),
+            ('minm', 'Track %d' % i),
+            ('asal', 'Album %d' % (i // 10)),
+            ('asar', 'Artist %d' % (i // 100)),
+            ('astm', 180000 + i),
+            ('asfm', 'mp3'),
+            ('asgn', 'Genre'),
+            ('assz', 4000000 + i),
+        ]))
+    return [('adbs', [
+        ('mstt', 200),   # DAAP_OK
+        ('muty', 0),
+        ('mtco', count),
+        ('mrco', count),
+        ('mlcl', items),
+    ])]
+
+class DMAPCodecTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.rand = random.Random(1234)
+
+    def test_round_trip(self):
+        for i in xrange(500):
+            listing = make_listing(self.rand)
+            data = str(subr.encode_response(listing))
+            self.assertEquals(subr.decode_response(data), listing)
+
+    def test_same_as_reference(self):
+        for i in xrange(500):
+            listing = make_listing(self.rand, lists_last=True)
+            data = str(subr.encode_response(listing))
+            self.assertEquals(data, reference_encode_response(listing))
+
+    def test_item_listing(self):
+        listing = make_item_listing(50)
+        data = str(subr.encode_response(listing))
+        self.assertEquals(data, reference_encode_response(listing))
+        self.assertEquals(subr.decode_response(data), listing)
+
+    def test_bad_values_skipped(self):
+        # values that don't fit their type get left out
+        listing = [('mstt', -1), ('miid', 1 << 40), ('minm', 'name')]
+        data = str(subr.encode_response(listing))
+        self.assertEquals(data, reference_encode_response(listing))
+        self.assertEquals(subr.decode_response(data), [('minm', 'name')])
+
+    def test_unicode_string(self):
+        listing = [('minm', u'abc')]
+        data = str(subr.encode_response(listing))
+        self.assertEquals(data, reference_encode_response(listing))
+
+    def test_corrupt_data(self):
+        # decode garbage the same way as the old decoder, including
+        # truncated lists and sizes that lie
+        for i in xrange(500):
+            listing = make_listing(self.rand)
+            data = bytearray(subr.encode_response(listing).data)
+            if not data:
+                continue
+            for j in xrange(self.rand.randint(1, 3)):
+                data[self.rand.randrange(len(data))] = self.rand.randint(0,
+                        255)
+            data = str(data[:self.rand.randint(0, len(data))])
+            self.assertEquals(subr.decode_response(data),
+                    reference_decode_response(data))
+
+class FakeItemBackend(object):
+    """Just enough of SharingManagerBackend to serve item listings, long-poll
+    updates and files.
+    """
+    def __init__(self, count):
+        self.revision = 1
+        self.revision_cv = threading.Condition()
+        self.revision_waiters = dict()
+        self.files = dict()
+        self.response_cache = libdaap.ResponseCache()
+        self.response_cache.invalidate(self.revision)
+        self.get_items_calls = 0
+        self.items = dict()
+        for i in xrange(1, count + 1):
+            self.items[i] = {'revision': 1, 'valid': True,
+                             'dmap.itemid': i,
+                             'dmap.itemname': 'Track %d' % i}
+
+    def get_items(self, playlist_id=None, delta=0):
+        self.get_items_calls += 1
+        return dict(self.items)
+
+    def update_revision(self):
+        with self.revision_cv:
+            self.revision += 1
+            self.response_cache.invalidate(self.revision)
+            self.revision_cv.notify_all()
+            waiters = self.revision_waiters
+            self.revision_waiters = dict()
+            for callback in waiters.itervalues():
+                callback(self.revision)
+
+    def get_revision(self, session, old_revision, request):
+        with self.revision_cv:
+            while self.revision == old_revision:
+                self.revision_cv.wait()
+            return self.revision
+
+    def add_revision_waiter(self, session, old_revision, callback):
+        with self.revision_cv:
+            if self.revision != old_revision:
+                return self.revision
+            self.revision_waiters[session] = callback
+
+    def remove_revision_waiter(self, session):
+        with self.revision_cv:
+            self.revision_waiters.pop(session, None)
+
+    def get_file(self, itemid, generation, ext, session, request_path_func,
+                 offset=0, chunk=None):
+        try:
+            path = self.files[itemid]
+        except KeyError:
+            return None, None
+        file_obj = open(path, 'rb')
+        file_obj.seek(offset, os.SEEK_SET)
+        return file_obj, os.path.basename(path)
+
+class FakeServer(object):
+    def __init__(self, backend):
+        self.backend = backend
+        self.response_cache = backend.response_cache
+
+class FakeHeaders(dict):
+    def getheader(self, name):
+        return self.get(name)
+
+class FakeRequestHandler(libdaap.DaapHttpRequestHandler):
+    """Request handler that doesn't need a socket to be created."""
+    def __init__(self, server, accept_encoding=None):
+        self.server = server
+        self.headers = FakeHeaders()
+        if accept_encoding:
+            self.headers['Accept-encoding'] = accept_encoding
+
+class ItemListCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.backend = FakeItemBackend(10)
+        self.server = FakeServer(self.backend)
+        self.query = {'meta': 'dmap.itemid,dmap.itemname'}
+
+    def get_itemlist(self, accept_encoding=None, query=None):
+        handler = FakeRequestHandler(self.server, accept_encoding)
+        if query is None:
+            query = self.query
+        rcode, blob, extra_headers = handler.do_itemlist(None, query)
+        self.assertEquals(rcode, libdaap.DAAP_OK)
+        return blob
+
+    def test_cached(self):
+        blob = self.get_itemlist()
+        self.assertEquals(self.get_itemlist(), blob)
+        self.assertEquals(self.backend.get_items_calls, 1)
+        [(tag, content)] = subr.decode_response(str(blob))
+        self.assertEquals(tag, 'adbs')
+        self.assertEquals(dict(content)['mrco'], 10)
+
+    def test_key(self):
+        # encoding, meta and delta each get their own entry
+        plain = self.get_itemlist()
+        gzipped = self.get_itemlist(accept_encoding='gzip')
+        self.assertNotEquals(str(plain), str(gzipped))
+        self.assertEquals(gzipped.get_headers(),
+                          [('Content-encoding', 'gzip')])
+        self.get_itemlist(query={'meta': 'dmap.itemid'})
+        self.get_itemlist(query={'meta': 'dmap.itemid', 'delta': '1',
+                                 'revision-number': '2'})
+        self.assertEquals(self.backend.get_items_calls, 4)
+        self.get_itemlist(accept_encoding='gzip')
+        self.assertEquals(self.backend.get_items_calls, 4)
+
+    def test_invalidated_by_revision(self):
+        self.get_itemlist()
+        self.backend.items[11] = {'revision': 2, 'valid': True,
+                                  'dmap.itemid': 11,
+                                  'dmap.itemname': 'Track 11'}
+        self.backend.update_revision()
+        blob = self.get_itemlist()
+        self.assertEquals(self.backend.get_items_calls, 2)
+        [(tag, content)] = subr.decode_response(str(blob))
+        self.assertEquals(dict(content)['mrco'], 11)
+
+    def test_stale_reply_not_stored(self):
+        # a revision bump while the listing is being built means the
+        # listing may already be out of date, so it must not be kept.
+        get_items = self.backend.get_items
+        def get_items_and_bump(playlist_id=None, delta=0):
+            items = get_items(playlist_id, delta)
+            self.backend.update_revision()
+            return items
+        self.backend.get_items = get_items_and_bump
+        self.get_itemlist()
+        self.backend.get_items = get_items
+        self.get_itemlist()
+        self.assertEquals(self.backend.get_items_calls, 2)
+
+    def test_no_cache(self):
+        # backends without a response cache get a fresh reply every time
+        self.server.response_cache = None
+        reply = self.get_itemlist()
+        self.assert_(isinstance(reply, list))
+        self.assertEquals(self.get_itemlist(), reply)
+        self.assertEquals(self.backend.get_items_calls, 2)
+
+class DaapTestClient(object):
+    """Minimal DAAP client speaking to a local server."""
+    def __init__(self, port):
+        self.conn = httplib.HTTPConnection('127.0.0.1', port)
+        self.session = 0
+
+    def request(self, path):
+        if self.session:
+            sep = '&' if '?' in path else '?'
+            path += '%ssession-id=%d' % (sep, self.session)
+        self.conn.request('GET', path)
+
+    def response(self):
+        response = self.conn.getresponse()
+        data = response.read()
+        if response.status != libdaap.DAAP_OK:
+            return response.status, data
+        return response.status, subr.decode_response(data)
+
+    def get(self, path):
+        self.request(path)
+        return self.response()
+
+    def login(self):
+        status, reply = self.get('/login')
+        if status == libdaap.DAAP_OK:
+            [(tag, content)] = reply
+            self.session = dict(content)['mlid']
+        return status
+
+    def item_count(self):
+        status, reply = self.get('/databases/1/items')
+        [(tag, content)] = reply
+        return dict(content)['mrco']
+
+    def start_update(self, revision):
+        self.request('/update?revision-number=%d' % revision)
+
+    def update_revision(self):
+        status, reply = self.response()
+        [(tag, content)] = reply
+        return dict(content)['musr']
+
+    def close(self):
+        self.conn.close()
+
+def start_daap_server(backend, event_driven, max_conn=libdaap.DAAP_MAXCONN):
+    """Start serving backend on a free port, in a thread.  Stop it with
+    stop_daap_server().
+    """
+    server = libdaap.make_daap_server(backend, port=0, max_conn=max_conn,
+                                      robust=False, event_driven=event_driven)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.daemon = True
+    thread.start()
+    return server
+
+def stop_daap_server(server):
+    server.shutdown()
+    server.server_close()
+
+def wait_for(condition, timeout=5.0):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+class EventServerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.backend = FakeItemBackend(10)
+        self.server = start_daap_server(self.backend, event_driven=True)
+        self.finished_sessions = []
+        self.server.set_finished_callback(self.finished_sessions.append)
+        self.port = self.server.server_address[1]
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        stop_daap_server(self.server)
+        MiroTestCase.tearDown(self)
+
+    def make_client(self):
+        client = DaapTestClient(self.port)
+        self.clients.append(client)
+        return client
+
+    def test_requests(self):
+        client = self.make_client()
+        status, reply = client.get('/server-info')
+        self.assertEquals(reply[0][0], 'msrv')
+        self.assertEquals(client.login(), libdaap.DAAP_OK)
+        self.assertEquals(self.server.session_count(), 1)
+        # keep-alive: the same connection serves every request
+        sock = client.conn.sock
+        for i in xrange(3):
+            self.assertEquals(client.item_count(), 10)
+        self.assert_(client.conn.sock is sock)
+
+    def test_bad_request(self):
+        client = self.make_client()
+        status, data = client.get('/nonsense')
+        self.assertEquals(status, libdaap.DAAP_BADREQUEST)
+        self.assertEquals(client.login(), libdaap.DAAP_OK)
+
+    def test_update_long_poll(self):
+        clients = [self.make_client() for i in xrange(3)]
+        for client in clients:
+            client.login()
+            client.start_update(self.backend.revision)
+        self.assert_(wait_for(lambda: len(self.backend.revision_waiters) == 3))
+        # nobody gets a reply until the revision changes
+        socks = [client.conn.sock for client in clients]
+        r, w, x = select.select(socks, [], [], 0.2)
+        self.assertEquals(r, [])
+        self.backend.update_revision()
+        for client in clients:
+            self.assertEquals(client.update_revision(), 2)
+            # and the connection is still good to use
+            self.assertEquals(client.item_count(), 10)
+
+    def test_update_not_parked(self):
+        client = self.make_client()
+        client.login()
+        self.backend.update_revision()
+        client.start_update(1)
+        self.assertEquals(client.update_revision(), 2)
+        self.assertEquals(self.backend.revision_waiters, {})
+
+    def test_parked_client_disconnects(self):
+        client = self.make_client()
+        client.login()
+        session = client.session
+        client.start_update(self.backend.revision)
+        self.assert_(wait_for(lambda: self.backend.revision_waiters))
+        client.close()
+        self.assert_(wait_for(lambda: not self.backend.revision_waiters))
+        # closing the control connection ends the session
+        self.assert_(wait_for(lambda: self.finished_sessions == [session]))
+        self.assertEquals(self.server.session_count(), 0)
+
+    def test_max_conn(self):
+        self.server.set_maxconn(2)
+        for i in xrange(2):
+            self.assertEquals(self.make_client().login(), libdaap.DAAP_OK)
+        self.assertEquals(self.make_client().login(),
+                          libdaap.DAAP_UNAVAILABLE)
+
+    def test_session_timeout(self):
+        old_timeout = libdaap.DAAP_TIMEOUT
+        libdaap.DAAP_TIMEOUT = 0.2
+        try:
+            client = self.make_client()
+            client.login()
+        finally:
+            libdaap.DAAP_TIMEOUT = old_timeout
+        self.assertEquals(self.server.session_count(), 1)
+        self.assert_(wait_for(lambda: self.server.session_count() == 0))
+        status, data = client.get('/databases/1/items')
+        self.assertEquals(status, libdaap.DAAP_FORBIDDEN)
+
+    def test_stream_file(self):
+        path = self.make_temp_path('.mp3')
+        # bigger than a ChunkedStreamObj chunk
+        data = ''.join(chr(i % 256) for i in xrange(300 * 1024))
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        self.backend.files[5] = path
+        client = self.make_client()
+        client.login()
+        client.request('/databases/1/items/5.mp3')
+        response = client.conn.getresponse()
+        self.assertEquals(response.status, libdaap.DAAP_OK)
+        self.assertEquals(response.read(), data)
+        self.assertEquals(client.item_count(), 10)
+
+    def test_server_close(self):
+        client = self.make_client()
+        client.login()
+        client.start_update(self.backend.revision)
+        self.assert_(wait_for(lambda: self.backend.revision_waiters))
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertEquals(self.backend.revision_waiters, {})
+        self.assertEquals(self.finished_sessions, [client.session])
+        self.server = start_daap_server(self.backend, event_driven=True)
+
+def stream_to_string(blob):
+    """Send a ChunkedStreamObj over a socket and return what arrived."""
+    sender, receiver = socket.socketpair()
+    chunks = []
+    def read_all():
+        while True:
+            data = receiver.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+    thread = threading.Thread(target=read_all)
+    thread.start()
+    try:
+        blob.sendall(sender)
+    finally:
+        sender.close()
+        thread.join()
+        receiver.close()
+    return ''.join(chunks)
+
+class ChunkedStreamObjTest(MiroTestCase):
+    SIZE = 300 * 1024 + 17
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.path = self.make_temp_path('.mp4')
+        self.data = ''.join(chr(i % 251) for i in xrange(self.SIZE))
+        f = open(self.path, 'wb')
+        f.write(self.data)
+        f.close()
+
+    def make_stream(self, start=0, end=0, **kwargs):
+        # like SharingManagerBackend.get_file() and do_stream_file()
+        file_obj = open(self.path, 'rb')
+        file_obj.seek(start)
+        return subr.ChunkedStreamObj(file_obj, self.path, start, end,
+                                     **kwargs)
+
+    def check_ranges(self, use_sendfile):
+        ranges = [(0, 0), (1000, 0), (1000, 1999), (0, self.SIZE - 1),
+                  (self.SIZE - 1, 0), (5, self.SIZE + 100), (2000, 1000)]
+        for start, end in ranges:
+            blob = self.make_stream(start, end, use_sendfile=use_sendfile)
+            expected = ''.join(self.make_stream(start, end))
+            self.assertEquals(stream_to_string(blob), expected)
+            self.assertEquals(len(expected), len(blob))
+            self.assertEquals(blob.get_headers(),
+                              self.make_stream(start, end).get_headers())
+            self.assertEquals(blob.send(None), 0)
+
+    def test_sendfile(self):
+        self.check_ranges(True)
+
+    def test_mmap(self):
+        self.check_ranges(False)
+
+    def test_range_headers(self):
+        blob = self.make_stream(1000, 1999)
+        self.assertEquals(stream_to_string(blob), self.data[1000:2000])
+        self.assertEquals(blob.get_headers()[0],
+                          ('Content-Range', 'bytes 1000-1999/%d' % self.SIZE))
+
+    def test_sendfile_not_supported(self):
+        def sendfile(out_fd, in_fd, offset, count):
+            raise OSError(errno.EINVAL, 'Invalid argument')
+        blob = self.make_stream(10)
+        blob.sendfile = sendfile
+        self.assertEquals(stream_to_string(blob), self.data[10:])
+        self.assertEquals(blob.sendfile, None)
+
+    def test_empty_file(self):
+        # can't be mapped
+        open(self.path, 'wb').close()
+        blob = self.make_stream(use_sendfile=False)
+        self.assertEquals(stream_to_string(blob), '')
+
+    def test_truncated_file(self):
+        blob = self.make_stream(use_sendfile=False)
+        f = open(self.path, 'r+b')
+        f.truncate(1000)
+        f.close()
+        self.assertEquals(stream_to_string(blob), self.data[:1000])
+
+    def check_server_range(self, event_driven):
+        backend = FakeItemBackend(1)
+        backend.files[1] = self.path
+        server = start_daap_server(backend, event_driven)
+        client = DaapTestClient(server.server_address[1])
+        try:
+            client.login()
+            client.request('/databases/1/items/1.mp4')
+            response = client.conn.getresponse()
+            self.assertEquals(response.read(), self.data)
+            client.conn.putrequest('GET', '/databases/1/items/1.mp4'
+                                   '?session-id=%d' % client.session)
+            client.conn.putheader('Range', 'bytes=1000-1999')
+            client.conn.endheaders()
+            response = client.conn.getresponse()
+            self.assertEquals(response.status, libdaap.DAAP_PARTIAL_CONTENT)
+            self.assertEquals(response.getheader('Content-Range'),
+                              'bytes 1000-1999/%d' % self.SIZE)
+            self.assertEquals(response.read(), self.data[1000:2000])
+        finally:
+            client.close()
+            stop_daap_server(server)
+
+    def test_threaded_server_range(self):
+        self.check_server_range(False)
+
+    def test_event_server_range(self):
+        self.check_server_range(True)
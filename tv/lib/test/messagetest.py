@@ -1,11 +1,12 @@
 import logging
 import cPickle
 import functools
+import os
 
 from miro import app
 from miro import prefs
 
-from miro.feed import Feed
+from miro.feed import Feed, fingerprint_stats
 from miro.guide import ChannelGuide
 from miro.item import Item, FeedParserValues
 from miro.playlist import SavedPlaylist
@@ -13,6 +14,7 @@ from miro.folder import PlaylistFolder, ChannelFolder
 from miro.singleclick import _build_entry
 from miro.tabs import TabOrder
 from miro import itemsource
+from miro import iteminfocache
 from miro import messages
 from miro import messagehandler
 
@@ -497,6 +499,27 @@ class FeedItemTrackTest(TrackerTest):
         self.runUrgentCalls()
         self.assertEquals(len(self.test_handler.messages), 1)
 
+    def test_search(self):
+        messages.SearchItems('feed', self.feed.id, 'second').send_to_backend()
+        self.runUrgentCalls()
+        self.assertEquals(len(self.test_handler.messages), 2)
+        message = self.test_handler.messages[1]
+        self.assert_(isinstance(message, messages.ItemSearchResults))
+        self.assertEquals(message.type, 'feed')
+        self.assertEquals(message.id, self.feed.id)
+        self.assertEquals(message.query, 'second')
+        self.assertEquals(message.ids, set([self.items[1].id]))
+
+    def test_ranked_search(self):
+        self.make_item(u'http://example.com/3', u'second second item')
+        messages.SearchItems('feed', self.feed.id, 'second',
+                             ranked=True).send_to_backend()
+        self.runUrgentCalls()
+        message = self.test_handler.messages[-1]
+        self.assert_(isinstance(message, messages.ItemSearchResults))
+        self.assert_(message.ranked)
+        self.assertEquals(message.ids, [self.items[2].id, self.items[1].id])
+
 class PlaylistItemTrackTest(TrackerTest):
     def setUp(self):
         TrackerTest.setUp(self)
@@ -582,6 +605,22 @@ class PlaylistItemTrackTest(TrackerTest):
         self.runUrgentCalls()
         self.assertEquals(len(self.test_handler.messages), 1)
 
+class FeedUpdateStatsTrackTest(TrackerTest):
+    def test_fingerprint_stats(self):
+        fingerprint_stats.reset()
+        fingerprint_stats.bodies_skipped = 2
+        fingerprint_stats.entries_skipped = 5
+        messages.TrackFeedUpdateStats().send_to_backend()
+        self.runUrgentCalls()
+        self.check_message_count(1)
+        message = self.test_handler.messages[0]
+        self.assert_(isinstance(message, messages.FeedUpdateStatsChanged))
+        self.assertEquals(message.bodies_skipped, 2)
+        self.assertEquals(message.entries_skipped, 5)
+        fingerprint_stats.reset()
+        messages.StopTrackingFeedUpdateStats().send_to_backend()
+        self.runUrgentCalls()
+
 class ItemInfoCacheTest(FeedItemTrackTest):
     # this class runs the exact same tests as FeedItemTrackTest, but using
     # values read from the item_info_cache file.  Also, we check to make sure
@@ -605,6 +644,14 @@ class ItemInfoCacheTest(FeedItemTrackTest):
         app.item_info_cache.save()
         self.setup_new_item_info_cache()
 
+class ColumnarItemInfoCacheTest(ItemInfoCacheTest):
+    # same as ItemInfoCacheTest, but using ColumnarItemInfoCache
+    def setup_new_item_info_cache(self):
+        path = os.path.join(self.tempdir, 'item_info_cache.dat')
+        app.item_info_cache = iteminfocache.ColumnarItemInfoCache(path)
+        app.item_info_cache.load()
+        self.setup_new_search_index()
+
 class ItemInfoCacheErrorTest(MiroTestCase):
     # Test errors when loading the Item info cache
     def setUp(self):
@@ -630,7 +677,8 @@ class ItemInfoCacheErrorTest(MiroTestCase):
         for item in self.items:
             cache_info = app.item_info_cache.id_to_info[item.id]
             real_info = itemsource.DatabaseItemSource._item_info_for(item)
-            self.assertEquals(cache_info.__dict__, real_info.__dict__)
+            self.assertEquals(cache_info.get_attributes(),
+                              real_info.get_attributes())
         # it should also delete all data from the item cache table
         app.db.cursor.execute("SELECT COUNT(*) FROM item_info_cache")
         self.assertEquals(app.db.cursor.fetchone()[0], 0)
@@ -644,7 +692,17 @@ class ItemInfoCacheErrorTest(MiroTestCase):
                     "WHERE id=%s" % item.id)
             db_info = cPickle.loads(str(app.db.cursor.fetchone()[0]))
             real_info = itemsource.DatabaseItemSource._item_info_for(item)
-            self.assertEquals(db_info.__dict__, real_info.__dict__)
+            self.assertEquals(db_info.get_attributes(),
+                              real_info.get_attributes())
+
+    def test_info_attributes_in_slots(self):
+        # every attribute we set should have a slot, ItemInfo doesn't have a
+        # __dict__ to fall back on
+        info = itemsource.DatabaseItemSource._item_info_for(self.items[0])
+        self.assert_(not hasattr(info, '__dict__'))
+        self.assertRaises(AttributeError, setattr, info, 'bogus', 1)
+        copy = cPickle.loads(cPickle.dumps(info, cPickle.HIGHEST_PROTOCOL))
+        self.assertEquals(copy.get_attributes(), info.get_attributes())
 
     def test_failsafe_load_item_change(self):
         # Test Items calling signal_change() when we do a failsafe load
@@ -1,15 +1,46 @@
+import gc
 import shutil
 import os
 import pstats
 import cProfile
+import cPickle
+import threading
+import time
+from datetime import datetime, timedelta
 
 from miro import app
+from miro import columncodec
+from miro import columnarstore
+from miro import databaseupgrade
+from miro import feedparserutil
+from miro import httpclient
+from miro import item
+from miro.libdaap import libdaap
+from miro.libdaap import subr
+from miro import iteminfocache
+from miro import itemsource
 from miro import messagehandler
 from miro import messages
 from miro import models
+from miro import playlist
+from miro import prefs
+from miro import schema
+from miro import search
+from miro import sharing
+from miro import storedatabase
+from miro import util
+from miro import workerprocess
 from miro.fileobject import FilenameType
-from miro.test.framework import EventLoopTest
+from miro.plat import resources
+from miro.plat.utils import get_logical_cpu_count
+from miro.test.framework import EventLoopTest, MiroTestCase, uses_httpclient
+from miro.test import httpclienttest
+from miro.test.feedparsertest import _make_big_feed
+from miro.test.indexadvisortest import SyntheticDatabase
+from miro.test import libdaaptest
 from miro.test import messagetest
+from miro.test import sharingtest
+from miro.test import testhttpserver
 
 class PerformanceTest(EventLoopTest):
     def setUp(self):
@@ -66,3 +97,907 @@ class PerformanceTest(EventLoopTest):
     def track_item_count(self):
         messages.TrackNewVideoCount().send_to_backend()
         self.runUrgentCalls()
+
+class BulkViewTrackerPerformanceTest(MiroTestCase):
+    """Measure how many queries view trackers run for a big feed refresh."""
+
+    ITEM_COUNT = 5000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = models.Feed(u'http://example.com/feed')
+        self.other_feeds = [models.Feed(u'http://example.com/feed%d' % i)
+                for i in xrange(10)]
+        self.trackers = []
+        for feed in [self.feed] + self.other_feeds:
+            self.trackers.append(models.Item.visible_feed_view(feed.id))
+            self.trackers.append(models.Item.feed_available_view(feed.id))
+            self.trackers.append(models.Item.feed_unwatched_view(feed.id))
+        self.trackers.extend([
+            models.Item.watchable_video_view(),
+            models.Item.watchable_audio_view(),
+            models.Item.downloaded_view(),
+            models.Item.unique_new_video_view(),
+            models.Item.manual_pending_view(),
+        ])
+        self.trackers = [view.make_tracker() for view in self.trackers]
+        for tracker in self.trackers:
+            tracker.set_bulk_mode(True)
+        self.query_count = 0
+        query_ids = app.db.query_ids
+        query_count = app.db.query_count
+        def counting_query_ids(*args, **kwargs):
+            self.query_count += 1
+            return query_ids(*args, **kwargs)
+        def counting_query_count(*args, **kwargs):
+            self.query_count += 1
+            return query_count(*args, **kwargs)
+        app.db.query_ids = counting_query_ids
+        app.db.query_count = counting_query_count
+
+    def test_feed_refresh(self):
+        items = []
+        for i in xrange(self.ITEM_COUNT):
+            url = u'http://example.com/feed/%d.mp3' % i
+            items.append(item.FeedParserValues({
+                'title': u'item %d' % i,
+                'enclosures': [{'url': url}],
+            }))
+        start = time.time()
+        app.bulk_sql_manager.start()
+        for fp_values in items:
+            models.Item(fp_values, feed_id=self.feed.id)
+        # don't count the queries that Item.setup_new() runs
+        self.query_count = 0
+        app.bulk_sql_manager.finish()
+        end = time.time()
+        chunks = len(list(util.split_values_for_sqlite(range(
+            self.ITEM_COUNT))))
+        print
+        print '%d items, %d trackers: %d tracker queries in %0.3f seconds' % (
+                self.ITEM_COUNT, len(self.trackers), self.query_count,
+                end - start)
+        self.assert_(self.query_count <= len(self.trackers) * chunks)
+
+class ColumnCodecPerformanceTest(MiroTestCase):
+    """Compare restoring pythonrepr columns stored as repr() and with
+    columncodec.
+    """
+
+    ROW_COUNT = 10000
+
+    def make_status(self, i):
+        return {
+            'state': u'finished',
+            'currentSize': i * 1024,
+            'totalSize': i * 1024,
+            'rate': 0.0,
+            'eta': 0,
+            'startTime': time.time(),
+            'endTime': time.time(),
+            'filename': u'/home/user/Movies/Miro/movie%d.avi' % i,
+            'shortFilename': u'movie%d.avi' % i,
+            'dlerType': u'HTTP',
+            'retryTime': None,
+            'retryCount': -1,
+            'channelName': None,
+            'metainfo': None,
+            'infohash': None,
+            'uploaded': 0,
+            'activity': None,
+        }
+
+    def test_restore_status(self):
+        converter = storedatabase.SQLiteConverter()
+        schema_item = None
+        statuses = [self.make_status(i) for i in xrange(self.ROW_COUNT)]
+        repr_values = [repr(status) for status in statuses]
+        codec_values = [buffer(columncodec.encode(status))
+                for status in statuses]
+
+        start = time.time()
+        for value in repr_values:
+            # how _repr_from_sql() used to restore values
+            databaseupgrade.eval_container(value)
+        repr_time = time.time() - start
+
+        start = time.time()
+        for value in codec_values:
+            converter._repr_from_sql(value, schema_item)
+        codec_time = time.time() - start
+        print
+        print '%d status dicts: repr %0.3fs, columncodec %0.3fs' % (
+                self.ROW_COUNT, repr_time, codec_time)
+        self.assert_(codec_time < repr_time)
+
+class ItemInfoCacheStartupPerformanceTest(MiroTestCase):
+    """Compare startup time for the sqlite and columnar ItemInfoCache
+    backends.
+    """
+
+    ITEM_COUNTS = (10000, 50000, 100000)
+    # how many infos to fetch after loading, like the first TrackItems call
+    # for a tab would
+    FETCH_COUNT = 200
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = models.Feed(u'dtv:manualFeed')
+        fp_values = item.FeedParserValues({
+            'title': u'template item',
+            'description': u'<p>a <b>long</b> description</p>' * 10,
+            'enclosures': [{'url': u'http://example.com/template.mp3'}],
+        })
+        template_item = models.Item(fp_values, feed_id=self.feed.id)
+        self.template_state = itemsource.DatabaseItemSource._item_info_for(
+                template_item).__getstate__()
+        app.db.finish_transaction()
+
+    def make_states(self, count):
+        for i in xrange(count):
+            state = self.template_state.copy()
+            state['id'] = i + 1
+            state['name'] = u'item %d' % i
+            state['file_url'] = u'http://example.com/%d.mp3' % i
+            yield state
+
+    def make_info(self, state):
+        info = messages.ItemInfo.__new__(messages.ItemInfo)
+        info.__setstate__(state)
+        return info
+
+    def time_load(self, cache, count):
+        cache._db_item_count = lambda: count
+        start = time.time()
+        cache._quick_load()
+        load_time = time.time() - start
+        self.assertEquals(len(cache.id_to_info), count)
+        start = time.time()
+        for id_ in xrange(1, self.FETCH_COUNT + 1):
+            cache.id_to_info[id_]
+        return load_time, time.time() - start
+
+    def time_sqlite(self, count):
+        cache = iteminfocache.ItemInfoCache()
+        app.db.cursor.execute("DELETE FROM item_info_cache")
+        app.db.cursor.executemany("INSERT INTO item_info_cache "
+                "(id, pickle) VALUES (?, ?)",
+                ((state['id'], buffer(cPickle.dumps(self.make_info(state))))
+                 for state in self.make_states(count)))
+        app.db.set_variable(cache.VERSION_KEY, cache.version())
+        return self.time_load(cache, count)
+
+    def time_columnar(self, count):
+        cache = self.make_columnar_cache(count)
+        rv = self.time_load(cache, count)
+        cache.id_to_info.close_file()
+        return rv
+
+    def make_columnar_cache(self, count):
+        path = self.make_temp_path('.dat')
+        cache = iteminfocache.ColumnarItemInfoCache(path)
+        columnarstore.write_file(path, list(self.make_states(count)),
+                                 cache.version(), 'token')
+        # no changes since the file was written
+        app.db.cursor.execute("DELETE FROM item_info_cache")
+        app.db.set_variable(cache.VERSION_KEY, cache.version())
+        app.db.set_variable(cache.TOKEN_KEY, 'token')
+        return cache
+
+    def time_columnar_save(self, count, rewrite):
+        cache = self.make_columnar_cache(count)
+        cache._db_item_count = lambda: count
+        cache._quick_load()
+        cache._reset_changes()
+        for id_ in xrange(1, self.FETCH_COUNT + 1):
+            cache._infos_changed[id_] = cache.id_to_info[id_]
+        cache._needs_rewrite = rewrite
+        start = time.time()
+        cache.save()
+        save_time = time.time() - start
+        cache.id_to_info.close_file()
+        return save_time
+
+    def test_save(self):
+        print
+        for count in self.ITEM_COUNTS:
+            print ('%6d items, %d changed: save changes %0.3fs, '
+                   'rewrite file %0.3fs' %
+                   (count, self.FETCH_COUNT,
+                    self.time_columnar_save(count, False),
+                    self.time_columnar_save(count, True)))
+
+    def test_startup(self):
+        print
+        for count in self.ITEM_COUNTS:
+            for name, timer in (('sqlite', self.time_sqlite),
+                                ('columnar', self.time_columnar)):
+                load_time, fetch_time = timer(count)
+                print ('%6d items, %-8s: load %0.3fs, fetch %d infos %0.3fs' %
+                       (count, name, load_time, self.FETCH_COUNT,
+                        fetch_time))
+
+class ItemInfoMemoryPerformanceTest(MiroTestCase):
+    """Measure memory usage for ItemInfo objects, like
+    util.db_mem_usage_test() does for DDBObjects.
+    """
+
+    ITEM_COUNT = 50000
+
+    class DictItemInfo(object):
+        """Stores attributes in __dict__, like ItemInfo used to."""
+        def __init__(self, attributes):
+            self.__dict__.update(attributes)
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = models.Feed(u'http://example.com/feed')
+        fp_values = item.FeedParserValues({
+            'title': u'template item',
+            'description': u'short description',
+            'enclosures': [{'url': u'http://example.com/template.mp3',
+                            'type': u'audio/mpeg'}],
+        })
+        template_item = models.Item(fp_values, feed_id=self.feed.id)
+        template_item.album = u'Album Title'
+        template_item.artist = u'Artist Name'
+        template_item.genre = u'Genre'
+        self.template_state = itemsource.DatabaseItemSource._item_info_for(
+                template_item).__getstate__()
+
+    def copy_strings(self, attributes):
+        rv = {}
+        for name, value in attributes.iteritems():
+            if isinstance(value, unicode):
+                # make a new string object, like unpickling would
+                value = value[:1] + value[1:]
+            rv[name] = value
+        return rv
+
+    def make_state(self, i):
+        state = self.copy_strings(self.template_state)
+        state['id'] = i
+        state['name'] = u'item %d' % i
+        return state
+
+    def measure(self, info_factory):
+        last_usage = util.get_mem_usage()
+        infos = [info_factory(self.make_state(i))
+                 for i in xrange(self.ITEM_COUNT)]
+        usage = util.get_mem_usage() - last_usage
+        del infos
+        return usage
+
+    def make_item_info(self, state):
+        info = messages.ItemInfo.__new__(messages.ItemInfo)
+        info.__setstate__(state)
+        return info
+
+    def make_dict_item_info(self, state):
+        info = self.make_item_info(state)
+        return self.DictItemInfo(self.copy_strings(info.get_attributes()))
+
+    def test_memory_usage(self):
+        # measure the slots version first, so that it doesn't get to reuse
+        # memory freed by the other one
+        slots_usage = self.measure(self.make_item_info)
+        dict_usage = self.measure(self.make_dict_item_info)
+        print
+        print '%d ItemInfos: __dict__ %dKB, __slots__ %dKB' % (
+                self.ITEM_COUNT, dict_usage, slots_usage)
+
+class ObjectEvictionMemoryTest(MiroTestCase):
+    """Measure memory usage for a failsafe ItemInfoCache rebuild with and
+    without evicting unused items from LiveStorage.
+    """
+
+    ITEM_COUNT = 50000
+    CACHE_SIZE = 1000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.db_path = os.path.join(self.tempdir, 'eviction.db')
+        self.reload_database(self.db_path)
+        self.feed = models.Feed(u'dtv:manualFeed')
+        models.Item(item.FeedParserValues({
+            'title': u'template item',
+            'description': u'<p>a <b>long</b> description</p>' * 10,
+            'enclosures': [{'url': u'http://example.com/template.mp3'}],
+        }), feed_id=self.feed.id)
+        # copy the template row to make the rest of the items, creating
+        # 50k Item objects would take forever
+        columns = ', '.join(name for name, schema_item
+                            in schema.ItemSchema.fields if name != 'id')
+        sql = "INSERT INTO item (%s) SELECT %s FROM item LIMIT 1" % (
+                columns, columns)
+        for i in xrange(self.ITEM_COUNT - 1):
+            app.db.cursor.execute(sql)
+        app.db.finish_transaction()
+
+    def measure(self, object_cache_size):
+        self.reload_database(self.db_path,
+                             object_cache_size=object_cache_size)
+        gc.collect()
+        last_usage = util.get_mem_usage()
+        cache = iteminfocache.ItemInfoCache()
+        cache._failsafe_load()
+        gc.collect()
+        self.assertEquals(len(cache.id_to_info), self.ITEM_COUNT)
+        usage = util.get_mem_usage() - last_usage
+        return usage, app.db.persistent_object_count(), cache
+
+    def test_failsafe_load(self):
+        # measure the evicting version first, so that it doesn't get to
+        # reuse memory freed by the other one.  Keep the caches around so
+        # the second run can't reuse the ItemInfo memory either.
+        evict_usage, evict_count, evict_cache = self.measure(self.CACHE_SIZE)
+        keep_usage, keep_count, keep_cache = self.measure(None)
+        print
+        print ('%d items: keep all %dKB (%d objects), '
+               'evicting %dKB (%d objects)' % (self.ITEM_COUNT, keep_usage,
+                   keep_count, evict_usage, evict_count))
+        self.assert_(keep_count > self.ITEM_COUNT)
+        # the items in the cache, plus a few pinned objects like the feed
+        self.assert_(evict_count <= self.CACHE_SIZE + 10)
+
+class ItemSearcherPerformanceTest(MiroTestCase):
+    """Compare ItemSearcher and CompactItemSearcher."""
+
+    ITEM_COUNTS = (10000, 100000)
+    QUERIES = (u'the', u'music', u'video 12', u'podcast -episode', u'ab')
+
+    class FakeInfo(object):
+        def __init__(self, id_, search_terms):
+            self.id = id_
+            self.search_terms = search_terms
+
+    def make_infos(self, count):
+        words = [u'the', u'music', u'video', u'podcast', u'episode', u'live',
+                 u'interview', u'news', u'weekly', u'show', u'mp3', u'avi']
+        infos = []
+        for i in xrange(count):
+            terms = [words[(i * 7 + j) % len(words)] for j in xrange(5)]
+            terms.append(unicode(i))
+            terms.append(u'feed%d' % (i % 50))
+            infos.append(self.FakeInfo(i + 1, terms))
+        return infos
+
+    def measure(self, searcher_class, infos):
+        last_usage = util.get_mem_usage()
+        start = time.time()
+        searcher = searcher_class()
+        for info in infos:
+            searcher.add_item(info)
+        if hasattr(searcher, 'compact'):
+            searcher.compact()
+        build_time = time.time() - start
+        memory = util.get_mem_usage() - last_usage
+        results = []
+        start = time.time()
+        for query in self.QUERIES:
+            results.append(searcher.search(query))
+        query_time = (time.time() - start) / len(self.QUERIES)
+        return build_time, memory, query_time, results
+
+    def test_searchers(self):
+        print
+        for count in self.ITEM_COUNTS:
+            infos = self.make_infos(count)
+            all_results = []
+            # measure the compact one first so that it can't reuse memory
+            # freed from the other one
+            for searcher_class in (search.CompactItemSearcher,
+                                   search.ItemSearcher):
+                build_time, memory, query_time, results = self.measure(
+                        searcher_class, infos)
+                all_results.append(results)
+                print ('%6d items, %-19s: build %0.3fs, %dKB, '
+                       'query %0.2fms' % (count, searcher_class.__name__,
+                                          build_time, memory,
+                                          query_time * 1000))
+            self.assertEquals(all_results[0], all_results[1])
+
+class FeedFetchConnectionPerformanceTest(httpclienttest.HTTPClientTestBase):
+    """Count the connections made for sequential fetches from one host."""
+
+    FETCH_COUNT = 500
+
+    @uses_httpclient
+    def test_sequential_fetches(self):
+        handler_class = testhttpserver.MiroHTTPRequestHandler
+        connections_before = handler_class.handlers_created
+        url = self.httpserver.build_url('test.txt')
+        start = time.time()
+        for i in xrange(self.FETCH_COUNT):
+            self.grab_url(url)
+        total_time = time.time() - start
+        connections = handler_class.handlers_created - connections_before
+        pool = httpclient.curl_manager.handle_pool
+        print
+        print ('%d fetches: %0.3fs, %d connections, %d handles created, '
+               '%d reused' % (self.FETCH_COUNT, total_time, connections,
+                              pool.created_count, pool.reused_count))
+        self.assert_(connections < 5)
+
+class FeedCountsPerformanceTest(MiroTestCase):
+    """Compare COUNT(*) view queries with FeedCounts for a sidebar refresh.
+    """
+
+    FEED_COUNT = 600
+    ITEMS_PER_FEED = 5
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feeds = []
+        app.bulk_sql_manager.start()
+        for i in xrange(self.FEED_COUNT):
+            feed = models.Feed(u'http://example.com/feed%d' % i)
+            for j in xrange(self.ITEMS_PER_FEED):
+                url = u'http://example.com/feed%d/%d.mp3' % (i, j)
+                models.Item(item.FeedParserValues({
+                    'title': u'item %d' % j,
+                    'enclosures': [{'url': url}],
+                }), feed_id=feed.id)
+            self.feeds.append(feed)
+        app.bulk_sql_manager.finish()
+
+    def change_items(self):
+        for feed in self.feeds:
+            for feed_item in feed.items:
+                feed_item.seen = not feed_item.seen
+                feed_item.signal_change()
+                break
+
+    def counts_from_views(self, feed):
+        return (feed.downloaded_items.count(),
+                feed.downloading_items.count(),
+                feed.unwatched_items.count(),
+                feed.available_items.count() -
+                feed.auto_pending_items.count())
+
+    def counts_from_feed_counts(self, feed):
+        return (feed.num_downloaded(), feed.num_downloading(),
+                feed.num_unwatched(), feed.num_available())
+
+    def measure(self, get_counts):
+        self.change_items()
+        start = time.time()
+        for feed in self.feeds:
+            get_counts(feed)
+        return time.time() - start
+
+    def test_refresh(self):
+        app.feed_counts.load()
+        view_time = self.measure(self.counts_from_views)
+        counts_time = self.measure(self.counts_from_feed_counts)
+        print
+        print '%d feeds: COUNT(*) queries %0.3fs, FeedCounts %0.3fs' % (
+                self.FEED_COUNT, view_time, counts_time)
+        self.assert_(app.feed_counts.check_consistency())
+
+class FeedParsePerformanceTest(MiroTestCase):
+    """Compare parse() and parse_streaming() on a big feed with 10 new
+    entries.
+    """
+
+    ENTRY_COUNT = 10000
+    NEW_COUNT = 10
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.html = _make_big_feed(self.ENTRY_COUNT)
+        self.known_ids = [u'guid-%d&x' % i
+                          for i in xrange(self.ENTRY_COUNT - self.NEW_COUNT)]
+
+    def measure(self, parse_func):
+        last_usage = util.get_mem_usage()
+        start = time.time()
+        parsed = parse_func()
+        parse_time = time.time() - start
+        usage = util.get_mem_usage() - last_usage
+        pickled_size = len(cPickle.dumps(parsed, cPickle.HIGHEST_PROTOCOL))
+        del parsed
+        return parse_time, usage, pickled_size
+
+    def test_parse(self):
+        # measure the streaming version first, so that it doesn't get to
+        # reuse memory freed by the other one
+        streaming = self.measure(lambda: feedparserutil.parse_streaming(
+            self.html, self.known_ids, 20))
+        full = self.measure(lambda: feedparserutil.parse(self.html))
+        print
+        for name, (parse_time, usage, pickled_size) in (('full', full),
+                ('streaming', streaming)):
+            print ('%d entries, %-9s: %0.3fs, %dKB, %dKB pickled' %
+                   (self.ENTRY_COUNT, name, parse_time, usage,
+                    pickled_size / 1024))
+        self.assert_(streaming[0] < full[0])
+
+class WorkerProcessPerformanceTest(EventLoopTest):
+    """Compare running mutagen tasks with 1 worker process vs 1 per CPU."""
+
+    TASK_COUNT = 2000
+    SOURCE_FILES = ('mp3-0.mp3', 'mp3-1.mp3', 'mp3-2.mp3', 'mp4-0.mp4',
+                    'drm.m4v', 'webm-0.webm')
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.corpus = []
+        for i in xrange(self.TASK_COUNT):
+            filename = self.SOURCE_FILES[i % len(self.SOURCE_FILES)]
+            source = resources.path("testdata/metadata/" + filename)
+            path = os.path.join(self.tempdir, '%d-%s' % (i, filename))
+            shutil.copyfile(source, path)
+            self.corpus.append(path)
+
+    def on_result(self, msg, result):
+        self.finished_count += 1
+        if self.finished_count == self.TASK_COUNT:
+            self.stopEventLoop(abnormal=False)
+
+    def run_tasks(self, process_count):
+        workerprocess.startup(process_count=process_count)
+        self.finished_count = 0
+        start = time.time()
+        for path in self.corpus:
+            msg = workerprocess.MutagenTask(path, self.tempdir)
+            workerprocess.send(msg, self.on_result, self.on_result)
+        self.runEventLoop(600)
+        total_time = time.time() - start
+        workerprocess.shutdown()
+        self.assertEquals(self.finished_count, self.TASK_COUNT)
+        return total_time
+
+    def test_mutagen_tasks(self):
+        cpu_count = get_logical_cpu_count()
+        single_time = self.run_tasks(1)
+        pool_time = self.run_tasks(cpu_count)
+        print
+        print '%d mutagen tasks, 1 process: %0.2fs' % (self.TASK_COUNT,
+                                                     single_time)
+        print '%d mutagen tasks, %d processes: %0.2fs (%0.1fx)' % (
+                self.TASK_COUNT, cpu_count, pool_time,
+                single_time / pool_time)
+
+class ViewIndexPerformanceTest(MiroTestCase):
+    """Compare view query times with and without the indexes that
+    upgrade181 added.
+    """
+
+    FEED_COUNT = 200
+    ITEMS_PER_FEED = 100
+    DOWNLOADER_COUNT = 5000
+    PLAYLIST_COUNT = 50
+    ITEMS_PER_PLAYLIST = 200
+    REPEAT = 20
+
+    INDEXES = ('item_feed_release_date', 'item_feed_watched',
+            'downloader_main_item', 'playlist_item_map_position',
+            'playlist_folder_item_map_position')
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.database = SyntheticDatabase(self.FEED_COUNT,
+                self.ITEMS_PER_FEED, self.DOWNLOADER_COUNT,
+                self.PLAYLIST_COUNT, self.ITEMS_PER_PLAYLIST)
+
+    def views(self):
+        # the first feed is the big one
+        feed_id = self.database.feeds[0].id
+        watched_before = datetime.now() - timedelta(days=1)
+        return [
+            ('Item.latest_in_feed_view',
+                models.Item.latest_in_feed_view(feed_id)),
+            ('Item.feed_expiring_view',
+                models.Item.feed_expiring_view(feed_id, watched_before)),
+            ('Item.watchable_other_view',
+                models.Item.watchable_other_view()),
+            ('Item.playlist_view', models.Item.playlist_view(1)),
+            ('Item.playlist_folder_view',
+                models.Item.playlist_folder_view(1)),
+            ('PlaylistItemMap.playlist_view',
+                playlist.PlaylistItemMap.playlist_view(1)),
+        ]
+
+    def time_views(self):
+        """Time the view queries and the SQL ViewTracker uses to check an
+        object.
+
+        :returns: (times, results) dicts that map view names to the time
+            each query took and the results it returned
+        """
+        times = {}
+        results = {}
+        check_ids = self.database.item_ids[:self.REPEAT * 10]
+        for name, view in self.views():
+            start = time.time()
+            for i in xrange(self.REPEAT):
+                ids = list(app.db.query_ids(view.table_name, view.where,
+                    view.values, view.order_by, view.joins, view.limit))
+            times[name] = (time.time() - start) / self.REPEAT
+            results[name] = ids
+            where = '%s.id = ? AND (%s)' % (view.table_name, view.where)
+            start = time.time()
+            counts = [app.db.query_count(view.table_name, where,
+                (id_,) + tuple(view.values or ()), view.joins)
+                for id_ in check_ids]
+            times[name, 'check'] = (time.time() - start) / len(check_ids)
+            results[name, 'check'] = counts
+        return times, results
+
+    def test_view_indexes(self):
+        after_times, after_results = self.time_views()
+        for index_name in self.INDEXES:
+            app.db.cursor.execute("DROP INDEX %s" % index_name)
+        before_times, before_results = self.time_views()
+        print
+        print '%-30s %23s %23s' % ('', 'view query (ms)',
+                'tracker check (ms)')
+        print '%-30s %11s %11s %11s %11s' % ('view', 'before', 'after',
+                'before', 'after')
+        for name, view in self.views():
+            print '%-30s %11.3f %11.3f %11.3f %11.3f' % (name,
+                    before_times[name] * 1000, after_times[name] * 1000,
+                    before_times[name, 'check'] * 1000,
+                    after_times[name, 'check'] * 1000)
+        self.assertEquals(before_results, after_results)
+
+class SaveStatementPerformanceTest(MiroTestCase):
+    """Measure single-object saves now that UPDATE statements bind the id
+    and their SQL is memoized.
+    """
+
+    ITEM_COUNT = 5000
+    SAVE_COUNT = 50000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = models.Feed(u'http://example.com/feed')
+        self.items = []
+        app.bulk_sql_manager.start()
+        for i in xrange(self.ITEM_COUNT):
+            self.items.append(models.Item(item.FeedParserValues({
+                'title': u'item %d' % i,
+                'enclosures': [{
+                    'url': u'http://example.com/feed/%d.mp3' % i}],
+            }), feed_id=self.feed.id))
+        app.bulk_sql_manager.finish()
+
+    def time_saves(self, save):
+        start = time.time()
+        for i in xrange(self.SAVE_COUNT):
+            obj = self.items[i % self.ITEM_COUNT]
+            obj.keep = not obj.keep
+            save(obj)
+        total_time = time.time() - start
+        app.db.finish_transaction()
+        return total_time
+
+    def time_updates(self, make_statement):
+        start = time.time()
+        for i in xrange(self.SAVE_COUNT):
+            item_id = self.items[i % self.ITEM_COUNT].id
+            sql, values = make_statement(item_id, i)
+            app.db.cursor.execute(sql, values)
+        return time.time() - start
+
+    def test_saves(self):
+        signal_change_time = self.time_saves(lambda obj: obj.signal_change())
+        update_obj_time = self.time_saves(app.db.update_obj)
+        # compare the statement that update_obj() runs now with the one it
+        # used to build, which had the id in the SQL text
+        bound_time = self.time_updates(lambda item_id, i: (
+            "UPDATE item SET keep=? WHERE id=?", (i % 2, item_id)))
+        inline_time = self.time_updates(lambda item_id, i: (
+            "UPDATE item SET keep=? WHERE id=%s" % item_id, (i % 2,)))
+        print
+        for name, total_time in (
+                ('signal_change()', signal_change_time),
+                ('LiveStorage.update_obj()', update_obj_time),
+                ('UPDATE with bound id', bound_time),
+                ('UPDATE with id in SQL text', inline_time)):
+            print '%-28s %7.3fs %7.1fus each' % (name, total_time,
+                    total_time / self.SAVE_COUNT * 1000000)
+
+class DMAPCodecPerformanceTest(MiroTestCase):
+    """Compare the offset-based DMAP codec with the old one on a big
+    /databases/1/items listing.
+    """
+
+    ITEM_COUNT = 50000
+
+    def time_call(self, func, arg):
+        start = time.time()
+        result = func(arg)
+        return time.time() - start, result
+
+    def test_item_listing(self):
+        listing = libdaaptest.make_item_listing(self.ITEM_COUNT)
+        encode_time, stream = self.time_call(subr.encode_response, listing)
+        data = str(stream)
+        old_encode_time, old_data = self.time_call(
+                libdaaptest.reference_encode_response, listing)
+        decode_time, decoded = self.time_call(subr.decode_response, data)
+        old_decode_time, old_decoded = self.time_call(
+                libdaaptest.reference_decode_response, data)
+        print
+        print '%d items (%d bytes)' % (self.ITEM_COUNT, len(data))
+        print 'encode: old %0.3fs, new %0.3fs' % (old_encode_time,
+                encode_time)
+        print 'decode: old %0.3fs, new %0.3fs' % (old_decode_time,
+                decode_time)
+        self.assertEquals(data, old_data)
+        self.assertEquals(decoded, listing)
+        self.assertEquals(old_decoded, listing)
+
+class ItemListCachePerformanceTest(MiroTestCase):
+    """Time repeated gzipped /databases/1/items requests with and without
+    the DAAP response cache.
+    """
+
+    ITEM_COUNT = 20000
+    REQUESTS = 10
+
+    def time_requests(self, server):
+        start = time.time()
+        for i in xrange(self.REQUESTS):
+            handler = libdaaptest.FakeRequestHandler(server, 'gzip')
+            rcode, reply, extra_headers = handler.do_itemlist(None, {})
+            str(subr.encode_response(reply, 'gzip')
+                if isinstance(reply, list) else reply)
+        return time.time() - start
+
+    def test_item_listing(self):
+        backend = libdaaptest.FakeItemBackend(self.ITEM_COUNT)
+        uncached_server = libdaaptest.FakeServer(backend)
+        uncached_server.response_cache = None
+        uncached_time = self.time_requests(uncached_server)
+        cached_time = self.time_requests(libdaaptest.FakeServer(backend))
+        print
+        print '%d requests for %d items' % (self.REQUESTS, self.ITEM_COUNT)
+        print 'uncached: %0.3fs, cached: %0.3fs' % (uncached_time,
+                cached_time)
+        self.assertEquals(backend.get_items_calls, self.REQUESTS + 1)
+
+class DeltaUpdatePerformanceTest(MiroTestCase):
+    """Time delta item listings served from SharingManagerBackend's change
+    log against the full scan that is used when the log doesn't go back far
+    enough.
+    """
+
+    ITEM_COUNT = 50000
+    CHANGED_COUNT = 10
+    REQUESTS = 20
+
+    def time_requests(self, backend, delta):
+        start = time.time()
+        for i in xrange(self.REQUESTS):
+            items = backend.get_items(delta=delta)
+            changed = [k for k, v in items.iteritems()
+                       if v['revision'] > delta]
+        return time.time() - start, sorted(changed)
+
+    def test_delta_listing(self):
+        app.config.set(prefs.SHARE_AUDIO, True)
+        backend = sharing.SharingManagerBackend()
+        items = [sharingtest.FakeItem(i)
+                 for i in xrange(1, self.ITEM_COUNT + 1)]
+        backend.handle_item_list(sharingtest.FakeMessage(items=items))
+        delta = backend.revision
+        backend.handle_items_changed(sharingtest.FakeMessage(
+            changed=items[:self.CHANGED_COUNT]))
+        log_time, log_changed = self.time_requests(backend, delta)
+        # Make the change log look too short for this delta.
+        backend.change_log_horizon = delta + 1
+        scan_time, scan_changed = self.time_requests(backend, delta)
+        print
+        print '%d requests, %d of %d items changed' % (self.REQUESTS,
+                self.CHANGED_COUNT, self.ITEM_COUNT)
+        print 'full scan: %0.3fs, change log: %0.3fs' % (scan_time, log_time)
+        self.assertEquals(log_changed, range(1, self.CHANGED_COUNT + 1))
+        self.assertEquals(scan_changed, log_changed)
+
+class DaapServerLoadTest(MiroTestCase):
+    """Run 200 DAAP clients against a local server: each one logs in,
+    fetches the item listing and then parks an /update long-poll, which a
+    revision change completes.  Compare the threaded and the event driven
+    server.
+    """
+
+    CLIENT_COUNT = 200
+    ITEM_COUNT = 100
+
+    def run_clients(self, event_driven):
+        backend = libdaaptest.FakeItemBackend(self.ITEM_COUNT)
+        server = libdaaptest.start_daap_server(backend, event_driven,
+                max_conn=self.CLIENT_COUNT)
+        port = server.server_address[1]
+        clients = [libdaaptest.DaapTestClient(port)
+                   for i in xrange(self.CLIENT_COUNT)]
+        try:
+            start = time.time()
+            for client in clients:
+                self.assertEquals(client.login(), 200)
+                self.assertEquals(client.item_count(), self.ITEM_COUNT)
+                client.start_update(backend.revision)
+            login_time = time.time() - start
+            # Let every /update reach the server before counting threads.
+            time.sleep(0.5)
+            thread_count = threading.active_count()
+            start = time.time()
+            backend.update_revision()
+            for client in clients:
+                self.assertEquals(client.update_revision(), 2)
+            update_time = time.time() - start
+        finally:
+            for client in clients:
+                client.close()
+            libdaaptest.stop_daap_server(server)
+        return login_time, update_time, thread_count
+
+    def test_load(self):
+        print
+        print '%d clients' % self.CLIENT_COUNT
+        for event_driven in (False, True):
+            login_time, update_time, thread_count = self.run_clients(
+                    event_driven)
+            print ('%s: %d threads, login+items %0.3fs, update %0.3fs' %
+                   ('event driven' if event_driven else 'threaded',
+                    thread_count, login_time, update_time))
+
+class FileStreamPerformanceTest(MiroTestCase):
+    """Stream a 2GB file to a local client the old way (reading chunks into
+    strings), through mmap() and with sendfile().
+    """
+
+    FILE_SIZE = 2 * 1024 * 1024 * 1024
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        # Sparse, so this doesn't need 2GB of disk.
+        self.path = self.make_temp_path('.mp4')
+        f = open(self.path, 'wb')
+        f.truncate(self.FILE_SIZE)
+        f.close()
+
+    def stream(self, send):
+        sender, receiver = libdaap.make_wakeup_pair()
+        received = [0]
+        def read_all():
+            buf = bytearray(1024 * 1024)
+            while True:
+                count = receiver.recv_into(buf)
+                if not count:
+                    break
+                received[0] += count
+        thread = threading.Thread(target=read_all)
+        thread.start()
+        blob = subr.ChunkedStreamObj(open(self.path, 'rb'), self.path)
+        start = time.time()
+        try:
+            send(blob, sender)
+        finally:
+            sender.close()
+            thread.join()
+            receiver.close()
+        self.assertEquals(received[0], self.FILE_SIZE)
+        return time.time() - start
+
+    def test_stream(self):
+        def send_chunks(blob, sock):
+            for chunk in blob:
+                sock.sendall(chunk)
+        def send_mmap(blob, sock):
+            blob.sendfile = None
+            blob.sendall(sock)
+        def send_sendfile(blob, sock):
+            blob.sendall(sock)
+        print
+        print 'streaming %d MB' % (self.FILE_SIZE // (1024 * 1024))
+        modes = [('read', send_chunks), ('mmap', send_mmap)]
+        if subr.sendfile:
+            modes.append(('sendfile', send_sendfile))
+        for name, send in modes:
+            elapsed = self.stream(send)
+            print '%s: %0.2fs (%d MB/s)' % (name, elapsed,
+                    self.FILE_SIZE / elapsed / (1024 * 1024))
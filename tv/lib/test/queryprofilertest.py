@@ -0,0 +1,109 @@
+from miro.test.framework import MiroTestCase
+from miro import app
+from miro import feed
+from miro import item
+from miro import queryprofiler
+
+class NormalizeSQLTest(MiroTestCase):
+    def test_literals(self):
+        self.assertEquals(queryprofiler.normalize_sql(
+            "SELECT id FROM item WHERE feed_id=12 AND title='it''s'"),
+            "SELECT id FROM item WHERE feed_id=? AND title=?")
+
+    def test_whitespace(self):
+        self.assertEquals(queryprofiler.normalize_sql(
+            "SELECT id\nFROM item\n   WHERE  seen"),
+            "SELECT id FROM item WHERE seen")
+
+    def test_in_list(self):
+        self.assertEquals(queryprofiler.normalize_sql(
+            "SELECT id FROM item WHERE id IN (?, ?, ?)"),
+            queryprofiler.normalize_sql(
+            "SELECT id FROM item WHERE id IN (?)"))
+
+    def test_identifiers_kept(self):
+        self.assertEquals(queryprofiler.normalize_sql(
+            "SELECT h264_count FROM t1"),
+            "SELECT h264_count FROM t1")
+
+class QueryStatsTest(MiroTestCase):
+    def test_stats(self):
+        stats = queryprofiler.QueryStats()
+        for i in xrange(100):
+            stats.add(i / 100.0, 2)
+        self.assertEquals(stats.count, 100)
+        self.assertEquals(stats.rows, 200)
+        self.assertAlmostEquals(stats.mean_time(), 0.495)
+        self.assertAlmostEquals(stats.percentile_time(95), 0.94)
+
+class QueryProfilerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = feed.Feed(u'dtv:manualFeed')
+        self.items = []
+        for i in xrange(3):
+            fp_values = item.FeedParserValues({'title': u'item%d' % i})
+            self.items.append(item.Item(fp_values, feed_id=self.feed.id))
+        self.profiler = app.db.profiler
+        self.profiler.start()
+
+    def tearDown(self):
+        self.profiler.stop()
+        self.profiler.reset()
+        MiroTestCase.tearDown(self)
+
+    def find_stats(self, stats_map, text):
+        for key, stats in stats_map.items():
+            if text in key:
+                return stats
+        raise AssertionError("%r not found in %s" % (text, stats_map.keys()))
+
+    def test_disabled(self):
+        self.profiler.stop()
+        self.profiler.reset()
+        list(item.Item.make_view('feed_id=?', (self.feed.id,)))
+        self.assertEquals(self.profiler.by_statement, {})
+
+    def test_statements(self):
+        for i in xrange(2):
+            app.db.query_ids('item', 'feed_id=?', (self.feed.id,))
+        stats = self.find_stats(self.profiler.by_statement,
+                                'FROM item WHERE feed_id=?')
+        self.assertEquals(stats.count, 2)
+        self.assertEquals(stats.rows, 6)
+
+    def test_call_site(self):
+        app.db.query_ids('item', 'feed_id=?', (self.feed.id,))
+        stats = self.find_stats(self.profiler.by_call_site,
+                                'queryprofilertest.py')
+        self.assertEquals(stats.count, 1)
+
+    def test_tracker_call_site(self):
+        # subqueries can't be compiled, so the tracker needs SQL to check
+        # objects
+        view = item.Item.make_view(
+            'item.id IN (SELECT id FROM item WHERE feed_id=?)',
+            (self.feed.id,))
+        tracker = view.make_tracker()
+        self.profiler.reset()
+        self.items[0].signal_change()
+        stats = self.find_stats(self.profiler.by_call_site,
+                                'ViewTracker check from')
+        self.assert_(stats.count > 0)
+        tracker.unlink()
+
+    def test_full_scans(self):
+        list(item.Item.make_view('entry_title=?', (u'item1',)))
+        list(item.Item.make_view('item.id=?', (self.items[0].id,)))
+        scans = [statement for statement in self.profiler.full_scans
+                 if 'entry_title' in statement]
+        self.assertEquals(len(scans), 1)
+        for statement in self.profiler.full_scans:
+            self.assert_('item.id=?' not in statement)
+
+    def test_report(self):
+        list(item.Item.make_view('entry_title=?', (u'item1',)))
+        report = self.profiler.format_report()
+        self.assert_('By statement:' in report)
+        self.assert_('By call site:' in report)
+        self.assert_('Full table scans on item:' in report)
@@ -1,5 +1,7 @@
 import gc
+from datetime import datetime, timedelta
 
+from miro import app
 from miro import messages
 from miro import models
 from miro import search
@@ -99,9 +101,11 @@ class SearchTest(MiroTestCase):
                 ['veryb', 'erybi', 'rybig'])
 
 class ItemSearcherTest(MiroTestCase):
+    searcher_class = search.ItemSearcher
+
     def setUp(self):
         MiroTestCase.setUp(self)
-        self.searcher = search.ItemSearcher()
+        self.searcher = self.searcher_class()
         self.feed = models.Feed(u'http://example.com/')
         self.item1 = self.make_item(u'http://example.com/', u'my first item')
         self.item2 = self.make_item(u'http://example.com/', u'my second item')
@@ -142,6 +146,198 @@ class ItemSearcherTest(MiroTestCase):
         self.check_search_results('my', self.item1)
         self.check_empty_result('second')
 
+class CompactItemSearcherTest(ItemSearcherTest):
+    searcher_class = search.CompactItemSearcher
+
+    def test_negative_and_short_terms(self):
+        self.check_search_results('my -second', self.item1)
+        self.check_search_results('-first -second')
+        self.check_search_results('my -se', self.item1, self.item2)
+        self.check_search_results('it', self.item1, self.item2)
+
+    def test_compact(self):
+        self.searcher.COMPACT_THRESHOLD = 1
+        self.item1.entry_title = u'my new title'
+        self.item1.signal_change()
+        self.searcher.update_item(self.make_info(self.item1))
+        self.assertEquals(self.searcher._added, {})
+        self.assertEquals(self.searcher._tombstones, {})
+        self.check_search_results('title', self.item1)
+        self.check_empty_result('first')
+        self.searcher.remove_item(self.item2.id)
+        self.check_empty_result('second')
+        self.check_search_results('my', self.item1)
+
+    def test_readd_after_remove(self):
+        info = self.make_info(self.item2)
+        self.searcher.compact()
+        self.searcher.remove_item(info.id)
+        self.searcher.add_item(info)
+        self.check_search_results('second', self.item2)
+        self.searcher.compact()
+        self.check_search_results('second', self.item2)
+
+class SearchIndexTest(ItemSearcherTest):
+    # run the ItemSearcher tests using the SearchIndex for the database
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.searcher = app.search_index
+        self.feed = models.Feed(u'http://example.com/')
+        self.item1 = self.make_item(u'http://example.com/', u'my first item')
+        self.item2 = self.make_item(u'http://example.com/', u'my second item')
+
+    def make_item(self, url, title=u'default item title'):
+        additional = {'title': title}
+        entry = _build_entry(url, 'video/x-unknown', additional)
+        # SearchIndex should pick up the new item from ItemInfoCache
+        return models.Item(FeedParserValues(entry), feed_id=self.feed.id)
+
+    def reload_search_index(self):
+        app.db.finish_transaction()
+        app.item_info_cache.save()
+        self.setup_new_item_info_cache()
+        self.searcher = app.search_index
+
+    def test_signals(self):
+        self.item1.entry_title = u'my new title'
+        self.item1.signal_change()
+        self.check_search_results('title', self.item1)
+        self.check_empty_result('first')
+        self.item2.remove()
+        self.check_empty_result('second')
+        self.check_search_results('my', self.item1)
+
+    def test_persistence(self):
+        self.reload_search_index()
+        # we should load the index from the DB rather than rebuild it
+        self.assertEquals(self.searcher._changed_items, {})
+        self.check_search_results('my', self.item1, self.item2)
+        self.check_search_results('first', self.item1)
+        # changes after the load should still work
+        self.item1.entry_title = u'my new title'
+        self.item1.signal_change()
+        self.item2.remove()
+        self.reload_search_index()
+        self.check_search_results('my', self.item1)
+        self.check_search_results('title', self.item1)
+        self.check_empty_result('first')
+        self.check_empty_result('second')
+
+    def test_rebuild(self):
+        self.reload_search_index()
+        app.db.cursor.execute("DELETE FROM item_search_ngrams")
+        self.setup_new_search_index()
+        self.searcher = app.search_index
+        # we should have rebuilt the index
+        self.assertEquals(len(self.searcher._changed_items), 2)
+        self.check_search_results('my', self.item1, self.item2)
+        self.check_search_results('first', self.item1)
+
+    def test_out_of_sync_rebuild(self):
+        self.reload_search_index()
+        # Simulate crashing after ItemInfoCache saves, but before we do.  The
+        # number of items stays the same, so only the token tells us that
+        # the index is stale.
+        app.search_index.unlink()
+        self.item1.entry_title = u'my new title'
+        self.item1.signal_change()
+        self.item2.remove()
+        self.make_item(u'http://example.com/3', u'my third item')
+        app.db.finish_transaction()
+        app.item_info_cache.save()
+        self.setup_new_item_info_cache()
+        self.searcher = app.search_index
+        self.assertEquals(len(self.searcher._changed_items), 2)
+        self.check_search_results('title', self.item1)
+        self.check_empty_result('first')
+        self.check_empty_result('second')
+
+    def test_changes_use_old_info(self):
+        # we should get the old N-grams for changed/removed items from
+        # ItemInfoCache, rather than reading them from the DB
+        self.reload_search_index()
+        app.db.cursor.execute("DELETE FROM item_search_ngrams")
+        self.item1.entry_title = u'my new title'
+        self.item1.signal_change()
+        self.item2.remove()
+        self.check_search_results('title', self.item1)
+        self.check_empty_result('first')
+        self.check_empty_result('second')
+        self.check_search_results('my', self.item1)
+
+    def test_item_matches(self):
+        self.assertTrue(self.item1.matches_search('first'))
+        self.assertFalse(self.item2.matches_search('first'))
+        self.reload_search_index()
+        self.assertTrue(self.item1.matches_search('my -second'))
+        self.assertFalse(self.item2.matches_search('my -second'))
+
+class RankedSearchTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = models.Feed(u'http://example.com/')
+        self.infos = {}
+        self.searcher = search.ItemSearcher(self.infos.__getitem__)
+
+    def make_info(self, title, description=u'', age=0):
+        additional = {'title': title, 'description': description}
+        entry = _build_entry(u'http://example.com/', 'video/x-unknown',
+                additional)
+        item = models.Item(FeedParserValues(entry), feed_id=self.feed.id)
+        info = itemsource.DatabaseItemSource._item_info_for(item)
+        info.release_date = datetime.now() - timedelta(days=age)
+        self.infos[info.id] = info
+        self.searcher.add_item(info)
+        return info
+
+    def check_ranking(self, search_text, *correct_order, **kwargs):
+        ranked = self.searcher.search_ranked(search_text, **kwargs)
+        self.assertEquals(ranked, [i.id for i in correct_order])
+
+    def test_title_beats_description(self):
+        in_description = self.make_info(u'an item', u'about cats')
+        in_title = self.make_info(u'cats', u'an item')
+        self.check_ranking('cats', in_title, in_description)
+
+    def test_term_frequency(self):
+        once = self.make_info(u'an item', u'about cats')
+        twice = self.make_info(u'an item', u'about cats and more cats')
+        self.check_ranking('cats', twice, once)
+
+    def test_recency(self):
+        old = self.make_info(u'cats', age=365)
+        new = self.make_info(u'cats', age=1)
+        self.check_ranking('cats', new, old)
+
+    def test_missing_release_date(self):
+        # items without a release date use datetime.min.  They should fall
+        # back to date_added rather than blowing up.
+        info = self.make_info(u'cats')
+        info.release_date = datetime.min
+        self.check_ranking('cats', info)
+
+    def test_negative_terms(self):
+        cats = self.make_info(u'cats')
+        self.make_info(u'cats and dogs')
+        self.check_ranking('cats -dogs', cats)
+
+    def test_limit(self):
+        infos = [self.make_info(u'cats', age=i) for i in xrange(10)]
+        self.check_ranking('cats', *infos[:3], **{'k': 3})
+
+    def test_compact_searcher(self):
+        self.searcher = search.CompactItemSearcher(self.infos.__getitem__)
+        in_description = self.make_info(u'an item', u'about cats')
+        in_title = self.make_info(u'cats', u'an item')
+        self.check_ranking('cats', in_title, in_description)
+
+    def test_search_index(self):
+        # SearchIndex gets the ItemInfos from ItemInfoCache
+        in_description = self.make_info(u'an item', u'about cats')
+        in_title = self.make_info(u'cats', u'an item')
+        self.assertEquals(app.search_index.search_ranked('cats'),
+                [in_title.id, in_description.id])
+
 class SearchFilterTest(MiroTestCase):
     def setUp(self):
         MiroTestCase.setUp(self)
@@ -237,3 +433,47 @@ class SearchFilterTest(MiroTestCase):
         # only info2 matches the search, so removed should only include it
         self.check_changed_filter([], [], [self.info1, self.info2],
                 [], [], [self.info2])
+
+    def send_search(self, query):
+        self.sent_searches.append(query)
+
+    def send_search_results(self):
+        query = self.sent_searches.pop(0)
+        return self.filterer.handle_search_results(query,
+                app.search_index.search(query))
+
+    def test_uses_search_index(self):
+        # database items should be searched by the backend, only other items
+        # should get indexed by the filter
+        self.sent_searches = []
+        self.filterer = SearchFilter(self.send_search)
+        attributes = self.info4.get_attributes()
+        del attributes['id']
+        attributes['source_type'] = 'device'
+        device_info = messages.ItemInfo(self.info4.id + 1000, **attributes)
+        self.filterer.set_search("four")
+        self.assertEquals(self.sent_searches, [])
+        # we don't know which database items match until the results come in
+        self.check_initial_list_filter([self.info1, self.info4, device_info],
+                [device_info])
+        self.assertEquals(self.sent_searches, ["four"])
+        self.assertEquals(self.send_search_results(), ([self.info4], set()))
+        self.assertSameSet(self.filterer.searcher._item_ngrams.keys(),
+                [device_info.id])
+        self.assertSameSet(self.filterer.indexed_ids,
+                [self.info1.id, self.info4.id])
+        # changed items get checked without a search
+        self.update_info(self.info1, u'four')
+        self.check_changed_filter([], [self.info1], [],
+                [self.info1], [], [])
+        self.assertEquals(self.sent_searches, [])
+        # results for an old search are ignored
+        self.check_search_change("one", [], [device_info])
+        self.check_search_change("info", [device_info], [])
+        self.assertEquals(self.send_search_results(), None)
+        self.assertEquals(self.send_search_results(), ([], set()))
+        # clearing the search doesn't need the backend
+        self.check_search_change("", [], [])
+        self.assertEquals(self.sent_searches, [])
+        self.assertSameSet(self.filterer.indexed_ids,
+                [self.info1.id, self.info4.id])
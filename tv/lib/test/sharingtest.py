@@ -0,0 +1,183 @@
+from miro import app
+from miro import prefs
+from miro import sharing
+from miro.test.framework import MiroTestCase
+
+class FakeItem(object):
+    """Just enough of ItemInfo for SharingManagerBackend.make_item_dict()."""
+    def __init__(self, id_):
+        self.id = id_
+        self.title = u'Item %d' % id_
+        self.file_type = u'audio'
+        self.file_format = u'.mp3'
+        self.video_path = '/music/%d.mp3' % id_
+        self.feed_url = u'dtv:manualFeed'
+        self.feed_id = None
+        self.is_file_item = True
+        self.thumbnail = ''
+
+class FakeMessage(object):
+    def __init__(self, id_=None, items=(), added=(), changed=(), removed=()):
+        self.id = id_
+        self.items = items
+        self.added = added
+        self.changed = changed
+        self.removed = removed
+
+class SharingBackendChangeLogTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        app.config.set(prefs.SHARE_AUDIO, True)
+        self.backend = sharing.SharingManagerBackend()
+        self.items = [FakeItem(i) for i in xrange(1, 11)]
+        self.backend.handle_item_list(FakeMessage(items=self.items))
+        self.start_revision = self.backend.revision
+
+    def change(self, **kwargs):
+        self.backend.handle_items_changed(FakeMessage(**kwargs))
+        return self.backend.revision
+
+    def scanned_delta(self, delta, playlist_id=None):
+        # what the old full scan would have sent for delta
+        items = self.backend.get_items(playlist_id=playlist_id)
+        return dict((k, v['valid']) for k, v in items.items()
+                    if v['revision'] > delta)
+
+    def logged_delta(self, delta, playlist_id=None):
+        items = self.backend.get_items(playlist_id=playlist_id, delta=delta)
+        return dict((k, v['valid']) for k, v in items.items()
+                    if v['revision'] > delta)
+
+    def test_delta(self):
+        self.change(changed=[self.items[0]])
+        middle = self.change(removed=[2])
+        self.change(added=[FakeItem(11)], changed=[self.items[2]])
+        for delta in (self.start_revision, middle):
+            self.assertEquals(self.logged_delta(delta),
+                              self.scanned_delta(delta))
+        self.assertEquals(self.logged_delta(self.start_revision),
+                          {1: True, 2: False, 3: True, 11: True})
+        self.assertEquals(self.logged_delta(middle), {3: True, 11: True})
+        self.assertEquals(self.logged_delta(self.backend.revision), {})
+
+    def test_delta_only_returns_changes(self):
+        self.change(changed=[self.items[0]])
+        items = self.backend.get_items(delta=self.start_revision)
+        self.assertEquals(items.keys(), [1])
+
+    def test_item_list_deletes(self):
+        # a full item list deletes the missing items, but only once
+        self.backend.handle_item_list(FakeMessage(items=self.items[1:]))
+        revision = self.backend.revision
+        self.assertEquals(self.logged_delta(self.start_revision),
+                          self.scanned_delta(self.start_revision))
+        self.backend.handle_item_list(FakeMessage(items=self.items[1:]))
+        self.assertEquals(self.backend.daapitems[1]['revision'], revision)
+
+    def test_playlist_delta(self):
+        self.backend.daap_playlists[100] = {'revision': 1, 'valid': True,
+                                            'podcast': False}
+        self.backend.handle_item_list(FakeMessage(id_=100,
+                                                  items=self.items[:3]))
+        start = self.backend.revision
+        self.change(changed=[self.items[1], self.items[5]])
+        self.assertEquals(self.logged_delta(start, playlist_id=100),
+                          {2: True})
+        self.assertEquals(self.logged_delta(start, playlist_id=100),
+                          self.scanned_delta(start, playlist_id=100))
+        middle = self.backend.revision
+        self.change(id_=100, removed=[3])
+        for delta in (start, middle):
+            self.assertEquals(self.logged_delta(delta, playlist_id=100),
+                              self.scanned_delta(delta, playlist_id=100))
+        self.assertEquals(self.logged_delta(middle, playlist_id=100),
+                          {3: False})
+        self.assertEquals(self.logged_delta(self.backend.revision,
+                                            playlist_id=100), {})
+
+    def test_playlist_removal(self):
+        self.backend.daap_playlists[100] = {'revision': 1, 'valid': True,
+                                            'podcast': False}
+        self.backend.handle_item_list(FakeMessage(id_=100,
+                                                  items=self.items[:3]))
+        self.change(id_=100, removed=[2])
+        items = self.backend.get_items(playlist_id=100)
+        self.assertEquals(dict((k, v['valid']) for k, v in items.items()),
+                          {1: True, 2: False, 3: True})
+        # putting it back in the playlist undoes the deletion
+        self.change(id_=100, added=[self.items[1]])
+        items = self.backend.get_items(playlist_id=100)
+        self.assertEquals(dict((k, v['valid']) for k, v in items.items()),
+                          {1: True, 2: True, 3: True})
+
+    def test_horizon(self):
+        old_size = sharing.CHANGE_LOG_SIZE
+        sharing.CHANGE_LOG_SIZE = 5
+        try:
+            for item in self.items:
+                self.change(changed=[item])
+        finally:
+            sharing.CHANGE_LOG_SIZE = old_size
+        self.assert_(len(self.backend.change_log) <= 10)
+        horizon = self.backend.change_log_horizon
+        self.assert_(horizon > self.start_revision)
+        # too old for the log: everything is sent
+        self.assertEquals(len(self.backend.get_items(
+            delta=self.start_revision)), 10)
+        self.assertEquals(self.logged_delta(self.start_revision),
+                          self.scanned_delta(self.start_revision))
+        # recent enough: only the changes are
+        self.assertEquals(sorted(self.backend.get_items(delta=horizon)),
+                          range(horizon - self.start_revision + 1, 11))
+
+    def test_config_change_resets_log(self):
+        app.config.set(prefs.SHARE_AUDIO, False)
+        self.assertEquals(self.backend.change_log, [])
+        self.assertEquals(self.logged_delta(self.start_revision),
+                          self.scanned_delta(self.start_revision))
+        self.assertEquals(len(self.logged_delta(self.start_revision)), 10)
+
+    def test_tombstone_compaction(self):
+        self.backend.get_revision(1, self.start_revision - 1, None)
+        deleted_revision = self.change(removed=[1])
+        self.change(changed=[self.items[1]])
+        # session 1 hasn't seen the deletion yet
+        self.backend.get_revision(1, deleted_revision - 1, None)
+        self.assertEquals(self.backend.daapitems[1]['valid'], False)
+        self.backend.get_revision(1, deleted_revision, None)
+        self.assert_(1 not in self.backend.daapitems)
+        # the log still knows about it
+        self.assertEquals(self.logged_delta(self.start_revision),
+                          {1: False, 2: True})
+
+    def test_tombstone_compaction_on_logout(self):
+        self.backend.get_revision(1, self.start_revision - 1, None)
+        self.change(removed=[1])
+        self.assert_(1 in self.backend.daapitems)
+        self.backend.finished_callback(1)
+        self.assert_(1 not in self.backend.daapitems)
+        self.assertEquals(self.backend.client_revisions, {})
+
+    def test_readded_item_not_compacted(self):
+        self.backend.get_revision(1, self.start_revision - 1, None)
+        self.change(removed=[1])
+        self.change(added=[self.items[0]])
+        self.backend.finished_callback(1)
+        self.assertEquals(self.backend.daapitems[1]['valid'], True)
+
+    def test_revision_waiter(self):
+        woken = []
+        revision = self.backend.revision
+        self.assertEquals(self.backend.add_revision_waiter(1, revision - 1,
+                                                           woken.append),
+                          revision)
+        self.assertEquals(self.backend.add_revision_waiter(1, revision,
+                                                           woken.append),
+                          None)
+        self.assertEquals(self.backend.add_revision_waiter(2, revision,
+                                                           woken.append),
+                          None)
+        self.backend.remove_revision_waiter(2)
+        self.change(changed=[self.items[0]])
+        self.assertEquals(woken, [revision + 1])
+        self.assertEquals(self.backend.revision_waiters, {})
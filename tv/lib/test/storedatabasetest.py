@@ -1,13 +1,16 @@
-from datetime import datetime
+from datetime import datetime, date, timedelta
+from datetime import time as dt_time
 import os
 import unittest
 import string
 import random
+import threading
 import time
 
 import sqlite3
 
 from miro import app
+from miro import columncodec
 from miro import database
 from miro import databaseupgrade
 from miro import dialogs
@@ -294,6 +297,27 @@ class DiskTest(FakeSchemaTest):
         self.reload_test_database()
         self.check_database()
 
+    def test_update_sql_shared(self):
+        # The id is a bound parameter, so updates that change the same
+        # columns use the same SQL for every object.
+        self.db.append(Human(u"sam", 31, 1.8, []))
+        statements = []
+        time_execute = app.db._time_execute
+        def record_execute(sql, values, many):
+            statements.append((sql, values))
+            return time_execute(sql, values, many)
+        app.db._time_execute = record_execute
+        for obj in (self.lee, self.db[-1]):
+            obj.name = obj.name.upper()
+            obj.signal_change()
+        app.db._time_execute = time_execute
+        self.assertEquals(len(statements), 2)
+        self.assert_(statements[0][0] is statements[1][0])
+        self.assertEquals(statements[0][1][-1], self.lee.id)
+        self.assertEquals(statements[1][1][-1], self.db[-1].id)
+        self.reload_test_database()
+        self.check_database()
+
     def test_binary_reload(self):
         self.joe.id_code = 'abc'
         self.joe.signal_change()
@@ -508,6 +532,143 @@ class ObjectMemoryTest(FakeSchemaTest):
         lee.remove()
         self.assertEquals(0, len(app.db._object_map))
 
+class ObjectEvictionTest(FakeSchemaTest):
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        Human.evictable = True
+        self.ids = [Human(u'human%d' % i, i, 1.5, []).id for i in xrange(10)]
+        self.reload_database(self.save_path, schema_version=0,
+                object_schemas=self.OBJECT_SCHEMAS, object_cache_size=2)
+
+    def tearDown(self):
+        del Human.evictable
+        FakeSchemaTest.tearDown(self)
+
+    def load_all(self):
+        return [h.id for h in Human.make_view()]
+
+    def test_evict(self):
+        self.assertEquals(len(self.load_all()), 11)
+        self.assertEquals(app.db.persistent_object_count(), 2)
+        # evicted objects get restored when we need them
+        human = Human.get_by_id(self.ids[0])
+        self.assertEquals(human.name, u'human0')
+
+    def test_identity(self):
+        human = Human.get_by_id(self.ids[0])
+        self.load_all()
+        self.assert_(Human.get_by_id(self.ids[0]) is human)
+        self.assert_(human.id_exists())
+
+    def test_unsaved_changes_pinned(self):
+        human = Human.get_by_id(self.ids[0])
+        human.age = 100
+        del human
+        self.load_all()
+        human = Human.get_by_id(self.ids[0])
+        self.assertEquals(human.age, 100)
+        human.signal_change()
+        # once it's saved, we can evict the object
+        del human
+        self.load_all()
+        self.assert_(not app.db.id_alive(self.ids[0], Human))
+        self.assertEquals(Human.get_by_id(self.ids[0]).age, 100)
+
+    def test_signal_callbacks_pinned(self):
+        removed = []
+        human = Human.get_by_id(self.ids[0])
+        human.connect('removed', lambda obj: removed.append(obj.id))
+        del human
+        self.load_all()
+        Human.get_by_id(self.ids[0]).remove()
+        self.assertEquals(removed, [self.ids[0]])
+
+    def test_remove_evicted(self):
+        self.load_all()
+        for human in Human.make_view():
+            human.remove()
+        self.assertEquals(Human.make_view().count(), 0)
+        self.assertEquals(app.db.persistent_object_count(), 0)
+
+class WALModeTest(FakeSchemaTest):
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        self.reload_wal_database(True)
+        self.results = []
+        self.errors = []
+
+    def reload_wal_database(self, wal_mode):
+        self.reload_database(self.save_path, schema_version=0,
+                object_schemas=self.OBJECT_SCHEMAS, wal_mode=wal_mode)
+
+    def journal_mode(self):
+        app.db.cursor.execute("PRAGMA journal_mode")
+        return app.db.cursor.fetchone()[0].lower()
+
+    def run_read_call(self, function, *args):
+        app.db.call_in_read_thread(self.results.append, self.errors.append,
+                function, 'test read call', *args)
+        # the first idle starts the call, the second runs our callback
+        self.runPendingIdles()
+        self.processThreads()
+        self.runPendingIdles()
+
+    def test_wal_mode(self):
+        self.assertEquals(self.journal_mode(), 'wal')
+        self.assertNotEquals(app.db.read_pool, None)
+
+    def test_read_in_thread(self):
+        def read_names(reader):
+            return (threading.currentThread(),
+                    reader.select(Human, ['name'], 'age > ?', (20,)))
+        self.run_read_call(read_names)
+        self.assertEquals(self.errors, [])
+        thread, rows = self.results[0]
+        self.assertNotEquals(thread, threading.currentThread())
+        self.assertEquals(rows, [[u'lee']])
+
+    def test_writes_fail(self):
+        def delete_humans(reader):
+            reader.query("DELETE FROM human")
+        self.run_read_call(delete_humans)
+        self.assertEquals(self.results, [])
+        self.assertEquals(len(self.errors), 1)
+        self.assert_(isinstance(self.errors[0], sqlite3.OperationalError))
+        self.assertEquals(Human.make_view().count(), 1)
+
+    def test_uncommitted_changes_hidden(self):
+        connection = app.db.read_pool.get()
+        try:
+            reader = storedatabase.DatabaseReader(app.db, connection.cursor())
+            Human(u'sam', 40, 1.8, [])
+            self.assertEquals(reader.select(Human, ['name'], 'age > ?',
+                                            (30,)), [])
+            app.db.finish_transaction()
+            self.assertEquals(reader.select(Human, ['name'], 'age > ?',
+                                            (30,)), [[u'sam']])
+        finally:
+            app.db.read_pool.put(connection)
+
+    def test_fallback_without_wal(self):
+        self.reload_wal_database(False)
+        self.assertEquals(self.journal_mode(), 'persist')
+        self.assertEquals(app.db.read_pool, None)
+        def read_names(reader):
+            return (threading.currentThread(),
+                    reader.select(Human, ['name'], 'age > ?', (20,)))
+        self.run_read_call(read_names)
+        thread, rows = self.results[0]
+        self.assertEquals(thread, threading.currentThread())
+        self.assertEquals(rows, [[u'lee']])
+
+    def test_close_checkpoints(self):
+        Human(u'sam', 40, 1.8, [])
+        app.db.finish_transaction()
+        app.db.close()
+        self.assert_(not os.path.exists(self.save_path + '-wal'))
+        app.db.open_connection()
+        self.assertEquals(Human.make_view().count(), 2)
+
 class ValidationTest(FakeSchemaTest):
     def assert_object_valid(self, obj):
         obj.signal_change()
@@ -565,29 +726,84 @@ class CorruptReprTest(FakeSchemaTest):
         self.assertEqual(restored_lee.stuff, 'testing123')
         app.db.cursor.execute("SELECT stuff from human WHERE name='lee'")
         row = app.db.cursor.fetchone()
-        self.assertEqual(row[0], "'testing123'")
+        self.assertEqual(columncodec.decode(row[0]), 'testing123')
 
     def test_repr_failure_no_handler(self):
         app.db.cursor.execute("UPDATE pcf_programmer SET stuff='{baddata' "
                               "WHERE name='ben'")
-        self.assertRaises(SyntaxError, self.reload_object, self.ben)
+        self.assertRaises(columncodec.DecodeError, self.reload_object,
+                          self.ben)
+
+class ReprUpgradeTest(FakeSchemaTest):
+    def test_upgrade_repr_columns(self):
+        stuff = {'a': [1, 2.5, None], u'b': datetime(2010, 1, 2, 3, 4, 5)}
+        app.db.cursor.execute("UPDATE human SET stuff=? WHERE name='lee'",
+                              (repr(stuff),))
+        app.db.cursor.execute("UPDATE restorable_human SET stuff='{baddata' "
+                              "WHERE name='joe'")
+        databaseupgrade.upgrade178(app.db.cursor)
+        app.db.cursor.execute("SELECT stuff from human WHERE name='lee'")
+        value = app.db.cursor.fetchone()[0]
+        self.assert_(columncodec.is_encoded(value))
+        self.assertEquals(columncodec.decode(value), stuff)
+        # corrupt values should be left alone
+        app.db.cursor.execute("SELECT stuff from restorable_human "
+                              "WHERE name='joe'")
+        self.assertEquals(app.db.cursor.fetchone()[0], '{baddata')
 
 class ConverterTest(StoreDatabaseTest):
-    def test_convert_repr(self):
+    def test_codec_round_trip(self):
         converter = storedatabase.SQLiteConverter()
-        # _repr_to_sql ignores the schema_item parameter, so we can just pass
-        # in None
         schema_item = None
+        for value in ({'updated_parsed': time.localtime(),
+                       'when': datetime.now(), 1: [u'unicode', 'bytes']},
+                      [1, 2L ** 70, 3.25, True, None],
+                      (u'a', ('nested', 'tuple')),
+                      {}):
+            sql_value = converter._repr_to_sql(value, schema_item)
+            self.assert_(columncodec.is_encoded(sql_value))
+            restored = converter._repr_from_sql(sql_value, schema_item)
+            if isinstance(value, dict) and 'updated_parsed' in value:
+                # struct_time gets converted to a 9-tuple
+                value = value.copy()
+                value['updated_parsed'] = tuple(value['updated_parsed'])
+            self.assertEquals(restored, value)
+
+    def test_codec_types(self):
+        for value in ('caf\xe9', buffer('\x00\xff'), date(2011, 1, 2),
+                      dt_time(1, 2, 3, 4), timedelta(1, 2, 3),
+                      {u'\x00s': u'not a tag'}, {'\x00t': 1},
+                      {u'unicode': 1, 'bytes': 2}, {(1, 'a'): None}):
+            restored = columncodec.decode(columncodec.encode(value))
+            self.assertEquals(restored, value)
+            self.assertEquals(type(restored), type(value))
+        self.assertRaises(ValueError, columncodec.encode, object())
+
+    def test_codec_corrupt(self):
+        header = columncodec.MAGIC + chr(columncodec.VERSION)
+        for data in (header + '{baddata',
+                     header + '{"\\u0000x":1}',
+                     header + '{"\\u0000dt":["2010",1,1]}',
+                     header + '{"\\u0000dt":[2010,13,1]}',
+                     header + '{"\\u0000t":"abc"}',
+                     header + '{"\\u0000d":[[[1],2]]}',
+                     columncodec.MAGIC + '\x09[]',
+                     # old repr() values aren't evaluated anymore
+                     "{'a': 1}"):
+            self.assertRaises(columncodec.DecodeError, columncodec.decode,
+                              data)
 
+    def test_convert_repr(self):
+        # upgrade178 converts old repr() values with eval_container()
         test1 = """{'updated_parsed': (2009, 6, 5, 1, 30, 0, 4, 156, 0)}"""
-        val = converter._repr_from_sql(test1, schema_item)
+        val = databaseupgrade.eval_container(test1)
         self.assertEquals(val, {"updated_parsed":
                                 (2009, 6, 5, 1, 30, 0, 4, 156, 0)})
 
         test2 = """{'updated_parsed': time.struct_time(tm_year=2009, \
 tm_mon=6, tm_mday=5, tm_hour=1, tm_min=30, tm_sec=0, tm_wday=4, tm_yday=156, \
 tm_isdst=0)}"""
-        val = converter._repr_from_sql(test2, schema_item)
+        val = databaseupgrade.eval_container(test2)
         self.assertEquals(val, {"updated_parsed":
                                 (2009, 6, 5, 1, 30, 0, 4, 156, 0)})
 
@@ -685,7 +901,8 @@ class BadTabOrderTest(StoreDatabaseTest):
     def screw_with_tab_order(self, *tab_ids):
         app.db.cursor.execute("UPDATE taborder_order "
                 "SET tab_ids=? WHERE id=?",
-                (repr(list(tab_ids)), self.tab_order.id,))
+                (buffer(columncodec.encode(list(tab_ids))),
+                 self.tab_order.id,))
 
     def check_order(self, *tab_ids):
         self.tab_order = self.reload_object(self.tab_order)
@@ -240,9 +240,9 @@ class WorkerProcessTest(EventLoopTest):
     def setUp(self):
         EventLoopTest.setUp(self)
         # override the normal handler class with our own
-        workerprocess._subprocess_manager.handler_class = (
+        workerprocess._worker_pool.handler_class = (
                 UnittestWorkerProcessHandler)
-        workerprocess._subprocess_manager.restart_delay = 0
+        workerprocess._worker_pool.restart_delay = 0
         self.reset_results()
 
     def reset_results(self):
@@ -292,14 +292,14 @@ class FeedParserTest(WorkerProcessTest):
 
     def test_crash(self):
         # force a crash of our subprocess right after we send the task
-        workerprocess.startup()
-        original_pid = workerprocess._subprocess_manager.process.pid
+        workerprocess.startup(process_count=1)
+        manager = workerprocess._worker_pool.managers[0]
+        original_pid = manager.process.pid
         self.send_feedparser_task()
-        workerprocess._subprocess_manager.process.terminate()
+        manager.process.terminate()
         self.runEventLoop(4.0)
         # check that we really restarted the subprocess
-        self.assertNotEqual(original_pid,
-                workerprocess._subprocess_manager.process.pid)
+        self.assertNotEqual(original_pid, manager.process.pid)
         self.check_successful_result()
 
     def test_queue_before_start(self):
@@ -312,6 +312,49 @@ class FeedParserTest(WorkerProcessTest):
         self.runEventLoop(4.0)
         self.check_successful_result()
 
+class WorkerProcessPoolTest(WorkerProcessTest):
+    def setUp(self):
+        WorkerProcessTest.setUp(self)
+        self.results = []
+        workerprocess.startup(process_count=2)
+        self.pool = workerprocess._worker_pool
+
+    def collect_result(self, msg, result):
+        self.results.append(msg)
+
+    def collect_error(self, msg, error):
+        raise AssertionError("task failed: %s (%s)" % (msg, error))
+
+    def test_process_count(self):
+        self.assertEquals(len(self.pool.managers), 2)
+        pids = set(manager.process.pid for manager in self.pool.managers)
+        self.assertEquals(len(pids), 2)
+
+    def test_least_loaded(self):
+        tasks = [SlowRunningTask() for i in xrange(4)]
+        for task in tasks:
+            workerprocess.send(task, self.collect_result, self.collect_error)
+        # each process should get 2 tasks
+        for manager in self.pool.managers:
+            self.assertEquals(len(manager.task_ids), 2)
+        self.runEventLoop(2.0, timeoutNormal=True)
+        self.assertSameSet(self.results, tasks)
+        for manager in self.pool.managers:
+            self.assertEquals(len(manager.task_ids), 0)
+
+    def test_cancel_sent_to_all_processes(self):
+        msg = workerprocess.CancelFileOperations(['/foo/bar.mp3'])
+        workerprocess.send(msg, self.collect_result, self.collect_error)
+        for manager in self.pool.managers:
+            self.assertEquals(manager.task_ids, set([msg.task_id]))
+        self.runEventLoop(1.0, timeoutNormal=True)
+        # we should only process the result once, after every process
+        # replies
+        self.assertEquals(self.results, [msg])
+        self.assertEquals(self.pool.broadcast_counts, {})
+        for manager in self.pool.managers:
+            self.assertEquals(len(manager.task_ids), 0)
+
 class MovieDataTest(WorkerProcessTest):
     def check_successful_result(self):
         # just do some very basic test to see if the result is correct
@@ -0,0 +1,273 @@
+import inspect
+import sqlite3
+from datetime import datetime, timedelta
+
+from miro.test.framework import MiroTestCase
+from miro import app
+from miro import downloader
+from miro import feed
+from miro import folder
+from miro import item
+from miro import viewpredicate
+from miro.fileobject import FilenameType
+
+class CompileWhereTest(MiroTestCase):
+    columns = {'id': 'integer', 'seen': 'integer', 'deleted': 'integer',
+        'file_type': 'text', 'filename': 'text', 'feed_id': 'integer',
+        'watched': 'timestamp', 'data': 'blob'}
+
+    def check(self, where, values, row, expected):
+        predicate = viewpredicate.compile_where(where, values, 'item',
+                self.columns)
+        get_column = lambda name: viewpredicate.sql_value(row.get(name))
+        self.assertEquals(predicate.matches(get_column), expected)
+
+    def test_null_logic(self):
+        self.check('NOT deleted', (), {'deleted': None}, False)
+        self.check('deleted IS NULL or NOT deleted', (), {'deleted': None},
+                True)
+        self.check('NOT (deleted AND seen)', (),
+                {'deleted': None, 'seen': False}, True)
+        self.check('NOT (deleted AND seen)', (),
+                {'deleted': None, 'seen': True}, False)
+        self.check("deleted NOT IN (1, NULL)", (), {'deleted': False}, False)
+
+    def test_placeholders(self):
+        self.check('feed_id=? AND seen', (3,), {'feed_id': 3, 'seen': True},
+                True)
+        self.check('feed_id=? AND seen', (4,), {'feed_id': 3, 'seen': True},
+                False)
+
+    def test_lower_and_like(self):
+        self.check('lower(filename)=?', (u'/foo/bar.avi',),
+                {'filename': u'/Foo/BAR.avi'}, True)
+        # SQLite only folds ASCII characters
+        self.check('lower(filename)=?', (u'/\xe9.avi',),
+                {'filename': u'/\xc9.avi'}, False)
+        self.check("filename LIKE '/foo/%.avi'", (),
+                {'filename': u'/FOO/bar.avi'}, True)
+        self.check("filename LIKE '/foo/_.avi'", (),
+                {'filename': u'/foo/bar.avi'}, False)
+
+    def test_datetime_truth(self):
+        self.check('seen', (), {'seen': datetime.now()}, True)
+
+    def test_mixed_types(self):
+        # SQLite converts between text and numbers using the column
+        # affinity
+        self.check('feed_id=?', (u'3',), {'feed_id': 3}, True)
+        self.check("feed_id='3'", (), {'feed_id': 3}, True)
+        self.check("feed_id='3.0'", (), {'feed_id': 3}, True)
+        self.check("feed_id='3x'", (), {'feed_id': 3}, False)
+        self.check('file_type=?', (1,), {'file_type': u'1'}, True)
+        self.check('file_type=1', (), {'file_type': u'1'}, True)
+        self.check('file_type IN (1, 2)', (), {'file_type': u'1'}, True)
+        self.check('feed_id IN (?)', (u'3',), {'feed_id': 3}, True)
+        # without an affinity, different storage classes are never equal
+        # and numbers sort before text
+        self.check("1='1'", (), {}, False)
+        self.check('lower(file_type)=1', (), {'file_type': u'1'}, False)
+        self.check("1<'0'", (), {}, True)
+        self.check('data=?', (u'1',), {'data': 1}, False)
+        self.check('data<?', (u'1',), {'data': 1}, True)
+        self.check('1 IN (?)', (u'1',), {}, False)
+
+    def test_mixed_types_match_sqlite(self):
+        connection = sqlite3.connect(':memory:')
+        cursor = connection.cursor()
+        cursor.execute("CREATE TABLE item (%s)" % ', '.join(
+            '%s %s' % (name, typ) for name, typ in self.columns.items()))
+        rows = [(3, u'3', None), (3, u'1', u'2010-01-01 00:00:00'),
+                (4, u'abc', u'5'), (0, u'', u'1.5')]
+        checks = [('feed_id=?', (u'3',)), ('feed_id<?', (u'10',)),
+                ('feed_id>?', (u'abc',)), ('file_type=?', (3,)),
+                ('file_type<?', (2,)), ('file_type>?', (3.0,)),
+                ('feed_id=file_type', ()), ('feed_id IN (?, 1)', (u'4',)),
+                ('file_type NOT IN (3, ?)', (1,)), ('watched>?', (2,)),
+                ('watched=?', (u'5',)), ('watched=?', (1.5,)),
+                ("file_type LIKE ?", (3.0,)), ('lower(feed_id)=?', (u'3',))]
+        for feed_id, file_type, watched in rows:
+            cursor.execute("DELETE FROM item")
+            cursor.execute("INSERT INTO item (id, feed_id, file_type, "
+                    "watched) VALUES (1, ?, ?, ?)",
+                    (feed_id, file_type, watched))
+            cursor.execute("SELECT * FROM item")
+            row = dict(zip([d[0] for d in cursor.description],
+                cursor.fetchone()))
+            for where, values in checks:
+                cursor.execute("SELECT COUNT(*) FROM item WHERE %s" % where,
+                        values)
+                expected = cursor.fetchone()[0] > 0
+                predicate = viewpredicate.compile_where(where, values,
+                        'item', self.columns)
+                # the in-memory values are what we stored, before SQLite
+                # converted them
+                stored = {'feed_id': feed_id, 'file_type': file_type,
+                        'watched': watched}
+                get_column = lambda name: viewpredicate.sql_value(
+                        stored.get(name, row[name]))
+                self.assertEquals(predicate.matches(get_column), expected,
+                        "%s %s with %s" % (where, values, stored))
+        connection.close()
+
+    def test_cant_compile(self):
+        for where in ("id NOT IN (SELECT downloader_id from item)",
+                "feed.origURL == 'dtv:search'",
+                "unknown_column=1",
+                "seen BETWEEN 0 AND 1"):
+            self.assertRaises(viewpredicate.CantCompile,
+                    viewpredicate.compile_where, where, (), 'item',
+                    self.columns)
+
+class ViewPredicateTest(MiroTestCase):
+    """Check that compiled views select the same objects that SQL does."""
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.folder = folder.ChannelFolder(u'folder')
+        self.feed = feed.Feed(u'http://example.com/feed')
+        self.feed.set_folder(self.folder)
+        self.manual_feed = feed.Feed(u'dtv:manualFeed',
+                initiallyAutoDownloadable=False)
+        self.watched_feed = feed.Feed(u'dtv:directoryfeed:/videos/')
+        self.watched_feed.visible = False
+        self.watched_feed.signal_change()
+        self.items = []
+        for i, file_type in enumerate((u'video', u'audio', u'other', None)):
+            self.items.append(self.make_item(i, file_type))
+        self.items[0].seen = True
+        self.items[0].watchedTime = self.items[0].lastWatched = datetime.now()
+        self.items[0].signal_change()
+        self.items[1].pendingManualDL = True
+        self.items[1].isContainerItem = True
+        self.items[1].signal_change()
+        self.child = self.make_item(10, u'video', parent_id=self.items[1].id)
+        self.file_items = []
+        for i, deleted in enumerate((None, True, False)):
+            path = FilenameType('/videos/File%d.avi' % i)
+            file_item = item.FileItem(path, feed_id=self.manual_feed.id)
+            file_item.file_type = u'video'
+            file_item.deleted = deleted
+            file_item.signal_change()
+            self.file_items.append(file_item)
+        self.downloaders = []
+        for i, state in enumerate((u'finished', u'uploading', u'paused')):
+            dl = downloader.RemoteDownloader(
+                    u'http://example.com/feed/movie%d.mpeg' % i,
+                    self.items[i])
+            self.items[i].set_downloader(dl)
+            dl.state = state
+            dl.manualUpload = (i == 1)
+            dl.signal_change(needs_signal_item=False)
+            self.downloaders.append(dl)
+
+    def make_item(self, i, file_type, parent_id=None):
+        fp_values = item.FeedParserValues({'title': u'item%d' % i,
+            'enclosures': [{'url': u'http://example.com/feed/%d.mpeg' % i}]})
+        if parent_id is None:
+            feed_id = self.feed.id
+        else:
+            # child items get their feed through their parent
+            feed_id = None
+        new_item = item.Item(fp_values, feed_id=feed_id,
+                parent_id=parent_id)
+        new_item.file_type = file_type
+        new_item.signal_change()
+        return new_item
+
+    def view_arguments(self, name):
+        if name in ('feed_id',):
+            return [self.feed.id, self.manual_feed.id]
+        elif name in ('parent_id',):
+            return [self.items[1].id]
+        elif name in ('folder_id', 'id_'):
+            return [self.folder.id]
+        elif name in ('dler_id',):
+            return [self.downloaders[0].id]
+        elif name in ('path',):
+            return [FilenameType('/VIDEOS/file1.avi')]
+        elif name in ('watched_before',):
+            return [datetime.now() + timedelta(days=1)]
+        elif name in ('include_podcasts',):
+            return [False, True]
+        elif name in ('playlist_id', 'playlist_folder_id'):
+            return [0]
+        else:
+            raise AssertionError("Don't know how to call a view with %s" %
+                    name)
+
+    def views_for_class(self, klass):
+        for name in dir(klass):
+            if not name.endswith('_view') or name == 'make_view':
+                continue
+            method = getattr(klass, name)
+            if not inspect.ismethod(method) or method.im_self is not klass:
+                continue # not a classmethod
+            arg_names = inspect.getargspec(method.im_func)[0][1:]
+            arg_lists = [[]]
+            for arg_name in arg_names:
+                arg_lists = [args + [value] for args in arg_lists
+                        for value in self.view_arguments(arg_name)]
+            for args in arg_lists:
+                yield '%s.%s%s' % (klass.__name__, name, args), method(*args)
+
+    def check_views(self, klass):
+        all_objects = list(klass.make_view())
+        self.assert_(len(all_objects) > 0)
+        compiled_count = 0
+        for name, view in self.views_for_class(klass):
+            predicate = app.db.compile_view_predicate(view.table_name,
+                    view.where, view.values, view.joins)
+            if predicate is None:
+                continue
+            compiled_count += 1
+            sql_ids = set(app.db.query_ids(view.table_name, view.where,
+                view.values, joins=view.joins))
+            predicate_ids = set(obj.id for obj in all_objects
+                    if app.db.obj_matches_predicate(obj, predicate))
+            self.assertEquals(predicate_ids, sql_ids,
+                    "%s: %s != %s" % (name, predicate_ids, sql_ids))
+        self.assert_(compiled_count > 0)
+
+    def test_item_views(self):
+        self.check_views(item.Item)
+
+    def test_feed_views(self):
+        self.check_views(feed.Feed)
+
+    def test_feed_impl_views(self):
+        # FeedImpl.orphaned_view uses a join, so nothing compiles.  Just
+        # check that we fall back to SQL.
+        for name, view in self.views_for_class(feed.FeedImpl):
+            self.assertEquals(app.db.compile_view_predicate(view.table_name,
+                view.where, view.values, view.joins), None)
+
+    def test_downloader_views(self):
+        self.check_views(downloader.RemoteDownloader)
+
+    def test_subquery_falls_back(self):
+        view = downloader.RemoteDownloader.orphaned_view()
+        tracker = view.make_tracker()
+        self.assertEquals(tracker.predicate, None)
+        tracker.unlink()
+
+    def test_tracker_uses_predicate(self):
+        view = item.Item.visible_feed_view(self.feed.id)
+        tracker = view.make_tracker()
+        self.assertNotEquals(tracker.predicate, None)
+        # make sure we don't go to SQL when checking objects
+        def fail_sql_check(obj):
+            raise AssertionError("_obj_in_view_sql called")
+        tracker._obj_in_view_sql = fail_sql_check
+        added, removed = [], []
+        tracker.connect('added', lambda t, obj: added.append(obj))
+        tracker.connect('removed', lambda t, obj: removed.append(obj))
+        self.items[2].deleted = True
+        self.items[2].signal_change()
+        self.assertEquals(removed, [self.items[2]])
+        self.items[2].deleted = False
+        self.items[2].signal_change()
+        self.assertEquals(added, [self.items[2]])
+        self.items[3].remove()
+        self.assertEquals(removed, [self.items[2], self.items[3]])
+        tracker.unlink()
@@ -0,0 +1,583 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.viewpredicate`` -- Check view membership without going to SQLite.
+
+ViewTracker needs to know if an object is in its view every time that object
+changes.  Running a ``SELECT COUNT(*)`` for each tracker and each change adds
+up to a lot of queries, so this module compiles the WHERE clauses that our
+views use into python functions that can be checked against the in-memory
+DDBObject.
+
+Only a subset of SQL is supported: column references, literals, ``?``
+placeholders, comparisons, ``AND``/``OR``/``NOT``, ``IS [NOT] NULL``,
+``[NOT] IN (...)``, ``[NOT] LIKE`` and ``lower()``.  Evaluation follows
+SQLite's three-valued logic, so NULL columns behave the same way they do in
+the database.  Comparisons follow SQLite's type affinity rules, so comparing
+an integer column with a text value converts the text the same way that
+SQLite does, and values of different storage classes never compare equal.
+Anything else (joins, subqueries, other tables) raises CantCompile and
+callers should fall back to SQL.
+"""
+
+import datetime
+import re
+
+class CantCompile(ValueError):
+    """Raised when a WHERE clause uses SQL that we can't handle in python."""
+    pass
+
+_token_re = re.compile(r"""\s*(?:
+    (?P<string>'(?:[^']|'')*') |
+    (?P<number>\d+(?:\.\d+)?) |
+    (?P<name>[A-Za-z_][A-Za-z_0-9]*(?:\.[A-Za-z_][A-Za-z_0-9]*)?) |
+    (?P<op><>|<=|>=|==|!=|=|<|>|\(|\)|,|\?)
+    )""", re.VERBOSE)
+
+_keywords = set(['and', 'or', 'not', 'is', 'null', 'in', 'like', 'select',
+    'exists', 'between', 'glob', 'case', 'escape'])
+
+_numeric_prefix_re = re.compile(
+        r'\s*[+-]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?')
+
+_numeric_text_re = re.compile(
+        r'\s*[+-]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?\s*\Z')
+
+# Column affinities.  BLOB is the affinity of blob columns, expressions
+# without an affinity are None.
+AFFINITY_TEXT = 'text'
+AFFINITY_NUMERIC = 'numeric'
+AFFINITY_INTEGER = 'integer'
+AFFINITY_REAL = 'real'
+AFFINITY_BLOB = 'blob'
+
+_numeric_affinities = frozenset([AFFINITY_NUMERIC, AFFINITY_INTEGER,
+    AFFINITY_REAL])
+
+_ascii_lower_table = dict((ord(c), ord(c.lower()))
+        for c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+
+def _ascii_lower(value):
+    # SQLite's lower() and LIKE only fold ASCII characters
+    if isinstance(value, unicode):
+        return value.translate(_ascii_lower_table)
+    else:
+        return value.lower()
+
+def column_affinity(declared_type):
+    """Get the affinity that SQLite gives a column with a declared type."""
+    declared_type = declared_type.lower()
+    if 'int' in declared_type:
+        return AFFINITY_INTEGER
+    elif ('char' in declared_type or 'clob' in declared_type or
+            'text' in declared_type):
+        return AFFINITY_TEXT
+    elif 'blob' in declared_type or not declared_type:
+        return AFFINITY_BLOB
+    elif ('real' in declared_type or 'floa' in declared_type or
+            'doub' in declared_type):
+        return AFFINITY_REAL
+    else:
+        return AFFINITY_NUMERIC
+
+def _to_numeric(value):
+    # text that looks like a number gets converted, anything else is
+    # left alone
+    if isinstance(value, basestring) and _numeric_text_re.match(value):
+        text = value.strip()
+        if '.' in text or 'e' in text or 'E' in text:
+            return float(text)
+        return int(text)
+    return value
+
+def _to_text(value):
+    if isinstance(value, bool):
+        return unicode(int(value))
+    elif isinstance(value, (int, long)):
+        return unicode(value)
+    elif isinstance(value, float):
+        # SQLite renders reals with %!.15g, which always includes a decimal
+        # point
+        text = u'%.15g' % value
+        mantissa, e, exponent = text.partition(u'e')
+        if mantissa[-1:].isdigit() and u'.' not in mantissa:
+            mantissa += u'.0'
+        return mantissa + e + exponent
+    return value
+
+_affinity_converters = {
+    AFFINITY_TEXT: _to_text,
+    AFFINITY_NUMERIC: _to_numeric,
+    AFFINITY_INTEGER: _to_numeric,
+    AFFINITY_REAL: _to_numeric,
+}
+
+def _storage_class(value):
+    # SQLite sorts numbers before text and text before blobs
+    if isinstance(value, (int, long, float)):
+        return 1
+    elif isinstance(value, basestring):
+        return 2
+    else:
+        return 3
+
+def _comparison_converter(left, right):
+    """Get the function that converts the operands of a comparison.
+
+    :returns: function to apply to both values, or None if they should be
+        compared as-is
+    """
+    left_affinity = getattr(left, 'affinity', None)
+    right_affinity = getattr(right, 'affinity', None)
+    if left_affinity is not None and right_affinity is not None:
+        if (left_affinity in _numeric_affinities or
+                right_affinity in _numeric_affinities):
+            return _to_numeric
+        return None
+    return _affinity_converters.get(left_affinity or right_affinity)
+
+def sql_value(value):
+    """Convert a python value to the form SQLite compares it in.
+
+    datetimes are stored as text by the sqlite3 adapter, and bools as
+    integers.
+    """
+    if isinstance(value, bool):
+        return int(value)
+    elif isinstance(value, datetime.datetime):
+        return unicode(value.isoformat(" "))
+    elif isinstance(value, datetime.date):
+        return unicode(value.isoformat())
+    return value
+
+def sql_truth(value):
+    """Calculate the truth value of a SQL value.
+
+    :returns: True, False or None for NULL
+    """
+    if value is None:
+        return None
+    elif isinstance(value, (int, long, float)):
+        return value != 0
+    elif isinstance(value, basestring):
+        # SQLite converts text to a number using its longest numeric prefix
+        m = _numeric_prefix_re.match(value)
+        return m is not None and float(m.group(0)) != 0
+    else:
+        return bool(value)
+
+def _tokenize(where):
+    tokens = []
+    pos = 0
+    where = where.rstrip()
+    while pos < len(where):
+        m = _token_re.match(where, pos)
+        if m is None or m.end() == pos:
+            raise CantCompile("can't tokenize %r at %d" % (where, pos))
+        pos = m.end()
+        for kind in ('string', 'number', 'name', 'op'):
+            text = m.group(kind)
+            if text is not None:
+                if kind == 'name' and text.lower() in _keywords:
+                    tokens.append(('keyword', text.lower()))
+                else:
+                    tokens.append((kind, text))
+                break
+    return tokens
+
+class _Parser(object):
+    """Recursive descent parser that turns a WHERE clause into a function.
+
+    Each node of the expression becomes a function that inputs a
+    function that returns column values and a tuple of bound values.
+    Column nodes also have an affinity attribute.
+    """
+    def __init__(self, where, table_name, column_types):
+        self.tokens = _tokenize(where)
+        self.pos = 0
+        self.table_name = table_name
+        self.column_types = column_types
+        self.placeholder_count = 0
+        self.columns_used = set()
+
+    def parse(self):
+        func = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise CantCompile("trailing tokens: %s" % (self.tokens[self.pos:],))
+        return func
+
+    def peek(self, offset=0):
+        try:
+            return self.tokens[self.pos + offset]
+        except IndexError:
+            return (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise CantCompile("unexpected end of clause")
+        self.pos += 1
+        return token
+
+    def accept_keyword(self, *words):
+        kind, text = self.peek()
+        if kind == 'keyword' and text in words:
+            self.pos += 1
+            return text
+        return None
+
+    def expect_op(self, op):
+        kind, text = self.next()
+        if kind != 'op' or text != op:
+            raise CantCompile("expected %s got %s" % (op, text))
+
+    def parse_or(self):
+        left = self.parse_and()
+        while self.accept_keyword('or'):
+            left = _make_or(left, self.parse_and())
+        return left
+
+    def parse_and(self):
+        left = self.parse_not()
+        while self.accept_keyword('and'):
+            left = _make_and(left, self.parse_not())
+        return left
+
+    def parse_not(self):
+        if self.accept_keyword('not'):
+            return _make_not(self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        left = self.parse_operand()
+        kind, text = self.peek()
+        if kind == 'op' and text in _comparisons:
+            self.pos += 1
+            return _make_comparison(_comparisons[text], left,
+                    self.parse_operand())
+        if self.accept_keyword('is'):
+            negate = bool(self.accept_keyword('not'))
+            if not self.accept_keyword('null'):
+                raise CantCompile("IS only supported with NULL")
+            return _make_is_null(left, negate)
+        negate = bool(self.accept_keyword('not'))
+        if self.accept_keyword('in'):
+            return _make_in(left, self.parse_in_list(), negate)
+        if self.accept_keyword('like'):
+            return _make_like(left, self.parse_operand(), negate)
+        if negate:
+            raise CantCompile("NOT in unexpected position")
+        return left
+
+    def parse_in_list(self):
+        self.expect_op('(')
+        if self.peek() == ('keyword', 'select'):
+            raise CantCompile("subqueries not supported")
+        items = [self.parse_operand()]
+        while self.peek() == ('op', ','):
+            self.pos += 1
+            items.append(self.parse_operand())
+        self.expect_op(')')
+        return items
+
+    def parse_operand(self):
+        kind, text = self.next()
+        if kind == 'string':
+            value = text[1:-1].replace("''", "'")
+            if isinstance(value, str):
+                value = value.decode('utf-8')
+            return _make_constant(value)
+        elif kind == 'number':
+            if '.' in text:
+                return _make_constant(float(text))
+            else:
+                return _make_constant(int(text))
+        elif kind == 'op' and text == '?':
+            index = self.placeholder_count
+            self.placeholder_count += 1
+            return _make_placeholder(index)
+        elif kind == 'op' and text == '(':
+            if self.peek() == ('keyword', 'select'):
+                raise CantCompile("subqueries not supported")
+            func = self.parse_or()
+            self.expect_op(')')
+            return func
+        elif kind == 'keyword' and text == 'null':
+            return _make_constant(None)
+        elif kind == 'name':
+            if self.peek() == ('op', '('):
+                return self.parse_function(text)
+            return self.parse_column(text)
+        raise CantCompile("unexpected token: %s" % text)
+
+    def parse_function(self, name):
+        if name.lower() != 'lower':
+            raise CantCompile("function not supported: %s" % name)
+        self.expect_op('(')
+        arg = self.parse_or()
+        self.expect_op(')')
+        return _make_lower(arg)
+
+    def parse_column(self, text):
+        if '.' in text:
+            table, column = text.split('.')
+            if table != self.table_name:
+                raise CantCompile("column from another table: %s" % text)
+        else:
+            column = text
+        if column not in self.column_types:
+            raise CantCompile("unknown column: %s" % text)
+        self.columns_used.add(column)
+        return _make_column(column,
+                column_affinity(self.column_types[column]))
+
+def _make_constant(value):
+    def evaluate(get, params):
+        return value
+    evaluate.constant = value
+    return evaluate
+
+def _make_placeholder(index):
+    def evaluate(get, params):
+        return params[index]
+    return evaluate
+
+def _make_column(name, affinity):
+    # SQLite converts values to the column's affinity when they're stored
+    convert = _affinity_converters.get(affinity)
+    if convert is None:
+        def evaluate(get, params):
+            return get(name)
+    else:
+        def evaluate(get, params):
+            return convert(get(name))
+    evaluate.affinity = affinity
+    return evaluate
+
+def _make_lower(arg):
+    def evaluate(get, params):
+        value = arg(get, params)
+        if value is None:
+            return None
+        if not isinstance(value, basestring):
+            value = _to_text(value)
+        return _ascii_lower(value)
+    return evaluate
+
+def _make_and(left, right):
+    def evaluate(get, params):
+        l = sql_truth(left(get, params))
+        if l is False:
+            return False
+        r = sql_truth(right(get, params))
+        if r is False:
+            return False
+        if l is None or r is None:
+            return None
+        return True
+    return evaluate
+
+def _make_or(left, right):
+    def evaluate(get, params):
+        l = sql_truth(left(get, params))
+        if l is True:
+            return True
+        r = sql_truth(right(get, params))
+        if r is True:
+            return True
+        if l is None or r is None:
+            return None
+        return False
+    return evaluate
+
+def _make_not(arg):
+    def evaluate(get, params):
+        value = sql_truth(arg(get, params))
+        if value is None:
+            return None
+        return not value
+    return evaluate
+
+_comparisons = {
+    '=': lambda a, b: a == b,
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<>': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+def _make_comparison(compare, left, right):
+    convert = _comparison_converter(left, right)
+    def evaluate(get, params):
+        l = left(get, params)
+        if l is None:
+            return None
+        r = right(get, params)
+        if r is None:
+            return None
+        if convert is not None:
+            l = convert(l)
+            r = convert(r)
+        l_class = _storage_class(l)
+        r_class = _storage_class(r)
+        if l_class != r_class:
+            return compare(l_class, r_class)
+        return compare(l, r)
+    return evaluate
+
+def _make_is_null(arg, negate):
+    def evaluate(get, params):
+        return (arg(get, params) is None) != negate
+    return evaluate
+
+def _make_in(arg, items, negate):
+    # The values in the list don't have an affinity, even if they're
+    # columns, so only the affinity of arg matters.
+    convert = _affinity_converters.get(getattr(arg, 'affinity', None))
+    def evaluate(get, params):
+        value = arg(get, params)
+        if value is None:
+            return None
+        value_class = _storage_class(value)
+        saw_null = False
+        for item in items:
+            item_value = item(get, params)
+            if item_value is None:
+                saw_null = True
+                continue
+            if convert is not None:
+                item_value = convert(item_value)
+            if (_storage_class(item_value) == value_class and
+                    item_value == value):
+                return not negate
+        if saw_null:
+            return None
+        return negate
+    return evaluate
+
+def _like_regex(pattern):
+    if not isinstance(pattern, basestring):
+        pattern = _to_text(pattern)
+    parts = []
+    for char in _ascii_lower(pattern):
+        if char == '%':
+            parts.append('.*')
+        elif char == '_':
+            parts.append('.')
+        else:
+            parts.append(re.escape(char))
+    return re.compile(''.join(parts) + r'\Z', re.DOTALL)
+
+def _make_like(arg, pattern, negate):
+    if hasattr(pattern, 'constant') and pattern.constant is not None:
+        regex = _like_regex(pattern.constant)
+        get_regex = lambda get, params: regex
+    else:
+        def get_regex(get, params):
+            value = pattern(get, params)
+            if value is None:
+                return None
+            return _like_regex(value)
+    def evaluate(get, params):
+        value = arg(get, params)
+        if value is None:
+            return None
+        regex = get_regex(get, params)
+        if regex is None:
+            return None
+        if not isinstance(value, basestring):
+            value = _to_text(value)
+        return (regex.match(_ascii_lower(value)) is not None) != negate
+    return evaluate
+
+class CompiledWhere(object):
+    """WHERE clause compiled into a python function.
+
+    Attributes:
+    - columns_used -- set of column names the clause references
+    - placeholder_count -- number of ``?`` values the clause needs
+    """
+    def __init__(self, where, table_name, column_types):
+        parser = _Parser(where, table_name, column_types)
+        self._evaluate = parser.parse()
+        self.columns_used = parser.columns_used
+        self.placeholder_count = parser.placeholder_count
+
+    def bind(self, values):
+        """Get a ViewPredicate for a set of placeholder values."""
+        if len(values) != self.placeholder_count:
+            raise CantCompile("wrong number of values")
+        return ViewPredicate(self, tuple(sql_value(v) for v in values))
+
+class ViewPredicate(object):
+    """A CompiledWhere with its placeholder values filled in."""
+    def __init__(self, compiled_where, params):
+        self.compiled_where = compiled_where
+        self.params = params
+
+    def matches(self, get_column):
+        """Check if a row matches.
+
+        :param get_column: function that inputs a column name and returns
+            the value of that column, as returned by sql_value()
+        """
+        rv = self.compiled_where._evaluate(get_column, self.params)
+        return sql_truth(rv) is True
+
+# maps (table_name, where) -> CompiledWhere or None if it can't be compiled
+_compile_cache = {}
+
+def compile_where(where, values, table_name, column_types):
+    """Compile a view's WHERE clause.
+
+    :param where: WHERE clause, or None to match all rows
+    :param values: values for the ? placeholders in where
+    :param table_name: table the view selects from
+    :param column_types: dict mapping the columns in that table to their
+        declared SQLite types
+    :returns: ViewPredicate
+    :raises CantCompile: where uses SQL that we can't evaluate in python
+    """
+    if where is None:
+        where = '1'
+    key = (table_name, where)
+    try:
+        compiled_where = _compile_cache[key]
+    except KeyError:
+        try:
+            compiled_where = CompiledWhere(where, table_name, column_types)
+        except CantCompile:
+            compiled_where = None
+        _compile_cache[key] = compiled_where
+    if compiled_where is None:
+        raise CantCompile(where)
+    return compiled_where.bind(values)
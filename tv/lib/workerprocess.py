@@ -30,8 +30,11 @@
 """```workerprocess.py``` -- Miro worker subprocess
 
 To avoid UI freezing due to the GIL, we farm out all CPU-intensive backend
-tasks to this process.  See #17328 for more details.  Right now this just
-includes feedparser, but we could pretty easily extend this to other tasks.
+tasks to this process.  See #17328 for more details.  Right now this
+includes feedparser, mutagen and the movie data program.
+
+We run several worker processes (one per CPU by default) so that those
+tasks can use more than one core.  See WorkerProcessPool.
 """
 
 from collections import deque, namedtuple
@@ -39,12 +42,14 @@ import itertools
 import logging
 import threading
 
+from miro import app
 from miro import clock
 from miro import eventloop
 from miro import feedparserutil
 from miro import filetags
 from miro import messagetools
 from miro import moviedata
+from miro import prefs
 from miro import subprocessmanager
 from miro import util
 
@@ -71,10 +76,18 @@ class TaskMessage(WorkerMessage):
         self.task_id = TaskMessage._id_counter.next()
 
 class FeedparserTask(TaskMessage):
+    """Parse a feed.
+
+    If known_ids is given, feedparserutil.parse_streaming() is used to
+    avoid parsing and sending back entries we don't need.  max_old_items is
+    the number of old items the feed keeps.
+    """
     priority = 20
-    def __init__(self, html):
+    def __init__(self, html, known_ids=None, max_old_items=0):
         TaskMessage.__init__(self)
         self.html = html
+        self.known_ids = known_ids
+        self.max_old_items = max_old_items
 
 class MovieDataProgramTask(TaskMessage):
     priority = 10
@@ -186,8 +199,9 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
         self.task_queue.cancel_file_operations(path_set)
         # we need to handle pending_moviedata_tasks, since those skip the task
         # queue
-        filtered_tasks = deque(t for t in self.pending_moviedata_tasks
-                               if t.source_path not in path_set)
+        filtered_tasks = deque((method, msg) for (method, msg)
+                               in self.pending_moviedata_tasks
+                               if msg.source_path not in path_set)
         self.pending_moviedata_tasks = filtered_tasks
         return None
 
@@ -203,7 +217,12 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
     # worker threads, so they should only call thread-safe functions
 
     def handle_feedparser_task(self, msg):
-        parsed_feed = feedparserutil.parse(msg.html)
+        if msg.known_ids:
+            parsed_feed = feedparserutil.parse_streaming(msg.html,
+                                                         msg.known_ids,
+                                                         msg.max_old_items)
+        else:
+            parsed_feed = feedparserutil.parse(msg.html)
         # bozo_exception is sometimes C object that is not picklable.  We
         # don't use it anyways, so just unset the value
         parsed_feed['bozo_exception'] = None
@@ -364,15 +383,17 @@ MovieDataTaskStatusInfo = namedtuple('MovieDataTaskStatusInfo',
                                      'task_id start_time')
 
 class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
-    def __init__(self):
+    def __init__(self, pool, manager):
         subprocessmanager.SubprocessResponder.__init__(self)
+        self.pool = pool
+        self.manager = manager
         self.worker_ready = False
         self.startup_message = None
         self.movie_data_task_status = None
 
     def on_startup(self):
-        self.startup_message.send_to_process()
-        _miro_task_queue.run_pending_tasks()
+        self.manager.send_message(self.startup_message)
+        self.pool.resend_tasks(self.manager)
 
     def on_shutdown(self):
         # do the tasks that we've already gotten
@@ -384,7 +405,8 @@ class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
 
 
     def handle_task_result(self, msg):
-        _miro_task_queue.process_result(msg)
+        if self.pool.task_finished(self.manager, msg.task_id):
+            _miro_task_queue.process_result(msg)
 
     def handle_worker_process_ready(self, msg):
         self.worker_ready = True
@@ -413,7 +435,7 @@ class MiroTaskQueue(object):
     def add_task(self, msg, callback, errback):
         """Add a new task to the queue."""
         self.tasks_in_progress[msg.task_id] = (msg, callback, errback)
-        if _subprocess_manager.is_running:
+        if _worker_pool.is_running:
             msg.send_to_process()
 
     def process_result(self, reply):
@@ -424,19 +446,33 @@ class MiroTaskQueue(object):
         else:
             callback(msg, reply.result)
 
-    def run_pending_tasks(self):
-        """Rerun all tasks in the queue."""
-        for msg, callback, errback in self.tasks_in_progress.values():
-            msg.send_to_process()
+    def get_task_message(self, task_id):
+        """Get the message for a task that's in progress."""
+        return self.tasks_in_progress[task_id][0]
+
+    def task_messages(self):
+        """Get the messages for all tasks in progress."""
+        return [msg for (msg, callback, errback) in
+                self.tasks_in_progress.values()]
 
 _miro_task_queue = MiroTaskQueue()
 
 # Manage subprocess
 class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
-    def __init__(self):
-        subprocessmanager.SubprocessManager.__init__(self, WorkerMessage,
-                WorkerProcessResponder(), WorkerProcessHandler)
+    """Manages a single worker process for WorkerProcessPool.
+
+    :ivar task_ids: ids of the tasks that we've sent to this process, but
+        haven't gotten a result for yet.
+    """
+    def __init__(self, pool, handler_class=WorkerProcessHandler,
+            restart_delay=60):
+        # Pass None for the message class, since WorkerProcessPool handles
+        # sending WorkerMessages to our process.
+        subprocessmanager.SubprocessManager.__init__(self, None,
+                WorkerProcessResponder(pool, self), handler_class,
+                restart_delay=restart_delay)
         self.check_hung_timeout = None
+        self.task_ids = set()
 
     def _start(self):
         subprocessmanager.SubprocessManager._start(self)
@@ -475,18 +511,125 @@ class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
         else:
             self.schedule_check_subprocess_hung()
 
-_subprocess_manager = WorkerSubprocessManager()
+class WorkerProcessPool(object):
+    """Runs tasks using a group of worker processes.
+
+    feedparser and mutagen are CPU-bound, so a single worker process can only
+    use one core no matter how many threads it runs.  WorkerProcessPool
+    starts several WorkerSubprocessManagers and sends each task to the one
+    with the fewest unfinished tasks.  Each process still orders its tasks
+    with WorkerTaskQueue.
+
+    CancelFileOperations messages are sent to every process.  We only
+    process the result once all of them have replied.
+
+    If a process crashes or hangs, it gets restarted and the tasks that were
+    sent to it are sent again.
+
+    WorkerProcessPool installs itself as the handler for WorkerMessage, so
+    msg.send_to_process() goes through handle().
+    """
+    def __init__(self):
+        WorkerMessage.install_handler(self)
+        self.handler_class = WorkerProcessHandler
+        self.restart_delay = 60
+        self.managers = []
+        self.is_running = False
+        # maps task ids for messages that we sent to all processes to the
+        # number of processes that we still need a result from
+        self.broadcast_counts = {}
+
+    def start(self, process_count, startup_message):
+        if self.is_running:
+            return
+        self.managers = [WorkerSubprocessManager(self, self.handler_class,
+                                                 self.restart_delay)
+                         for i in xrange(process_count)]
+        for manager in self.managers:
+            manager.responder.startup_message = startup_message
+            manager.start()
+        self.is_running = True
+        # send tasks that were queued up before we started
+        for msg in _miro_task_queue.task_messages():
+            self.handle(msg)
+
+    def shutdown(self):
+        for manager in self.managers:
+            manager.shutdown()
+        self.is_running = False
+
+    def restart(self, clean=False):
+        for manager in self.managers:
+            manager.restart(clean)
+
+    def resend_tasks(self, manager):
+        """Send all unfinished tasks for a process again.
 
-def startup(thread_count=3):
-    """Startup the worker process."""
+        This is called when a worker process (re)starts.
+        """
+        for task_id in manager.task_ids:
+            manager.send_message(_miro_task_queue.get_task_message(task_id))
+
+    def task_finished(self, manager, task_id):
+        """Called when a worker process sends back a TaskResult.
 
+        :returns: True if we're done with the task and the result should be
+            processed.
+        """
+        manager.task_ids.discard(task_id)
+        try:
+            count = self.broadcast_counts[task_id]
+        except KeyError:
+            return True
+        if count > 1:
+            self.broadcast_counts[task_id] = count - 1
+            return False
+        else:
+            del self.broadcast_counts[task_id]
+            return True
+
+    def least_loaded_manager(self):
+        return min(self.managers, key=lambda m: len(m.task_ids))
+
+    # implement the MessageHandler interface
+
+    def handle(self, msg):
+        if not self.is_running:
+            raise ValueError("worker processes not running")
+        if isinstance(msg, CancelFileOperations):
+            managers = self.managers
+            self.broadcast_counts[msg.task_id] = len(managers)
+        elif isinstance(msg, TaskMessage):
+            managers = [self.least_loaded_manager()]
+        else:
+            managers = self.managers
+        for manager in managers:
+            if isinstance(msg, TaskMessage):
+                manager.task_ids.add(msg.task_id)
+            # If the process isn't running, it's waiting to be restarted.
+            # resend_tasks() will send the task once it's back up.
+            if manager.is_running:
+                manager.send_message(msg)
+
+_worker_pool = WorkerProcessPool()
+
+def startup(thread_count=3, process_count=None):
+    """Startup the worker processes.
+
+    :param thread_count: number of threads to run in each process
+    :param process_count: number of processes to run.  If None, we use
+        prefs.WORKER_PROCESS_COUNT, or the number of CPUs if that's 0.
+    """
+    if process_count is None:
+        process_count = app.config.get(prefs.WORKER_PROCESS_COUNT)
+    if process_count <= 0:
+        process_count = utils.get_logical_cpu_count()
     startup_msg = WorkerStartupInfo(thread_count)
-    _subprocess_manager.responder.startup_message = startup_msg
-    _subprocess_manager.start()
+    _worker_pool.start(process_count, startup_msg)
 
 def shutdown():
-    """Shutdown the worker process."""
-    _subprocess_manager.shutdown()
+    """Shutdown the worker processes."""
+    _worker_pool.shutdown()
 
 # API for sending tasks
 def send(msg, callback, errback):